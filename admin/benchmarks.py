@@ -0,0 +1,243 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+"""
+Benchmarks for performance sensitive parts of Flocker.
+"""
+
+import sys
+from timeit import default_timer
+from uuid import UUID
+
+from twisted.internet.defer import succeed
+from twisted.internet.task import react
+from twisted.python.filepath import FilePath
+from twisted.python.usage import Options, UsageError
+
+from flocker.control import (
+    Application, AttachedVolume, Dataset, Deployment, DockerImage,
+    Manifestation, Node, Port,
+)
+from flocker.control._persistence import CODECS, wire_decode
+from flocker.node._docker import BASE_NAMESPACE, DockerClient, FakeDockerEvents
+from flocker.node.testtools import FakeDockerAPI
+
+
+def _time(function, repeat):
+    """
+    Call a function a number of times and return the fastest run.
+
+    :param function: Callable taking no arguments.
+    :param int repeat: Number of times to call it.
+
+    :return: Tuple of the result of the last call and the fastest time in
+        seconds.
+    """
+    best = None
+    for i in range(repeat):
+        start = default_timer()
+        result = function()
+        elapsed = default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return result, best
+
+
+def _time_deferred(function, repeat):
+    """
+    Call a function returning a ``Deferred`` a number of times, one call
+    after another, and find the fastest run.
+
+    :param function: Callable taking no arguments and returning a
+        ``Deferred``.
+    :param int repeat: Number of times to call it.
+
+    :return: ``Deferred`` firing with a tuple of the result of the last
+        call and the fastest time in seconds.
+    """
+    timings = []
+
+    def run(_):
+        start = default_timer()
+        d = function()
+
+        def finished(result):
+            timings.append(default_timer() - start)
+            return result
+        return d.addCallback(finished)
+
+    d = succeed(None)
+    for i in range(repeat):
+        d.addCallback(run)
+    return d.addCallback(lambda result: (result, min(timings)))
+
+
+def make_deployment(node_count, applications_per_node=5):
+    """
+    Create a ``Deployment`` resembling a real cluster, with applications
+    that have ports, volumes and environment variables.
+
+    :param int node_count: The number of nodes.
+    :param int applications_per_node: The number of applications on each
+        node, each with its own dataset.
+
+    :return Deployment: The configuration.
+    """
+    nodes = []
+    for i in range(node_count):
+        applications = []
+        manifestations = {}
+        for j in range(applications_per_node):
+            dataset = Dataset(
+                dataset_id=unicode(UUID(int=i * applications_per_node + j)),
+                metadata={u"name": u"app-%d" % (j,)})
+            manifestation = Manifestation(dataset=dataset, primary=True)
+            manifestations[dataset.dataset_id] = manifestation
+            applications.append(Application(
+                name=u"app-%d-%d" % (i, j),
+                image=DockerImage.from_string(u"clusterhq/app:1.0"),
+                ports=[Port(internal_port=80, external_port=8000 + j)],
+                volume=AttachedVolume(manifestation=manifestation,
+                                      mountpoint=FilePath(b"/data")),
+                environment={u"MODE": u"production"}))
+        nodes.append(Node(hostname=u"10.0.%d.%d" % (i // 256, i % 256),
+                          applications=applications,
+                          manifestations=manifestations))
+    return Deployment(nodes=nodes)
+
+
+class WireFormatOptions(Options):
+    """
+    Options for the wire format benchmark.
+    """
+    synopsis = "Usage: benchmark-wire-format [options] [node-count ...]"
+
+    optParameters = [
+        ["repeat", "r", 3, "Number of times to repeat each measurement.",
+         int],
+    ]
+
+    def parseArgs(self, *node_counts):
+        try:
+            self["node-counts"] = [int(count) for count in node_counts] or [
+                10, 100, 1000]
+        except ValueError:
+            raise UsageError("Node counts must be integers.")
+
+
+def wire_format_main(args, stdout=sys.stdout):
+    """
+    Compare the encoded size and encoding and decoding time of the
+    configuration codecs for deployments of various sizes.
+
+    :param list args: The command line arguments.
+    :param stdout: File to write results to.
+    """
+    options = WireFormatOptions()
+    try:
+        options.parseOptions(args)
+    except UsageError as e:
+        sys.stderr.write("%s\n%s\n" % (e, options))
+        raise SystemExit(1)
+
+    stdout.write("%6s %-8s %10s %10s %10s %10s\n" % (
+        "nodes", "codec", "bytes", "encode ms", "decode ms", "trusted ms"))
+    for node_count in options["node-counts"]:
+        deployment = make_deployment(node_count)
+        for name, codec in sorted(CODECS.items()):
+            data, encode_time = _time(
+                lambda: codec.encode(deployment), options["repeat"])
+            decoded, decode_time = _time(
+                lambda: wire_decode(data), options["repeat"])
+            trusted, trusted_time = _time(
+                lambda: wire_decode(data, trusted=True), options["repeat"])
+            if not (decoded == trusted == deployment):
+                raise AssertionError("%s did not round-trip" % (name,))
+            stdout.write("%6d %-8s %10d %10.1f %10.1f %10.1f\n" % (
+                node_count, name, len(data), encode_time * 1000,
+                decode_time * 1000, trusted_time * 1000))
+
+
+class DockerListOptions(Options):
+    """
+    Options for the Docker listing benchmark.
+    """
+    synopsis = "Usage: benchmark-docker-list [options] [container-count ...]"
+
+    optParameters = [
+        ["repeat", "r", 3, "Number of times to repeat each measurement.",
+         int],
+        ["latency", "l", 0.001,
+         "Seconds each call to the fake Docker API takes.", float],
+        ["images", "i", 10, "Number of distinct images.", int],
+    ]
+
+    def parseArgs(self, *container_counts):
+        try:
+            self["container-counts"] = [
+                int(count) for count in container_counts] or [10, 100, 500]
+        except ValueError:
+            raise UsageError("Container counts must be integers.")
+
+
+def _benchmark_docker_list(reactor, options, stdout):
+    """
+    Measure ``DockerClient.list`` for each number of containers in turn.
+
+    :return: ``Deferred`` that fires when all measurements are done.
+    """
+    def measure(_, container_count):
+        api = FakeDockerAPI(latency=options["latency"])
+        for i in range(container_count):
+            container_id = u"%064x" % (i,)
+            api.containers_by_id[container_id] = BASE_NAMESPACE + u"app-%d" % (
+                i,)
+            api.images_by_id[container_id] = u"image-%d" % (
+                i % options["images"],)
+
+        def client(**kwargs):
+            result = DockerClient(**kwargs)
+            result._client = api
+            return result
+
+        def new_list(**kwargs):
+            # A new client each time, so nothing is cached between runs:
+            return lambda: client(**kwargs).list()
+
+        cached = client(events=FakeDockerEvents())
+        timings = []
+        d = _time_deferred(new_list(inspect_concurrency=1), options["repeat"])
+        d.addCallback(lambda result: timings.append(result[1]))
+        d.addCallback(lambda _: _time_deferred(new_list(), options["repeat"]))
+        d.addCallback(lambda result: timings.append(result[1]))
+        # Seed the cache, then measure listing with nothing changed:
+        d.addCallback(lambda _: cached.list())
+        d.addCallback(lambda _: _time_deferred(cached.list, options["repeat"]))
+        d.addCallback(lambda result: timings.append(result[1]))
+        d.addCallback(lambda _: stdout.write(
+            "%10d %10.1f %10.1f %10.1f\n" % (
+                (container_count,) + tuple(t * 1000 for t in timings))))
+        return d
+
+    stdout.write("%10s %10s %10s %10s\n" % (
+        "containers", "serial ms", "parallel ms", "cached ms"))
+    d = succeed(None)
+    for container_count in options["container-counts"]:
+        d.addCallback(measure, container_count)
+    return d
+
+
+def docker_list_main(args, stdout=sys.stdout):
+    """
+    Compare the time taken to list units with ``DockerClient`` when
+    inspecting containers one at a time, several at a time, and when units
+    are cached, against a fake Docker API with simulated latency.
+
+    :param list args: The command line arguments.
+    :param stdout: File to write results to.
+    """
+    options = DockerListOptions()
+    try:
+        options.parseOptions(args)
+    except UsageError as e:
+        sys.stderr.write("%s\n%s\n" % (e, options))
+        raise SystemExit(1)
+    react(_benchmark_docker_list, [options, stdout])
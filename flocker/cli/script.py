@@ -5,6 +5,7 @@ The command-line ``flocker-deploy`` tool.
 """
 
 from subprocess import CalledProcessError
+from tempfile import mkdtemp
 
 from twisted.internet.defer import DeferredList, succeed
 from twisted.internet.threads import deferToThread
@@ -24,7 +25,7 @@ from ..control import (FlockerConfiguration, ConfigurationError,
                        FigConfiguration, applications_to_flocker_yaml,
                        model_from_configuration)
 
-from ..common import ProcessNode, gather_deferreds
+from ..common import ProcessNode, SSHConnectionCache, gather_deferreds
 from ._sshconfig import DEFAULT_SSH_DIRECTORY, OpenSSHConfiguration
 
 
@@ -57,6 +58,11 @@ class DeployOptions(Options):
                 "DEPLOYMENT_CONFIGURATION_PATH APPLICATION_CONFIGURATION_PATH"
                 "{feedback}").format(feedback=FEEDBACK_CLI_TEXT)
 
+    optFlags = [
+        ["reuse-ssh-connections", None,
+         "Run all the commands on a node over a single SSH connection."],
+    ]
+
     def parseArgs(self, deployment_config, application_config):
         deployment_config = FilePath(deployment_config)
         application_config = FilePath(application_config)
@@ -119,12 +125,17 @@ class DeployOptions(Options):
 class DeployScript(object):
     """
     A script to start configured deployments on a Flocker cluster.
+
+    :ivar connection_cache: The ``SSHConnectionCache`` shared by the
+        commands run on the nodes, or ``None`` to connect afresh for each
+        command.
     """
     def __init__(self, ssh_configuration=None, ssh_port=22):
         if ssh_configuration is None:
             ssh_configuration = OpenSSHConfiguration.defaults()
         self.ssh_configuration = ssh_configuration
         self.ssh_port = ssh_port
+        self.connection_cache = None
 
     def _configure_ssh(self, deployment):
         """
@@ -162,6 +173,8 @@ class DeployScript(object):
                  has encountered an error.
         """
         deployment = options['deployment']
+        if options["reuse-ssh-connections"]:
+            self.connection_cache = SSHConnectionCache(FilePath(mkdtemp()))
         configuring = self._configure_ssh(deployment)
         configuring.addCallback(
             lambda _: self._reportstate_on_nodes(deployment))
@@ -174,8 +187,26 @@ class DeployScript(object):
                 current_config)
         configuring.addCallback(configured)
         configuring.addCallback(lambda _: None)
+        configuring.addBoth(self._close_connections)
         return configuring
 
+    def _close_connections(self, result):
+        """
+        Close the SSH connections shared through ``connection_cache``, if
+        any.
+
+        :param result: The result to pass on once the connections are
+            closed.
+
+        :return: ``Deferred`` that fires with ``result``.
+        """
+        cache, self.connection_cache = self.connection_cache, None
+        if cache is None:
+            return result
+        d = deferToThread(cache.close)
+        d.addCallback(lambda _: result)
+        return d
+
     def _get_destinations(self, deployment):
         """
         Return iterable of ``NodeTargets`` to connect to for given deployment.
@@ -192,7 +223,8 @@ class DeployScript(object):
         for node in deployment.nodes:
             yield NodeTarget(
                 node=ProcessNode.using_ssh(
-                    node.hostname, 22, b"root", private_key),
+                    node.hostname, 22, b"root", private_key,
+                    connection_cache=self.connection_cache),
                 hostname=node.hostname
             )
 
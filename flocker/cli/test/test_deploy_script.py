@@ -18,7 +18,7 @@ from ...testtools import (
 from ..script import DeployScript, DeployOptions, NodeTarget
 from .._sshconfig import DEFAULT_SSH_DIRECTORY
 from ...control import Application, Deployment, DockerImage, Node
-from ...common import ProcessNode, FakeNode
+from ...common import ProcessNode, FakeNode, SSHConnectionCache
 
 
 class NodeTargetInitTests(
@@ -336,13 +336,35 @@ class FlockerDeployMainTests(TestCase):
             {node(node1.hostname), node(node2.hostname)},
             set(destinations))
 
-    def run_script(self, alternate_destinations):
+    def test_get_destinations_connection_cache(self):
+        """
+        ``DeployScript._get_destinations`` creates SSH ``INode`` destinations
+        which share connections through ``DeployScript.connection_cache``.
+        """
+        node = Node(hostname=u"node101.example.com")
+        id_rsa_flocker = DEFAULT_SSH_DIRECTORY.child(b"id_rsa_flocker")
+
+        script = DeployScript()
+        script.connection_cache = SSHConnectionCache(
+            FilePath(self.mktemp()))
+        destinations = script._get_destinations(Deployment(nodes={node}))
+
+        self.assertEqual(
+            [NodeTarget(
+                node=ProcessNode.using_ssh(
+                    node.hostname, 22, b"root", id_rsa_flocker,
+                    connection_cache=script.connection_cache),
+                hostname=node.hostname)],
+            list(destinations))
+
+    def run_script(self, alternate_destinations, arguments=()):
         """
         Run ``DeployScript.main`` with overridden destinations for
         ``flocker-changestate`` and ``flocker-reportstate``.
 
         :param list alternate_destinations: ``INode`` providers to connect
              to instead of the default SSH-based ``ProcessNode``.
+        :param arguments: Extra command-line options for ``flocker-deploy``.
 
         :return: ``Deferred`` that fires with result of ``DeployScript.main``.
         """
@@ -378,11 +400,12 @@ class FlockerDeployMainTests(TestCase):
         deployment_config_path.setContent(self.deployment_config)
 
         options = DeployOptions()
-        options.parseOptions([
+        options.parseOptions(list(arguments) + [
             deployment_config_path.path, application_config_path.path])
 
         # Change destination of commands:
         script = DeployScript()
+        self.script = script
         script._get_destinations = lambda nodes: alternate_destinations
 
         # Disable SSH configuration:
@@ -443,6 +466,49 @@ class FlockerDeployMainTests(TestCase):
         running.addCallback(ran)
         return running
 
+    def test_reuse_ssh_connections(self):
+        """
+        When ``--reuse-ssh-connections`` is given, ``DeployScript.main`` runs
+        its commands with a ``connection_cache`` which it closes once the
+        deployment is complete.
+        """
+        caches = []
+
+        def changestate(script, *args):
+            caches.append(script.connection_cache)
+        self.patch(DeployScript, "_changestate_on_nodes", changestate)
+
+        destinations = [NodeTarget(node=FakeNode([b"{}"]),
+                                   hostname=b'node101.example.com')]
+        running = self.run_script(
+            destinations, [b"--reuse-ssh-connections"])
+
+        def ran(ignored):
+            [cache] = caches
+            self.assertEqual(
+                (True, None, False),
+                (isinstance(cache, SSHConnectionCache),
+                 self.script.connection_cache, cache.directory.exists()))
+        running.addCallback(ran)
+        return running
+
+    def test_no_connection_cache(self):
+        """
+        By default ``DeployScript.main`` runs its commands without a
+        ``connection_cache``.
+        """
+        caches = []
+
+        def changestate(script, *args):
+            caches.append(script.connection_cache)
+        self.patch(DeployScript, "_changestate_on_nodes", changestate)
+
+        destinations = [NodeTarget(node=FakeNode([b"{}"]),
+                                   hostname=b'node101.example.com')]
+        running = self.run_script(destinations)
+        running.addCallback(lambda _: self.assertEqual([None], caches))
+        return running
+
     def test_reportstate_failure_means_no_changestate(self):
         """
         If ``flocker-reportstate`` fails to respond for some reason,
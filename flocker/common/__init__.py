@@ -4,7 +4,13 @@
 Shared flocker components.
 """
 
-__all__ = ['INode', 'FakeNode', 'ProcessNode', 'gather_deferreds']
+__all__ = [
+    'INode', 'FakeNode', 'ProcessNode', 'SSHConnectionCache',
+    'process_output', 'pipe_processes', 'gather_deferreds',
+]
 
-from ._ipc import INode, FakeNode, ProcessNode
+from ._ipc import (
+    INode, FakeNode, ProcessNode, SSHConnectionCache, process_output,
+    pipe_processes,
+)
 from ._defer import gather_deferreds
@@ -4,16 +4,25 @@
 Inter-process communication for flocker.
 """
 
-from subprocess import Popen, PIPE, check_output, CalledProcessError
+import os
+from subprocess import Popen, PIPE, check_output, CalledProcessError, call
 from contextlib import contextmanager
 from io import BytesIO
 from threading import current_thread
 from pipes import quote
+from time import time
 
 from zope.interface import Interface, implementer
 
 from characteristic import with_cmp, with_repr
 
+from eliot import ActionType, Field, Logger
+
+from twisted.internet.defer import Deferred, DeferredList
+from twisted.internet.error import ProcessDone, ProcessExitedAlready
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.protocol import ProcessProtocol
+
 
 class INode(Interface):
     """
@@ -43,13 +52,100 @@ class INode(Interface):
         """
 
 
+_REMOTE_COMMAND = Field.forTypes(
+    u"remote_command", [list],
+    u"The command being run on another node, with its arguments.")
+
+_ELAPSED = Field.forTypes(
+    u"elapsed", [float],
+    u"The number of seconds the command took to run.")
+
+REMOTE_COMMAND = ActionType(
+    u"flocker:common:ipc:remote_command",
+    [_REMOTE_COMMAND], [_ELAPSED],
+    u"A command run on another node by a ``ProcessNode``.")
+
+
+@contextmanager
+def _timed_remote_command(logger, remote_command):
+    """
+    Log a ``REMOTE_COMMAND`` action around the body of the ``with``
+    statement, recording how long it took if it succeeds.
+
+    :param eliot.Logger logger: The log writer to use.
+    :param remote_command: ``list`` of ``bytes``, the command being run
+        remotely along with its arguments.
+    """
+    with REMOTE_COMMAND(logger=logger,
+                        remote_command=list(remote_command)) as action:
+        started = time()
+        yield
+        action.addSuccessFields(elapsed=time() - started)
+
+
+@with_cmp(["directory", "persist"])
+@with_repr(["directory", "persist"])
+class SSHConnectionCache(object):
+    """
+    Reuse one SSH connection for all the commands run on a node, using
+    OpenSSH's ``ControlMaster`` support.
+
+    The first command run on a node starts a master connection, which stays
+    open in the background for ``persist`` seconds after it was last used.
+    Later commands are multiplexed over it, saving a handshake each.
+
+    :ivar FilePath directory: The directory in which the master connections'
+        control sockets are created.  Control socket paths are limited to
+        about a hundred bytes, so it should have a short path.
+    :ivar int persist: Seconds to keep an idle master connection open.
+    """
+    def __init__(self, directory, persist=60):
+        self.directory = directory
+        self.persist = persist
+
+    def ssh_options(self):
+        """
+        :return: ``list`` of ``bytes``, the ``ssh`` command-line arguments
+            which share connections using this cache.
+        """
+        return [
+            b"-o", b"ControlMaster=auto",
+            b"-o", b"ControlPath=" + self.directory.child(b"%r@%h:%p").path,
+            b"-o", b"ControlPersist=%d" % (self.persist,),
+        ]
+
+    def close(self):
+        """
+        Stop all the master connections and remove ``directory``.
+
+        Masters which have already exited are ignored.
+        """
+        if not self.directory.exists():
+            return
+        with open(os.devnull, "wb") as devnull:
+            for socket in self.directory.children():
+                # The control socket identifies the connection; the host
+                # argument is required but otherwise unused.
+                call([b"ssh", b"-q", b"-O", b"exit",
+                      b"-o", b"ControlPath=" + socket.path, b"flocker"],
+                     stdout=devnull, stderr=devnull)
+        self.directory.remove()
+
+
 @with_cmp(["initial_command_arguments"])
 @with_repr(["initial_command_arguments"])
 @implementer(INode)
 class ProcessNode(object):
     """
     Communicate with a remote node using a subprocess.
+
+    Each command run is logged as a ``REMOTE_COMMAND`` action which records
+    how long it took.
+
+    :ivar eliot.Logger logger: The log writer to use.
     """
+    logger = Logger()
+
     def __init__(self, initial_command_arguments, quote=lambda d: d):
         """
         :param initial_command_arguments: ``tuple`` of ``bytes``, initial
@@ -63,34 +159,45 @@ class ProcessNode(object):
         self.initial_command_arguments = tuple(initial_command_arguments)
         self._quote = quote
 
+    def command(self, remote_command):
+        """
+        Construct the local command which runs a remote command.
+
+        :param remote_command: ``list`` of ``bytes``, the command to run
+            remotely along with its arguments.
+
+        :return: ``list`` of ``bytes``, the local command and its arguments.
+        """
+        return list(self.initial_command_arguments +
+                    tuple(map(self._quote, remote_command)))
+
     @contextmanager
     def run(self, remote_command):
-        process = Popen(
-            self.initial_command_arguments +
-            tuple(map(self._quote, remote_command)),
-            stdin=PIPE)
-        try:
-            yield process.stdin
-        finally:
-            process.stdin.close()
-            exit_code = process.wait()
-            if exit_code:
-                # We should really capture this and stderr better:
-                # https://clusterhq.atlassian.net/browse/FLOC-155
-                raise IOError("Bad exit", remote_command, exit_code)
+        with _timed_remote_command(self.logger, remote_command):
+            process = Popen(self.command(remote_command), stdin=PIPE)
+            try:
+                yield process.stdin
+            finally:
+                process.stdin.close()
+                exit_code = process.wait()
+                if exit_code:
+                    # We should really capture this and stderr better:
+                    # https://clusterhq.atlassian.net/browse/FLOC-155
+                    raise IOError("Bad exit", remote_command, exit_code)
 
     def get_output(self, remote_command):
-        try:
-            return check_output(
-                self.initial_command_arguments +
-                tuple(map(self._quote, remote_command)))
-        except CalledProcessError as e:
-            # We should really capture this and stderr better:
-            # https://clusterhq.atlassian.net/browse/FLOC-155
-            raise IOError("Bad exit", remote_command, e.returncode, e.output)
+        with _timed_remote_command(self.logger, remote_command):
+            try:
+                return check_output(self.command(remote_command))
+            except CalledProcessError as e:
+                # We should really capture this and stderr better:
+                # https://clusterhq.atlassian.net/browse/FLOC-155
+                raise IOError(
+                    "Bad exit", remote_command, e.returncode, e.output)
 
     @classmethod
-    def using_ssh(cls, host, port, username, private_key):
+    def using_ssh(cls, host, port, username, private_key,
+                  connection_cache=None):
         """Create a ``ProcessNode`` that communicate over SSH.
 
         :param bytes host: The hostname or IP.
@@ -98,9 +205,18 @@ class ProcessNode(object):
         :param bytes username: The username to SSH as.
         :param FilePath private_key: Path to private key to use when talking to
             SSH server.
+        :param SSHConnectionCache connection_cache: The cache through which
+            commands share a connection, or ``None`` to make a new
+            connection for every command.
 
         :return: ``ProcessNode`` instance that communicates over SSH.
         """
+        if connection_cache is None:
+            # The tests hang if ControlMaster is set, since OpenSSH won't
+            # ever close the connection to the test server.
+            sharing = (b"-o", b"ControlMaster=no")
+        else:
+            sharing = tuple(connection_cache.ssh_options())
         return cls(initial_command_arguments=(
             b"ssh",
             b"-q",  # suppress warnings
@@ -110,9 +226,7 @@ class ProcessNode(object):
             # SSH by the time Flocker is production-ready and security is
             # a concern.
             b"-o", b"StrictHostKeyChecking=no",
-            # The tests hang if ControlMaster is set, since OpenSSH won't
-            # ever close the connection to the test server.
-            b"-o", b"ControlMaster=no",
+        ) + sharing + (
             # Some systems (notably Ubuntu) enable GSSAPI authentication which
             # involves a slow DNS operation before failing and moving on to a
             # working mechanism.  The expectation is that key-based auth will
@@ -171,3 +285,149 @@ class FakeNode(object):
             raise result
         else:
             return result
+
+
+class _ProcessOutput(ProcessProtocol):
+    """
+    Accumulate the stdout of a process and report how it exited.
+
+    :ivar ended: ``Deferred`` firing with the process's stdout when it exits
+        successfully, or errbacking with ``IOError`` otherwise.
+    """
+    def __init__(self, command):
+        """
+        :param command: ``list`` of ``bytes``, the command being run.
+        """
+        self._command = command
+        self._output = []
+        self.ended = Deferred()
+
+    def connectionMade(self):
+        self.transport.closeStdin()
+
+    def outReceived(self, data):
+        self._output.append(data)
+
+    def processEnded(self, reason):
+        output = b"".join(self._output)
+        if reason.check(ProcessDone):
+            self.ended.callback(output)
+        else:
+            self.ended.errback(IOError(
+                "Bad exit", self._command, reason.value.exitCode, output))
+
+
+@implementer(IPushProducer)
+class _PipeSource(_ProcessOutput):
+    """
+    Copy the stdout of a process to the stdin of another process.
+
+    This is also the producer for the other process's stdin, pausing and
+    resuming reading from our process as it asks.
+    """
+    def __init__(self, command, destination):
+        """
+        :param command: ``list`` of ``bytes``, the command being run.
+        :param IProcessTransport destination: The process to copy to.
+        """
+        _ProcessOutput.__init__(self, command)
+        self._destination = destination
+
+    def outReceived(self, data):
+        self._destination.write(data)
+
+    def outConnectionLost(self):
+        self._destination.unregisterProducer()
+        self._destination.closeStdin()
+
+    def pauseProducing(self):
+        self.transport.pauseProducing()
+
+    def resumeProducing(self):
+        self.transport.resumeProducing()
+
+    def stopProducing(self):
+        self.transport.loseConnection()
+
+
+class _PipeDestination(_ProcessOutput):
+    """
+    Report how a process reading from a ``_PipeSource`` exited.
+    """
+    def connectionMade(self):
+        # Leave stdin open; the source closes it when it is done.
+        pass
+
+
+def process_output(reactor, command):
+    """
+    Asynchronously run a local command and collect its stdout.
+
+    This is the non-blocking equivalent of ``ProcessNode.get_output``.
+
+    :param IReactorProcess reactor: The reactor to run the command with.
+    :param command: ``list`` of ``bytes``, the command to run along with its
+        arguments.
+
+    :return: ``Deferred`` firing with the ``bytes`` of stdout, or errbacking
+        with ``IOError`` if the command exits unsuccessfully.
+    """
+    protocol = _ProcessOutput(command)
+    reactor.spawnProcess(protocol, command[0], command, env=os.environ,
+                         childFDs={0: "w", 1: "r", 2: 2})
+    return protocol.ended
+
+
+def pipe_processes(reactor, source, destination):
+    """
+    Asynchronously run two local commands, copying the stdout of ``source``
+    to the stdin of ``destination``.
+
+    The ``source`` process is registered as a push producer for the
+    stdin of ``destination``, so reading from ``source`` is paused whenever
+    ``destination`` falls behind.  At most one buffer's worth of data is held
+    in memory no matter how large the stream is.
+
+    If ``destination`` exits unsuccessfully while ``source`` is still running,
+    ``source`` is terminated.
+
+    :param IReactorProcess reactor: The reactor to run the commands with.
+    :param source: ``list`` of ``bytes``, the command whose stdout is read.
+    :param destination: ``list`` of ``bytes``, the command whose stdin is
+        written.
+
+    :return: ``Deferred`` firing with ``None`` when both commands have exited
+        successfully, or errbacking with ``IOError`` if either exits
+        unsuccessfully.
+    """
+    receiving = _PipeDestination(destination)
+    receiver = reactor.spawnProcess(
+        receiving, destination[0], destination, env=os.environ,
+        childFDs={0: "w", 1: 1, 2: 2})
+    sending = _PipeSource(source, receiver)
+    sender = reactor.spawnProcess(
+        sending, source[0], source, env=os.environ,
+        childFDs={0: "w", 1: "r", 2: 2})
+    receiver.registerProducer(sending, True)
+
+    def stop_sender(reason):
+        if not sending.ended.called:
+            try:
+                sender.signalProcess("TERM")
+            except ProcessExitedAlready:
+                pass
+        return reason
+    receiving.ended.addErrback(stop_sender)
+
+    def finished(results):
+        failures = [result for (success, result) in results if not success]
+        # A source killed by a signal was most likely stopped because the
+        # destination went away, which is the more useful failure to report.
+        failures.sort(key=lambda failure: failure.value.args[2] is None)
+        if failures:
+            return failures[0]
+        return None
+    waiting = DeferredList([sending.ended, receiving.ended],
+                           consumeErrors=True)
+    waiting.addCallback(finished)
+    return waiting
@@ -4,11 +4,20 @@
 Functional tests for IPC.
 """
 
+import sys
+from tempfile import mkdtemp
+
+from eliot.testing import validateLogging, assertHasAction, LoggedAction
+
+from twisted.internet import reactor
 from twisted.internet.threads import deferToThread
 from twisted.python.filepath import FilePath
 from twisted.trial.unittest import TestCase
 
-from .. import ProcessNode
+from .. import (
+    ProcessNode, SSHConnectionCache, process_output, pipe_processes,
+)
+from .._ipc import REMOTE_COMMAND
 from ..test.test_ipc import make_inode_tests
 from ...testtools.ssh import create_ssh_server
 
@@ -93,12 +102,49 @@ class ProcessNodeTests(TestCase):
         nonexistent = self.mktemp()
         self.assertRaises(IOError, node.get_output, [b"ls", nonexistent])
 
+    @validateLogging(assertHasAction, REMOTE_COMMAND, True,
+                     {u"remote_command": [b"-c", b"true"]})
+    def test_run_logged(self, logger):
+        """
+        ``ProcessNode.run`` logs the remote command as a successful
+        ``REMOTE_COMMAND`` action.
+        """
+        node = ProcessNode(initial_command_arguments=[b"sh"])
+        node.logger = logger
+        with node.run([b"-c", b"true"]):
+            pass
 
-def make_sshnode(test_case):
+    @validateLogging(None)
+    def test_get_output_timed(self, logger):
+        """
+        ``ProcessNode.get_output`` records how long the remote command took in
+        the ``elapsed`` field of its ``REMOTE_COMMAND`` action.
+        """
+        node = ProcessNode(initial_command_arguments=[b"sh"])
+        node.logger = logger
+        node.get_output([b"-c", b"sleep 0.1"])
+        [action] = LoggedAction.ofType(logger.messages, REMOTE_COMMAND)
+        self.assertTrue(action.endMessage[u"elapsed"] >= 0.1)
+
+    @validateLogging(assertHasAction, REMOTE_COMMAND, False,
+                     {u"remote_command": [b"-c", b"false"]})
+    def test_get_output_bad_exit_logged(self, logger):
+        """
+        ``ProcessNode.get_output`` logs a failed ``REMOTE_COMMAND`` action if
+        the remote command fails.
+        """
+        node = ProcessNode(initial_command_arguments=[b"sh"])
+        node.logger = logger
+        self.assertRaises(IOError, node.get_output, [b"-c", b"false"])
+
+
+def make_sshnode(test_case, connection_cache=None):
     """
     Create a ``ProcessNode`` that can SSH into the local machine.
 
     :param TestCase test_case: The test case to use.
+    :param SSHConnectionCache connection_cache: The cache to share
+        connections through, if any.
 
     :return: A ``ProcessNode`` instance.
     """
@@ -107,7 +153,8 @@ def make_sshnode(test_case):
 
     return ProcessNode.using_ssh(
         host=unicode(server.ip).encode("ascii"), port=server.port,
-        username=b"root", private_key=server.key_path)
+        username=b"root", private_key=server.key_path,
+        connection_cache=connection_cache)
 
 
 class SSHProcessNodeTests(TestCase):
@@ -178,6 +225,92 @@ class SSHProcessNodeTests(TestCase):
         return d
 
 
+class SSHConnectionCacheTests(TestCase):
+    """
+    Tests for ``SSHConnectionCache`` used by a SSH ``ProcessNode``.
+    """
+    def test_shared_connection(self):
+        """
+        Commands run by a ``ProcessNode`` using a ``SSHConnectionCache`` share
+        a master connection, which ``SSHConnectionCache.close`` stops.
+        """
+        # Control socket paths must be short, so avoid the trial temporary
+        # directory:
+        directory = FilePath(mkdtemp())
+        self.addCleanup(lambda: directory.exists() and directory.remove())
+        cache = SSHConnectionCache(directory)
+        node = make_sshnode(self, connection_cache=cache)
+
+        def go():
+            outputs = [node.get_output([b"echo", b"-n", b"hello"]),
+                       node.get_output([b"echo", b"-n", b"there"])]
+            sockets = directory.children()
+            cache.close()
+            return outputs, len(sockets), directory.exists()
+        d = deferToThread(go)
+        d.addCallback(
+            self.assertEqual, ([b"hello", b"there"], 1, False))
+        return d
+
+
+class ProcessOutputTests(TestCase):
+    """
+    Tests for ``process_output``.
+    """
+    def test_output(self):
+        """
+        ``process_output`` runs a command and fires with its output.
+        """
+        d = process_output(reactor, [b"echo", b"-n", b"hello"])
+        d.addCallback(self.assertEqual, b"hello")
+        return d
+
+    def test_bad_exit(self):
+        """
+        ``process_output`` errbacks with ``IOError`` if the command has a
+        non-zero exit code.
+        """
+        d = process_output(reactor, [b"ls", self.mktemp()])
+        return self.assertFailure(d, IOError)
+
+
+class PipeProcessesTests(TestCase):
+    """
+    Tests for ``pipe_processes``.
+    """
+    def test_copies(self):
+        """
+        ``pipe_processes`` copies all of the source command's stdout to the
+        destination command's stdin, even if it is much larger than the
+        pipe's buffers.
+        """
+        data = b"".join(b"%08d" % (i,) for i in range(2 ** 18))
+        source = FilePath(self.mktemp())
+        source.setContent(data)
+        destination = FilePath(self.mktemp())
+        d = pipe_processes(
+            reactor, [b"cat", source.path],
+            [b"sh", b"-c", b"cat > " + destination.path])
+
+        def piped(result):
+            self.assertEqual(
+                (None, data), (result, destination.getContent()))
+        d.addCallback(piped)
+        return d
+
+    def test_destination_failed(self):
+        """
+        If the destination command exits unsuccessfully ``pipe_processes``
+        terminates the source command and errbacks with ``IOError``.
+        """
+        d = pipe_processes(
+            reactor, [b"yes"],
+            [sys.executable, b"-c", b"import sys; sys.exit(3)"])
+        d = self.assertFailure(d, IOError)
+        d.addCallback(lambda error: self.assertEqual(3, error.args[2]))
+        return d
+
+
 class MutatingProcessNode(ProcessNode):
     """Mutate the command being run in order to make tests work.
 
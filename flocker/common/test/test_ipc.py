@@ -10,8 +10,17 @@ from unittest import TestCase as PyTestCase
 
 from zope.interface.verify import verifyObject
 
-from .. import INode, FakeNode
-from ...testtools import assertNoFDsLeaked
+from twisted.internet.error import ProcessDone, ProcessTerminated
+from twisted.internet.interfaces import IPushProducer
+from twisted.python.failure import Failure
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import SynchronousTestCase
+
+from .. import (
+    INode, FakeNode, ProcessNode, SSHConnectionCache, process_output,
+    pipe_processes,
+)
+from ...testtools import assertNoFDsLeaked, FakeProcessReactor
 
 
 def make_inode_tests(fixture):
@@ -95,3 +104,219 @@ def make_inode_tests(fixture):
 
 class FakeINodeTests(make_inode_tests(lambda t: FakeNode([b"hello"]))):
     """``INode`` tests for ``FakeNode``."""
+
+
+class SSHConnectionCacheTests(SynchronousTestCase):
+    """
+    Tests for ``SSHConnectionCache``.
+    """
+    def test_ssh_options(self):
+        """
+        ``SSHConnectionCache.ssh_options`` configures ``ssh`` to share master
+        connections, kept open for ``persist`` seconds, through control
+        sockets in the cache's directory.
+        """
+        directory = FilePath(self.mktemp())
+        cache = SSHConnectionCache(directory, persist=30)
+        self.assertEqual(
+            [b"-o", b"ControlMaster=auto",
+             b"-o", b"ControlPath=" + directory.path + b"/%r@%h:%p",
+             b"-o", b"ControlPersist=30"],
+            cache.ssh_options())
+
+    def test_using_ssh(self):
+        """
+        ``ProcessNode.using_ssh`` given a ``connection_cache`` runs ``ssh``
+        with the cache's options instead of disabling connection sharing.
+        """
+        cache = SSHConnectionCache(FilePath(self.mktemp()))
+        key = FilePath(self.mktemp())
+        shared = ProcessNode.using_ssh(
+            b"example.com", 22, b"root", key, connection_cache=cache)
+        unshared = ProcessNode.using_ssh(b"example.com", 22, b"root", key)
+        expected = list(unshared.initial_command_arguments)
+        index = expected.index(b"ControlMaster=no")
+        expected[index - 1:index + 1] = cache.ssh_options()
+        self.assertEqual(expected, list(shared.initial_command_arguments))
+
+    def test_close_removes_directory(self):
+        """
+        ``SSHConnectionCache.close`` removes the cache's directory, ignoring
+        control sockets whose master connection has already exited.
+        """
+        directory = FilePath(self.mktemp())
+        directory.makedirs()
+        directory.child(b"root@example.com:22").setContent(b"")
+        SSHConnectionCache(directory).close()
+        self.assertFalse(directory.exists())
+
+    def test_close_no_directory(self):
+        """
+        ``SSHConnectionCache.close`` does nothing if no connection was ever
+        made.
+        """
+        directory = FilePath(self.mktemp())
+        SSHConnectionCache(directory).close()
+        self.assertFalse(directory.exists())
+
+
+def _exit(process, code, signal=None):
+    """
+    Pretend a process spawned by a ``FakeProcessReactor`` has exited.
+
+    :param SpawnProcessArguments process: The process.
+    :param int code: Its exit code, or ``None`` if it was killed by a signal.
+    :param int signal: The signal which killed it, if any.
+    """
+    if signal is not None:
+        reason = ProcessTerminated(signal=signal)
+    elif code:
+        reason = ProcessTerminated(exitCode=code)
+    else:
+        reason = ProcessDone(0)
+    process.processProtocol.processEnded(Failure(reason))
+
+
+class ProcessOutputTests(SynchronousTestCase):
+    """
+    Tests for ``process_output``.
+    """
+    def test_spawn(self):
+        """
+        ``process_output`` spawns the given command with its stdin closed.
+        """
+        reactor = FakeProcessReactor()
+        process_output(reactor, [b"echo", b"hello"])
+        process = reactor.processes[0]
+        self.assertEqual(
+            (b"echo", [b"echo", b"hello"], True),
+            (process.executable, process.args,
+             process.transport.stdin_closed))
+
+    def test_output(self):
+        """
+        The ``Deferred`` returned by ``process_output`` fires with the stdout
+        of the command once it exits successfully.
+        """
+        reactor = FakeProcessReactor()
+        d = process_output(reactor, [b"echo", b"hello"])
+        process = reactor.processes[0]
+        process.processProtocol.childDataReceived(1, b"hel")
+        process.processProtocol.childDataReceived(1, b"lo\n")
+        self.assertNoResult(d)
+        _exit(process, 0)
+        self.assertEqual(b"hello\n", self.successResultOf(d))
+
+    def test_bad_exit(self):
+        """
+        The ``Deferred`` returned by ``process_output`` errbacks with
+        ``IOError`` if the command exits unsuccessfully.
+        """
+        reactor = FakeProcessReactor()
+        d = process_output(reactor, [b"false"])
+        _exit(reactor.processes[0], 1)
+        self.assertEqual(
+            ("Bad exit", [b"false"], 1, b""),
+            self.failureResultOf(d, IOError).value.args)
+
+
+class PipeProcessesTests(SynchronousTestCase):
+    """
+    Tests for ``pipe_processes``.
+    """
+    def setUp(self):
+        self.reactor = FakeProcessReactor()
+        self.result = pipe_processes(
+            self.reactor, [b"zfs", b"send"], [b"ssh", b"receive"])
+        self.destination, self.source = self.reactor.processes
+
+    def test_spawn(self):
+        """
+        ``pipe_processes`` spawns both commands.
+        """
+        self.assertEqual(
+            ([b"zfs", b"send"], [b"ssh", b"receive"]),
+            (self.source.args, self.destination.args))
+
+    def test_producer(self):
+        """
+        A push producer is registered for the stdin of the destination
+        process.
+        """
+        self.assertTrue(
+            verifyObject(IPushProducer, self.destination.transport.producer))
+
+    def test_pause(self):
+        """
+        Reading from the source process is paused when the destination
+        process's stdin pauses its producer.
+        """
+        self.destination.transport.producer.pauseProducing()
+        self.assertTrue(self.source.transport.paused)
+
+    def test_resume(self):
+        """
+        Reading from the source process is resumed when the destination
+        process's stdin resumes its producer.
+        """
+        self.destination.transport.producer.pauseProducing()
+        self.destination.transport.producer.resumeProducing()
+        self.assertFalse(self.source.transport.paused)
+
+    def test_copies(self):
+        """
+        The stdout of the source process is written to the stdin of the
+        destination process.
+        """
+        self.source.processProtocol.childDataReceived(1, b"abc")
+        self.source.processProtocol.childDataReceived(1, b"def")
+        self.assertEqual(
+            (b"abcdef", False),
+            (self.destination.transport.data,
+             self.destination.transport.stdin_closed))
+
+    def test_source_finished(self):
+        """
+        When the stdout of the source process is closed the producer is
+        unregistered and the stdin of the destination process is closed.
+        """
+        self.source.processProtocol.childConnectionLost(1)
+        self.assertEqual(
+            (None, True),
+            (self.destination.transport.producer,
+             self.destination.transport.stdin_closed))
+
+    def test_success(self):
+        """
+        The ``Deferred`` returned by ``pipe_processes`` fires with ``None``
+        once both processes have exited successfully.
+        """
+        _exit(self.source, 0)
+        self.assertNoResult(self.result)
+        _exit(self.destination, 0)
+        self.assertIs(None, self.successResultOf(self.result))
+
+    def test_source_failed(self):
+        """
+        If the source process exits unsuccessfully the ``Deferred`` returned
+        by ``pipe_processes`` errbacks with an ``IOError`` describing it.
+        """
+        _exit(self.source, 1)
+        _exit(self.destination, 2)
+        self.assertEqual(
+            ("Bad exit", [b"zfs", b"send"], 1, b""),
+            self.failureResultOf(self.result, IOError).value.args)
+
+    def test_destination_failed(self):
+        """
+        If the destination process exits unsuccessfully the source process is
+        terminated and the ``Deferred`` returned by ``pipe_processes``
+        errbacks with an ``IOError`` describing the destination's exit.
+        """
+        _exit(self.destination, 1)
+        signals = self.source.transport.signals[:]
+        self.assertNoResult(self.result)
+        _exit(self.source, None, signal=15)
+        self.assertEqual(
+            (["TERM"], ("Bad exit", [b"ssh", b"receive"], 1, b"")),
+            (signals, self.failureResultOf(self.result, IOError).value.args))
@@ -44,8 +44,9 @@ class ClusterStateService(Service):
 
         :return FilePath: The path where the manifestation exists.
         """
-        [node] = (node for node in self._deployment_state.nodes
-                  if node.hostname == hostname)
+        node = self._deployment_state.get_node(hostname)
+        if node is None:
+            raise KeyError(hostname)
         return node.paths[dataset_id]
 
     def as_deployment(self):
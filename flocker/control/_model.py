@@ -25,29 +25,169 @@ from pyrsistent import (
 
 from zope.interface import Interface, implementer
 
+from ..route import Proxy, OpenPort
 
-def pset_field(item_type, optional=False):
+
+class _UniqueIndex(object):
+    """
+    An index for ``_IndexedSet`` mapping an attribute of each item to the
+    item itself.  Items must have distinct values for the attribute.
+
+    :ivar str key: The name of the attribute items are indexed by.
+    """
+    def __init__(self, key):
+        self.key = key
+
+    def _duplicate(self, key):
+        """
+        :return: ``ValueError`` for two items sharing ``key``.
+        """
+        return ValueError(
+            "More than one item has {}={!r}".format(self.key, key))
+
+    def build(self, items):
+        index = {}
+        for item in items:
+            key = getattr(item, self.key)
+            if key in index:
+                raise self._duplicate(key)
+            index[key] = item
+        return pmap(index)
+
+    def add(self, index, item):
+        key = getattr(item, self.key)
+        if key in index:
+            raise self._duplicate(key)
+        return index.set(key, item)
+
+    def remove(self, index, item):
+        key = getattr(item, self.key)
+        if index.get(key) == item:
+            return index.discard(key)
+        return index
+
+
+class _IndexedSet(object):
+    """
+    Mixin for ``CheckedPSet`` subclasses which keeps persistent indexes of
+    its items, so that items can be found without scanning the whole set.
+
+    Each index is built the first time it is needed and is then carried
+    over by ``add``, ``remove`` and ``discard``, so lookups and updates of
+    a set derived from an indexed set are logarithmic rather than linear.
+
+    An index is described by an object with ``build(items)``,
+    ``add(index, item)`` and ``remove(index, item)`` methods, each
+    returning a ``PMap``.
+
+    :cvar str __index_key__: The name of the attribute ``lookup`` finds
+        items by, or ``None``.
+    :cvar dict __indexes__: Mapping from index name to index description.
+    """
+    def index(self, name):
+        """
+        :param str name: The name of the index.
+
+        :return PMap: The named index of this set.
+        """
+        indexes = self.__dict__.setdefault("_indexes", {})
+        try:
+            return indexes[name]
+        except KeyError:
+            result = indexes[name] = self.__indexes__[name].build(self)
+            return result
+
+    def lookup(self, key, default=None):
+        """
+        Find the item with the given index key.
+
+        :param key: The value of the index attribute to look for.
+        :param default: Value to return if there is no matching item.
+
+        :return: The matching item or ``default``.
+        """
+        return self.index(self.__index_key__).get(key, default)
+
+    def _derive(self, result, operation, item):
+        """
+        Carry the indexes built for this set over to a set derived from it.
+
+        :param result: A set derived from this one by adding or removing
+            ``item``.
+        :param str operation: ``"add"`` or ``"remove"``.
+        :param item: The item added or removed.
+
+        :return: ``result``
+        """
+        indexes = self.__dict__.get("_indexes")
+        if result is not self and indexes:
+            result._indexes = {
+                name: getattr(self.__indexes__[name], operation)(index, item)
+                for name, index in indexes.items()}
+        return result
+
+    def add(self, element):
+        return self._derive(
+            super(_IndexedSet, self).add(element), "add", element)
+
+    def remove(self, element):
+        return self._derive(
+            super(_IndexedSet, self).remove(element), "remove", element)
+
+    def discard(self, element):
+        return self._derive(
+            super(_IndexedSet, self).discard(element), "remove", element)
+
+
+def pset_field(item_type, optional=False, index_by=None, indexes=None):
     """
     Create checked ``PSet`` field.
 
     :param item_type: The required type for the items in the set.
     :param bool optional: If true, ``None`` can be used as a value for
         this field.
+    :param str index_by: If not ``None``, the name of an attribute of the
+        items; the set will then have a ``lookup`` method finding items by
+        that attribute without scanning the set.  Items must have distinct
+        values for the attribute, otherwise ``ValueError`` is raised.
+    :param dict indexes: If not ``None``, a mapping from names to further
+        index descriptions (see ``_IndexedSet``), available from the set's
+        ``index`` method.
 
     :return: A ``field`` containing a ``CheckedPSet`` of the given type.
     """
-    class TheSet(CheckedPSet):
-        __type__ = item_type
-    TheSet.__name__ = item_type.__name__.capitalize() + "PSet"
+    all_indexes = dict(indexes or {})
+    if index_by is not None:
+        all_indexes[index_by] = _UniqueIndex(index_by)
+    if all_indexes:
+        bases = (_IndexedSet, CheckedPSet)
+    else:
+        bases = (CheckedPSet,)
+    TheSet = type(CheckedPSet)(
+        item_type.__name__.capitalize() + "PSet", bases,
+        {"__type__": item_type, "__index_key__": index_by,
+         "__indexes__": all_indexes})
+
+    def create(argument):
+        # Sets derived from an existing set are already checked; rebuilding
+        # them would be linear in their size and would lose any index.
+        if type(argument) is TheSet:
+            return argument
+        result = TheSet(argument)
+        if index_by is not None:
+            # Reject items with duplicate keys now rather than on the first
+            # lookup:
+            result.index(index_by)
+        return result
 
     if optional:
         def factory(argument):
             if argument is None:
                 return None
             else:
-                return TheSet(argument)
+                return create(argument)
     else:
-        factory = TheSet
+        factory = create
     return field(type=optional_type(TheSet) if optional else TheSet,
                  factory=factory, mandatory=True,
                  initial=TheSet())
@@ -353,15 +493,98 @@ class Node(PRecord):
     manifestations = pmap_field(unicode, Manifestation)
 
 
+class _ManifestationIndex(object):
+    """
+    An index for sets of ``Node`` or ``NodeState`` mapping each dataset ID
+    to a ``PMap`` of hostname to the nodes which have a manifestation of
+    that dataset.
+    """
+    def build(self, nodes):
+        index = {}
+        for node in nodes:
+            for dataset_id in node.manifestations or ():
+                index.setdefault(dataset_id, {})[node.hostname] = node
+        return pmap({dataset_id: pmap(hosts)
+                     for dataset_id, hosts in index.items()})
+
+    def add(self, index, node):
+        for dataset_id in node.manifestations or ():
+            index = index.set(
+                dataset_id,
+                index.get(dataset_id, pmap()).set(node.hostname, node))
+        return index
+
+    def remove(self, index, node):
+        for dataset_id in node.manifestations or ():
+            hosts = index.get(dataset_id)
+            if hosts is None or hosts.get(node.hostname) != node:
+                continue
+            hosts = hosts.discard(node.hostname)
+            if hosts:
+                index = index.set(dataset_id, hosts)
+            else:
+                index = index.discard(dataset_id)
+        return index
+
+
+def _nodes_field(node_type):
+    """
+    Create the ``nodes`` field of ``Deployment`` or ``DeploymentState``.
+
+    :param node_type: ``Node`` or ``NodeState``.
+
+    :return: A ``pset_field`` indexed by hostname and by dataset ID.
+    """
+    return pset_field(node_type, index_by="hostname",
+                      indexes={"dataset_id": _ManifestationIndex()})
+
+
+def _manifestations(nodes, dataset_id):
+    """
+    Find the manifestations of a dataset.
+
+    :param nodes: The ``nodes`` of a ``Deployment`` or ``DeploymentState``.
+    :param unicode dataset_id: The dataset ID.
+
+    :return: Iterable of tuples of a ``Manifestation`` of the dataset and
+        the node it is on.
+    """
+    for node in nodes.index("dataset_id").get(dataset_id, pmap()).values():
+        yield node.manifestations[dataset_id], node
+
+
 class Deployment(PRecord):
     """
     A ``Deployment`` describes the configuration of a number of applications on
     a number of cooperating nodes.
 
     :ivar PSet nodes: A set containing ``Node`` instances
-        describing the configuration of each cooperating node.
+        describing the configuration of each cooperating node, indexed by
+        hostname and by dataset ID.
     """
-    nodes = pset_field(Node)
+    nodes = _nodes_field(Node)
+
+    def get_node(self, hostname, default=None):
+        """
+        Find the ``Node`` with the given hostname.
+
+        :param unicode hostname: The hostname of the node.
+        :param default: Value to return if there is no such node.
+
+        :return: The matching ``Node`` or ``default``.
+        """
+        return self.nodes.lookup(hostname, default)
+
+    def get_manifestations(self, dataset_id):
+        """
+        Find the manifestations of a dataset.
+
+        :param unicode dataset_id: The dataset ID.
+
+        :return: Iterable of tuples of a ``Manifestation`` of the dataset
+            and the ``Node`` it is on.
+        """
+        return _manifestations(self.nodes, dataset_id)
 
     def applications(self):
         """
@@ -384,9 +607,11 @@ class Deployment(PRecord):
 
         :return Deployment: Updated with new ``Node``.
         """
-        return Deployment(nodes=frozenset(
-            list(n for n in self.nodes if n.hostname != node.hostname) +
-            [node]))
+        nodes = self.nodes
+        existing = nodes.lookup(node.hostname)
+        if existing is not None:
+            nodes = nodes.discard(existing)
+        return self.set("nodes", nodes.add(node))
 
     def move_application(self, application, target_node):
         """
@@ -491,6 +716,12 @@ class NodeState(PRecord):
         unknown.
     :ivar PMap paths: The filesystem paths of the manifestations on this
         node. Maps ``dataset_id`` to a ``FilePath``.
+    :ivar proxies: A ``PSet`` of ``Proxy`` instances for the traffic this
+        node forwards to other nodes, with the addresses as ``unicode``, or
+        ``None`` if the information is not known.
+    :ivar open_ports: A ``PSet`` of ``OpenPort`` instances for the ports
+        opened in this node's firewall, or ``None`` if the information is
+        not known.
     """
     def __invariant__(self):
         if self.manifestations is None:
@@ -505,6 +736,8 @@ class NodeState(PRecord):
     applications = pset_field(Application, optional=True)
     manifestations = pmap_field(unicode, Manifestation, optional=True)
     paths = pmap_field(unicode, FilePath, optional=True)
+    proxies = pset_field(Proxy, optional=True)
+    open_ports = pset_field(OpenPort, optional=True)
 
 
 class DeploymentState(PRecord):
@@ -512,9 +745,32 @@ class DeploymentState(PRecord):
     A ``DeploymentState`` describes the state of the nodes in the cluster.
 
     :ivar PSet nodes: A set containing ``NodeState`` instances describing
-        the state of each cooperating node.
+        the state of each cooperating node, indexed by hostname and by
+        dataset ID.
     """
-    nodes = pset_field(NodeState)
+    nodes = _nodes_field(NodeState)
+
+    def get_node(self, hostname, default=None):
+        """
+        Find the ``NodeState`` with the given hostname.
+
+        :param unicode hostname: The hostname of the node.
+        :param default: Value to return if there is no such node.
+
+        :return: The matching ``NodeState`` or ``default``.
+        """
+        return self.nodes.lookup(hostname, default)
+
+    def get_manifestations(self, dataset_id):
+        """
+        Find the manifestations of a dataset.
+
+        :param unicode dataset_id: The dataset ID.
+
+        :return: Iterable of tuples of a ``Manifestation`` of the dataset
+            and the ``NodeState`` it is on.
+        """
+        return _manifestations(self.nodes, dataset_id)
 
     def update_node(self, node_state):
         """
@@ -531,10 +787,9 @@ class DeploymentState(PRecord):
 
         :return DeploymentState: Updated with new ``NodeState``.
         """
-        nodes = {n for n in self.nodes if n.hostname == node_state.hostname}
-        if not nodes:
+        original_node = self.get_node(node_state.hostname)
+        if original_node is None:
             return self.transform(["nodes"], lambda s: s.add(node_state))
-        [original_node] = nodes
         updated_node = original_node
         for key, value in node_state.items():
             if value is not None:
@@ -543,9 +798,54 @@ class DeploymentState(PRecord):
             "nodes", self.nodes.discard(original_node).add(updated_node))
 
 
+def _node_changes(old, new):
+    """
+    Calculate the nodes that differ between two ``Deployment`` or two
+    ``DeploymentState`` instances.
+
+    :param old: The original ``Deployment`` or ``DeploymentState``.
+    :param new: The updated ``Deployment`` or ``DeploymentState``.
+
+    :return: Tuple of a ``list`` of nodes in ``new`` that are either
+        absent from or different in ``old``, and a ``list`` of hostnames of
+        nodes in ``old`` which are missing from ``new``.
+    """
+    changed = []
+    for node in new.nodes:
+        old_node = old.get_node(node.hostname)
+        if old_node is None or (old_node is not node and old_node != node):
+            changed.append(node)
+    removed = [node.hostname for node in old.nodes
+               if new.get_node(node.hostname) is None]
+    return changed, removed
+
+
+def _apply_node_changes(original, changed, removed):
+    """
+    Apply changes calculated by ``_node_changes``.
+
+    :param original: The ``Deployment`` or ``DeploymentState`` to update.
+    :param changed: Iterable of new or replaced nodes.
+    :param removed: Iterable of hostnames of nodes to remove.
+
+    :return: Updated ``Deployment`` or ``DeploymentState``.
+    """
+    nodes = original.nodes
+    for hostname in removed:
+        existing = nodes.lookup(hostname)
+        if existing is not None:
+            nodes = nodes.discard(existing)
+    for node in changed:
+        existing = nodes.lookup(node.hostname)
+        if existing is not None:
+            nodes = nodes.discard(existing)
+        nodes = nodes.add(node)
+    return original.set("nodes", nodes)
+
+
 # Classes that can be serialized to disk or sent over the network:
 SERIALIZABLE_CLASSES = [
     Deployment, Node, DockerImage, Port, Link, RestartNever, RestartAlways,
     RestartOnFailure, Application, Dataset, Manifestation, AttachedVolume,
-    NodeState, DeploymentState,
+    NodeState, DeploymentState, Proxy, OpenPort,
 ]
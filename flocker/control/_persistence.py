@@ -4,17 +4,28 @@
 Persistence of cluster configuration.
 """
 
-from json import dumps, loads, JSONEncoder
+from hashlib import sha256
+from itertools import chain
+from json import dumps, loads, JSONEncoder, JSONDecoder
+from os import fsync
 
 from eliot import Logger, write_traceback, MessageType, Field, ActionType
+from eliot.twisted import DeferredContext
 
-from pyrsistent import PRecord, PVector, PMap, PSet
+from pyrsistent import (
+    PRecord, PVector, PMap, PSet, CheckedPSet, CheckedPMap, pmap,
+)
 
 from twisted.python.filepath import FilePath
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
 from twisted.application.service import Service
-from twisted.internet.defer import succeed
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.threads import deferToThreadPool
 
-from ._model import SERIALIZABLE_CLASSES, Deployment
+from ._model import (
+    SERIALIZABLE_CLASSES, Deployment, _node_changes, _apply_node_changes,
+)
 
 
 # Serialization marker storing the class name:
@@ -40,36 +51,785 @@ class _ConfigurationEncoder(JSONEncoder):
         return JSONEncoder.default(self, obj)
 
 
-def wire_encode(obj):
+def _trusted_field_converter(field):
+    """
+    Create a function that converts a decoded value to the type a
+    ``PRecord`` field requires, without checking its contents.
+
+    :param field: A ``PRecord`` field.
+
+    :return: A one argument callable, or ``None`` if decoded values can be
+        used as is.
+    """
+    for field_type in field.type:
+        if issubclass(field_type, CheckedPSet):
+            def convert(value, field_type=field_type):
+                if value is None or isinstance(value, field_type):
+                    return value
+                # A PSet is a PMap of its elements to True:
+                return field_type(pmap(dict.fromkeys(value, True)))
+            return convert
+        elif issubclass(field_type, CheckedPMap):
+            def convert(value, field_type=field_type):
+                if value is None or isinstance(value, field_type):
+                    return value
+                as_pmap = pmap(value)
+                return field_type(as_pmap._buckets, as_pmap._size)
+            return convert
+        elif field_type is PMap:
+            return pmap
+    return None
+
+
+# Record class -> {field name: converter or None}:
+_TRUSTED_CONVERTERS = {}
+
+
+def _trusted_create(cls, values):
+    """
+    Create a ``PRecord`` from decoded values without validating them.
+
+    Field factories, type checks and invariants are skipped, apart from
+    converting sets and maps to the types the fields require.  This must
+    only be used for data that was produced by encoding valid records.
+
+    :param cls: The ``PRecord`` subclass to create.
+    :param dict values: Mapping of field names to decoded values.
+
+    :return: An instance of ``cls``.
+    """
+    converters = _TRUSTED_CONVERTERS.get(cls)
+    if converters is None:
+        converters = _TRUSTED_CONVERTERS[cls] = {
+            name: _trusted_field_converter(field)
+            for name, field in cls._precord_fields.items()}
+    fields = {}
+    for name, initial in cls._precord_initial_values.items():
+        if name not in values:
+            fields[name] = initial
+    for name, value in values.items():
+        converter = converters[name]
+        if converter is not None:
+            value = converter(value)
+        fields[name] = value
+    as_pmap = pmap(fields)
+    return cls(_precord_buckets=as_pmap._buckets, _precord_size=as_pmap._size)
+
+
+class _JSONCodec(object):
+    """
+    The original encoding: JSON, with the class name stored in every
+    serialized record.
+    """
+    name = u"json"
+
+    def encode(self, obj):
+        """
+        :param obj: An object from the configuration model.
+        :return bytes: Encoded object.
+        """
+        return dumps(obj, cls=_ConfigurationEncoder)
+
+    def iterencode(self, obj):
+        """
+        :param obj: An object from the configuration model.
+        :return: Iterator of ``bytes`` which together are the same as the
+            output of ``encode``.
+        """
+        return self._iterencode(obj, _ENCODER, _INCREMENTAL_DEPTH)
+
+    def _iterencode(self, obj, encoder, depth):
+        """
+        Encode an object, splitting the outer ``depth`` levels of records
+        and containers into separate pieces.  Everything below that is
+        encoded by the C accelerated ``json`` encoder in one go.
+
+        :return: Iterator of ``bytes``.
+        """
+        if depth > 0:
+            if isinstance(obj, (PRecord, PMap, PSet, PVector, set)):
+                obj = encoder.default(obj)
+            if isinstance(obj, dict) and all(
+                    isinstance(key, basestring) for key in obj):
+                yield b"{"
+                for i, (key, value) in enumerate(obj.items()):
+                    yield (b", " if i else b"") + dumps(key) + b": "
+                    for piece in self._iterencode(value, encoder, depth - 1):
+                        yield piece
+                yield b"}"
+                return
+            elif isinstance(obj, list):
+                yield b"["
+                for i, item in enumerate(obj):
+                    if i:
+                        yield b", "
+                    for piece in self._iterencode(item, encoder, depth - 1):
+                        yield piece
+                yield b"]"
+                return
+        yield dumps(obj, cls=_ConfigurationEncoder)
+
+    def _object_decoder(self, trusted):
+        """
+        :param bool trusted: If true, records are created without being
+            validated; see ``wire_decode``.
+        :return: ``object_hook`` for ``json`` that recreates records.
+        """
+        classes = {cls.__name__: cls for cls in SERIALIZABLE_CLASSES}
+
+        def decode_object(dictionary):
+            class_name = dictionary.get(_CLASS_MARKER, None)
+            if class_name == u"FilePath":
+                return FilePath(dictionary.get(u"path").encode("utf-8"))
+            elif class_name in classes:
+                dictionary = dictionary.copy()
+                dictionary.pop(_CLASS_MARKER)
+                if trusted:
+                    return _trusted_create(classes[class_name], dictionary)
+                return classes[class_name].create(dictionary)
+            else:
+                return dictionary
+        return decode_object
+
+    def decode(self, data, trusted=False):
+        """
+        :param bytes data: Encoded object.
+        :param bool trusted: If true, records are created without being
+            validated; see ``wire_decode``.
+        :return: The decoded object.
+        """
+        return loads(data, object_hook=self._object_decoder(trusted))
+
+    def decode_chunks(self, chunks, trusted=False):
+        """
+        :param chunks: Iterator of ``bytes`` which together are the encoded
+            object.
+        :param bool trusted: If true, records are created without being
+            validated; see ``wire_decode``.
+        :return: The decoded object.
+        """
+        decode_object = self._object_decoder(trusted)
+        parser = _ChunkParser(chunks, decode_object)
+        result = parser.parse(_INCREMENTAL_DEPTH, decode_object)
+        parser.finish()
+        return result
+
+
+# The number of levels of records and containers at the top of an encoded
+# object that are encoded and decoded piece by piece when it is sent in
+# chunks.  For a ``Deployment`` or ``DeploymentState`` this means each node
+# is a separate piece.  Anything deeper is handed to the C accelerated
+# ``json`` module in one go.
+_INCREMENTAL_DEPTH = 2
+
+_ENCODER = _ConfigurationEncoder()
+
+_WHITESPACE = b" \t\n\r"
+
+
+class _ChunkParser(object):
+    """
+    Parse JSON from a series of chunks without joining them all together.
+
+    The outer levels of objects and arrays are parsed here, while the
+    values nested below them are each parsed by the C accelerated ``json``
+    decoder.  Only the part of the input needed for the value currently
+    being parsed is kept in memory.
+    """
+    def __init__(self, chunks, object_hook=None):
+        """
+        :param chunks: Iterator of ``bytes`` which together are the JSON.
+        :param object_hook: ``object_hook`` for ``json``, also applied to
+            the objects parsed by this parser.
+        """
+        self._chunks = iter(chunks)
+        self._data = b""
+        self._position = 0
+        self._exhausted = False
+        self._decoder = JSONDecoder(object_hook=object_hook)
+
+    def _fill(self, length):
+        """
+        Read chunks until at least ``length`` bytes are buffered after the
+        current position, or there are no more chunks.
+
+        :return bool: Whether any more data was read.
+        """
+        pieces = [self._data[self._position:]]
+        buffered = len(pieces[0])
+        while buffered < length and not self._exhausted:
+            try:
+                chunk = next(self._chunks)
+            except StopIteration:
+                self._exhausted = True
+            else:
+                pieces.append(chunk)
+                buffered += len(chunk)
+        if len(pieces) == 1:
+            return False
+        self._data = b"".join(pieces)
+        self._position = 0
+        return True
+
+    def _peek(self):
+        """
+        Skip whitespace and return the next character, without consuming it.
+
+        :return bytes: The next character.
+        """
+        while True:
+            while (self._position < len(self._data) and
+                   self._data[self._position] in _WHITESPACE):
+                self._position += 1
+            if self._position < len(self._data):
+                return self._data[self._position]
+            if not self._fill(1):
+                raise ValueError("Unexpected end of data")
+
+    def _value(self):
+        """
+        Parse a complete value with the C accelerated ``json`` decoder.
+
+        :return: The decoded value.
+        """
+        self._peek()
+        while True:
+            remaining = len(self._data) - self._position
+            try:
+                value, end = self._decoder.raw_decode(
+                    self._data, self._position)
+            except ValueError:
+                if not self._fill(2 * remaining):
+                    raise
+                continue
+            # A number at the end of the data may continue in the next
+            # chunk:
+            if end == len(self._data) and self._fill(2 * remaining):
+                continue
+            self._position = end
+            return value
+
+    def parse(self, depth, object_hook=None):
+        """
+        Parse the next value.
+
+        :param int depth: The number of levels of nesting to parse here
+            rather than with the ``json`` decoder.
+        :param object_hook: Function called with each object parsed here.
+
+        :return: The decoded value.
+        """
+        start = self._peek()
+        if depth <= 0 or start not in b"{[":
+            return self._value()
+        self._position += 1
+        if start == b"{":
+            result = {}
+            end = b"}"
+        else:
+            result = []
+            end = b"]"
+        if self._peek() == end:
+            self._position += 1
+        else:
+            while True:
+                if end == b"}":
+                    key = self._value()
+                    if self._peek() != b":":
+                        raise ValueError("Expected ':'")
+                    self._position += 1
+                    result[key] = self.parse(depth - 1, object_hook)
+                else:
+                    result.append(self.parse(depth - 1, object_hook))
+                separator = self._peek()
+                self._position += 1
+                if separator == end:
+                    break
+                elif separator != b",":
+                    raise ValueError("Expected ',' or {!r}".format(end))
+        if end == b"}" and object_hook is not None:
+            result = object_hook(result)
+        return result
+
+    def finish(self):
+        """
+        Check that nothing but whitespace follows the parsed value.
+        """
+        try:
+            self._peek()
+        except ValueError:
+            return
+        raise ValueError("Extra data after encoded object")
+
+
+# Prefix of data encoded by _CompactCodec, followed by the format version
+# and a newline.  JSON can never start with a NUL byte, so this also
+# distinguishes the two encodings.
+_COMPACT_PREFIX = b"\x00compact:"
+
+# Tags identifying the type of an encoded container in the compact format:
+_LIST_TAG = 0
+_MAP_TAG = 1
+_FILEPATH_TAG = 2
+# A record field that has no value:
+_MISSING_TAG = 3
+# Records are tagged with their index in the class table plus this:
+_FIRST_RECORD_TAG = 4
+
+# Stands in for the value of a record field that has no value:
+_MISSING = object()
+
+_SCALAR_TYPES = (unicode, bytes, int, long, float, bool, type(None))
+
+
+class _CompactCodec(object):
+    """
+    A compact encoding of the configuration model.
+
+    The encoded data consists of a versioned header followed by a JSON
+    array of the encoded object and a class table.  The class table lists
+    the name and fields of each record class used, once per document.  It
+    comes last so the object can be encoded piece by piece, discovering
+    the classes as it goes.  Containers are encoded as JSON arrays whose
+    first element is a tag:
+
+    * ``[0, item, ...]`` for sets and lists.
+    * ``[1, key, value, ...]`` for maps.
+    * ``[2, path]`` for ``FilePath``.
+    * ``[4 + index, value, ...]`` for records, with the values in the order
+      of the record's fields in the class table.  Fields without a value
+      are encoded as ``[3]``.
+
+    This avoids repeating field and class names for every record, making
+    the encoded data around a third of the size of the JSON encoding.  It
+    only saves space: converting records to and from the tagged arrays is
+    done in Python, so encoding and decoding are slightly slower than with
+    ``JSON_CODEC``.
+    """
+    name = u"compact"
+    version = 1
+
+    def __init__(self):
+        self._header = _COMPACT_PREFIX + b"%d\n" % (self.version,)
+
+    def _children(self, obj, classes, table):
+        """
+        Find the tag and contents of a record or container.
+
+        :param obj: The record or container.
+        :param list classes: The class table, added to as new record classes
+            are encountered.
+        :param dict table: Mapping of record class to its tag and fields.
+
+        :return: Tuple of the tag and a ``list`` of the objects to encode
+            after it.
+        """
+        if isinstance(obj, PRecord):
+            cls = obj.__class__
+            entry = table.get(cls)
+            if entry is None:
+                fields = sorted(cls._precord_fields)
+                entry = table[cls] = (len(classes) + _FIRST_RECORD_TAG, fields)
+                classes.append([cls.__name__, fields])
+            tag, fields = entry
+            return tag, [obj[field_name] if field_name in obj else _MISSING
+                         for field_name in fields]
+        elif isinstance(obj, (PMap, dict)):
+            children = []
+            for key, value in obj.items():
+                children.append(key)
+                children.append(value)
+            return _MAP_TAG, children
+        elif isinstance(obj, (PSet, PVector, set, frozenset, list, tuple)):
+            return _LIST_TAG, list(obj)
+        raise TypeError("{!r} cannot be encoded".format(obj))
+
+    def _to_tree(self, obj, classes, table):
+        """
+        Convert an object to JSON-compatible values.
+
+        :param obj: The object to convert.
+        :param list classes: The class table, added to as new record classes
+            are encountered.
+        :param dict table: Mapping of record class to its tag and fields.
+
+        :return: JSON-compatible representation of ``obj``.
+        """
+        if isinstance(obj, _SCALAR_TYPES):
+            return obj
+        elif obj is _MISSING:
+            return [_MISSING_TAG]
+        elif isinstance(obj, FilePath):
+            return [_FILEPATH_TAG, obj.path.decode("utf-8")]
+        tag, children = self._children(obj, classes, table)
+        result = [tag]
+        for child in children:
+            result.append(self._to_tree(child, classes, table))
+        return result
+
+    def encode(self, obj):
+        """
+        :param obj: An object from the configuration model.
+        :return bytes: Encoded object.
+        """
+        classes = []
+        tree = self._to_tree(obj, classes, {})
+        return self._header + dumps([tree, classes], separators=(",", ":"))
+
+    def iterencode(self, obj):
+        """
+        :param obj: An object from the configuration model.
+        :return: Iterator of ``bytes`` which together are the same as the
+            output of ``encode``.
+        """
+        classes = []
+        yield self._header + b"["
+        for piece in self._iterencode(obj, classes, {}, _INCREMENTAL_DEPTH):
+            yield piece
+        yield b"," + dumps(classes, separators=(",", ":")) + b"]"
+
+    def _iterencode(self, obj, classes, table, depth):
+        """
+        Encode an object, splitting the outer ``depth`` levels of records
+        and containers into separate pieces.
+
+        :return: Iterator of ``bytes``.
+        """
+        if (depth > 0 and not isinstance(obj, _SCALAR_TYPES) and
+                obj is not _MISSING and not isinstance(obj, FilePath)):
+            tag, children = self._children(obj, classes, table)
+            yield b"[%d" % (tag,)
+            for child in children:
+                yield b","
+                for piece in self._iterencode(child, classes, table,
+                                              depth - 1):
+                    yield piece
+            yield b"]"
+            return
+        yield dumps(self._to_tree(obj, classes, table), separators=(",", ":"))
+
+    def _check_header(self, header):
+        """
+        :param bytes header: The first line of encoded data, including the
+            newline.
+        :raise ValueError: If the data was not encoded by this version.
+        """
+        if header != self._header:
+            raise ValueError(
+                "Unsupported compact encoding: {!r}".format(header))
+
+    def decode(self, data, trusted=False):
+        """
+        :param bytes data: Encoded object.
+        :param bool trusted: If true, records are created without being
+            validated; see ``wire_decode``.
+        :return: The decoded object.
+        """
+        header, body = data.split(b"\n", 1)
+        self._check_header(header + b"\n")
+        return self._from_document(loads(body), trusted)
+
+    def decode_chunks(self, chunks, trusted=False):
+        """
+        :param chunks: Iterator of ``bytes`` which together are the encoded
+            object.
+        :param bool trusted: If true, records are created without being
+            validated; see ``wire_decode``.
+        :return: The decoded object.
+        """
+        chunks = iter(chunks)
+        header = b""
+        for chunk in chunks:
+            header += chunk
+            if b"\n" in header:
+                break
+        else:
+            raise ValueError("Missing compact encoding header")
+        header, rest = header.split(b"\n", 1)
+        self._check_header(header + b"\n")
+        # The document array itself is one more level of nesting:
+        parser = _ChunkParser(chain([rest], chunks))
+        document = parser.parse(_INCREMENTAL_DEPTH + 1)
+        parser.finish()
+        return self._from_document(document, trusted)
+
+    def _from_document(self, document, trusted):
+        """
+        :param list document: The encoded object and class table, as parsed
+            from JSON.
+        :param bool trusted: If true, records are created without being
+            validated; see ``wire_decode``.
+        :return: The decoded object.
+        """
+        tree, classes = document
+        known = {cls.__name__: cls for cls in SERIALIZABLE_CLASSES}
+        table = [(known.get(name), fields) for (name, fields) in classes]
+        if trusted:
+            create = _trusted_create
+        else:
+            create = lambda cls, values: cls.create(values)
+        return self._from_tree(tree, table, create)
+
+    def _from_tree(self, tree, table, create):
+        """
+        Convert JSON-compatible values back to objects.
+
+        :param tree: The output of ``_to_tree``, as parsed from JSON.
+        :param list table: List of (record class or ``None`` if unknown,
+            field names), indexed by record tag.
+        :param create: Callable taking a record class and a ``dict`` of
+            field values, returning a record.
+
+        :return: The decoded object.
+        """
+        if not isinstance(tree, list):
+            return tree
+        tag = tree[0]
+        if tag == _LIST_TAG:
+            return [self._from_tree(item, table, create)
+                    for item in tree[1:]]
+        elif tag == _MAP_TAG:
+            return {self._from_tree(tree[i], table, create):
+                    self._from_tree(tree[i + 1], table, create)
+                    for i in range(1, len(tree), 2)}
+        elif tag == _FILEPATH_TAG:
+            return FilePath(tree[1].encode("utf-8"))
+        cls, fields = table[tag - _FIRST_RECORD_TAG]
+        values = {}
+        for field_name, value in zip(fields, tree[1:]):
+            if value != [_MISSING_TAG]:
+                values[field_name] = self._from_tree(value, table, create)
+        if cls is None:
+            # Unknown classes are not decoded, just as with JSON:
+            return values
+        return create(cls, values)
+
+
+JSON_CODEC = _JSONCodec()
+COMPACT_CODEC = _CompactCodec()
+
+# Codecs by name:
+CODECS = {codec.name: codec for codec in [JSON_CODEC, COMPACT_CODEC]}
+
+
+def wire_encode(obj, codec=JSON_CODEC):
     """
     Encode the given configuration object into bytes.
 
     :param obj: An object from the configuration model, e.g. ``Deployment``.
+    :param codec: The codec to use, e.g. ``JSON_CODEC`` or
+        ``COMPACT_CODEC``.
     :return bytes: Encoded object.
     """
-    return dumps(obj, cls=_ConfigurationEncoder)
+    return codec.encode(obj)
 
 
-def wire_decode(data):
+def wire_encode_chunks(obj, chunk_size, codec=JSON_CODEC):
+    """
+    Encode the given configuration object into a series of chunks.
+
+    The object is encoded incrementally, so the complete encoded form is
+    never built up as a single string: the outer records and containers,
+    e.g. the nodes of a ``Deployment``, are encoded one at a time, each with
+    the C accelerated ``json`` encoder.  Joining the chunks results in the
+    same bytes as ``wire_encode`` would return.
+
+    :param obj: An object from the configuration model, e.g. ``Deployment``.
+    :param int chunk_size: The maximum length of each chunk.
+    :param codec: The codec to use, e.g. ``JSON_CODEC`` or
+        ``COMPACT_CODEC``.
+
+    :return: Iterator of ``bytes``, each no longer than ``chunk_size``. At
+        least one chunk is always produced.
+    """
+    pieces = []
+    length = 0
+    produced = False
+    for piece in codec.iterencode(obj):
+        while piece:
+            space = chunk_size - length
+            pieces.append(piece[:space])
+            length += len(pieces[-1])
+            piece = piece[space:]
+            if length == chunk_size:
+                yield b"".join(pieces)
+                produced = True
+                pieces = []
+                length = 0
+    if pieces or not produced:
+        yield b"".join(pieces)
+
+
+def wire_decode(data, trusted=False):
     """
     Decode the given configuration object from bytes.
 
+    The codec used to encode the data is detected automatically.
+
     :param bytes data: Encoded object.
-    :param obj: An object from the configuration model, e.g. ``Deployment``.
+    :param bool trusted: If true, the data is known to have been produced by
+        ``wire_encode`` from valid objects, so records are created without
+        running field factories, type checks or invariants.  This is much
+        faster for large configurations, but will produce invalid objects
+        if the data was not produced by ``wire_encode``.
+    :return: An object from the configuration model, e.g. ``Deployment``.
     """
-    classes = {cls.__name__: cls for cls in SERIALIZABLE_CLASSES}
+    if data.startswith(_COMPACT_PREFIX):
+        return COMPACT_CODEC.decode(data, trusted)
+    return JSON_CODEC.decode(data, trusted)
+
+
+def wire_decode_chunks(chunks, trusted=False):
+    """
+    Decode the given configuration object from a series of chunks, such as
+    those produced by ``wire_encode_chunks``.
+
+    The chunks are decoded incrementally rather than being joined into a
+    single string first, so only one chunk and the outer record or
+    container currently being decoded, e.g. one node of a ``Deployment``,
+    are held in memory as encoded data at a time.
+
+    :param chunks: Iterable of ``bytes`` which together are the encoded
+        object.
+    :param bool trusted: See ``wire_decode``.
+    :return: An object from the configuration model, e.g. ``Deployment``.
+    """
+    chunks = iter(chunks)
+    start = b""
+    for chunk in chunks:
+        start += chunk
+        if len(start) >= len(_COMPACT_PREFIX):
+            break
+    chunks = chain([start], chunks)
+    if start.startswith(_COMPACT_PREFIX):
+        return COMPACT_CODEC.decode_chunks(chunks, trusted)
+    return JSON_CODEC.decode_chunks(chunks, trusted)
+
+
+def _write_durably(path, content):
+    """
+    Replace the contents of a file, making sure the new contents are on disk
+    before returning.
+
+    :param FilePath path: The file to write.
+    :param bytes content: The new contents.
+    """
+    temporary = path.temporarySibling()
+    with temporary.open("w") as f:
+        f.write(content)
+        f.flush()
+        fsync(f.fileno())
+    temporary.moveTo(path)
 
-    def decode_object(dictionary):
-        class_name = dictionary.get(_CLASS_MARKER, None)
-        if class_name == u"FilePath":
-            return FilePath(dictionary.get(u"path").encode("utf-8"))
-        elif class_name in classes:
-            dictionary = dictionary.copy()
-            dictionary.pop(_CLASS_MARKER)
-            return classes[class_name].create(dictionary)
-        else:
-            return dictionary
-    return loads(data, object_hook=decode_object)
+
+class _Journal(object):
+    """
+    An append-only log of changes to the configuration made since the
+    configuration file was last written.
+
+    The journal starts with a line giving the SHA-256 digest of the
+    configuration file it applies to, so a journal left behind by a crash
+    while the configuration file was being replaced is recognized as stale.
+    Each entry is a line giving the length and SHA-256 digest of its
+    payload, followed by the payload and a newline.  The payload is an
+    encoded ``dict`` of the nodes that were added or changed and the
+    hostnames of the nodes that were removed.
+
+    :ivar FilePath path: The journal file.
+    :ivar int size: The size of the journal in bytes.
+    """
+    def __init__(self, path, codec):
+        """
+        :param FilePath path: The journal file.
+        :param codec: The codec used to encode entries.
+        """
+        self.path = path
+        self.size = 0
+        self._codec = codec
+
+    def _header(self, snapshot_digest):
+        return b"snapshot %s\n" % (snapshot_digest,)
+
+    def replay(self, snapshot_digest, deployment):
+        """
+        Apply the changes recorded in the journal.
+
+        Entries following the first incomplete or corrupt entry, which may
+        have been left behind by a crash while it was written, are ignored.
+
+        :param bytes snapshot_digest: The SHA-256 hex digest of the
+            configuration file.
+        :param Deployment deployment: The configuration loaded from the
+            configuration file.
+
+        :return: Tuple of the updated ``Deployment`` and the number of
+            entries applied.
+        """
+        if not self.path.exists():
+            return deployment, 0
+        content = self.path.getContent()
+        offset = len(self._header(snapshot_digest))
+        if content[:offset] != self._header(snapshot_digest):
+            return deployment, 0
+        entries = 0
+        while True:
+            end_of_line = content.find(b"\n", offset)
+            if end_of_line == -1:
+                break
+            try:
+                length, digest = content[offset:end_of_line].split(b" ")
+                length = int(length)
+            except ValueError:
+                break
+            start = end_of_line + 1
+            payload = content[start:start + length]
+            if (len(payload) != length or
+                    content[start + length:start + length + 1] != b"\n" or
+                    sha256(payload).hexdigest() != digest):
+                break
+            entry = wire_decode(payload, trusted=True)
+            deployment = _apply_node_changes(
+                deployment, entry[u"changed"], entry[u"removed"])
+            offset = start + length + 1
+            entries += 1
+        return deployment, entries
+
+    def reset(self, snapshot_digest):
+        """
+        Start a new, empty journal.
+
+        :param bytes snapshot_digest: The SHA-256 hex digest of the
+            configuration file the journal applies to.
+        """
+        header = self._header(snapshot_digest)
+        _write_durably(self.path, header)
+        self.size = len(header)
+
+    def append(self, changes):
+        """
+        Record changes to the configuration.  All the given changes are
+        written with a single flush to disk.
+
+        :param changes: ``list`` of tuples of changed nodes and removed
+            hostnames, as returned by ``_node_changes``.
+        """
+        entries = []
+        for changed, removed in changes:
+            payload = wire_encode({u"changed": changed, u"removed": removed},
+                                  self._codec)
+            entries.append(b"%d %s\n%s\n" % (
+                len(payload), sha256(payload).hexdigest(), payload))
+        data = b"".join(entries)
+        with self.path.open("a") as f:
+            f.write(data)
+            f.flush()
+            fsync(f.fileno())
+        self.size += len(data)
+
+
+# The journal is compacted into the configuration file once it is larger
+# than the configuration file and at least this many bytes:
+_MINIMUM_COMPACTION_SIZE = 64 * 1024
 
 
 _DEPLOYMENT_FIELD = Field(u"configuration", repr)
@@ -77,6 +837,24 @@ _LOG_STARTUP = MessageType(u"flocker-control:persistence:startup",
                            [_DEPLOYMENT_FIELD])
 _LOG_SAVE = ActionType(u"flocker-control:persistence:save",
                        [_DEPLOYMENT_FIELD], [])
+_LOG_SAVE_CHANGES = ActionType(
+    u"flocker-control:persistence:save-changes",
+    [Field(u"changed", repr, u"The nodes that were added or changed."),
+     Field.forTypes(u"removed", [list],
+                    u"The hostnames of the nodes that were removed.")],
+    [],
+    u"Changes to the configuration are being saved to the journal.")
+_LOG_COMPACT = MessageType(
+    u"flocker-control:persistence:compact",
+    [Field.forTypes(u"journal_size", [int, long],
+                    u"The size of the journal in bytes.")],
+    u"The configuration journal is being replaced by a new configuration "
+    u"file.")
+_LOG_GROUP_COMMIT = MessageType(
+    u"flocker-control:persistence:group-commit",
+    [Field.forTypes(u"saves", [int, long],
+                    u"The number of saves combined into the write.")],
+    u"Saved configuration is being written to disk.")
 
 
 class ConfigurationPersistenceService(Service):
@@ -84,30 +862,103 @@ class ConfigurationPersistenceService(Service):
     Persist configuration to disk, and load it back.
 
     :ivar Deployment _deployment: The current desired deployment configuration.
+    :ivar Deployment _durable_deployment: The last configuration known to
+        have been written to disk.
+    :ivar ThreadPool _writer: The thread configuration is written in, or
+        ``None`` if it is written in the reactor thread.
+    :ivar list _pending: Tuples of configuration, changes and ``Deferred``
+        for saves waiting to be written by ``_writer``.
+    :ivar bool _snapshot_needed: Whether a write failed, leaving the journal
+        in an unknown state, so the next write must be a full snapshot.
     """
     logger = Logger()
 
-    def __init__(self, reactor, path):
+    def __init__(self, reactor, path, codec=JSON_CODEC, journal=False,
+                 commit_interval=None):
         """
         :param reactor: Reactor to use for thread pool.
         :param FilePath path: Directory where desired deployment will be
             persisted.
+        :param codec: The codec used to write the configuration. Existing
+            configuration written with any codec can be loaded.
+        :param bool journal: If true, each save appends the changed nodes to
+            a journal rather than rewriting the whole configuration file.
+            The journal is compacted into a new configuration file once it
+            grows larger than the configuration file.
+        :param commit_interval: If ``None``, configuration is written in the
+            reactor thread as part of each save.  Otherwise configuration is
+            written in a dedicated thread, and all saves made within this
+            many seconds of each other, or while a write is in progress, are
+            written together with a single flush to disk.
         """
+        self._reactor = reactor
         self._path = path
+        self._codec = codec
+        self._use_journal = journal
+        self._commit_interval = commit_interval
         self._change_callbacks = []
+        self._writer = None
+        self._pending = []
+        self._flush_call = None
+        self._writing = False
+        self._idle_waiters = []
+        self._snapshot_needed = False
 
     def startService(self):
         if not self._path.exists():
             self._path.makedirs()
         self._config_path = self._path.child(b"current_configuration.v1.json")
+        self._checksum_path = self._path.child(
+            b"current_configuration.v1.sha256")
+        self._journal = _Journal(
+            self._path.child(b"current_configuration.v1.journal"),
+            self._codec)
         if self._config_path.exists():
-            self._deployment = wire_decode(
-                self._config_path.getContent())
+            content = self._config_path.getContent()
+            digest = sha256(content).hexdigest()
+            self._snapshot_size = len(content)
+            # If the file is exactly what we last wrote there is no need to
+            # validate it again:
+            trusted = (self._checksum_path.exists() and
+                       self._checksum_path.getContent() == digest)
+            self._deployment = wire_decode(content, trusted=trusted)
+            self._deployment, replayed = self._journal.replay(
+                digest, self._deployment)
+            if replayed:
+                digest = self._sync_save(self._deployment)
         else:
             self._deployment = Deployment(nodes=frozenset())
-            self._sync_save(self._deployment)
+            digest = self._sync_save(self._deployment)
+        self._durable_deployment = self._deployment
+        if self._use_journal:
+            self._journal.reset(digest)
+        elif self._journal.path.exists():
+            self._journal.path.remove()
+        if self._commit_interval is not None:
+            self._writer = ThreadPool(
+                minthreads=1, maxthreads=1,
+                name="flocker-control:persistence")
+            self._writer.start()
         _LOG_STARTUP(configuration=self.get()).write(self.logger)
 
+    def stopService(self):
+        """
+        Stop the service once all saved configuration has been written.
+        """
+        Service.stopService(self)
+        if self._writer is None:
+            return None
+        if self._flush_call is not None:
+            self._flush_call.cancel()
+            self._flush()
+        if self._writing:
+            idle = Deferred()
+            self._idle_waiters.append(idle)
+        else:
+            idle = succeed(None)
+        idle.addCallback(lambda _: self._writer.stop())
+        return idle
+
     def register(self, change_callback):
         """
         Register a function to be called whenever the configuration changes.
@@ -120,28 +971,152 @@ class ConfigurationPersistenceService(Service):
     def _sync_save(self, deployment):
         """
         Save and flush new deployment to disk synchronously.
+
+        A checksum of the written data is saved alongside it, allowing it to
+        be loaded without validation.
+
+        :return bytes: The SHA-256 hex digest of the written data.
+        """
+        content = wire_encode(deployment, self._codec)
+        digest = sha256(content).hexdigest()
+        _write_durably(self._config_path, content)
+        self._checksum_path.setContent(digest)
+        self._snapshot_size = len(content)
+        return digest
+
+    def _write(self, deployment, changes):
+        """
+        Write new configuration to disk.  This may run in the writer thread.
+
+        :param Deployment deployment: The new configuration.
+        :param list changes: If a journal is used, tuples of changed nodes
+            and removed hostnames made by each save since the last write, as
+            returned by ``_node_changes``.
+        """
+        if not self._use_journal:
+            self._sync_save(deployment)
+            return
+        try:
+            if self._snapshot_needed:
+                # The journal may contain changes from a save that failed
+                # and was rolled back, so start again from a snapshot:
+                self._journal.reset(self._sync_save(deployment))
+                self._snapshot_needed = False
+                return
+            changes = [(changed, removed) for (changed, removed) in changes
+                       if changed or removed]
+            if changes:
+                self._journal.append(changes)
+            if self._journal.size > max(self._snapshot_size,
+                                        _MINIMUM_COMPACTION_SIZE):
+                _LOG_COMPACT(
+                    journal_size=self._journal.size).write(self.logger)
+                self._journal.reset(self._sync_save(deployment))
+        except:
+            self._snapshot_needed = True
+            raise
+
+    def _configuration_changed(self):
+        """
+        Call the registered change callbacks.
         """
-        self._config_path.setContent(wire_encode(deployment))
+        for callback in self._change_callbacks:
+            try:
+                callback()
+            except:
+                # Second argument will be ignored in next Eliot release, so
+                # not bothering with particular value.
+                write_traceback(self.logger, u"")
+
+    def _queue(self, deployment, changes):
+        """
+        Queue new configuration to be written by the writer thread.
+
+        :param Deployment deployment: The new configuration.
+        :param changes: The changes made, if a journal is used.
+
+        :return Deferred: Fires when the configuration has been written.
+        """
+        saved = Deferred()
+        self._pending.append((deployment, changes, saved))
+        if self._flush_call is None and not self._writing:
+            self._flush_call = self._reactor.callLater(
+                self._commit_interval, self._flush)
+        return saved
+
+    def _flush(self):
+        """
+        Write all queued configuration in the writer thread.
+        """
+        self._flush_call = None
+        batch, self._pending = self._pending, []
+        _LOG_GROUP_COMMIT(saves=len(batch)).write(self.logger)
+        self._writing = True
+        writing = deferToThreadPool(
+            self._reactor, self._writer, self._write, batch[-1][0],
+            [changes for (_, changes, _) in batch])
+
+        def written(result):
+            # ``_writing`` stays set while the saves' callbacks run, so any
+            # saves they make are picked up below rather than scheduling a
+            # second flush:
+            if isinstance(result, Failure):
+                # Saves queued during the write were based on configuration
+                # that was never written, so they are discarded as well:
+                failed, self._pending = batch + self._pending, []
+                self._deployment = self._durable_deployment
+                for _, _, saved in failed:
+                    saved.errback(result)
+            else:
+                self._durable_deployment = batch[-1][0]
+                self._configuration_changed()
+                for _, _, saved in batch:
+                    saved.callback(None)
+            self._writing = False
+            if self._pending:
+                # These saves have already waited for the write to finish:
+                self._flush()
+            else:
+                idle_waiters, self._idle_waiters = self._idle_waiters, []
+                for idle in idle_waiters:
+                    idle.callback(None)
+        writing.addBoth(written)
 
     def save(self, deployment):
         """
         Save and flush new deployment to disk.
 
+        The new configuration is returned by ``get`` immediately.  If a
+        ``commit_interval`` was given the registered change callbacks are
+        called once it has been written, otherwise they are called before
+        this method returns.  If writing fails, ``get`` returns the last
+        configuration that was written again, and this save and any made
+        while it was waiting to be written fail.
+
         :return Deferred: Fires when write is finished.
         """
-        with _LOG_SAVE(self.logger, configuration=deployment):
-            self._sync_save(deployment)
-            self._deployment = deployment
+        if self._use_journal:
+            changes = _node_changes(self._deployment, deployment)
+            changed, removed = changes
+            # Only the changes are logged, since logging the whole
+            # configuration costs as much as writing it out:
+            action = _LOG_SAVE_CHANGES(
+                self.logger, changed=changed, removed=removed)
+        else:
+            changes = None
+            action = _LOG_SAVE(self.logger, configuration=deployment)
+        if self._writer is not None:
+            with action.context():
+                self._deployment = deployment
+                saving = DeferredContext(self._queue(deployment, changes))
+                return saving.addActionFinish()
+        with action:
+            self._write(deployment, [changes])
+            self._deployment = self._durable_deployment = deployment
             # At some future point this will likely involve talking to a
             # distributed system (e.g. ZooKeeper or etcd), so the API doesn't
             # guarantee immediate saving of the data.
-            for callback in self._change_callbacks:
-                try:
-                    callback()
-                except:
-                    # Second argument will be ignored in next Eliot release, so
-                    # not bothering with particular value.
-                    write_traceback(self.logger, u"")
+            self._configuration_changed()
             return succeed(None)
 
     def get(self):
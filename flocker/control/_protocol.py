@@ -17,15 +17,24 @@ Interactions:
 * The control service caches the current state of all nodes. Whenever the
   control service receives an update to the state of a specific node via a
   NodeStateCommand, the control service then aggregates that update with
-  the rest of the nodes' state and sends a ClusterStatusCommand to all
-  convergence agents.
+  the rest of the nodes' state and notifies all convergence agents.
+
+Every combination of configuration and state sent to agents is labeled
+with an increasing generation number. A newly connected agent is sent the
+full configuration and state using ClusterStatusCommand. Afterwards the
+agent is only sent the nodes that changed since the generation it last
+successfully received, using ClusterStatusDeltaCommand. If the agent does
+not have the base generation of a delta it responds with an error, and the
+control service falls back to sending the full configuration and state.
 
 Eliot contexts are transferred along with AMP commands, allowing tracing
 of logged actions across processes (see
 http://eliot.readthedocs.org/en/0.6.0/threads.html).
 """
 
-from eliot import Logger, ActionType, Action, Field
+from collections import OrderedDict
+
+from eliot import Logger, ActionType, Action, Field, MessageType
 from eliot.twisted import DeferredContext
 
 from characteristic import with_cmp
@@ -34,37 +43,172 @@ from zope.interface import Interface, Attribute
 
 from twisted.application.service import Service
 from twisted.protocols.amp import (
-    Argument, Command, Integer, CommandLocator, AMP, Unicode,
+    Argument, Command, Integer, CommandLocator, AMP, Unicode, ListOf,
+    MAX_VALUE_LENGTH,
 )
 from twisted.internet.protocol import ServerFactory
 from twisted.application.internet import StreamServerEndpointService
 
-from ._persistence import wire_encode, wire_decode
-from ._model import Deployment, NodeState, DeploymentState
+from ._persistence import (
+    wire_encode, wire_decode, wire_encode_chunks, wire_decode_chunks,
+    JSON_CODEC,
+)
+from ._model import (
+    Deployment, NodeState, DeploymentState, _node_changes, _apply_node_changes,
+)
+
+
+def _chunk_key(name, index):
+    """
+    The AMP box key used for a particular chunk of a chunked argument.
+
+    :param bytes name: The name of the argument.
+    :param int index: The index of the chunk.
+
+    :return bytes: The key. The first chunk uses the argument name, so a
+        value that fits in one chunk is encoded the same as a normal
+        argument.
+    """
+    if index == 0:
+        return name
+    return b"%s.%d" % (name, index)
+
+
+class EncodingCache(object):
+    """
+    Cache of the serialized form of recently encoded objects, keyed on
+    object identity.
+
+    The control service sends the same immutable configuration and state
+    objects to every connected agent, so this allows a broadcast to
+    serialize them once rather than once per connection.  A reference to
+    each cached object is kept, so its identity cannot be reused by a
+    different object while it is in the cache.
+
+    :ivar int hits: The number of lookups that found an existing encoding.
+    :ivar int misses: The number of lookups that required encoding.
+    """
+    def __init__(self, size):
+        """
+        :param int size: The maximum number of objects to cache.
+        """
+        self._size = size
+        # (id(obj), chunk_size, codec name) -> (obj, chunks), least recently
+        # used first:
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def encode_chunks(self, obj, chunk_size, codec):
+        """
+        Encode an object as ``wire_encode_chunks`` would, reusing a
+        previous encoding of the same object if possible.
+
+        :param obj: An object from the configuration model.
+        :param int chunk_size: The maximum length of each chunk.
+        :param codec: The codec to encode with.
+
+        :return: ``list`` of ``bytes``.
+        """
+        key = (id(obj), chunk_size, codec.name)
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            entry = (obj, list(wire_encode_chunks(obj, chunk_size, codec)))
+            if len(self._entries) >= self._size:
+                self._entries.popitem(last=False)
+        else:
+            self.hits += 1
+        self._entries[key] = entry
+        return entry[1]
+
+
+# Shared by all ``SerializableArgument`` instances, since the same object
+# may be sent using different commands, e.g. a full configuration to a new
+# agent and a delta to the others:
+ENCODING_CACHE = EncodingCache(size=16)
 
 
 class SerializableArgument(Argument):
     """
     AMP argument that takes an object that can be serialized by the
     configuration persistence layer.
+
+    AMP limits a single value to ``MAX_VALUE_LENGTH`` bytes, so the
+    serialized object is split across as many keys in the box as
+    necessary: ``name``, ``name.1``, ``name.2`` and so on.  The chunks are
+    encoded and decoded incrementally, so the whole serialized object is
+    never held as a single string.
+
+    The serialized form is cached in ``ENCODING_CACHE``, so sending the same
+    object to many connections only serializes it once.
+
+    Objects are encoded with the codec given to the argument, or if there is
+    none with the ``codec`` attribute of the protocol they are sent over,
+    falling back to ``JSON_CODEC``.  Objects are decoded regardless of which
+    codec was used to encode them.
     """
-    def __init__(self, cls):
+    def __init__(self, cls, chunk_size=MAX_VALUE_LENGTH, codec=None):
         """
         :param cls: The type of the objects we expect to (de)serialize.
+        :param int chunk_size: The maximum size of a single value in the box.
+        :param codec: The codec to encode objects with, or ``None`` to use
+            the protocol's.
         """
         Argument.__init__(self)
         self._expected_class = cls
+        self._chunk_size = chunk_size
+        self._codec = codec
 
-    def fromString(self, in_bytes):
-        obj = wire_decode(in_bytes)
+    def _check_type(self, obj):
         if not isinstance(obj, self._expected_class):
             raise TypeError("{} is not a {}".format(obj, self._expected_class))
+
+    def fromString(self, in_bytes):
+        obj = wire_decode(in_bytes)
+        self._check_type(obj)
         return obj
 
+    def _codec_for(self, proto):
+        """
+        :param proto: The protocol an object is being sent over, or ``None``.
+        :return: The codec to encode the object with.
+        """
+        if self._codec is not None:
+            return self._codec
+        return getattr(proto, "codec", None) or JSON_CODEC
+
     def toString(self, obj):
-        if not isinstance(obj, self._expected_class):
-            raise TypeError("{} is not a {}".format(obj, self._expected_class))
-        return wire_encode(obj)
+        self._check_type(obj)
+        return wire_encode(obj, self._codec_for(None))
+
+    def _chunks(self, name, strings):
+        """
+        Remove the chunks of an argument from a box as they are needed.
+
+        :param bytes name: The name of the argument.
+        :param dict strings: The box.
+
+        :return: Iterator of ``bytes``.
+        """
+        yield strings.pop(name)
+        index = 1
+        while _chunk_key(name, index) in strings:
+            yield strings.pop(_chunk_key(name, index))
+            index += 1
+
+    def fromBox(self, name, strings, objects, proto):
+        obj = wire_decode_chunks(self._chunks(name, strings))
+        self._check_type(obj)
+        objects[name] = obj
+
+    def toBox(self, name, strings, objects, proto):
+        obj = objects.pop(name)
+        self._check_type(obj)
+        for index, chunk in enumerate(
+                ENCODING_CACHE.encode_chunks(
+                    obj, self._chunk_size, self._codec_for(proto))):
+            strings[_chunk_key(name, index)] = chunk
 
 
 class _EliotActionArgument(Unicode):
@@ -80,6 +224,13 @@ class _EliotActionArgument(Unicode):
         return inObject.serialize_task_id()
 
 
+class GenerationMismatch(Exception):
+    """
+    A delta was received whose base generation does not match the
+    generation the receiver currently knows about.
+    """
+
+
 class VersionCommand(Command):
     """
     Return configuration protocol version of the control service.
@@ -100,8 +251,29 @@ class ClusterStatusCommand(Command):
     """
     arguments = [('configuration', SerializableArgument(Deployment)),
                  ('state', SerializableArgument(DeploymentState)),
+                 ('generation', Integer()),
+                 ('eliot_context', _EliotActionArgument())]
+    response = []
+
+
+class ClusterStatusDeltaCommand(Command):
+    """
+    Used by the control service to inform a convergence agent of changes
+    to the cluster state and desired configuration since a generation the
+    agent has already received.
+
+    The changed nodes are sent in their entirety; nodes that were not
+    changed are not sent at all.
+    """
+    arguments = [('base_generation', Integer()),
+                 ('generation', Integer()),
+                 ('configuration_changes', SerializableArgument(Deployment)),
+                 ('configuration_removals', ListOf(Unicode())),
+                 ('state_changes', SerializableArgument(DeploymentState)),
+                 ('state_removals', ListOf(Unicode())),
                  ('eliot_context', _EliotActionArgument())]
     response = []
+    errors = {GenerationMismatch: b"GENERATION_MISMATCH"}
 
 
 class NodeStateCommand(Command):
@@ -132,7 +304,7 @@ class ControlServiceLocator(CommandLocator):
 
     @VersionCommand.responder
     def version(self):
-        return {"major": 1}
+        return {"major": 2}
 
     @NodeStateCommand.responder
     def node_changed(self, eliot_context, node_state):
@@ -144,6 +316,8 @@ class ControlServiceLocator(CommandLocator):
 class ControlAMP(AMP):
     """
     AMP protocol for control service server.
+
+    :ivar codec: The codec configuration and state are sent to agents with.
     """
     def __init__(self, control_amp_service):
         """
@@ -152,6 +326,7 @@ class ControlAMP(AMP):
         """
         AMP.__init__(self, locator=ControlServiceLocator(control_amp_service))
         self.control_amp_service = control_amp_service
+        self.codec = control_amp_service.codec
 
     def connectionMade(self):
         AMP.connectionMade(self)
@@ -174,31 +349,86 @@ LOG_SEND_CLUSTER_STATE = ActionType(
     "Send the configuration and state of the cluster to all agents.")
 
 AGENT = Field(u"agent", repr, u"The agent we're sending to")
+GENERATION = Field.forTypes(
+    u"generation", [int, long],
+    u"The generation of configuration and state being sent.")
+BASE_GENERATION = Field.forTypes(
+    u"base_generation", [int, long, None],
+    u"The generation the agent is known to have, or ``None`` if the full "
+    u"configuration and state are being sent.")
 
 LOG_SEND_TO_AGENT = ActionType(
     "flocker:controlservice:send_state_to_agent",
-    [AGENT],
+    [AGENT, GENERATION, BASE_GENERATION],
     [],
     "Send the configuration and state of the cluster to a specific agent.")
 
+LOG_COALESCED_NODE_UPDATES = MessageType(
+    "flocker:controlservice:coalesced_node_updates",
+    [Field.forTypes(u"updates", [int, long],
+                    u"The number of node state updates sent to agents "
+                    u"as a single broadcast.")],
+    "Several node state updates received during the coalescing interval "
+    "are being sent to agents.")
+
 
 class ControlAMPService(Service):
     """
     Control Service AMP server.
 
     Convergence agents connect to this server.
+
+    Node state updates can be coalesced: rather than notifying agents
+    every time a single node reports its state, updates arriving within a
+    short interval are combined into a single broadcast.
+
+    :ivar int generation: The generation of the most recent configuration
+        and state sent to agents.
+    :ivar codec: The codec configuration and state are sent to agents with.
+    :ivar int node_updates: The number of node state updates received.
+    :ivar int coalesced_updates: The number of node state updates that were
+        merged into a broadcast already scheduled by an earlier update.
+    :ivar int broadcasts: The number of broadcasts triggered by node state
+        updates.
     """
     logger = Logger()
 
-    def __init__(self, cluster_state, configuration_service, endpoint):
+    def __init__(self, cluster_state, configuration_service, endpoint,
+                 history_size=100, reactor=None, coalesce_interval=0,
+                 codec=JSON_CODEC):
         """
         :param ClusterStateService cluster_state: Object that records known
             cluster state.
         :param ConfigurationPersistenceService configuration_service:
             Persistence service for desired cluster configuration.
         :param endpoint: Endpoint to listen on.
+        :param int history_size: The number of past generations to remember
+            for the purpose of sending deltas.  Agents that are further
+            behind than this will be sent full configuration and state.
+        :param IReactorTime reactor: Used to schedule coalesced
+            broadcasts. Only required if ``coalesce_interval`` is positive.
+        :param float coalesce_interval: Number of seconds to wait after a
+            node state update before notifying agents, during which further
+            updates are merged into the same broadcast. If zero, agents are
+            notified immediately on every update.
+        :param codec: The codec to send configuration and state to agents
+            with, e.g. ``JSON_CODEC`` or ``COMPACT_CODEC``.
         """
         self.connections = set()
+        self.codec = codec
+        self._reactor = reactor
+        self._coalesce_interval = coalesce_interval
+        self._pending_broadcast = None
+        self._pending_updates = 0
+        self.node_updates = 0
+        self.coalesced_updates = 0
+        self.broadcasts = 0
+        self.generation = 0
+        # Generation -> (configuration, state):
+        self._history = OrderedDict()
+        self._history_size = history_size
+        # Connection -> generation last sent to it:
+        self._connection_generations = {}
         self.cluster_state = cluster_state
         self.configuration_service = configuration_service
         self.endpoint_service = StreamServerEndpointService(
@@ -212,31 +442,129 @@ class ControlAMPService(Service):
 
     def stopService(self):
         self.endpoint_service.stopService()
+        if self._pending_broadcast is not None:
+            self._pending_broadcast.cancel()
+            self._pending_broadcast = None
         for connection in self.connections:
             connection.transport.loseConnection()
 
+    def _record_generation(self, configuration, state):
+        """
+        Make sure the given configuration and state are recorded in the
+        history, allocating a new generation if they differ from the most
+        recent one.
+
+        :param Deployment configuration: The desired configuration.
+        :param DeploymentState state: The cluster state.
+
+        :return int: The generation of the given configuration and state.
+        """
+        if self._history:
+            last_configuration, last_state = self._history[self.generation]
+            if ((last_configuration is configuration or
+                 last_configuration == configuration) and
+                    (last_state is state or last_state == state)):
+                return self.generation
+        self.generation += 1
+        self._history[self.generation] = (configuration, state)
+        while len(self._history) > self._history_size:
+            self._history.popitem(last=False)
+        return self.generation
+
+    def _delta_arguments(self, base_generation, configuration, state):
+        """
+        Calculate the arguments for a ``ClusterStatusDeltaCommand``.
+
+        :param int base_generation: The generation the agent already has.
+        :param Deployment configuration: The desired configuration.
+        :param DeploymentState state: The cluster state.
+
+        :return dict: Keyword arguments for the command, excluding the
+            generations and the Eliot context.
+        """
+        base_configuration, base_state = self._history[base_generation]
+        configuration_changes, configuration_removals = _node_changes(
+            base_configuration, configuration)
+        state_changes, state_removals = _node_changes(base_state, state)
+        return dict(
+            configuration_changes=Deployment(nodes=configuration_changes),
+            configuration_removals=configuration_removals,
+            state_changes=DeploymentState(nodes=state_changes),
+            state_removals=state_removals)
+
     def _send_state_to_connections(self, connections):
         """
         Send desired configuration and cluster state to all given connections.
 
+        Connections that have successfully received an earlier generation
+        that is still in the history are only sent the changes since then.
+        Connections that already have the current generation are skipped.
+
         :param connections: A collection of ``AMP`` instances.
         """
         configuration = self.configuration_service.get()
         state = self.cluster_state.as_deployment()
+        generation = self._record_generation(configuration, state)
+        # Many connections will share the same base generation, so only
+        # calculate each delta once:
+        deltas = {}
         with LOG_SEND_CLUSTER_STATE(self.logger,
                                     configuration=configuration,
                                     state=state):
             for connection in connections:
-                action = LOG_SEND_TO_AGENT(self.logger, agent=connection)
+                base_generation = self._connection_generations.get(
+                    connection)
+                if base_generation == generation:
+                    continue
+                if base_generation not in self._history:
+                    base_generation = None
+                action = LOG_SEND_TO_AGENT(
+                    self.logger, agent=connection, generation=generation,
+                    base_generation=base_generation)
                 with action.context():
-                    d = DeferredContext(connection.callRemote(
-                        ClusterStatusCommand,
-                        configuration=configuration,
-                        state=state,
-                        eliot_context=action
-                    ))
+                    self._connection_generations[connection] = generation
+                    if base_generation is None:
+                        result = connection.callRemote(
+                            ClusterStatusCommand,
+                            configuration=configuration,
+                            state=state,
+                            generation=generation,
+                            eliot_context=action
+                        )
+                    else:
+                        if base_generation not in deltas:
+                            deltas[base_generation] = self._delta_arguments(
+                                base_generation, configuration, state)
+                        result = connection.callRemote(
+                            ClusterStatusDeltaCommand,
+                            base_generation=base_generation,
+                            generation=generation,
+                            eliot_context=action,
+                            **deltas[base_generation]
+                        )
+                    d = DeferredContext(result)
                     d.addActionFinish()
-                    d.result.addErrback(lambda _: None)
+                    d.result.addErrback(
+                        self._send_failed, connection, generation)
+
+    def _send_failed(self, failure, connection, generation):
+        """
+        Sending configuration and state to an agent failed.
+
+        The agent's generation is forgotten so that it will be sent the
+        full configuration and state next time.  If the failure was due to
+        the agent not having the base generation of a delta, the full
+        configuration and state are sent immediately.
+
+        :param Failure failure: The reason the send failed.
+        :param ControlAMP connection: The connection the send failed on.
+        :param int generation: The generation that was being sent.
+        """
+        if self._connection_generations.get(connection) == generation:
+            del self._connection_generations[connection]
+            if (failure.check(GenerationMismatch) and
+                    connection in self.connections):
+                self._send_state_to_connections([connection])
 
     def connected(self, connection):
         """
@@ -254,6 +582,7 @@ class ControlAMPService(Service):
         :param ControlAMP connection: The lost connection.
         """
         self.connections.remove(connection)
+        self._connection_generations.pop(connection, None)
 
     def node_changed(self, node_state):
         """
@@ -263,6 +592,27 @@ class ControlAMPService(Service):
         :param NodeState node_state: The changed state for the node.
         """
         self.cluster_state.update_node_state(node_state)
+        self.node_updates += 1
+        self._pending_updates += 1
+        if self._coalesce_interval <= 0:
+            self._broadcast_node_updates()
+        elif self._pending_broadcast is None:
+            self._pending_broadcast = self._reactor.callLater(
+                self._coalesce_interval, self._broadcast_node_updates)
+        else:
+            self.coalesced_updates += 1
+
+    def _broadcast_node_updates(self):
+        """
+        Notify all connected agents of node state updates received since
+        the last broadcast.
+        """
+        self._pending_broadcast = None
+        self.broadcasts += 1
+        if self._pending_updates > 1:
+            LOG_COALESCED_NODE_UPDATES(
+                updates=self._pending_updates).write(self.logger)
+        self._pending_updates = 0
         self._send_state_to_connections(self.connections)
 
 
@@ -302,6 +652,10 @@ class IConvergenceAgent(Interface):
 class _AgentLocator(CommandLocator):
     """
     Command locator for convergence agent.
+
+    :ivar generation: The generation of the most recently received
+        configuration and state, or ``None`` if nothing has been received
+        yet.
     """
     def __init__(self, agent):
         """
@@ -309,6 +663,9 @@ class _AgentLocator(CommandLocator):
         """
         CommandLocator.__init__(self)
         self.agent = agent
+        self.generation = None
+        self._configuration = None
+        self._state = None
 
     @property
     def logger(self):
@@ -317,10 +674,38 @@ class _AgentLocator(CommandLocator):
         """
         return self.agent.logger
 
+    def _update(self, generation, configuration, state):
+        """
+        Record a new generation and notify the agent.
+        """
+        self.generation = generation
+        self._configuration = configuration
+        self._state = state
+        self.agent.cluster_updated(configuration, state)
+
     @ClusterStatusCommand.responder
-    def cluster_updated(self, eliot_context, configuration, state):
+    def cluster_updated(self, eliot_context, configuration, state,
+                        generation):
+        with eliot_context:
+            self._update(generation, configuration, state)
+            return {}
+
+    @ClusterStatusDeltaCommand.responder
+    def cluster_changed(self, eliot_context, base_generation, generation,
+                        configuration_changes, configuration_removals,
+                        state_changes, state_removals):
         with eliot_context:
-            self.agent.cluster_updated(configuration, state)
+            if self.generation is None or base_generation != self.generation:
+                raise GenerationMismatch(
+                    "Have generation {} but delta is based on {}".format(
+                        self.generation, base_generation))
+            self._update(
+                generation,
+                _apply_node_changes(
+                    self._configuration, configuration_changes.nodes,
+                    configuration_removals),
+                _apply_node_changes(
+                    self._state, state_changes.nodes, state_removals))
             return {}
 
 
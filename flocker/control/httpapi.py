@@ -380,10 +380,8 @@ class ConfigurationAPIUserV1(object):
             ("manifestations", dataset_id), discard)
         deployment = deployment.update_node(new_origin_node)
 
-        primary_nodes = list(
-            node for node in deployment.nodes if primary == node.hostname
-        )
-        if len(primary_nodes) == 0:
+        target_node = deployment.get_node(primary)
+        if target_node is None:
             # `primary` is not in cluster. Add it.
             # XXX Check cluster state to determine if the given primary node
             # actually exists.  If not, raise PRIMARY_NODE_NOT_FOUND.
@@ -393,9 +391,6 @@ class ConfigurationAPIUserV1(object):
                 manifestations={dataset_id: primary_manifestation},
             )
         else:
-            # There should only be one node with the requested primary
-            # hostname. ``ValueError`` here if that's not the case.
-            (target_node,) = primary_nodes
             new_target_node = target_node.transform(
                 ("manifestations", dataset_id), primary_manifestation)
 
@@ -809,9 +804,7 @@ def manifestations_from_deployment(deployment, dataset_id):
     :return: Iterable returning all manifestations of the supplied
         ``dataset_id``.
     """
-    for node in deployment.nodes:
-        if dataset_id in node.manifestations:
-                yield node.manifestations[dataset_id], node
+    return deployment.get_manifestations(dataset_id)
 
 
 def datasets_from_deployment(deployment):
@@ -11,13 +11,30 @@ from twisted.python.filepath import FilePath
 from twisted.application.service import MultiService
 
 from .httpapi import create_api_service, REST_API_PORT
-from ._persistence import ConfigurationPersistenceService
+from ._persistence import ConfigurationPersistenceService, CODECS
 from ._clusterstate import ClusterStateService
 from ..common.script import (
     flocker_standard_options, FlockerScriptRunner, main_for_service)
 from ._protocol import ControlAMPService
 
 
+def _codec(name):
+    """
+    Look up a configuration codec by name.
+
+    :param bytes name: The name of the codec.
+
+    :raise ValueError: If there is no such codec.
+
+    :return: The codec.
+    """
+    try:
+        return CODECS[name.decode("ascii")]
+    except (KeyError, UnicodeDecodeError):
+        raise ValueError("Unknown format; choose from: {}".format(
+            ", ".join(sorted(CODECS))))
+
+
 @flocker_standard_options
 class ControlOptions(Options):
     """
@@ -30,6 +47,26 @@ class ControlOptions(Options):
          "The external API port to listen on."],
         ["agent-port", "a", 'tcp:4524',
          "The port convergence agents will connect to."],
+        ["coalesce-interval", None, 0.0,
+         "Seconds during which node state updates are combined into a "
+         "single notification to convergence agents.  By default every "
+         "update is sent immediately.", float],
+        ["configuration-format", None, CODECS[u"json"],
+         "The format used to store the configuration: json or compact.",
+         _codec],
+        ["agent-format", None, CODECS[u"json"],
+         "The format used to send configuration and state to convergence "
+         "agents: json or compact.", _codec],
+        ["configuration-commit-interval", None, None,
+         "If given, configuration is written to disk in a separate thread, "
+         "and changes made within this many seconds of each other are "
+         "written together.", float],
+    ]
+
+    optFlags = [
+        ["journal-configuration", None,
+         "Record configuration changes in an append-only journal instead "
+         "of rewriting the whole configuration on every change."],
     ]
 
 
@@ -41,7 +78,10 @@ class ControlScript(object):
     def main(self, reactor, options):
         top_service = MultiService()
         persistence = ConfigurationPersistenceService(
-            reactor, options["data-path"])
+            reactor, options["data-path"],
+            codec=options["configuration-format"],
+            journal=options["journal-configuration"],
+            commit_interval=options["configuration-commit-interval"])
         persistence.setServiceParent(top_service)
         cluster_state = ClusterStateService()
         cluster_state.setServiceParent(top_service)
@@ -49,7 +89,10 @@ class ControlScript(object):
             reactor, options["port"])).setServiceParent(top_service)
         amp_service = ControlAMPService(
             cluster_state, persistence, serverFromString(
-                reactor, options["agent-port"]))
+                reactor, options["agent-port"]),
+            reactor=reactor,
+            coalesce_interval=options["coalesce-interval"],
+            codec=options["agent-format"])
         amp_service.setServiceParent(top_service)
         return main_for_service(reactor, top_service)
 
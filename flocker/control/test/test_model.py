@@ -15,7 +15,8 @@ from ...testtools import make_with_init_tests
 from .._model import (
     Application, DockerImage, Node, Deployment, AttachedVolume, Dataset,
     RestartOnFailure, RestartAlways, RestartNever, Manifestation,
-    NodeState, pset_field, pmap_field, DeploymentState
+    NodeState, pset_field, pmap_field, DeploymentState, _node_changes,
+    _apply_node_changes,
 )
 
 
@@ -261,6 +262,15 @@ class DeploymentTests(SynchronousTestCase):
     """
     Tests for ``Deployment``.
     """
+    def test_duplicate_hostnames(self):
+        """
+        A ``Deployment`` can't have two nodes with the same hostname.
+        """
+        node = Node(hostname=u"node1.example.com")
+        self.assertRaises(
+            ValueError, Deployment,
+            nodes=[node, node.set("applications", [APP1])])
+
     def test_applications(self):
         """
         ``Deployment.applications()`` returns applications from all nodes.
@@ -335,6 +345,67 @@ class DeploymentTests(SynchronousTestCase):
                           Deployment(nodes=frozenset([
                               updated_node, another_node]))))
 
+    def test_get_node(self):
+        """
+        ``get_node`` returns the ``Node`` with the given hostname.
+        """
+        node = Node(hostname=u"node1.example.com", applications={APP1})
+        another_node = Node(hostname=u"node2.example.com")
+        deployment = Deployment(nodes=[node, another_node])
+        self.assertEqual(
+            (deployment.get_node(u"node1.example.com"),
+             deployment.get_node(u"node3.example.com")),
+            (node, None))
+
+    def test_get_node_after_update(self):
+        """
+        ``get_node`` on the result of ``update_node`` returns the updated
+        ``Node``.
+        """
+        node = Node(hostname=u"node1.example.com")
+        updated_node = Node(hostname=u"node1.example.com",
+                            applications={APP1})
+        deployment = Deployment(nodes=[node])
+        deployment.get_node(u"node1.example.com")
+        self.assertEqual(
+            deployment.update_node(updated_node).get_node(
+                u"node1.example.com"),
+            updated_node)
+
+    def test_get_manifestations(self):
+        """
+        ``get_manifestations`` returns the manifestations of the given
+        dataset together with the ``Node`` each is on.
+        """
+        replica = MANIFESTATION.set(primary=False)
+        node = Node(hostname=u"node1.example.com",
+                    manifestations={MANIFESTATION.dataset_id: MANIFESTATION})
+        another_node = Node(hostname=u"node2.example.com",
+                            manifestations={replica.dataset_id: replica})
+        deployment = Deployment(nodes=[node, another_node])
+        self.assertEqual(
+            (set(deployment.get_manifestations(MANIFESTATION.dataset_id)),
+             list(deployment.get_manifestations(u"unknown"))),
+            ({(MANIFESTATION, node), (replica, another_node)}, []))
+
+    def test_get_manifestations_after_update(self):
+        """
+        ``get_manifestations`` on the result of ``update_node`` reflects
+        manifestations added to and removed from the updated ``Node``.
+        """
+        node = Node(hostname=u"node1.example.com",
+                    manifestations={MANIFESTATION.dataset_id: MANIFESTATION})
+        another_node = Node(hostname=u"node2.example.com")
+        deployment = Deployment(nodes=[node, another_node])
+        list(deployment.get_manifestations(MANIFESTATION.dataset_id))
+        moved_to = another_node.set(
+            "manifestations", {MANIFESTATION.dataset_id: MANIFESTATION})
+        updated = deployment.update_node(
+            node.set("manifestations", {})).update_node(moved_to)
+        self.assertEqual(
+            list(updated.get_manifestations(MANIFESTATION.dataset_id)),
+            [(MANIFESTATION, moved_to)])
+
     def test_move_application(self):
         """
         Moving an ``Application`` from one node to another results in a new
@@ -621,6 +692,159 @@ class PSetFieldTests(SynchronousTestCase):
                  Record().value2.__class__.__name__) ==
                 ("SomethingPSet", "IntPSet"))
 
+    def test_derived_set_not_rebuilt(self):
+        """
+        Setting a field to a set derived from the field's existing value
+        stores that set as is.
+        """
+        class Record(PRecord):
+            value = pset_field(int)
+        record = Record(value=[1, 2])
+        new_value = record.value.add(3)
+        assert record.set("value", new_value).value is new_value
+
+
+class IndexedPSetFieldTests(SynchronousTestCase):
+    """
+    Tests for ``pset_field`` with ``index_by``.
+    """
+    def setUp(self):
+        class Record(PRecord):
+            value = pset_field(Node, index_by="hostname")
+        self.record_class = Record
+        self.node = Node(hostname=u"node1.example.com")
+        self.another_node = Node(hostname=u"node2.example.com")
+
+    def test_lookup(self):
+        """
+        ``lookup`` finds the item with the given key.
+        """
+        record = self.record_class(value=[self.node, self.another_node])
+        self.assertIs(record.value.lookup(u"node2.example.com"),
+                      self.another_node)
+
+    def test_lookup_missing(self):
+        """
+        ``lookup`` returns the given default if no item has the given key.
+        """
+        record = self.record_class(value=[self.node])
+        marker = object()
+        self.assertEqual(
+            (record.value.lookup(u"node2.example.com"),
+             record.value.lookup(u"node2.example.com", marker)),
+            (None, marker))
+
+    def test_lookup_after_add(self):
+        """
+        ``lookup`` on a set created by ``add`` finds the added item, whether
+        or not the original set had been indexed.
+        """
+        value = self.record_class(value=[self.node]).value
+        unindexed = type(value)([self.node]).add(self.another_node)
+        indexed = value.add(self.another_node)
+        self.assertEqual(
+            (unindexed.lookup(u"node2.example.com"),
+             indexed.lookup(u"node2.example.com"),
+             indexed.lookup(u"node1.example.com")),
+            (self.another_node, self.another_node, self.node))
+
+    def test_lookup_after_discard(self):
+        """
+        ``lookup`` on a set created by ``discard`` or ``remove`` does not
+        find the removed item.
+        """
+        value = self.record_class(value=[self.node, self.another_node]).value
+        value.lookup(u"node1.example.com")
+        self.assertEqual(
+            (value.discard(self.node).lookup(u"node1.example.com"),
+             value.remove(self.node).lookup(u"node1.example.com"),
+             value.discard(self.node).lookup(u"node2.example.com")),
+            (None, None, self.another_node))
+
+    def test_discard_other_item_with_same_key(self):
+        """
+        Discarding an item which is not in the set leaves the item with the
+        same key indexed.
+        """
+        value = self.record_class(value=[self.node]).value
+        value.lookup(u"node1.example.com")
+        other = self.node.set(
+            "applications", [APP1]).set("manifestations", {})
+        self.assertIs(value.discard(other).lookup(u"node1.example.com"),
+                      self.node)
+
+    def test_duplicate_key(self):
+        """
+        Creating a set with two items which have the same key raises
+        ``ValueError``.
+        """
+        other = self.node.set(
+            "applications", [APP1]).set("manifestations", {})
+        self.assertRaises(
+            ValueError, self.record_class, value=[self.node, other])
+
+    def test_add_duplicate_key(self):
+        """
+        Adding an item with the same key as an item already in the set
+        raises ``ValueError``.
+        """
+        value = self.record_class(value=[self.node]).value
+        other = self.node.set(
+            "applications", [APP1]).set("manifestations", {})
+        self.assertRaises(ValueError, value.add, other)
+
+    def test_lookup_duplicate_key(self):
+        """
+        ``lookup`` on a set which was not indexed when an item with a
+        duplicate key was added to it raises ``ValueError``.
+        """
+        value = self.record_class(value=[self.node]).value
+        other = self.node.set(
+            "applications", [APP1]).set("manifestations", {})
+        unindexed = type(value)([self.node]).add(other)
+        self.assertRaises(ValueError, unindexed.lookup, u"node1.example.com")
+
+    def test_equality(self):
+        """
+        Indexed sets compare equal regardless of whether they have been
+        indexed.
+        """
+        first = self.record_class(value=[self.node])
+        second = self.record_class(value=[self.node])
+        first.value.lookup(u"node1.example.com")
+        self.assertEqual(first, second)
+
+    def test_index(self):
+        """
+        ``index`` returns the named index, built by the description passed
+        to ``pset_field`` and updated as items are added and removed.
+        """
+        class Lengths(object):
+            def build(self, items):
+                return pmap({item: len(item) for item in items})
+
+            def add(self, index, item):
+                return index.set(item, len(item))
+
+            def remove(self, index, item):
+                return index.discard(item)
+
+        class Record(PRecord):
+            value = pset_field(unicode, indexes={"length": Lengths()})
+        value = Record(value=[u"a", u"bb"]).value
+        built = value.index("length")
+        derived = value.add(u"ccc").discard(u"a")
+        self.assertEqual((built, derived.index("length")),
+                         ({u"a": 1, u"bb": 2}, {u"bb": 2, u"ccc": 3}))
+
+    def test_unindexed_has_no_lookup(self):
+        """
+        Sets created without ``index_by`` have no ``lookup`` method.
+        """
+        class Record(PRecord):
+            value = pset_field(Node)
+        self.assertFalse(hasattr(Record().value, "lookup"))
+
 
 class PMapFieldTests(SynchronousTestCase):
     """
@@ -726,6 +950,15 @@ class DeploymentStateTests(SynchronousTestCase):
     """
     Tests for ``DeploymentState``.
     """
+    def test_duplicate_hostnames(self):
+        """
+        A ``DeploymentState`` can't have two nodes with the same hostname.
+        """
+        node = NodeState(hostname=u"node1.example.com")
+        self.assertRaises(
+            ValueError, DeploymentState,
+            nodes=[node, node.set("used_ports", [80])])
+
     def test_update_node_new(self):
         """
         When doing ``update_node()``, if the given ``NodeState`` has hostname
@@ -785,3 +1018,88 @@ class DeploymentStateTests(SynchronousTestCase):
         updated = original.update_node(update_applications).update_node(
             update_manifestations)
         self.assertEqual(updated, DeploymentState(nodes=[end_node]))
+
+    def test_get_node(self):
+        """
+        ``get_node`` returns the ``NodeState`` with the given hostname, or
+        the given default if there is none.
+        """
+        node = NodeState(hostname=u"node1.example.com", used_ports=[1])
+        state = DeploymentState(nodes=[node])
+        self.assertEqual(
+            (state.get_node(u"node1.example.com"),
+             state.get_node(u"node2.example.com", default=1)),
+            (node, 1))
+
+    def test_get_node_after_update(self):
+        """
+        ``get_node`` on the result of ``update_node`` returns the merged
+        ``NodeState``.
+        """
+        state = DeploymentState(
+            nodes=[NodeState(hostname=u"node1.example.com", used_ports=[1])])
+        state.get_node(u"node1.example.com")
+        updated = state.update_node(
+            NodeState(hostname=u"node1.example.com", applications=[APP1],
+                      used_ports=None))
+        self.assertEqual(
+            updated.get_node(u"node1.example.com"),
+            NodeState(hostname=u"node1.example.com", used_ports=[1],
+                      applications=[APP1]))
+
+    def test_get_manifestations(self):
+        """
+        ``get_manifestations`` returns the manifestations of the given
+        dataset together with the ``NodeState`` each is on, ignoring nodes
+        whose manifestations are unknown.
+        """
+        node = NodeState(
+            hostname=u"node1.example.com",
+            manifestations={MANIFESTATION.dataset_id: MANIFESTATION})
+        unknown = NodeState(hostname=u"node2.example.com",
+                            manifestations=None)
+        state = DeploymentState(nodes=[node, unknown])
+        self.assertEqual(
+            list(state.get_manifestations(MANIFESTATION.dataset_id)),
+            [(MANIFESTATION, node)])
+
+
+class NodeChangesTests(SynchronousTestCase):
+    """
+    Tests for ``_node_changes`` and ``_apply_node_changes``.
+    """
+    def test_unchanged(self):
+        """
+        Identical deployments have no changes.
+        """
+        deployment = Deployment(
+            nodes=[Node(hostname=u"192.0.2.1", applications=[APP1])])
+        self.assertEqual(_node_changes(deployment, deployment), ([], []))
+
+    def test_changes(self):
+        """
+        Added and modified nodes are returned as changes, nodes missing
+        from the new deployment are returned as removals.
+        """
+        original = NodeState(hostname=u"192.0.2.3", applications=[APP1])
+        added = NodeState(hostname=u"192.0.2.2")
+        modified = original.set(used_ports=[1, 2, 3])
+        old = DeploymentState(nodes=[original,
+                                     NodeState(hostname=u"192.0.2.1")])
+        new = DeploymentState(nodes=[modified, added])
+        changed, removed = _node_changes(old, new)
+        self.assertEqual((set(changed), removed),
+                         ({added, modified}, [u"192.0.2.1"]))
+
+    def test_roundtrip(self):
+        """
+        Applying the changes calculated between two deployments to the
+        first results in the second.
+        """
+        old = Deployment(nodes=[Node(hostname=u"192.0.2.1"),
+                                Node(hostname=u"192.0.2.2")])
+        new = Deployment(nodes=[Node(hostname=u"192.0.2.2",
+                                     applications=[APP1]),
+                                Node(hostname=u"192.0.2.3")])
+        self.assertEqual(
+            _apply_node_changes(old, *_node_changes(old, new)), new)
@@ -4,23 +4,33 @@
 Tests for ``flocker.control._persistence``.
 """
 
+from hashlib import sha256
 from uuid import uuid4
 
-from eliot.testing import validate_logging, assertHasMessage, assertHasAction
+from eliot.testing import (
+    validate_logging, assertHasMessage, assertHasAction, LoggedMessage,
+)
 
 from twisted.internet import reactor
+from twisted.internet.defer import gatherResults
+from twisted.python.threadable import isInIOThread
 from twisted.trial.unittest import TestCase, SynchronousTestCase
 from twisted.python.filepath import FilePath
 
-from pyrsistent import PRecord
+from pyrsistent import PRecord, PMap, PSet, field, InvariantException
 
+from ...route import Proxy, OpenPort
+from .. import _persistence
 from .._persistence import (
     ConfigurationPersistenceService, wire_decode, wire_encode,
-    _LOG_SAVE, _LOG_STARTUP,
+    wire_encode_chunks, wire_decode_chunks, _LOG_SAVE, _LOG_STARTUP,
+    JSON_CODEC, COMPACT_CODEC,
+    CODECS, _LOG_COMPACT, _LOG_SAVE_CHANGES, _LOG_GROUP_COMMIT,
     )
 from .._model import (
     Deployment, Application, DockerImage, Node, Dataset, Manifestation,
-    AttachedVolume, SERIALIZABLE_CLASSES)
+    AttachedVolume, SERIALIZABLE_CLASSES, NodeState, DeploymentState, Port,
+    Link, RestartOnFailure)
 
 
 DATASET = Dataset(dataset_id=unicode(uuid4()),
@@ -39,6 +49,13 @@ TEST_DEPLOYMENT = Deployment(
                 manifestations={DATASET.dataset_id: MANIFESTATION})])
 
 
+# A RestartOnFailure with a value its invariant rejects, as it might be
+# encoded by something other than ``wire_encode``:
+INVALID_RESTART_POLICY = wire_encode(
+    RestartOnFailure(maximum_retry_count=1)).replace(
+        b'"maximum_retry_count": 1', b'"maximum_retry_count": -1')
+
+
 class ConfigurationPersistenceServiceTests(TestCase):
     """
     Tests for ``ConfigurationPersistenceService``.
@@ -113,6 +130,104 @@ class ConfigurationPersistenceServiceTests(TestCase):
         d.addCallback(retrieve_in_new_service)
         return d
 
+    def test_persist_compact(self):
+        """
+        A configuration saved by a service configured with the compact codec
+        is written using that codec and can be loaded from a new service.
+        """
+        path = FilePath(self.mktemp())
+        service = ConfigurationPersistenceService(
+            reactor, path, codec=COMPACT_CODEC)
+        service.startService()
+        d = service.save(TEST_DEPLOYMENT)
+        d.addCallback(lambda _: service.stopService())
+
+        def retrieve_in_new_service(_):
+            new_service = self.service(path)
+            self.assertEqual(
+                (path.child(b"current_configuration.v1.json").getContent(),
+                 new_service.get()),
+                (COMPACT_CODEC.encode(TEST_DEPLOYMENT), TEST_DEPLOYMENT))
+        d.addCallback(retrieve_in_new_service)
+        return d
+
+    def test_load_json_with_compact(self):
+        """
+        A service configured with the compact codec can load configuration
+        that was saved as JSON.
+        """
+        path = FilePath(self.mktemp())
+        service = ConfigurationPersistenceService(reactor, path)
+        service.startService()
+        d = service.save(TEST_DEPLOYMENT)
+        d.addCallback(lambda _: service.stopService())
+
+        def retrieve_in_new_service(_):
+            new_service = ConfigurationPersistenceService(
+                reactor, path, codec=COMPACT_CODEC)
+            new_service.startService()
+            self.addCleanup(new_service.stopService)
+            self.assertEqual(new_service.get(), TEST_DEPLOYMENT)
+        d.addCallback(retrieve_in_new_service)
+        return d
+
+    def test_checksum_written(self):
+        """
+        A checksum of the saved configuration is written alongside it.
+        """
+        path = FilePath(self.mktemp())
+        service = self.service(path)
+        d = service.save(TEST_DEPLOYMENT)
+
+        def saved(_):
+            self.assertEqual(
+                path.child(b"current_configuration.v1.sha256").getContent(),
+                sha256(path.child(
+                    b"current_configuration.v1.json").getContent()
+                ).hexdigest())
+        d.addCallback(saved)
+        return d
+
+    def test_matching_checksum_trusted(self):
+        """
+        If the checksum matches the configuration file it is loaded without
+        validation.
+        """
+        path = FilePath(self.mktemp())
+        path.makedirs()
+        path.child(b"current_configuration.v1.json").setContent(
+            INVALID_RESTART_POLICY)
+        path.child(b"current_configuration.v1.sha256").setContent(
+            sha256(INVALID_RESTART_POLICY).hexdigest())
+        service = self.service(path)
+        self.assertEqual(service.get().maximum_retry_count, -1)
+
+    def test_mismatched_checksum_validated(self):
+        """
+        If the checksum does not match the configuration file, for example
+        because the file was edited, it is validated when loaded.
+        """
+        path = FilePath(self.mktemp())
+        path.makedirs()
+        path.child(b"current_configuration.v1.json").setContent(
+            INVALID_RESTART_POLICY)
+        path.child(b"current_configuration.v1.sha256").setContent(
+            sha256(b"something else").hexdigest())
+        service = ConfigurationPersistenceService(reactor, path)
+        self.assertRaises(InvariantException, service.startService)
+
+    def test_missing_checksum_validated(self):
+        """
+        If there is no checksum the configuration file is validated when
+        loaded.
+        """
+        path = FilePath(self.mktemp())
+        path.makedirs()
+        path.child(b"current_configuration.v1.json").setContent(
+            INVALID_RESTART_POLICY)
+        service = ConfigurationPersistenceService(reactor, path)
+        self.assertRaises(InvariantException, service.startService)
+
     def test_register_for_callback(self):
         """
         Callbacks can be registered that are called every time there is a
@@ -153,6 +268,415 @@ class ConfigurationPersistenceServiceTests(TestCase):
         return d
 
 
+class JournalTests(TestCase):
+    """
+    Tests for ``ConfigurationPersistenceService`` with a journal.
+    """
+    def setUp(self):
+        self.path = FilePath(self.mktemp())
+        self.config = self.path.child(b"current_configuration.v1.json")
+        self.journal = self.path.child(b"current_configuration.v1.journal")
+        self.first = TEST_DEPLOYMENT
+        self.second = TEST_DEPLOYMENT.update_node(
+            Node(hostname=u"node2.example.com"))
+        self.third = self.second.update_node(
+            Node(hostname=u"node1.example.com"))
+
+    def service(self, journal=True, codec=JSON_CODEC, logger=None):
+        """
+        Start a service, schedule its stop.
+
+        :param bool journal: Whether to use a journal.
+        :param codec: The codec to use.
+        :param logger: Optional eliot ``Logger`` to set before startup.
+
+        :return: Started ``ConfigurationPersistenceService``.
+        """
+        service = ConfigurationPersistenceService(
+            reactor, self.path, codec=codec, journal=journal)
+        if logger is not None:
+            self.patch(service, "logger", logger)
+        service.startService()
+        self.addCleanup(service.stopService)
+        return service
+
+    def save_all(self, service, deployments):
+        """
+        Save each of the given configurations in turn.
+        """
+        for deployment in deployments:
+            self.successResultOf(service.save(deployment))
+
+    def test_save_appends(self):
+        """
+        Saving appends to the journal rather than rewriting the
+        configuration file.
+        """
+        service = self.service()
+        config = self.config.getContent()
+        journal = self.journal.getContent()
+        self.save_all(service, [self.first])
+        self.assertEqual(
+            (self.config.getContent(),
+             len(self.journal.getContent()) > len(journal)),
+            (config, True))
+
+    @validate_logging(
+        assertHasAction, _LOG_SAVE_CHANGES, succeeded=True,
+        startFields=dict(changed=list(TEST_DEPLOYMENT.nodes), removed=[]))
+    def test_save_logs_changes(self, logger):
+        """
+        Saving logs the changed nodes rather than the whole configuration.
+        """
+        service = self.service(logger=logger)
+        self.save_all(service, [self.first])
+
+    def test_unchanged_not_journaled(self):
+        """
+        Saving the current configuration again does not add to the journal.
+        """
+        service = self.service()
+        self.save_all(service, [self.first])
+        journal = self.journal.getContent()
+        self.save_all(service, [self.first])
+        self.assertEqual(self.journal.getContent(), journal)
+
+    def test_replay(self):
+        """
+        Configuration saved to the journal, including added, changed and
+        removed nodes, is loaded by a new service.
+        """
+        service = self.service()
+        self.save_all(service, [self.first, self.second, self.third,
+                                self.second])
+        service.stopService()
+        self.assertEqual(self.service().get(), self.second)
+
+    def test_replay_compact(self):
+        """
+        A journal written with the compact codec can be replayed.
+        """
+        service = self.service(codec=COMPACT_CODEC)
+        self.save_all(service, [self.first, self.second])
+        service.stopService()
+        self.assertEqual(self.service().get(), self.second)
+
+    def test_startup_compacts(self):
+        """
+        On startup the replayed configuration is written to the
+        configuration file and a new journal is started.
+        """
+        service = self.service()
+        self.save_all(service, [self.first, self.second])
+        service.stopService()
+        self.service()
+        self.assertEqual(
+            (wire_decode(self.config.getContent()),
+             self.journal.getContent().count(b"\n")),
+            (self.second, 1))
+
+    def test_replay_without_journal(self):
+        """
+        A service not configured to use a journal still loads the changes
+        recorded in an existing journal, and then removes it.
+        """
+        service = self.service()
+        self.save_all(service, [self.first, self.second])
+        service.stopService()
+        self.assertEqual(
+            (self.service(journal=False).get(),
+             wire_decode(self.config.getContent()), self.journal.exists()),
+            (self.second, self.second, False))
+
+    def test_incomplete_entry_ignored(self):
+        """
+        An incomplete entry at the end of the journal, as left by a crash
+        during a write, is ignored along with everything after it.
+        """
+        service = self.service()
+        self.save_all(service, [self.first, self.second])
+        service.stopService()
+        self.journal.setContent(self.journal.getContent()[:-5])
+        self.assertEqual(self.service().get(), self.first)
+
+    def test_corrupt_entry_ignored(self):
+        """
+        An entry whose digest does not match its contents is ignored along
+        with everything after it.
+        """
+        service = self.service()
+        self.save_all(service, [self.first, self.second, self.third])
+        service.stopService()
+        entries = self.journal.getContent().split(b"\n")
+        # The payload of the second entry:
+        entries[4] = entries[4].replace(b"node2", b"node3")
+        self.journal.setContent(b"\n".join(entries))
+        self.assertEqual(self.service().get(), self.first)
+
+    def test_stale_journal_ignored(self):
+        """
+        A journal written for a different configuration file, as left by a
+        crash while the configuration file was replaced, is ignored.
+        """
+        service = self.service()
+        self.save_all(service, [self.first, self.second])
+        service.stopService()
+        self.config.setContent(wire_encode(self.third))
+        self.assertEqual(self.service().get(), self.third)
+
+    @validate_logging(assertHasMessage, _LOG_COMPACT)
+    def test_compaction(self, logger):
+        """
+        Once the journal is larger than the configuration file it is
+        replaced by a new configuration file.
+        """
+        self.patch(_persistence, "_MINIMUM_COMPACTION_SIZE", 0)
+        service = self.service(logger=logger)
+        self.save_all(service, [self.first])
+        self.assertEqual(
+            (wire_decode(self.config.getContent()),
+             self.journal.getContent().count(b"\n")),
+            (self.first, 1))
+
+
+def assert_group_commits(saves):
+    """
+    Create an assertion for ``validate_logging`` that the given group
+    commits were logged.
+
+    :param list saves: The expected number of saves in each group commit.
+    """
+    def assertion(test, logger):
+        test.assertEqual(
+            [message.message[u"saves"] for message
+             in LoggedMessage.ofType(logger.messages, _LOG_GROUP_COMMIT)],
+            saves)
+    return assertion
+
+
+class BackgroundWriteTests(TestCase):
+    """
+    Tests for ``ConfigurationPersistenceService`` with a ``commit_interval``.
+    """
+    def setUp(self):
+        self.path = FilePath(self.mktemp())
+        self.second = TEST_DEPLOYMENT.update_node(
+            Node(hostname=u"node2.example.com"))
+
+    def service(self, logger=None, journal=False):
+        """
+        Start a service which writes in the background, schedule its stop.
+
+        :param logger: Optional eliot ``Logger`` to set before startup.
+        :param bool journal: Whether to use a journal.
+
+        :return: Started ``ConfigurationPersistenceService``.
+        """
+        service = ConfigurationPersistenceService(
+            reactor, self.path, journal=journal, commit_interval=0)
+        if logger is not None:
+            self.patch(service, "logger", logger)
+        service.startService()
+        self.addCleanup(service.stopService)
+        return service
+
+    def loaded(self, ignored=None):
+        """
+        :return: The configuration loaded by a new synchronous service.
+        """
+        service = ConfigurationPersistenceService(reactor, self.path)
+        service.startService()
+        return service.get()
+
+    def test_get_immediately(self):
+        """
+        Saved configuration is returned by ``get`` before it is written.
+        """
+        service = self.service()
+        d = service.save(TEST_DEPLOYMENT)
+        self.assertEqual((service.get(), self.loaded()),
+                         (TEST_DEPLOYMENT, Deployment()))
+        return d
+
+    def test_written(self):
+        """
+        The ``Deferred`` returned by ``save`` fires once the configuration
+        has been written.
+        """
+        service = self.service()
+        d = service.save(TEST_DEPLOYMENT)
+        d.addCallback(self.loaded)
+        d.addCallback(self.assertEqual, TEST_DEPLOYMENT)
+        return d
+
+    def test_written_in_thread(self):
+        """
+        Configuration is written outside the reactor thread.
+        """
+        service = self.service()
+        threads = []
+        original = service._write
+
+        def write(*args):
+            threads.append(isInIOThread())
+            return original(*args)
+        self.patch(service, "_write", write)
+        d = service.save(TEST_DEPLOYMENT)
+        d.addCallback(lambda _: self.assertEqual(threads, [False]))
+        return d
+
+    @validate_logging(assert_group_commits([3]))
+    def test_group_commit(self, logger):
+        """
+        Saves made within the commit interval are written together, and
+        the last configuration saved is the one written.
+        """
+        service = self.service(logger)
+        d = gatherResults([service.save(TEST_DEPLOYMENT),
+                           service.save(self.second),
+                           service.save(TEST_DEPLOYMENT)])
+        d.addCallback(self.loaded)
+        d.addCallback(self.assertEqual, TEST_DEPLOYMENT)
+        return d
+
+    @validate_logging(assert_group_commits([1, 2]))
+    def test_saves_during_write(self, logger):
+        """
+        Saves made while a write is in progress are written together once
+        it finishes.
+        """
+        service = self.service(logger)
+        first = service.save(TEST_DEPLOYMENT)
+        # Start writing the first save straight away:
+        service._flush_call.cancel()
+        service._flush()
+        d = gatherResults([first, service.save(self.second),
+                           service.save(TEST_DEPLOYMENT)])
+        d.addCallback(self.loaded)
+        d.addCallback(self.assertEqual, TEST_DEPLOYMENT)
+        return d
+
+    @validate_logging(assert_group_commits([2]))
+    def test_group_commit_journal(self, logger):
+        """
+        Saves combined into one write are all recorded in the journal.
+        """
+        service = self.service(logger, journal=True)
+        d = gatherResults([service.save(TEST_DEPLOYMENT),
+                           service.save(self.second)])
+        d.addCallback(self.loaded)
+        d.addCallback(self.assertEqual, self.second)
+        return d
+
+    def test_callbacks_after_write(self):
+        """
+        Change callbacks are called once saved configuration has been
+        written.
+        """
+        service = self.service()
+        callbacks = []
+        service.register(lambda: callbacks.append(self.loaded()))
+        d = service.save(TEST_DEPLOYMENT)
+        self.assertEqual(callbacks, [])
+        d.addCallback(lambda _: self.assertEqual(callbacks,
+                                                 [TEST_DEPLOYMENT]))
+        return d
+
+    def test_failed_write(self):
+        """
+        If writing fails the ``Deferred`` returned by ``save`` fails and no
+        change callbacks are called.
+        """
+        service = self.service()
+        callbacks = []
+        service.register(lambda: callbacks.append(1))
+
+        def write(*args):
+            raise ZeroDivisionError()
+        self.patch(service, "_write", write)
+        d = self.assertFailure(service.save(TEST_DEPLOYMENT),
+                               ZeroDivisionError)
+        d.addCallback(lambda _: self.assertEqual(callbacks, []))
+        return d
+
+    def test_failed_write_rolled_back(self):
+        """
+        If writing fails ``get`` returns the last configuration that was
+        written.
+        """
+        service = self.service()
+        d = service.save(TEST_DEPLOYMENT)
+
+        def written(_):
+            def write(*args):
+                raise ZeroDivisionError()
+            self.patch(service, "_write", write)
+            return self.assertFailure(service.save(self.second),
+                                      ZeroDivisionError)
+        d.addCallback(written)
+        d.addCallback(lambda _: self.assertEqual(
+            (service.get(), self.loaded()),
+            (TEST_DEPLOYMENT, TEST_DEPLOYMENT)))
+        return d
+
+    def test_failed_write_fails_queued_saves(self):
+        """
+        If writing fails, saves made while the write was in progress fail
+        too, since they were made on top of the unwritten configuration.
+        """
+        service = self.service()
+
+        def write(*args):
+            raise ZeroDivisionError()
+        self.patch(service, "_write", write)
+        first = service.save(TEST_DEPLOYMENT)
+        # Start writing the first save straight away:
+        service._flush_call.cancel()
+        service._flush()
+        second = service.save(self.second)
+        d = gatherResults([
+            self.assertFailure(first, ZeroDivisionError),
+            self.assertFailure(second, ZeroDivisionError)])
+        d.addCallback(lambda _: self.assertEqual(service.get(), Deployment()))
+        return d
+
+    def test_failed_journal_write_snapshot(self):
+        """
+        If appending to the journal fails after the change was partially
+        recorded, the next write replaces it with a snapshot so the rolled
+        back change is not loaded on restart.
+        """
+        service = self.service(journal=True)
+        original = service._journal.append
+        failures = [ZeroDivisionError()]
+
+        def append(changes):
+            original(changes)
+            if failures:
+                raise failures.pop()
+        d = service.save(TEST_DEPLOYMENT)
+        d.addCallback(lambda _: self.patch(service._journal, "append", append))
+        d.addCallback(lambda _: self.assertFailure(service.save(self.second),
+                                                   ZeroDivisionError))
+        d.addCallback(lambda _: service.save(TEST_DEPLOYMENT))
+        d.addCallback(self.loaded)
+        d.addCallback(self.assertEqual, TEST_DEPLOYMENT)
+        return d
+
+    def test_stop_writes(self):
+        """
+        Stopping the service waits for saved configuration to be written.
+        """
+        service = ConfigurationPersistenceService(
+            reactor, self.path, commit_interval=10)
+        service.startService()
+        service.save(TEST_DEPLOYMENT)
+        d = service.stopService()
+        d.addCallback(self.loaded)
+        d.addCallback(self.assertEqual, TEST_DEPLOYMENT)
+        return d
+
+
 class WireEncodeDecodeTests(SynchronousTestCase):
     """
     Tests for ``wire_encode`` and ``wire_decode``.
@@ -170,6 +694,28 @@ class WireEncodeDecodeTests(SynchronousTestCase):
         self.assertEqual(TEST_DEPLOYMENT,
                          wire_decode(wire_encode(TEST_DEPLOYMENT)))
 
+    def test_roundtrip_network_state(self):
+        """
+        A ``NodeState`` with proxies and open ports round-trips with every
+        codec.
+        """
+        state = NodeState(hostname=u"192.0.2.1",
+                          proxies=[Proxy(ip=u"192.0.2.2", port=80)],
+                          open_ports=[OpenPort(port=443)])
+        self.assertEqual(
+            [wire_decode(wire_encode(state, codec))
+             for codec in CODECS.values()],
+            [state] * len(CODECS))
+
+    def test_iterencode(self):
+        """
+        Joining the output of ``JSON_CODEC.iterencode`` results in the same
+        bytes as ``wire_encode``.
+        """
+        self.assertEqual(
+            b"".join(JSON_CODEC.iterencode(TEST_DEPLOYMENT)),
+            wire_encode(TEST_DEPLOYMENT))
+
     def test_no_arbitrary_decoding(self):
         """
         ``wire_decode`` will not decode classes that are not in
@@ -189,3 +735,444 @@ class WireEncodeDecodeTests(SynchronousTestCase):
         # Possibly future versions might throw exception, the key point is
         # that the returned object is not a Temp instance.
         self.assertFalse(isinstance(wire_decode(data), Temp))
+
+
+class WireDecodeDetectionTests(SynchronousTestCase):
+    """
+    Tests for ``wire_decode``'s detection of the codec used.
+    """
+    def test_json(self):
+        """
+        ``wire_decode`` decodes data encoded with ``JSON_CODEC``.
+        """
+        self.assertEqual(wire_decode(wire_encode(TEST_DEPLOYMENT, JSON_CODEC)),
+                         TEST_DEPLOYMENT)
+
+    def test_compact(self):
+        """
+        ``wire_decode`` decodes data encoded with ``COMPACT_CODEC``.
+        """
+        self.assertEqual(
+            wire_decode(wire_encode(TEST_DEPLOYMENT, COMPACT_CODEC)),
+            TEST_DEPLOYMENT)
+
+    def test_codecs(self):
+        """
+        ``CODECS`` maps codec names to codecs.
+        """
+        self.assertEqual(CODECS, {u"json": JSON_CODEC,
+                                  u"compact": COMPACT_CODEC})
+
+
+class CompactCodecTests(SynchronousTestCase):
+    """
+    Tests for ``COMPACT_CODEC``.
+    """
+    def assert_roundtrip(self, obj):
+        """
+        Assert the given object is unchanged by encoding and decoding.
+        """
+        encoded = COMPACT_CODEC.encode(obj)
+        self.assertEqual(
+            (type(encoded), COMPACT_CODEC.decode(encoded)),
+            (bytes, obj))
+
+    def test_roundtrip_deployment(self):
+        """
+        A ``Deployment`` can be round-tripped.
+        """
+        self.assert_roundtrip(TEST_DEPLOYMENT)
+
+    def test_roundtrip_deployment_state(self):
+        """
+        A ``DeploymentState`` with ``FilePath``, ``None`` values and integer
+        sets can be round-tripped.
+        """
+        self.assert_roundtrip(DeploymentState(nodes=[
+            NodeState(hostname=u"192.0.2.1", used_ports=[1, 2],
+                      applications=None,
+                      manifestations={DATASET.dataset_id: MANIFESTATION},
+                      paths={DATASET.dataset_id: FilePath(b"/x/y")}),
+            NodeState(hostname=u"192.0.2.2")]))
+
+    def test_roundtrip_application(self):
+        """
+        An ``Application`` using all of its fields can be round-tripped.
+        """
+        self.assert_roundtrip(Application(
+            name=u"app",
+            image=DockerImage.from_string(u"image:1"),
+            ports=[Port(internal_port=1, external_port=2)],
+            links=[Link(local_port=3, remote_port=4, alias=u"db")],
+            memory_limit=100,
+            cpu_shares=10,
+            restart_policy=RestartOnFailure(maximum_retry_count=2),
+            environment={u"A": u"B"},
+            running=False))
+
+    def test_missing_field(self):
+        """
+        A record field without a value is decoded as missing.
+        """
+        class Temp(PRecord):
+            a = field()
+            b = field()
+        SERIALIZABLE_CLASSES.append(Temp)
+        self.addCleanup(SERIALIZABLE_CLASSES.remove, Temp)
+        self.assert_roundtrip(Temp(a=1))
+
+    def test_header(self):
+        """
+        The encoded data starts with a header identifying the format and its
+        version.
+        """
+        self.assertTrue(
+            COMPACT_CODEC.encode(TEST_DEPLOYMENT).startswith(
+                b"\x00compact:1\n"))
+
+    def test_unsupported_version(self):
+        """
+        Decoding data with an unknown version of the format raises a
+        ``ValueError``.
+        """
+        data = COMPACT_CODEC.encode(TEST_DEPLOYMENT).replace(
+            b"\x00compact:1\n", b"\x00compact:2\n", 1)
+        self.assertRaises(ValueError, COMPACT_CODEC.decode, data)
+
+    def test_class_names_once(self):
+        """
+        The name of a record class appears in the encoded data only once,
+        regardless of how many records of that class are encoded.
+        """
+        deployment = Deployment(nodes=[
+            Node(hostname=u"192.0.2.%d" % (i,)) for i in range(10)])
+        self.assertEqual(
+            COMPACT_CODEC.encode(deployment).count(b'"Node"'), 1)
+
+    def test_smaller(self):
+        """
+        The compact encoding is smaller than the JSON encoding.
+        """
+        self.assertTrue(len(COMPACT_CODEC.encode(TEST_DEPLOYMENT)) <
+                        len(JSON_CODEC.encode(TEST_DEPLOYMENT)))
+
+    def test_iterencode(self):
+        """
+        Joining the output of ``iterencode`` results in the same bytes as
+        ``encode``.
+        """
+        self.assertEqual(
+            b"".join(COMPACT_CODEC.iterencode(TEST_DEPLOYMENT)),
+            COMPACT_CODEC.encode(TEST_DEPLOYMENT))
+
+    def test_no_arbitrary_decoding(self):
+        """
+        Classes that are not in ``SERIALIZABLE_CLASSES`` are not decoded.
+        """
+        class Temp(PRecord):
+            """A class."""
+        SERIALIZABLE_CLASSES.append(Temp)
+
+        def cleanup():
+            if Temp in SERIALIZABLE_CLASSES:
+                SERIALIZABLE_CLASSES.remove(Temp)
+        self.addCleanup(cleanup)
+
+        data = COMPACT_CODEC.encode(Temp())
+        SERIALIZABLE_CLASSES.remove(Temp)
+        self.assertFalse(isinstance(COMPACT_CODEC.decode(data), Temp))
+
+
+def assert_same_types(test, expected, actual):
+    """
+    Assert that two equal objects from the configuration model also have
+    the same types throughout, e.g. the same ``CheckedPSet`` subclasses.
+
+    :param TestCase test: The test to use for assertions.
+    :param expected: The expected object.
+    :param actual: The actual object.
+    """
+    test.assertEqual((type(actual), actual), (type(expected), expected))
+    if isinstance(expected, PMap):
+        for key, value in expected.items():
+            assert_same_types(test, value, actual[key])
+    elif isinstance(expected, PSet):
+        actual_items = {item: item for item in actual}
+        for item in expected:
+            assert_same_types(test, item, actual_items[item])
+
+
+def make_trusted_decode_tests(codec):
+    """
+    Create tests for decoding data with the given codec without validation.
+
+    :param codec: The codec to test.
+
+    :return: ``SynchronousTestCase`` subclass.
+    """
+    class TrustedDecodeTests(SynchronousTestCase):
+        """
+        Tests for ``wire_decode`` with ``trusted=True``.
+        """
+        def assert_roundtrip(self, obj):
+            """
+            Decoding the encoded form of an object without validation
+            results in an object that is equal to, and has the same types as,
+            both the original and the object decoded with validation.
+            """
+            data = wire_encode(obj, codec)
+            trusted = wire_decode(data, trusted=True)
+            assert_same_types(self, obj, trusted)
+            assert_same_types(self, wire_decode(data), trusted)
+            self.assertEqual((hash(trusted), trusted == obj, obj == trusted),
+                             (hash(obj), True, True))
+
+        def test_deployment(self):
+            """
+            A ``Deployment`` round-trips.
+            """
+            self.assert_roundtrip(TEST_DEPLOYMENT)
+
+        def test_many_nodes(self):
+            """
+            A ``Deployment`` with many nodes and applications round-trips.
+            """
+            self.assert_roundtrip(Deployment(nodes=[
+                Node(hostname=u"192.0.2.%d" % (i,),
+                     applications=[
+                         Application(
+                             name=u"app-%d-%d" % (i, j),
+                             image=DockerImage.from_string(u"a:%d" % (j,)),
+                             ports=[Port(internal_port=j,
+                                         external_port=j + 1000)],
+                             environment={u"A": unicode(j)})
+                         for j in range(5)])
+                for i in range(20)]))
+
+        def test_deployment_state(self):
+            """
+            A ``DeploymentState`` with unknown information and paths
+            round-trips.
+            """
+            self.assert_roundtrip(DeploymentState(nodes=[
+                NodeState(hostname=u"192.0.2.1", used_ports=[1, 2],
+                          applications=None,
+                          manifestations={DATASET.dataset_id: MANIFESTATION},
+                          paths={DATASET.dataset_id: FilePath(b"/x/y")}),
+                NodeState(hostname=u"192.0.2.2")]))
+
+        def test_application(self):
+            """
+            An ``Application`` using all of its fields round-trips.
+            """
+            self.assert_roundtrip(Application(
+                name=u"app",
+                image=DockerImage.from_string(u"image:1"),
+                ports=[Port(internal_port=1, external_port=2)],
+                links=[Link(local_port=3, remote_port=4, alias=u"db")],
+                memory_limit=100,
+                cpu_shares=10,
+                restart_policy=RestartOnFailure(maximum_retry_count=2),
+                environment={u"A": u"B"},
+                running=False))
+
+        def test_initial_values(self):
+            """
+            Fields missing from the encoded data get their initial values.
+            """
+            class Temp(PRecord):
+                a = field()
+                b = field(initial=2)
+            SERIALIZABLE_CLASSES.append(Temp)
+            self.addCleanup(SERIALIZABLE_CLASSES.remove, Temp)
+            data = wire_encode(Temp(a=1).remove("b"), codec)
+            self.assertEqual(wire_decode(data, trusted=True), Temp(a=1, b=2))
+
+        def test_usable(self):
+            """
+            Records decoded without validation can be updated like any other
+            record, with the usual validation of the changes.
+            """
+            decoded = wire_decode(wire_encode(TEST_DEPLOYMENT, codec),
+                                  trusted=True)
+            self.assertRaises(TypeError, decoded.set, "nodes", [1])
+            self.assertEqual(
+                decoded.update_node(Node(hostname=u"192.0.2.1")),
+                TEST_DEPLOYMENT.update_node(Node(hostname=u"192.0.2.1")))
+
+        def test_no_validation(self):
+            """
+            Invariants are not checked when decoding with ``trusted=True``.
+            """
+            data = wire_encode(
+                wire_decode(INVALID_RESTART_POLICY, trusted=True), codec)
+            self.assertEqual(
+                wire_decode(data, trusted=True).maximum_retry_count, -1)
+            self.assertRaises(InvariantException, wire_decode, data)
+
+    return TrustedDecodeTests
+
+
+class JSONTrustedDecodeTests(make_trusted_decode_tests(JSON_CODEC)):
+    """
+    Trusted decoding tests for ``JSON_CODEC``.
+    """
+
+
+class CompactTrustedDecodeTests(make_trusted_decode_tests(COMPACT_CODEC)):
+    """
+    Trusted decoding tests for ``COMPACT_CODEC``.
+    """
+
+
+class WireEncodeChunksTests(SynchronousTestCase):
+    """
+    Tests for ``wire_encode_chunks``.
+    """
+    def test_same_as_wire_encode(self):
+        """
+        Joining the chunks returned by ``wire_encode_chunks`` results in
+        the output of ``wire_encode``.
+        """
+        self.assertEqual(
+            b"".join(wire_encode_chunks(TEST_DEPLOYMENT, 100)),
+            wire_encode(TEST_DEPLOYMENT))
+
+    def test_chunk_size(self):
+        """
+        All chunks are ``bytes`` of the given size, except possibly the
+        last one which may be shorter.
+        """
+        chunks = list(wire_encode_chunks(TEST_DEPLOYMENT, 100))
+        self.assertEqual(
+            ([type(chunk) for chunk in chunks],
+             [len(chunk) for chunk in chunks[:-1]],
+             0 < len(chunks[-1]) <= 100),
+            ([bytes] * len(chunks), [100] * (len(chunks) - 1), True))
+
+    def test_large_value(self):
+        """
+        A single value that is larger than the chunk size is split across
+        chunks.
+        """
+        dataset = DATASET.set(metadata={u"name": u"x" * 1000})
+        chunks = list(wire_encode_chunks(dataset, 100))
+        self.assertEqual(
+            (max(len(chunk) for chunk in chunks), b"".join(chunks)),
+            (100, wire_encode(dataset)))
+
+    def test_codec(self):
+        """
+        ``wire_encode_chunks`` encodes with the given codec.
+        """
+        self.assertEqual(
+            b"".join(wire_encode_chunks(TEST_DEPLOYMENT, 100, COMPACT_CODEC)),
+            wire_encode(TEST_DEPLOYMENT, COMPACT_CODEC))
+
+    def test_small_value(self):
+        """
+        An object whose encoding is smaller than the chunk size is encoded
+        as a single chunk.
+        """
+        self.assertEqual(list(wire_encode_chunks(DATASET, 65535)),
+                         [wire_encode(DATASET)])
+
+    def test_incremental(self):
+        """
+        The outer parts of the object are encoded separately, so the whole
+        encoded object is never built as a single string.
+        """
+        deployment = TEST_DEPLOYMENT.update_node(
+            Node(hostname=u"node2.example.com"))
+        encoded = wire_encode(deployment)
+        lengths = []
+        original = _persistence.dumps
+
+        def dumps(*args, **kwargs):
+            result = original(*args, **kwargs)
+            lengths.append(len(result))
+            return result
+        self.patch(_persistence, "dumps", dumps)
+        list(wire_encode_chunks(deployment, 100))
+        self.assertTrue(max(lengths) < len(encoded))
+
+
+class WireDecodeChunksTests(SynchronousTestCase):
+    """
+    Tests for ``wire_decode_chunks``.
+    """
+    def setUp(self):
+        self.deployment = TEST_DEPLOYMENT.update_node(
+            Node(hostname=u"node2.example.com",
+                 applications=[Application(
+                     name=u"app", image=DockerImage.from_string(u"app"),
+                     ports=[Port(internal_port=12345,
+                                 external_port=54321)])]))
+
+    def test_roundtrip(self):
+        """
+        ``wire_decode_chunks`` decodes the output of ``wire_encode_chunks``
+        for any chunk size and codec, including chunk boundaries within
+        strings and numbers.
+        """
+        for codec in CODECS.values():
+            for chunk_size in [1, 7, 100, 65535]:
+                chunks = wire_encode_chunks(self.deployment, chunk_size,
+                                            codec)
+                self.assertEqual(
+                    wire_decode_chunks(chunks), self.deployment,
+                    (codec.name, chunk_size))
+
+    def test_trusted(self):
+        """
+        ``wire_decode_chunks`` decodes without validation if ``trusted`` is
+        true.
+        """
+        data = INVALID_RESTART_POLICY
+        chunks = [data[i:i + 10] for i in range(0, len(data), 10)]
+        self.assertEqual(
+            wire_decode_chunks(chunks, trusted=True).maximum_retry_count, -1)
+
+    def test_untrusted(self):
+        """
+        ``wire_decode_chunks`` validates decoded records by default.
+        """
+        data = INVALID_RESTART_POLICY
+        chunks = [data[i:i + 10] for i in range(0, len(data), 10)]
+        self.assertRaises(InvariantException, wire_decode_chunks, chunks)
+
+    def test_not_joined(self):
+        """
+        Only part of the encoded data is held in memory as a single string
+        while decoding.
+        """
+        encoded = wire_encode(self.deployment)
+        lengths = []
+        original = _persistence.JSONDecoder
+
+        class JSONDecoder(original):
+            def raw_decode(self, s, idx=0):
+                lengths.append(len(s))
+                return original.raw_decode(self, s, idx)
+        self.patch(_persistence, "JSONDecoder", JSONDecoder)
+        wire_decode_chunks(wire_encode_chunks(self.deployment, 100))
+        self.assertTrue(max(lengths) < len(encoded))
+
+    def test_truncated(self):
+        """
+        ``wire_decode_chunks`` raises ``ValueError`` if the data ends before
+        the object does.
+        """
+        for codec in CODECS.values():
+            chunks = list(wire_encode_chunks(self.deployment, 100, codec))
+            self.assertRaises(ValueError, wire_decode_chunks, chunks[:-1])
+
+    def test_extra_data(self):
+        """
+        ``wire_decode_chunks`` raises ``ValueError`` if there is data after
+        the end of the object.
+        """
+        for codec in CODECS.values():
+            chunks = list(wire_encode_chunks(self.deployment, 100, codec))
+            self.assertRaises(ValueError, wire_decode_chunks,
+                              chunks + [b"[]"])
@@ -12,15 +12,24 @@ from zope.interface.verify import verifyObject
 from characteristic import attributes, Attribute
 
 from eliot import ActionType, start_action, MemoryLogger, Logger
-from eliot.testing import validate_logging, assertHasAction, LoggedAction
+from eliot.testing import (
+    validate_logging, assertHasAction, assertHasMessage, LoggedAction,
+    LoggedMessage,
+)
+
+from pyrsistent import InvariantException
 
 from twisted.trial.unittest import SynchronousTestCase
 from twisted.test.proto_helpers import StringTransport, MemoryReactor
-from twisted.protocols.amp import UnknownRemoteError, RemoteAmpError, AMP
+from twisted.protocols.amp import (
+    UnknownRemoteError, RemoteAmpError, AMP, AmpBox, MAX_VALUE_LENGTH,
+    parseString,
+)
 from twisted.python.failure import Failure
 from twisted.internet.error import ConnectionLost
 from twisted.internet.endpoints import TCP4ServerEndpoint
 from twisted.internet.defer import succeed, fail
+from twisted.internet.task import Clock
 from twisted.python.filepath import FilePath
 from twisted.application.internet import StreamServerEndpointService
 
@@ -29,13 +38,18 @@ from .._protocol import (
     VersionCommand, ClusterStatusCommand, NodeStateCommand, IConvergenceAgent,
     AgentAMP, ControlAMPService, ControlAMP, _AgentLocator,
     ControlServiceLocator, LOG_SEND_CLUSTER_STATE, LOG_SEND_TO_AGENT,
+    ClusterStatusDeltaCommand, GenerationMismatch,
+    LOG_COALESCED_NODE_UPDATES, EncodingCache, ENCODING_CACHE,
 )
 from .._clusterstate import ClusterStateService
 from .._model import (
     Deployment, Application, DockerImage, Node, NodeState, Manifestation,
-    Dataset, DeploymentState,
+    Dataset, DeploymentState, RestartOnFailure,
+)
+from .._persistence import (
+    ConfigurationPersistenceService, wire_encode_chunks, wire_encode,
+    JSON_CODEC, COMPACT_CODEC,
 )
-from .._persistence import ConfigurationPersistenceService
 
 
 class LoopbackAMPClient(object):
@@ -100,6 +114,12 @@ NODE_STATE = NodeState(hostname=u'node1.example.com',
                                        MANIFESTATION})
 
 
+# A RestartOnFailure with a value its invariant rejects:
+INVALID_RESTART_POLICY = wire_encode(
+    RestartOnFailure(maximum_retry_count=1)).replace(
+        b'"maximum_retry_count": 1', b'"maximum_retry_count": -1')
+
+
 class SerializationTests(SynchronousTestCase):
     """
     Tests for argument serialization.
@@ -124,6 +144,153 @@ class SerializationTests(SynchronousTestCase):
         self.assertEqual([bytes, TEST_DEPLOYMENT],
                          [type(as_bytes), deserialized])
 
+    def test_small_single_key(self):
+        """
+        ``SerializableArgument.toBox`` stores an object whose serialized
+        form fits in a single AMP value under the argument name.
+        """
+        strings = AmpBox()
+        SerializableArgument(Deployment).toBox(
+            b"configuration", strings, {b"configuration": TEST_DEPLOYMENT},
+            None)
+        self.assertEqual(
+            strings,
+            {b"configuration":
+             SerializableArgument(Deployment).toString(TEST_DEPLOYMENT)})
+
+    def test_chunked(self):
+        """
+        ``SerializableArgument.toBox`` splits an object whose serialized form
+        is larger than the chunk size across multiple keys, and
+        ``SerializableArgument.fromBox`` reassembles it.
+        """
+        argument = SerializableArgument(Deployment, chunk_size=100)
+        strings = AmpBox()
+        argument.toBox(b"configuration", strings,
+                       {b"configuration": TEST_DEPLOYMENT}, None)
+        chunk_lengths = [len(value) for value in strings.values()]
+        objects = {}
+        argument.fromBox(b"configuration", strings, objects, None)
+        self.assertEqual(
+            (max(chunk_lengths) <= 100, len(chunk_lengths) > 1, objects,
+             strings),
+            (True, True, {b"configuration": TEST_DEPLOYMENT}, {}))
+
+    def test_larger_than_amp_limit(self):
+        """
+        A ``ClusterStatusCommand`` whose configuration is serialized to more
+        than ``MAX_VALUE_LENGTH`` bytes can be serialized to an AMP box on
+        the wire and parsed back.
+        """
+        configuration = Deployment(nodes={
+            Node(hostname=u"192.0.2.%d" % (i,),
+                 applications=[
+                     Application(name=u"app-%d-%d" % (i, j),
+                                 image=DockerImage.from_string(u"image"))
+                     for j in range(50)])
+            for i in range(20)})
+        self.assertTrue(
+            len(SerializableArgument(Deployment).toString(configuration)) >
+            MAX_VALUE_LENGTH)
+        arguments = dict(configuration=configuration,
+                         state=DeploymentState(),
+                         generation=1,
+                         eliot_context=TEST_ACTION)
+        locator = _AgentLocator(FakeAgent())
+        box = ClusterStatusCommand.makeArguments(arguments, locator)
+        [parsed_box] = parseString(box.serialize())
+        parsed = ClusterStatusCommand.parseArguments(parsed_box, locator)
+        self.assertEqual(parsed["configuration"], configuration)
+
+    def test_agent_validates(self):
+        """
+        The configuration sent to an agent by ``ClusterStatusCommand`` is
+        validated when it is parsed.
+        """
+        application = APP1.set(
+            "restart_policy", RestartOnFailure(maximum_retry_count=2))
+        arguments = dict(
+            configuration=Deployment(nodes={
+                Node(hostname=u"192.0.2.1", applications=[application])}),
+            state=DeploymentState(),
+            generation=1,
+            eliot_context=TEST_ACTION)
+        locator = _AgentLocator(FakeAgent())
+        box = ClusterStatusCommand.makeArguments(arguments, locator)
+        box[b"configuration"] = box[b"configuration"].replace(
+            b'"maximum_retry_count": 2', b'"maximum_retry_count": 0')
+        self.assertRaises(InvariantException,
+                          ClusterStatusCommand.parseArguments, box, locator)
+
+    def test_cached(self):
+        """
+        ``SerializableArgument.toBox`` reuses the encoding of an object it
+        has recently encoded.
+        """
+        argument = SerializableArgument(Deployment)
+        hits = ENCODING_CACHE.hits
+        boxes = []
+        for i in range(2):
+            strings = AmpBox()
+            argument.toBox(b"configuration", strings,
+                           {b"configuration": TEST_DEPLOYMENT}, None)
+            boxes.append(strings)
+        self.assertEqual(
+            (boxes[0], boxes[0][b"configuration"] is
+             boxes[1][b"configuration"], ENCODING_CACHE.hits - hits),
+            (boxes[1], True, 1))
+
+    def test_json_by_default(self):
+        """
+        ``SerializableArgument`` uses the JSON codec by default.
+        """
+        self.assertEqual(
+            SerializableArgument(Deployment).toString(TEST_DEPLOYMENT),
+            JSON_CODEC.encode(TEST_DEPLOYMENT))
+
+    def test_protocol_codec(self):
+        """
+        ``SerializableArgument.toBox`` encodes with the codec of the
+        protocol, if it has one.
+        """
+        class Protocol(object):
+            codec = COMPACT_CODEC
+        strings = AmpBox()
+        SerializableArgument(Deployment).toBox(
+            b"configuration", strings, {b"configuration": TEST_DEPLOYMENT},
+            Protocol())
+        self.assertEqual(strings[b"configuration"],
+                         COMPACT_CODEC.encode(TEST_DEPLOYMENT))
+
+    def test_codec(self):
+        """
+        ``SerializableArgument`` can be configured to encode with a specific
+        codec.
+        """
+        self.assertEqual(
+            SerializableArgument(Deployment, codec=JSON_CODEC).toString(
+                TEST_DEPLOYMENT),
+            JSON_CODEC.encode(TEST_DEPLOYMENT))
+
+    def test_decode_any_codec(self):
+        """
+        ``SerializableArgument`` decodes objects regardless of the codec
+        they were encoded with.
+        """
+        argument = SerializableArgument(Deployment, codec=COMPACT_CODEC)
+        self.assertEqual(
+            argument.fromString(JSON_CODEC.encode(TEST_DEPLOYMENT)),
+            TEST_DEPLOYMENT)
+
+    def test_validates(self):
+        """
+        ``SerializableArgument`` validates decoded objects.
+        """
+        data = INVALID_RESTART_POLICY
+        self.assertRaises(InvariantException,
+                          SerializableArgument(RestartOnFailure).fromString,
+                          data)
+
     def test_wrong_type_serialization(self):
         """
         ``SerializableArgument`` throws a ``TypeError`` if one attempts to
@@ -132,6 +299,15 @@ class SerializationTests(SynchronousTestCase):
         argument = SerializableArgument(Deployment)
         self.assertRaises(TypeError, argument.toString, NODE_STATE)
 
+    def test_wrong_type_to_box(self):
+        """
+        ``SerializableArgument.toBox`` throws a ``TypeError`` if one attempts
+        to serialize an object of the wrong type.
+        """
+        argument = SerializableArgument(Deployment)
+        self.assertRaises(TypeError, argument.toBox, b"configuration",
+                          AmpBox(), {b"configuration": NODE_STATE}, None)
+
     def test_wrong_type_deserialization(self):
         """
         ``SerializableArgument`` throws a ``TypeError`` if one attempts to
@@ -143,11 +319,12 @@ class SerializationTests(SynchronousTestCase):
             TypeError, SerializableArgument(NodeState).fromString, as_bytes)
 
 
-def build_control_amp_service(test):
+def build_control_amp_service(test, **kwargs):
     """
     Create a new ``ControlAMPService``.
 
     :param TestCase test: The test this service is for.
+    :param kwargs: Additional arguments for ``ControlAMPService``.
 
     :return ControlAMPService: Not started.
     """
@@ -159,7 +336,8 @@ def build_control_amp_service(test):
     persistence_service.startService()
     test.addCleanup(persistence_service.stopService)
     return ControlAMPService(cluster_state, persistence_service,
-                             TCP4ServerEndpoint(MemoryReactor(), 1234))
+                             TCP4ServerEndpoint(MemoryReactor(), 1234),
+                             **kwargs)
 
 
 class ControlTestCase(SynchronousTestCase):
@@ -232,7 +410,8 @@ class ControlAMPTests(ControlTestCase):
             sent[0],
             (((ClusterStatusCommand,),
               dict(configuration=TEST_DEPLOYMENT,
-                   state=cluster_state))))
+                   state=cluster_state,
+                   generation=self.control_amp_service.generation))))
 
     def test_connection_lost(self):
         """
@@ -256,7 +435,7 @@ class ControlAMPTests(ControlTestCase):
         """
         self.assertEqual(
             self.successResultOf(self.client.callRemote(VersionCommand)),
-            {"major": 1})
+            {"major": 2})
 
     def test_nodestate_updates_node_state(self):
         """
@@ -273,13 +452,16 @@ class ControlAMPTests(ControlTestCase):
     def test_nodestate_notifies_all_connected(self):
         """
         ``NodeStateCommand`` results in all connected ``ControlAMP``
-        connections getting the updated cluster state along with the
-        desired configuration.
+        connections getting the changes to the cluster state since the
+        generation they were last sent.
         """
         self.control_amp_service.configuration_service.save(TEST_DEPLOYMENT)
+        self.patch_call_remote([], self.protocol)
         self.protocol.makeConnection(StringTransport())
         another_protocol = ControlAMP(self.control_amp_service)
+        self.patch_call_remote([], another_protocol)
         another_protocol.makeConnection(StringTransport())
+        base_generation = self.control_amp_service.generation
         sent1 = []
         sent2 = []
 
@@ -290,12 +472,91 @@ class ControlAMPTests(ControlTestCase):
             self.client.callRemote(NodeStateCommand,
                                    node_state=NODE_STATE,
                                    eliot_context=TEST_ACTION))
-        cluster_state = self.control_amp_service.cluster_state.as_deployment()
         self.assertListEqual(
             [sent1[-1], sent2[-1]],
-            [(((ClusterStatusCommand,),
-              dict(configuration=TEST_DEPLOYMENT,
-                   state=cluster_state)))] * 2)
+            [(((ClusterStatusDeltaCommand,),
+              dict(base_generation=base_generation,
+                   generation=base_generation + 1,
+                   configuration_changes=Deployment(),
+                   configuration_removals=[],
+                   state_changes=DeploymentState(nodes={NODE_STATE}),
+                   state_removals=[])))] * 2)
+
+
+class EncodingCacheTests(SynchronousTestCase):
+    """
+    Tests for ``EncodingCache``.
+    """
+    def test_miss(self):
+        """
+        The first time an object is encoded ``EncodingCache.encode_chunks``
+        returns the result of ``wire_encode_chunks`` and counts a miss.
+        """
+        cache = EncodingCache(size=2)
+        self.assertEqual(
+            (cache.encode_chunks(TEST_DEPLOYMENT, 100, JSON_CODEC),
+             cache.hits, cache.misses),
+            (list(wire_encode_chunks(TEST_DEPLOYMENT, 100, JSON_CODEC)),
+             0, 1))
+
+    def test_hit(self):
+        """
+        Encoding the same object again returns the same chunks without
+        encoding it again, and counts a hit.
+        """
+        cache = EncodingCache(size=2)
+        first = cache.encode_chunks(TEST_DEPLOYMENT, 100, JSON_CODEC)
+        second = cache.encode_chunks(TEST_DEPLOYMENT, 100, JSON_CODEC)
+        self.assertEqual((first is second, cache.hits, cache.misses),
+                         (True, 1, 1))
+
+    def test_equal_not_identical(self):
+        """
+        An object that is equal to but not the same as a cached object is
+        encoded again.
+        """
+        cache = EncodingCache(size=2)
+        for i in range(2):
+            cache.encode_chunks(
+                NodeState(hostname=u"192.0.2.1"), 100, JSON_CODEC)
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+
+    def test_chunk_size(self):
+        """
+        Encodings with different chunk sizes are cached separately.
+        """
+        cache = EncodingCache(size=2)
+        cache.encode_chunks(TEST_DEPLOYMENT, 100, JSON_CODEC)
+        self.assertEqual(
+            cache.encode_chunks(TEST_DEPLOYMENT, 50, JSON_CODEC),
+            list(wire_encode_chunks(TEST_DEPLOYMENT, 50, JSON_CODEC)))
+
+    def test_codec(self):
+        """
+        Encodings with different codecs are cached separately.
+        """
+        cache = EncodingCache(size=2)
+        cache.encode_chunks(TEST_DEPLOYMENT, 100, JSON_CODEC)
+        self.assertEqual(
+            cache.encode_chunks(TEST_DEPLOYMENT, 100, COMPACT_CODEC),
+            list(wire_encode_chunks(TEST_DEPLOYMENT, 100, COMPACT_CODEC)))
+
+    def test_least_recently_used_evicted(self):
+        """
+        When the cache is full the least recently used object is evicted.
+        """
+        cache = EncodingCache(size=2)
+        first = NodeState(hostname=u"192.0.2.1")
+        second = NodeState(hostname=u"192.0.2.2")
+        third = NodeState(hostname=u"192.0.2.3")
+        cache.encode_chunks(first, 100, JSON_CODEC)
+        cache.encode_chunks(second, 100, JSON_CODEC)
+        cache.encode_chunks(first, 100, JSON_CODEC)
+        cache.encode_chunks(third, 100, JSON_CODEC)
+        hits = cache.hits
+        cache.encode_chunks(first, 100, JSON_CODEC)
+        cache.encode_chunks(second, 100, JSON_CODEC)
+        self.assertEqual((cache.hits - hits, cache.misses), (1, 4))
 
 
 class ControlAMPServiceTests(ControlTestCase):
@@ -317,6 +578,18 @@ class ControlAMPServiceTests(ControlTestCase):
              protocol.__class__, protocol.control_amp_service),
             (False, True, StreamServerEndpointService, ControlAMP, service))
 
+    def test_codec(self):
+        """
+        Connections send configuration and state with the service's codec,
+        JSON by default.
+        """
+        default = build_control_amp_service(self)
+        compact = build_control_amp_service(self, codec=COMPACT_CODEC)
+        self.assertEqual(
+            [service.endpoint_service.factory.buildProtocol(None).codec
+             for service in (default, compact)],
+            [JSON_CODEC, COMPACT_CODEC])
+
     def test_stop_service_endpoint(self):
         """
         Stopping the service stops listening on the endpoint.
@@ -362,12 +635,14 @@ class ControlAMPServiceTests(ControlTestCase):
     def test_configuration_change(self):
         """
         A configuration change results in connected protocols being notified
-        of new cluster status.
+        of the changed nodes in the new configuration.
         """
         service = build_control_amp_service(self)
         service.startService()
         protocol = ControlAMP(service)
+        self.patch_call_remote([], protocol=protocol)
         protocol.makeConnection(StringTransport())
+        base_generation = service.generation
         sent = []
         self.patch_call_remote(sent, protocol=protocol)
 
@@ -377,14 +652,305 @@ class ControlAMPServiceTests(ControlTestCase):
         self.assertArgsEqual(
             sent,
             (
-                (ClusterStatusCommand,),
+                (ClusterStatusDeltaCommand,),
                 dict(
-                    configuration=TEST_DEPLOYMENT,
-                    state=Deployment(nodes=frozenset())
+                    base_generation=base_generation,
+                    generation=base_generation + 1,
+                    configuration_changes=TEST_DEPLOYMENT,
+                    configuration_removals=[],
+                    state_changes=DeploymentState(),
+                    state_removals=[],
                 )
             )
         )
 
+    def connect(self, service, sent, results=None):
+        """
+        Connect a new ``ControlAMP`` to the given service, capturing the
+        commands it is sent.
+
+        :param ControlAMPService service: The service to connect to.
+        :param list sent: List to which tuples of the command and its
+            arguments will be appended.
+        :param list results: Optional ``list`` of ``Deferred`` to return
+            from successive ``callRemote`` calls.  When it is exhausted, or
+            if it is not given, successful results are returned.
+
+        :return ControlAMP: The connected protocol.
+        """
+        protocol = ControlAMP(service)
+        if results is None:
+            results = []
+
+        def call_remote(command, **kwargs):
+            kwargs.pop('eliot_context')
+            sent.append((command, kwargs))
+            if results:
+                return results.pop(0)
+            return succeed({})
+        # Patching is bad.
+        # https://clusterhq.atlassian.net/browse/FLOC-1603
+        self.patch(protocol, "callRemote", call_remote)
+        protocol.makeConnection(StringTransport())
+        return protocol
+
+    def test_unchanged_not_sent(self):
+        """
+        If neither the configuration nor the cluster state have changed
+        since a connection was last sent them, nothing is sent.
+        """
+        service = build_control_amp_service(self)
+        service.startService()
+        sent = []
+        self.connect(service, sent)
+        service.node_changed(NODE_STATE)
+        service.node_changed(NODE_STATE)
+        self.assertEqual([command for (command, _) in sent],
+                         [ClusterStatusCommand, ClusterStatusDeltaCommand])
+
+    def test_generation_increases(self):
+        """
+        Each change to the configuration or state results in a new
+        generation being sent to agents.
+        """
+        service = build_control_amp_service(self)
+        service.startService()
+        sent = []
+        self.connect(service, sent)
+        service.node_changed(NODE_STATE)
+        service.configuration_service.save(TEST_DEPLOYMENT)
+        generations = [kwargs["generation"] for (_, kwargs) in sent]
+        base_generations = [kwargs["base_generation"]
+                            for (_, kwargs) in sent[1:]]
+        self.assertEqual(
+            (generations, base_generations),
+            ([generations[0], generations[0] + 1, generations[0] + 2],
+             generations[:2]))
+
+    def test_node_removal(self):
+        """
+        Nodes removed from the configuration are sent as removals.
+        """
+        service = build_control_amp_service(self)
+        service.startService()
+        service.configuration_service.save(TEST_DEPLOYMENT)
+        sent = []
+        self.connect(service, sent)
+        service.configuration_service.save(Deployment())
+        self.assertEqual(
+            (sent[-1][1]["configuration_changes"],
+             sent[-1][1]["configuration_removals"]),
+            (Deployment(), [u"node1.example.com"]))
+
+    def test_history_exhausted(self):
+        """
+        If the generation last sent to a connection is no longer in the
+        history the full configuration and state are sent.
+        """
+        service = build_control_amp_service(self, history_size=1)
+        service.startService()
+        sent = []
+        self.connect(service, sent)
+        # Record a new generation without sending it to the connection:
+        service.cluster_state.update_node_state(
+            NodeState(hostname=u"192.0.2.1"))
+        service._send_state_to_connections([])
+        service.node_changed(NODE_STATE)
+        self.assertEqual(
+            sent[-1],
+            (ClusterStatusCommand,
+             dict(configuration=Deployment(),
+                  state=service.cluster_state.as_deployment(),
+                  generation=service.generation)))
+
+    def test_generation_mismatch(self):
+        """
+        If a connection responds to a delta with ``GenerationMismatch`` the
+        full configuration and state are sent to it.
+        """
+        service = build_control_amp_service(self)
+        service.startService()
+        sent = []
+        self.connect(service, sent,
+                     results=[succeed({}), fail(GenerationMismatch())])
+        service.node_changed(NODE_STATE)
+        self.assertEqual(
+            sent[1:],
+            [(ClusterStatusDeltaCommand, sent[1][1]),
+             (ClusterStatusCommand,
+              dict(configuration=Deployment(),
+                   state=service.cluster_state.as_deployment(),
+                   generation=service.generation))])
+
+    def test_failure_forgets_generation(self):
+        """
+        If sending to a connection fails for some other reason, the next
+        change results in the full configuration and state being sent.
+        """
+        service = build_control_amp_service(self)
+        service.startService()
+        sent = []
+        self.connect(service, sent,
+                     results=[succeed({}), fail(ConnectionLost())])
+        service.node_changed(NODE_STATE)
+        service.configuration_service.save(TEST_DEPLOYMENT)
+        self.assertEqual(
+            [command for (command, _) in sent],
+            [ClusterStatusCommand, ClusterStatusDeltaCommand,
+             ClusterStatusCommand])
+
+    def test_disconnect_forgets_generation(self):
+        """
+        Disconnecting a connection removes its record of the generation it
+        was last sent.
+        """
+        service = build_control_amp_service(self)
+        service.startService()
+        protocol = self.connect(service, [])
+        protocol.connectionLost(Failure(ConnectionLost()))
+        self.assertEqual(service._connection_generations, {})
+
+    def test_coalesce_node_updates(self):
+        """
+        If a coalescing interval is given, node state updates received
+        within that interval are sent to agents as a single broadcast once
+        the interval has passed.
+        """
+        reactor = Clock()
+        service = build_control_amp_service(
+            self, reactor=reactor, coalesce_interval=0.1)
+        service.startService()
+        sent = []
+        self.connect(service, sent)
+        other_state = NodeState(hostname=u"192.0.2.1")
+        service.node_changed(NODE_STATE)
+        reactor.advance(0.05)
+        service.node_changed(other_state)
+        before = len(sent)
+        reactor.advance(0.05)
+        self.assertEqual(
+            (before, [command for (command, _) in sent],
+             set(sent[-1][1]["state_changes"].nodes)),
+            (1, [ClusterStatusCommand, ClusterStatusDeltaCommand],
+             {NODE_STATE, other_state}))
+
+    def test_coalesce_metrics(self):
+        """
+        ``ControlAMPService`` counts the node state updates it received, how
+        many of them were merged into an already scheduled broadcast, and
+        the number of broadcasts.
+        """
+        reactor = Clock()
+        service = build_control_amp_service(
+            self, reactor=reactor, coalesce_interval=0.1)
+        service.startService()
+        for i in range(3):
+            service.node_changed(NodeState(hostname=u"192.0.2.%d" % (i,)))
+        reactor.advance(0.1)
+        service.node_changed(NODE_STATE)
+        reactor.advance(0.1)
+        self.assertEqual(
+            (service.node_updates, service.coalesced_updates,
+             service.broadcasts),
+            (4, 2, 2))
+
+    @validate_logging(None)
+    def test_coalesce_logging(self, logger):
+        """
+        A coalesced broadcast logs the number of node state updates it
+        includes.
+        """
+        reactor = Clock()
+        service = build_control_amp_service(
+            self, reactor=reactor, coalesce_interval=0.1)
+        self.patch(service, 'logger', logger)
+        service.startService()
+        service.node_changed(NODE_STATE)
+        service.node_changed(NODE_STATE)
+        reactor.advance(0.1)
+        assertHasMessage(self, logger, LOG_COALESCED_NODE_UPDATES,
+                         {"updates": 2})
+
+    @validate_logging(None)
+    def test_single_update_not_logged(self, logger):
+        """
+        A broadcast of a single node state update, whether or not it was
+        delayed by a coalescing interval, is not logged as coalesced.
+        """
+        reactor = Clock()
+        immediate = build_control_amp_service(self)
+        delayed = build_control_amp_service(
+            self, reactor=reactor, coalesce_interval=0.1)
+        for service in (immediate, delayed):
+            self.patch(service, 'logger', logger)
+            service.startService()
+            service.node_changed(NODE_STATE)
+        reactor.advance(0.1)
+        self.assertEqual(
+            (2, []),
+            (immediate.broadcasts + delayed.broadcasts,
+             LoggedMessage.ofType(logger.messages,
+                                  LOG_COALESCED_NODE_UPDATES)))
+
+    def test_stop_cancels_coalesced_broadcast(self):
+        """
+        Stopping the service cancels any scheduled broadcast.
+        """
+        reactor = Clock()
+        service = build_control_amp_service(
+            self, reactor=reactor, coalesce_interval=0.1)
+        service.startService()
+        service.node_changed(NODE_STATE)
+        service.stopService()
+        self.assertEqual(reactor.getDelayedCalls(), [])
+
+    def test_broadcast_encoded_once(self):
+        """
+        Broadcasting a change to many agents serializes the changes only
+        once.
+        """
+        service = build_control_amp_service(self)
+        service.startService()
+        agents = [FakeAgent() for i in range(3)]
+        for agent in agents:
+            protocol = ControlAMP(service)
+            # Patching is bad.
+            # https://clusterhq.atlassian.net/browse/FLOC-1603
+            self.patch(protocol, "callRemote",
+                       LoopbackAMPClient(AgentAMP(agent).locator).callRemote)
+            protocol.makeConnection(StringTransport())
+        hits, misses = ENCODING_CACHE.hits, ENCODING_CACHE.misses
+        service.node_changed(NODE_STATE)
+        self.assertEqual(
+            (ENCODING_CACHE.hits - hits, ENCODING_CACHE.misses - misses,
+             [agent.actual for agent in agents]),
+            # Configuration and state changes are each encoded once:
+            (4, 2, [service.cluster_state.as_deployment()] * 3))
+
+    def test_agent_receives_changes(self):
+        """
+        An agent that receives a full update followed by deltas ends up
+        with the same configuration and state as the control service.
+        """
+        service = build_control_amp_service(self)
+        service.startService()
+        agent = FakeAgent()
+        protocol = ControlAMP(service)
+        # Patching is bad.
+        # https://clusterhq.atlassian.net/browse/FLOC-1603
+        self.patch(protocol, "callRemote",
+                   LoopbackAMPClient(AgentAMP(agent).locator).callRemote)
+        protocol.makeConnection(StringTransport())
+        service.configuration_service.save(TEST_DEPLOYMENT)
+        service.node_changed(NODE_STATE)
+        service.node_changed(NodeState(hostname=u"192.0.2.1"))
+        service.configuration_service.save(
+            TEST_DEPLOYMENT.update_node(Node(hostname=u"192.0.2.1")))
+        self.assertEqual(
+            (agent.desired, agent.actual),
+            (service.configuration_service.get(),
+             service.cluster_state.as_deployment()))
+
 
 @implementer(IConvergenceAgent)
 @attributes([Attribute("is_connected", default_value=False),
@@ -462,6 +1028,7 @@ class AgentClientTests(SynchronousTestCase):
             ClusterStatusCommand,
             configuration=TEST_DEPLOYMENT,
             state=actual,
+            generation=1,
             eliot_context=TEST_ACTION
         )
 
@@ -471,6 +1038,59 @@ class AgentClientTests(SynchronousTestCase):
                                                desired=TEST_DEPLOYMENT,
                                                actual=actual))
 
+    def test_cluster_changed(self):
+        """
+        ``ClusterStatusDeltaCommand`` sent to the ``AgentClient`` after a
+        ``ClusterStatusCommand`` results in the agent having the changes
+        applied to the previously received configuration and state.
+        """
+        self.client.makeConnection(StringTransport())
+        self.successResultOf(self.server.callRemote(
+            ClusterStatusCommand,
+            configuration=TEST_DEPLOYMENT,
+            state=DeploymentState(nodes=[NodeState(hostname=u"192.0.2.1")]),
+            generation=1,
+            eliot_context=TEST_ACTION
+        ))
+        new_node = Node(hostname=u"192.0.2.2")
+        d = self.server.callRemote(
+            ClusterStatusDeltaCommand,
+            base_generation=1,
+            generation=2,
+            configuration_changes=Deployment(nodes=[new_node]),
+            configuration_removals=[],
+            state_changes=DeploymentState(nodes=[NODE_STATE]),
+            state_removals=[u"192.0.2.1"],
+            eliot_context=TEST_ACTION
+        )
+        self.successResultOf(d)
+        self.assertEqual(
+            (self.agent.desired, self.agent.actual,
+             self.client.locator.generation),
+            (TEST_DEPLOYMENT.update_node(new_node),
+             DeploymentState(nodes=[NODE_STATE]), 2))
+
+    def test_cluster_changed_mismatch(self):
+        """
+        ``ClusterStatusDeltaCommand`` whose base generation is not the most
+        recently received generation fails with ``GenerationMismatch`` and
+        does not notify the agent.
+        """
+        self.client.makeConnection(StringTransport())
+        d = self.server.callRemote(
+            ClusterStatusDeltaCommand,
+            base_generation=1,
+            generation=2,
+            configuration_changes=TEST_DEPLOYMENT,
+            configuration_removals=[],
+            state_changes=DeploymentState(),
+            state_removals=[],
+            eliot_context=TEST_ACTION
+        )
+        self.failureResultOf(d, GenerationMismatch)
+        self.assertEqual(self.agent, FakeAgent(is_connected=True,
+                                               client=self.client))
+
 
 def iconvergence_agent_tests_factory(fixture):
     """
@@ -561,7 +1181,7 @@ class ClusterStatusCommandTests(SynchronousTestCase):
         ClusterStatusCommand requires the following arguments.
         """
         self.assertItemsEqual(
-            ['configuration', 'state', 'eliot_context'],
+            ['configuration', 'state', 'generation', 'eliot_context'],
             (v[0] for v in ClusterStatusCommand.arguments))
 
 
@@ -3,11 +3,13 @@
 from twisted.web.server import Site
 from twisted.trial.unittest import SynchronousTestCase
 from twisted.python.filepath import FilePath
+from twisted.python.usage import UsageError
 
 from ..script import ControlOptions, ControlScript
 from ...testtools import MemoryCoreReactor, StandardOptionsTestsMixin
 from .._clusterstate import ClusterStateService
 from .._protocol import ControlAMP, ControlAMPService
+from .._persistence import JSON_CODEC, COMPACT_CODEC
 from ..httpapi import REST_API_PORT
 
 
@@ -70,6 +72,102 @@ class ControlOptionsTests(StandardOptionsTestsMixin,
         options.parseOptions([b"--agent-port", b"tcp:1234"])
         self.assertEqual(options["agent-port"], b"tcp:1234")
 
+    def test_default_coalesce_interval(self):
+        """
+        By default node state updates are not coalesced.
+        """
+        options = ControlOptions()
+        options.parseOptions([])
+        self.assertEqual(options["coalesce-interval"], 0)
+
+    def test_custom_coalesce_interval(self):
+        """
+        The ``--coalesce-interval`` command-line option is converted to a
+        ``float``.
+        """
+        options = ControlOptions()
+        options.parseOptions([b"--coalesce-interval", b"0.5"])
+        self.assertEqual(options["coalesce-interval"], 0.5)
+
+    def test_default_configuration_format(self):
+        """
+        By default configuration is stored as JSON.
+        """
+        options = ControlOptions()
+        options.parseOptions([])
+        self.assertIs(options["configuration-format"], JSON_CODEC)
+
+    def test_custom_configuration_format(self):
+        """
+        The ``--configuration-format`` command-line option is converted to
+        the codec with that name.
+        """
+        options = ControlOptions()
+        options.parseOptions([b"--configuration-format", b"compact"])
+        self.assertIs(options["configuration-format"], COMPACT_CODEC)
+
+    def test_unknown_configuration_format(self):
+        """
+        An unknown ``--configuration-format`` is rejected.
+        """
+        options = ControlOptions()
+        self.assertRaises(UsageError, options.parseOptions,
+                          [b"--configuration-format", b"xml"])
+
+    def test_default_agent_format(self):
+        """
+        By default configuration and state are sent to agents as JSON.
+        """
+        options = ControlOptions()
+        options.parseOptions([])
+        self.assertIs(options["agent-format"], JSON_CODEC)
+
+    def test_custom_agent_format(self):
+        """
+        The ``--agent-format`` command-line option is converted to the codec
+        with that name.
+        """
+        options = ControlOptions()
+        options.parseOptions([b"--agent-format", b"compact"])
+        self.assertIs(options["agent-format"], COMPACT_CODEC)
+
+    def test_unknown_agent_format(self):
+        """
+        An unknown ``--agent-format`` is rejected.
+        """
+        options = ControlOptions()
+        self.assertRaises(UsageError, options.parseOptions,
+                          [b"--agent-format", b"xml"])
+
+    def test_journal_configuration(self):
+        """
+        Configuration is not journaled by default; the
+        ``--journal-configuration`` flag enables it.
+        """
+        default = ControlOptions()
+        default.parseOptions([])
+        journaled = ControlOptions()
+        journaled.parseOptions([b"--journal-configuration"])
+        self.assertEqual(
+            (default["journal-configuration"],
+             journaled["journal-configuration"]),
+            (False, True))
+
+    def test_configuration_commit_interval(self):
+        """
+        Configuration is written synchronously by default; the
+        ``--configuration-commit-interval`` option gives the number of
+        seconds saves are combined for when writing in the background.
+        """
+        default = ControlOptions()
+        default.parseOptions([])
+        custom = ControlOptions()
+        custom.parseOptions([b"--configuration-commit-interval", b"0.01"])
+        self.assertEqual(
+            (default["configuration-commit-interval"],
+             custom["configuration-commit-interval"]),
+            (None, 0.01))
+
 
 class ControlScriptEffectsTests(SynchronousTestCase):
     """
@@ -138,3 +236,72 @@ class ControlScriptEffectsTests(SynchronousTestCase):
         self.assertEqual(
             (port, protocol.__class__, protocol.control_amp_service.__class__),
             (8001, ControlAMP, ControlAMPService))
+
+    def test_control_amp_service_coalesce_interval(self):
+        """
+        ``ControlScript.main`` configures the AMP service with the given
+        coalescing interval.
+        """
+        options = ControlOptions()
+        options.parseOptions(
+            [b"--coalesce-interval", b"0.25", b"--data-path", self.mktemp()])
+        reactor = MemoryCoreReactor()
+        ControlScript().main(reactor, options)
+        service = reactor.tcpServers[1][1].buildProtocol(
+            None).control_amp_service
+        self.assertEqual((service._reactor, service._coalesce_interval),
+                         (reactor, 0.25))
+
+    def test_control_amp_service_agent_format(self):
+        """
+        ``ControlScript.main`` configures the AMP service with the given
+        agent format.
+        """
+        options = ControlOptions()
+        options.parseOptions(
+            [b"--agent-format", b"compact", b"--data-path", self.mktemp()])
+        reactor = MemoryCoreReactor()
+        ControlScript().main(reactor, options)
+        protocol = reactor.tcpServers[1][1].buildProtocol(None)
+        self.assertIs(protocol.codec, COMPACT_CODEC)
+
+    def test_persistence_configuration_format(self):
+        """
+        ``ControlScript.main`` stores configuration using the given format.
+        """
+        path = FilePath(self.mktemp())
+        options = ControlOptions()
+        options.parseOptions([b"--configuration-format", b"compact",
+                              b"--data-path", path.path])
+        ControlScript().main(MemoryCoreReactor(), options)
+        self.assertTrue(
+            path.child(b"current_configuration.v1.json").getContent(
+            ).startswith(b"\x00compact:"))
+
+    def test_persistence_journal(self):
+        """
+        ``ControlScript.main`` journals configuration changes if requested.
+        """
+        path = FilePath(self.mktemp())
+        options = ControlOptions()
+        options.parseOptions([b"--journal-configuration",
+                              b"--data-path", path.path])
+        ControlScript().main(MemoryCoreReactor(), options)
+        self.assertTrue(
+            path.child(b"current_configuration.v1.journal").exists())
+
+    def test_persistence_commit_interval(self):
+        """
+        ``ControlScript.main`` configures the persistence service to write
+        in the background with the given commit interval.
+        """
+        options = ControlOptions()
+        options.parseOptions([b"--configuration-commit-interval", b"0.5",
+                              b"--data-path", self.mktemp()])
+        reactor = MemoryCoreReactor()
+        ControlScript().main(reactor, options)
+        service = reactor.tcpServers[1][1].buildProtocol(
+            None).control_amp_service.configuration_service
+        self.addCleanup(service.stopService)
+        self.assertEqual((service._reactor, service._commit_interval),
+                         (reactor, 0.5))
@@ -5,8 +5,6 @@
 Deploy applications on nodes.
 """
 
-from itertools import chain
-
 from zope.interface import Interface, implementer, Attribute
 
 from characteristic import attributes
@@ -15,17 +13,25 @@ from pyrsistent import PRecord, field
 
 from eliot import write_failure, Logger
 
-from twisted.internet.defer import gatherResults, fail, succeed
+from twisted.internet.defer import (
+    gatherResults, fail, succeed, maybeDeferred, FirstError,
+)
 
-from ._docker import DockerClient, PortMap, Environment, Volume as DockerVolume
+from ._docker import (
+    DockerClient, DockerEvents, PortMap, Environment, Volume as DockerVolume,
+)
 from ..control._model import (
     Application, DatasetChanges, AttachedVolume, DatasetHandoff,
     NodeState, DockerImage, Port, Link, Manifestation, Dataset,
     pset_field,
     )
-from ..route import make_host_network, Proxy, OpenPort
-from ..volume._ipc import RemoteVolumeManager, standard_node
+from ..route import (
+    make_host_network, make_threaded_network, Proxy, OpenPort,
+    IBatchedNetwork, IAsyncNetwork,
+)
+from ..volume._ipc import StreamingRemoteVolumeManager, standard_node
 from ..volume._model import VolumeSize
+from ..volume.filesystems.interfaces import IStreamingFilesystem
 from ..volume.service import VolumeName
 from ..common import gather_deferreds
 
@@ -295,6 +301,26 @@ class WaitForDataset(object):
             _to_volume_name(self.dataset.dataset_id))
 
 
+def _remote_volume_manager(deployer, volume, hostname):
+    """
+    Create the remote volume manager used to push a dataset to another node.
+
+    :param P2PNodeDeployer deployer: The deployer running the push.
+    :param Volume volume: The volume being pushed.
+    :param bytes hostname: The node to push to.
+
+    :return: A manager using the deployer's ``transfer_pool`` if it has one
+        and the volume's filesystem can be streamed to it, or running
+        ``flocker-volume`` over SSH through the deployer's
+        ``connection_cache`` otherwise.
+    """
+    if (deployer.transfer_pool is not None and
+            IStreamingFilesystem.providedBy(volume.get_filesystem())):
+        return deployer.transfer_pool.remote_volume_manager(hostname)
+    return StreamingRemoteVolumeManager(
+        standard_node(hostname, connection_cache=deployer.connection_cache))
+
+
 @implementer(IStateChange)
 @attributes(["dataset", "hostname"])
 class HandoffDataset(object):
@@ -310,10 +336,9 @@ class HandoffDataset(object):
     """
     def run(self, deployer):
         service = deployer.volume_service
-        destination = standard_node(self.hostname)
+        volume = service.get(_to_volume_name(self.dataset.dataset_id))
         return service.handoff(
-            service.get(_to_volume_name(self.dataset.dataset_id)),
-            RemoteVolumeManager(destination))
+            volume, _remote_volume_manager(deployer, volume, self.hostname))
 
 
 @implementer(IStateChange)
@@ -331,10 +356,9 @@ class PushDataset(object):
     """
     def run(self, deployer):
         service = deployer.volume_service
-        destination = standard_node(self.hostname)
+        volume = service.get(_to_volume_name(self.dataset.dataset_id))
         return service.push(
-            service.get(_to_volume_name(self.dataset.dataset_id)),
-            RemoteVolumeManager(destination))
+            volume, _remote_volume_manager(deployer, volume, self.hostname))
 
 
 @implementer(IStateChange)
@@ -373,18 +397,25 @@ class SetProxies(object):
     """
     Set the ports which will be forwarded to other nodes.
 
+    Only proxies which are not already configured are created and only
+    proxies which are no longer wanted are deleted.
+
     :ivar proxy: A collection of ``Port`` objects.
     """
     def run(self, deployer):
+        if IAsyncNetwork.providedBy(deployer.network):
+            return deployer.network.set_proxies(self.ports)
+        if IBatchedNetwork.providedBy(deployer.network):
+            return maybeDeferred(deployer.network.set_proxies, self.ports)
         results = []
-        # XXX: The proxy manipulation operations are blocking. Convert to a
-        # non-blocking API. See https://clusterhq.atlassian.net/browse/FLOC-320
-        for proxy in deployer.network.enumerate_proxies():
+        current = set(deployer.network.enumerate_proxies())
+        desired = set(self.ports)
+        for proxy in current - desired:
             try:
                 deployer.network.delete_proxy(proxy)
             except:
                 results.append(fail())
-        for proxy in self.ports:
+        for proxy in desired - current:
             try:
                 deployer.network.create_proxy_to(proxy.ip, proxy.port)
             except:
@@ -397,21 +428,28 @@ class OpenPorts(PRecord):
     """
     Set the ports which will have the firewall opened.
 
+    Only ports which are not already open are opened and only ports which
+    are no longer wanted are closed.
+
     :ivar ports: A list of :class:`OpenPort`s.
     """
 
     ports = pset_field(OpenPort)
 
     def run(self, deployer):
+        if IAsyncNetwork.providedBy(deployer.network):
+            return deployer.network.set_open_ports(self.ports)
+        if IBatchedNetwork.providedBy(deployer.network):
+            return maybeDeferred(deployer.network.set_open_ports, self.ports)
         results = []
-        # XXX: The proxy manipulation operations are blocking. Convert to a
-        # non-blocking API. See https://clusterhq.atlassian.net/browse/FLOC-320
-        for open_port in deployer.network.enumerate_open_ports():
+        current = set(deployer.network.enumerate_open_ports())
+        desired = set(self.ports)
+        for open_port in current - desired:
             try:
                 deployer.network.delete_open_port(open_port)
             except:
                 results.append(fail())
-        for open_port in self.ports:
+        for open_port in desired - current:
             try:
                 deployer.network.open_port(open_port.port)
             except:
@@ -490,20 +528,53 @@ class ApplicationNodeDeployer(object):
     :ivar unicode hostname: The hostname of the node that this is running
             on.
     :ivar IDockerClient docker_client: The Docker client API to use in
-        deployment operations. Default ``DockerClient``.
-    :ivar INetwork network: The network routing API to use in
-        deployment operations. Default is iptables-based implementation.
+        deployment operations. Default ``DockerClient``, caching units
+        based on Docker events.
+    :ivar network: The ``INetwork`` or ``IAsyncNetwork`` provider to use
+        in deployment operations. Default is the iptables-based
+        implementation, run in its own thread so that it does not block the
+        reactor.
     """
     def __init__(self, hostname, docker_client=None,
                  network=None):
         self.hostname = hostname
         if docker_client is None:
-            docker_client = DockerClient()
+            docker_client = DockerClient(events=DockerEvents())
         self.docker_client = docker_client
         if network is None:
-            network = make_host_network()
+            network = make_threaded_network(make_host_network())
         self.network = network
 
+    def _discover_network(self):
+        """
+        Enumerate the network configuration.
+
+        :return: A ``Deferred`` which fires with a ``dict`` of the
+            ``used_ports``, ``proxies`` and ``open_ports`` fields of a
+            ``NodeState``.
+        """
+        d = gatherResults(
+            [maybeDeferred(self.network.enumerate_used_ports),
+             maybeDeferred(self.network.enumerate_proxies),
+             maybeDeferred(self.network.enumerate_open_ports)],
+            consumeErrors=True)
+
+        def discovered(results):
+            used_ports, proxies, open_ports = results
+            return dict(
+                used_ports=used_ports,
+                # Addresses are kept as text so the state can be sent to
+                # the control service:
+                proxies=[Proxy(ip=unicode(proxy.ip), port=proxy.port)
+                         for proxy in proxies],
+                open_ports=open_ports)
+
+        def discovery_failed(failure):
+            failure.trap(FirstError)
+            return failure.value.subFailure
+        d.addCallbacks(discovered, discovery_failed)
+        return d
+
     def discover_local_state(self, local_state):
         """
         List all the ``Application``\ s running on this node.
@@ -520,10 +591,16 @@ class ApplicationNodeDeployer(object):
         https://clusterhq.atlassian.net/browse/FLOC-1646.
 
         :return: A ``Deferred`` which fires with a ``NodeState`` instance
-            with information only about ``Application``.
+            with information only about ``Application``\ s and the network.
             ``NodeState.manifestations`` and ``NodeState.paths`` will not be
             filled in.
         """
+        # Each convergence iteration starts with discovery.  Make sure this
+        # iteration sees the current network configuration; the rest of it
+        # can reuse what is found now.
+        forgetting = maybeDeferred(self.network.forget_cached_state)
+        forgetting.addErrback(
+            write_failure, _logger, u"flocker:node:forget_network_state")
         if local_state.manifestations is None:
             # Without manifestations we don't know if local applications'
             # volumes are manifestations or not. Rather than return
@@ -531,12 +608,14 @@ class ApplicationNodeDeployer(object):
             # convergence actions, just declare ignorance. Eventually the
             # convergence agent for datasets will discover the information
             # and then we can proceed.
-            return succeed(NodeState(
+            return forgetting.addCallback(lambda _: NodeState(
                 hostname=self.hostname,
                 applications=None,
                 used_ports=None,
                 manifestations=None,
                 paths=None,
+                proxies=None,
+                open_ports=None,
             ))
 
         path_to_manifestations = {path: local_state.manifestations[dataset_id]
@@ -611,13 +690,16 @@ class ApplicationNodeDeployer(object):
                     running=(unit.activation_state == u"active"),
                 ))
 
-            return NodeState(
+            discovering = forgetting.addCallback(
+                lambda _: self._discover_network())
+            discovering.addCallback(lambda network: NodeState(
                 hostname=self.hostname,
                 applications=applications,
-                used_ports=self.network.enumerate_used_ports(),
                 manifestations=None,
                 paths=None,
-            )
+                **network
+            ))
+            return discovering
         d.addCallback(applications_from_units)
         return d
 
@@ -670,10 +752,16 @@ class ApplicationNodeDeployer(object):
                         desired_proxies.add(Proxy(ip=node.hostname,
                                                   port=port.external_port))
 
-        if desired_proxies != set(self.network.enumerate_proxies()):
+        # The network may only be usable asynchronously, so compare against
+        # the state discovery found rather than asking it again.  If that is
+        # not known the desired configuration is applied regardless; doing
+        # so is harmless if nothing has changed.
+        if local_state.proxies is None or (
+                desired_proxies != set(local_state.proxies)):
             phases.append(SetProxies(ports=desired_proxies))
 
-        if desired_open_ports != set(self.network.enumerate_open_ports()):
+        if local_state.open_ports is None or (
+                desired_open_ports != set(local_state.open_ports)):
             phases.append(OpenPorts(ports=desired_open_ports))
 
         # We are a node-specific IDeployer:
@@ -806,12 +894,8 @@ def change_node_state(deployer, desired_configuration,  current_cluster_state):
 
     :return: ``Deferred`` that fires when the necessary changes are done.
     """
-    nodes = [node for node in current_cluster_state.nodes
-             if node.hostname == deployer.hostname]
-    if nodes:
-        node = nodes[0]
-    else:
-        node = NodeState(hostname=deployer.hostname)
+    node = current_cluster_state.get_node(
+        deployer.hostname, default=NodeState(hostname=deployer.hostname))
     d = deployer.discover_local_state(node)
     d.addCallback(deployer.calculate_necessary_state_changes,
                   desired_configuration=desired_configuration,
@@ -845,65 +929,52 @@ def find_dataset_changes(hostname, current_state, desired_state):
     :return DatasetChanges: Changes to datasets that will be needed in
          order to match desired configuration.
     """
-    desired_datasets = {node.hostname:
-                        set(manifestation.dataset for manifestation
-                            in node.manifestations.values())
-                        for node in desired_state.nodes}
-    current_datasets = {node.hostname:
-                        set(manifestation.dataset for manifestation
-                            in node.manifestations.values())
-                        for node in current_state.nodes}
-    local_desired_datasets = desired_datasets.get(hostname, set())
-    local_desired_dataset_ids = set(dataset.dataset_id for dataset in
-                                    local_desired_datasets)
-    local_current_dataset_ids = set(dataset.dataset_id for dataset in
-                                    current_datasets.get(hostname, set()))
-    remote_current_dataset_ids = set()
-    for dataset_hostname, current in current_datasets.items():
-        if dataset_hostname != hostname:
-            remote_current_dataset_ids |= set(
-                dataset.dataset_id for dataset in current)
+    local_current = current_state.get_node(hostname)
+    if local_current is None or local_current.manifestations is None:
+        local_current_manifestations = {}
+    else:
+        local_current_manifestations = local_current.manifestations
+    local_desired = desired_state.get_node(hostname)
+    local_desired_datasets = set(
+        manifestation.dataset for manifestation
+        in local_desired.manifestations.values()
+    ) if local_desired is not None else set()
 
     # If a dataset exists locally and is desired anywhere on the cluster, and
     # the desired dataset is a different maximum_size to the existing dataset,
     # the existing local dataset should be resized before any other action
     # is taken on it.
     resizing = set()
-    for desired in desired_datasets.values():
-        for new_dataset in desired:
-            if new_dataset.dataset_id in local_current_dataset_ids:
-                for cur_dataset in current_datasets[hostname]:
-                    if cur_dataset.dataset_id != new_dataset.dataset_id:
-                        continue
-                    if cur_dataset.maximum_size != new_dataset.maximum_size:
-                        resizing.add(new_dataset)
-
     # Look at each dataset that is going to be running elsewhere and is
     # currently running here, and add a DatasetHandoff for it to `going`.
     going = set()
-    for dataset_hostname, desired in desired_datasets.items():
-        if dataset_hostname != hostname:
-            for dataset in desired:
-                if dataset.dataset_id in local_current_dataset_ids:
-                    going.add(DatasetHandoff(dataset=dataset,
-                                             hostname=dataset_hostname))
+    for dataset_id, current in local_current_manifestations.items():
+        for new_manifestation, node in desired_state.get_manifestations(
+                dataset_id):
+            new_dataset = new_manifestation.dataset
+            if current.dataset.maximum_size != new_dataset.maximum_size:
+                resizing.add(new_dataset)
+            if node.hostname != hostname:
+                going.add(DatasetHandoff(dataset=new_dataset,
+                                         hostname=node.hostname))
 
     # Look at each dataset that is going to be hosted on this node.  If it
     # was running somewhere else, we want that dataset to be in `coming`.
-    coming_dataset_ids = local_desired_dataset_ids.intersection(
-        remote_current_dataset_ids)
-    coming = set(dataset for dataset in local_desired_datasets
-                 if dataset.dataset_id in coming_dataset_ids)
+    coming = set(
+        dataset for dataset in local_desired_datasets
+        if any(node.hostname != hostname for _, node
+               in current_state.get_manifestations(dataset.dataset_id)))
 
     # For each dataset that is going to be hosted on this node and did not
     # exist previously, make sure that dataset is in `creating`.
-    creating_dataset_ids = local_desired_dataset_ids.difference(
-        local_current_dataset_ids | remote_current_dataset_ids)
+    current_datasets = current_state.nodes.index("dataset_id")
     creating = set(dataset for dataset in local_desired_datasets
-                   if dataset.dataset_id in creating_dataset_ids)
+                   if dataset.dataset_id not in current_datasets)
 
-    deleting = set(dataset for dataset in chain(*desired_datasets.values())
-                   if dataset.deleted)
+    deleting = set(manifestation.dataset
+                   for node in desired_state.nodes
+                   for manifestation in node.manifestations.values()
+                   if manifestation.dataset.deleted)
     return DatasetChanges(going=going, coming=coming, deleting=deleting,
                           creating=creating, resizing=resizing)
 
@@ -915,9 +986,14 @@ class P2PNodeDeployer(object):
 
     Temporary expedient, to be removed in FLOC-1553 or perhaps another
     sub-task of FLOC-1443.
+
+    :ivar transfer_pool: The ``VolumeTransferPool`` used to push datasets to
+        other nodes, or ``None`` to push them over SSH.
+    :ivar connection_cache: The ``SSHConnectionCache`` shared by datasets
+        pushed over SSH, or ``None`` to connect afresh for each command.
     """
     def __init__(self, hostname, volume_service, docker_client=None,
-                 network=None):
+                 network=None, transfer_pool=None, connection_cache=None):
         self.manifestations_deployer = P2PManifestationDeployer(
             hostname, volume_service)
         self.applications_deployer = ApplicationNodeDeployer(
@@ -926,6 +1002,8 @@ class P2PNodeDeployer(object):
         self.volume_service = self.manifestations_deployer.volume_service
         self.docker_client = self.applications_deployer.docker_client
         self.network = self.applications_deployer.network
+        self.transfer_pool = transfer_pool
+        self.connection_cache = connection_cache
 
     def discover_local_state(self, local_state):
         d = self.manifestations_deployer.discover_local_state(local_state)
@@ -7,10 +7,15 @@ Docker API client.
 
 from __future__ import absolute_import
 
+from collections import OrderedDict
+from json import JSONDecoder
+from threading import Lock, Thread
 from time import sleep
 
 from zope.interface import Interface, implementer
 
+from eliot import write_traceback
+
 from docker import Client
 from docker.errors import APIError
 from docker.utils import create_host_config
@@ -19,7 +24,9 @@ from pyrsistent import field, PRecord
 
 from twisted.python.components import proxyForInterface
 from twisted.python.filepath import FilePath
-from twisted.internet.defer import succeed, fail
+from twisted.internet.defer import (
+    succeed, fail, gatherResults, DeferredSemaphore, FirstError,
+)
 from twisted.internet.threads import deferToThread
 from twisted.web.http import NOT_FOUND, INTERNAL_SERVER_ERROR
 
@@ -274,6 +281,177 @@ class FakeDockerClient(object):
 BASE_NAMESPACE = u"flocker--"
 BASE_DOCKER_API_URL = u'unix://var/run/docker.sock'
 
+# Docker events that indicate a container was created, destroyed or
+# started or stopped running:
+_CONTAINER_EVENTS = frozenset([u"create", u"start", u"die", u"destroy"])
+
+
+class IDockerEvents(Interface):
+    """
+    A source of Docker container events.
+    """
+    def start(changed, lost):
+        """
+        Start delivering events.
+
+        Both callbacks are called in the reactor thread.  Once ``lost`` has
+        been called no further events will be delivered until ``start`` is
+        called again.
+
+        :param changed: One-argument callable, called with the ``unicode``
+            ID of a container each time it is created, destroyed, starts or
+            stops.
+
+        :param lost: No-argument callable, called if the event stream ends.
+            Any events that happen afterwards are missed.
+        """
+
+
+@implementer(IDockerEvents)
+class FakeDockerEvents(object):
+    """
+    In-memory fake of a Docker event stream, driven by test code.
+
+    :ivar int starts: The number of times ``start`` has been called.
+    """
+    def __init__(self):
+        self.starts = 0
+        self._changed = None
+        self._lost = None
+
+    def start(self, changed, lost):
+        self.starts += 1
+        self._changed = changed
+        self._lost = lost
+
+    def emit(self, container_id):
+        """
+        Deliver an event for a container, if events are being delivered.
+
+        :param unicode container_id: The container that changed.
+        """
+        if self._changed is not None:
+            self._changed(container_id)
+
+    def lose(self):
+        """
+        End the event stream.
+        """
+        lost = self._lost
+        self._changed = self._lost = None
+        if lost is not None:
+            lost()
+
+
+def _parse_events(chunks):
+    """
+    Parse the JSON objects in a Docker event stream.
+
+    :param chunks: Iterable of ``bytes`` from the ``/events`` HTTP response;
+        objects may be split across chunks, or several may share one.
+
+    :return: Iterable of ``dict``, one per event.
+    """
+    decoder = JSONDecoder()
+    buffered = b""
+    for chunk in chunks:
+        buffered += chunk
+        while True:
+            buffered = buffered.lstrip()
+            if not buffered:
+                break
+            try:
+                event, end = decoder.raw_decode(buffered)
+            except ValueError:
+                # The rest of the object is in a later chunk:
+                break
+            buffered = buffered[end:]
+            yield event
+
+
+@implementer(IDockerEvents)
+class DockerEvents(object):
+    """
+    Read events from the Docker ``/events`` API.
+
+    The HTTP response never finishes, so it is read by a dedicated daemon
+    thread rather than tying up a thread in the reactor's pool.
+    """
+    def __init__(self, base_url=BASE_DOCKER_API_URL, reactor=None):
+        """
+        :param unicode base_url: The Docker API to connect to.
+
+        :param reactor: The reactor to deliver events in, by default the
+            global reactor.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        # Events can be minutes apart on a quiet host, so reading them must
+        # not time out; each timeout would throw away the units cached by
+        # ``DockerClient``.
+        self._client = Client(version="1.15", base_url=base_url, timeout=None)
+        self._reactor = reactor
+
+    def _read(self, changed, lost):
+        """
+        Read events until the stream ends, passing them to the reactor
+        thread.
+        """
+        try:
+            for event in _parse_events(self._client.events()):
+                if event.get(u"status") in _CONTAINER_EVENTS:
+                    self._reactor.callFromThread(changed, event[u"id"])
+        except:
+            write_traceback()
+        finally:
+            self._reactor.callFromThread(lost)
+
+    def start(self, changed, lost):
+        thread = Thread(target=self._read, args=(changed, lost),
+                        name="flocker-docker-events")
+        thread.daemon = True
+        thread.start()
+
+
+class _LRUCache(object):
+    """
+    A thread-safe mapping which holds a limited number of entries, evicting
+    the least recently used.
+    """
+    def __init__(self, size):
+        """
+        :param int size: The maximum number of entries.
+        """
+        self._size = size
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, create):
+        """
+        Get the value for a key, creating it if necessary.
+
+        :param key: The key to look up.
+        :param create: One-argument callable which creates the value for a
+            key that isn't in the cache.  It is called without holding the
+            lock, so may occasionally be called more than once for a key.
+
+        :return: The value for ``key``.
+        """
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                pass
+            else:
+                self._entries[key] = value
+                return value
+        value = create(key)
+        with self._lock:
+            self._entries[key] = value
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+        return value
+
 
 @implementer(IDockerClient)
 class DockerClient(object):
@@ -284,13 +462,51 @@ class DockerClient(object):
     use a thread pool. See https://clusterhq.atlassian.net/browse/FLOC-718
     for using a custom thread pool.
 
+    If given an ``IDockerEvents`` provider the units are cached in memory:
+    all containers are inspected once, and afterwards only those that
+    Docker reports events for (or that were added or removed through this
+    client) are inspected again.  Those events can also be passed on with
+    ``add_change_listener``.
+
     :ivar unicode namespace: A namespace prefix to add to container names
         so we don't clobber other applications interacting with Docker.
     """
     def __init__(self, namespace=BASE_NAMESPACE,
-                 base_url=BASE_DOCKER_API_URL):
+                 base_url=BASE_DOCKER_API_URL, events=None,
+                 inspect_concurrency=8, image_cache_size=256):
+        """
+        :param unicode namespace: See ``namespace`` above.
+
+        :param unicode base_url: The Docker API to connect to.
+
+        :param IDockerEvents events: Events used to keep the cache of units
+            up to date, or ``None`` to inspect all containers on every call
+            to ``list``.
+
+        :param int inspect_concurrency: The maximum number of containers to
+            inspect at once.
+
+        :param int image_cache_size: The number of images whose environment
+            variables are remembered.
+        """
         self.namespace = namespace
         self._client = Client(version="1.15", base_url=base_url)
+        self._events = events
+        self._inspections = DeferredSemaphore(inspect_concurrency)
+        # Maps image IDs to the image's environment variables:
+        self._image_environments = _LRUCache(image_cache_size)
+        # Maps container ID to its ``Unit``, or to ``None`` for containers
+        # outside our namespace.  ``None`` until events are being received
+        # and all containers have been inspected:
+        self._units = None
+        # Container IDs or names which need inspecting again:
+        self._stale = set()
+        self._listening = False
+        # Called with no arguments when a container may have changed:
+        self._change_listeners = []
+        # Incremented whenever events are lost, so that inspections that
+        # started beforehand are not trusted:
+        self._generation = 0
 
     def _to_container_name(self, unit_name):
         """
@@ -451,6 +667,7 @@ class DockerClient(object):
                 continue
             self._client.start(container_name)
         d = deferToThread(_add)
+        d.addBoth(self._mark_stale, container_name)
 
         def _extract_error(failure):
             failure.trap(APIError)
@@ -518,85 +735,263 @@ class DockerClient(object):
                 # it's definitely necessary:
                 raise
         d = deferToThread(_remove)
+        d.addBoth(self._mark_stale, container_name)
         return d
 
-    def list(self):
-        def _list():
-            result = set()
-            ids = [d[u"Id"] for d in
-                   self._client.containers(quiet=True, all=True)]
-            for i in ids:
+    def _mark_stale(self, result, container):
+        """
+        Note that a container needs inspecting again before it is next
+        listed.
 
-                try:
-                    data = self._client.inspect_container(i)
-                except APIError as e:
-                    # The container ID returned by the list API call above, may
-                    # have been removed in another thread.
-                    if e.response.status_code == NOT_FOUND:
-                        continue
+        :param result: Passed through.
+        :param unicode container: The ID or name of the container.
 
-                state = (u"active" if data[u"State"][u"Running"]
-                         else u"inactive")
-                name = data[u"Name"]
-                image = data[u"Config"][u"Image"]
-                port_bindings = data[u"HostConfig"][u"PortBindings"]
-                if port_bindings is not None:
-                    ports = self._parse_container_ports(port_bindings)
-                else:
-                    ports = list()
-                volumes = []
-                binds = data[u"HostConfig"]['Binds']
-                if binds is not None:
-                    for bind_config in binds:
-                        parts = bind_config.split(':', 2)
-                        node_path, container_path = parts[:2]
-                        volumes.append(
-                            Volume(container_path=FilePath(container_path),
-                                   node_path=FilePath(node_path))
-                        )
-                if name.startswith(u"/" + self.namespace):
-                    name = name[1 + len(self.namespace):]
+        :return: ``result``
+        """
+        if self._events is not None:
+            self._stale.add(container)
+        return result
+
+    def add_change_listener(self, listener):
+        """
+        Call ``listener`` whenever Docker reports that a container was
+        created, destroyed, started or stopped, and whenever such reports
+        may have been missed.
+
+        Events are listened to from now on, rather than from the next call
+        to ``list``.  Without an ``IDockerEvents`` provider this does
+        nothing.
+
+        :param listener: No-argument callable, called in the reactor thread.
+        """
+        if self._events is None:
+            return
+        self._change_listeners.append(listener)
+        self._listen()
+
+    def _listen(self):
+        """
+        Start receiving events, if not doing so already.
+        """
+        if not self._listening:
+            self._listening = True
+            self._events.start(self._container_changed, self._events_lost)
+
+    def _container_changed(self, container_id):
+        """
+        Note that Docker reported an event for a container.
+
+        :param unicode container_id: The ID of the container.
+        """
+        self._stale.add(container_id)
+        self._notify_listeners()
+
+    def _events_lost(self):
+        """
+        Stop trusting the cached units, since we may have missed events.
+        """
+        self._listening = False
+        self._units = None
+        self._generation += 1
+        # Listeners are told too, since they may have missed changes; the
+        # next ``list`` starts listening again.
+        self._notify_listeners()
+
+    def _notify_listeners(self):
+        """
+        Call the listeners added with ``add_change_listener``.
+        """
+        for listener in self._change_listeners:
+            listener()
+
+    def _blocking_inspect(self, container):
+        """
+        Blocking API to inspect a container.
+
+        :param unicode container: The ID or name of the container.
+
+        :return: ``None`` if the container doesn't exist, otherwise a tuple
+            of the container's ID and its ``Unit``, or ``None`` instead of a
+            ``Unit`` if the container is outside our namespace.
+        """
+        try:
+            data = self._client.inspect_container(container)
+        except APIError as e:
+            # The container may have been removed in another thread.
+            if e.response.status_code == NOT_FOUND:
+                return None
+            raise
+        return data[u"Id"], self._unit_from_inspection(data)
+
+    def _inspect(self, containers):
+        """
+        Inspect containers, several at a time.
+
+        :param containers: Iterable of container IDs or names.
+
+        :return: ``Deferred`` firing with a ``dict`` mapping each of
+            ``containers`` to the result of ``_blocking_inspect`` for it.
+        """
+        containers = list(containers)
+        d = gatherResults(
+            [self._inspections.run(
+                deferToThread, self._blocking_inspect, container)
+             for container in containers],
+            consumeErrors=True)
+
+        def inspection_failed(failure):
+            failure.trap(FirstError)
+            return failure.value.subFailure
+        d.addCallbacks(lambda results: dict(zip(containers, results)),
+                       inspection_failed)
+        return d
+
+    def _list_all(self):
+        """
+        Inspect all containers.
+
+        :return: ``Deferred`` firing with a ``dict`` mapping container IDs
+            to ``Unit``, or to ``None`` for containers outside our
+            namespace.
+        """
+        d = deferToThread(self._client.containers, quiet=True, all=True)
+        d.addCallback(lambda containers: self._inspect(
+            container[u"Id"] for container in containers))
+
+        def inspected(results):
+            # Containers may have been removed in the meantime:
+            return dict(inspection for inspection in results.values()
+                        if inspection is not None)
+        return d.addCallback(inspected)
+
+    def _refresh(self):
+        """
+        Bring the cached units up to date, inspecting containers again only
+        if they are stale.
+
+        :return: ``Deferred`` firing with the ``dict`` of cached units.
+        """
+        generation = self._generation
+        if self._units is None:
+            # Start receiving events before inspecting everything, so that
+            # no change goes unnoticed:
+            self._listen()
+            self._stale.clear()
+            d = self._list_all()
+
+            def listed(units):
+                if generation == self._generation:
+                    self._units = units
+                return units
+            return d.addCallback(listed)
+
+        stale = set(self._stale)
+        self._stale.clear()
+        if not stale:
+            return succeed(self._units)
+        d = self._inspect(stale)
+
+        def inspected(results):
+            units = self._units
+            if generation != self._generation or units is None:
+                # Events were lost meanwhile; everything gets reinspected
+                # next time, but this result is still good enough for now:
+                units = dict(units or {})
+            for container, inspection in results.items():
+                if inspection is None:
+                    # Gone; ``container`` may be an ID or a name:
+                    units.pop(container, None)
+                    for container_id, unit in units.items():
+                        if (unit is not None and
+                                unit.container_name == container):
+                            del units[container_id]
                 else:
-                    continue
-                # Retrieve environment variables for this container,
-                # disregarding any environment variables that are part
-                # of the image, rather than supplied in the configuration.
-                image_data = self._client.inspect_image(image)
-                unit_environment = []
-                container_environment = data[u"Config"][u"Env"]
-                image_environment = image_data[u"Config"]["Env"]
-                for environment in container_environment:
-                    if environment not in image_environment:
-                        env_key, env_value = environment.split('=', 1)
-                        unit_environment.append((env_key, env_value))
-                unit_environment = (
-                    Environment(variables=frozenset(unit_environment))
-                    if unit_environment else None
-                )
-                # Our Unit model counts None as the value for cpu_shares and
-                # mem_limit in containers without specified limits, however
-                # Docker returns the values in these cases as zero, so we
-                # manually convert.
-                cpu_shares = data[u"Config"][u"CpuShares"]
-                cpu_shares = None if cpu_shares == 0 else cpu_shares
-                mem_limit = data[u"Config"][u"Memory"]
-                mem_limit = None if mem_limit == 0 else mem_limit
-                restart_policy = self._parse_restart_policy(
-                    data[U"HostConfig"][u"RestartPolicy"])
-                result.add(Unit(
-                    name=name,
-                    container_name=self._to_container_name(name),
-                    activation_state=state,
-                    container_image=image,
-                    ports=frozenset(ports),
-                    volumes=frozenset(volumes),
-                    environment=unit_environment,
-                    mem_limit=mem_limit,
-                    cpu_shares=cpu_shares,
-                    restart_policy=restart_policy)
+                    container_id, unit = inspection
+                    units[container_id] = unit
+            return units
+        return d.addCallback(inspected)
+
+    def list(self):
+        if self._events is None:
+            d = self._list_all()
+        else:
+            d = self._refresh()
+        d.addCallback(lambda units: set(
+            unit for unit in units.values() if unit is not None))
+        return d
+
+    def _unit_from_inspection(self, data):
+        """
+        Create a ``Unit`` from the result of inspecting a container.
+
+        :param dict data: The result of ``inspect_container``.
+
+        :return: The ``Unit``, or ``None`` if the container is outside our
+            namespace.
+        """
+        state = (u"active" if data[u"State"][u"Running"]
+                 else u"inactive")
+        name = data[u"Name"]
+        image = data[u"Config"][u"Image"]
+        port_bindings = data[u"HostConfig"][u"PortBindings"]
+        if port_bindings is not None:
+            ports = self._parse_container_ports(port_bindings)
+        else:
+            ports = list()
+        volumes = []
+        binds = data[u"HostConfig"]['Binds']
+        if binds is not None:
+            for bind_config in binds:
+                parts = bind_config.split(':', 2)
+                node_path, container_path = parts[:2]
+                volumes.append(
+                    Volume(container_path=FilePath(container_path),
+                           node_path=FilePath(node_path))
                 )
-            return result
-        return deferToThread(_list)
+        if name.startswith(u"/" + self.namespace):
+            name = name[1 + len(self.namespace):]
+        else:
+            return None
+        # Retrieve environment variables for this container,
+        # disregarding any environment variables that are part
+        # of the image, rather than supplied in the configuration.
+        # Many containers typically share an image, and an image ID always
+        # refers to the same image, so the image's environment is cached:
+        image_environment = self._image_environments.get(
+            data[u"Image"],
+            lambda image_id: self._client.inspect_image(
+                image_id)[u"Config"][u"Env"] or [])
+        unit_environment = []
+        container_environment = data[u"Config"][u"Env"]
+        for environment in container_environment:
+            if environment not in image_environment:
+                env_key, env_value = environment.split('=', 1)
+                unit_environment.append((env_key, env_value))
+        unit_environment = (
+            Environment(variables=frozenset(unit_environment))
+            if unit_environment else None
+        )
+        # Our Unit model counts None as the value for cpu_shares and
+        # mem_limit in containers without specified limits, however
+        # Docker returns the values in these cases as zero, so we
+        # manually convert.
+        cpu_shares = data[u"Config"][u"CpuShares"]
+        cpu_shares = None if cpu_shares == 0 else cpu_shares
+        mem_limit = data[u"Config"][u"Memory"]
+        mem_limit = None if mem_limit == 0 else mem_limit
+        restart_policy = self._parse_restart_policy(
+            data[U"HostConfig"][u"RestartPolicy"])
+        return Unit(
+            name=name,
+            container_name=self._to_container_name(name),
+            activation_state=state,
+            container_image=image,
+            ports=frozenset(ports),
+            volumes=frozenset(volumes),
+            environment=unit_environment,
+            mem_limit=mem_limit,
+            cpu_shares=cpu_shares,
+            restart_policy=restart_policy)
 
 
 class NamespacedDockerClient(proxyForInterface(IDockerClient, "_client")):
@@ -611,9 +1006,11 @@ class NamespacedDockerClient(proxyForInterface(IDockerClient, "_client")):
     containers in ``/flocker/`` and this class would look at containers in
     in ``/flocker/<namespace>/``.
     """
-    def __init__(self, namespace, base_url=BASE_DOCKER_API_URL):
+    def __init__(self, namespace, base_url=BASE_DOCKER_API_URL, events=None):
         """
         :param unicode namespace: Namespace to restrict containers to.
+
+        :param IDockerEvents events: See ``DockerClient``.
         """
         self._client = DockerClient(
-            namespace=BASE_NAMESPACE + namespace + u"--")
+            namespace=BASE_NAMESPACE + namespace + u"--", events=events)
@@ -13,12 +13,14 @@ The ClusterStatus state machine receives inputs from the connection to the
 control service, and sends inputs to the ConvergenceLoop state machine.
 """
 
+from random import uniform
+
 from zope.interface import implementer
 
 from eliot import ActionType, Field
 from eliot.twisted import DeferredContext
 
-from characteristic import attributes
+from characteristic import attributes, Attribute
 
 from machinist import (
     trivialInput, TransitionTable, constructFiniteStateMachine,
@@ -33,6 +35,7 @@ from ..control._protocol import (
     NodeStateCommand, IConvergenceAgent, AgentAMP,
     )
 from ..control import NodeState
+from ._deploy import Sequentially, InParallel
 
 
 class ClusterStatusInputs(Names):
@@ -196,6 +199,9 @@ class ConvergenceLoopInputs(Names):
     # Finished applying necessary changes to local state, a single
     # iteration of the convergence loop:
     ITERATION_DONE = NamedConstant()
+    # Something may have changed (the desired configuration, or local
+    # state), or the idle timer expired; another iteration is needed:
+    WAKEUP = NamedConstant()
 
 
 @attributes(["client", "configuration", "state"])
@@ -222,6 +228,12 @@ class ConvergenceLoopStates(Names):
     # Local state is being converged, and once that is done we will
     # immediately stop:
     CONVERGING_STOPPING = NamedConstant()
+    # Local state is being converged, and we were woken up in the meantime
+    # so once that is done we will immediately start another iteration:
+    CONVERGING_WOKEN = NamedConstant()
+    # An iteration finished and nothing is known to have changed since; we
+    # are waiting for a wakeup:
+    SLEEPING = NamedConstant()
 
 
 class ConvergenceLoopOutputs(Names):
@@ -233,6 +245,10 @@ class ConvergenceLoopOutputs(Names):
     STORE_INFO = NamedConstant()
     # Start an iteration of the covergence loop:
     CONVERGE = NamedConstant()
+    # Schedule a WAKEUP input after the idle interval:
+    SCHEDULE_WAKEUP = NamedConstant()
+    # Cancel the scheduled WAKEUP input, if it is still pending:
+    CANCEL_WAKEUP = NamedConstant()
 
 
 _FIELD_CONNECTION = Field(
@@ -246,6 +262,38 @@ LOG_SEND_TO_CONTROL_SERVICE = ActionType(
     "Send the local state to the control service.")
 
 
+def _has_changes(change):
+    """
+    Determine whether a calculated state change actually does anything.
+
+    :param IStateChange change: The result of
+        ``IDeployer.calculate_necessary_state_changes``.
+
+    :return: ``False`` if ``change`` is made up only of empty
+        ``Sequentially`` and ``InParallel`` changes, otherwise ``True``.
+    """
+    if isinstance(change, (Sequentially, InParallel)):
+        return any(_has_changes(c) for c in change.changes)
+    return True
+
+
+@attributes([
+    Attribute("interval", default_value=None),
+    Attribute("iterations", default_value=0),
+    Attribute("last_iteration_duration", default_value=None),
+])
+class ConvergenceLoopMetrics(object):
+    """
+    Statistics about a convergence loop, updated as it runs.
+
+    :ivar float interval: Seconds the loop last slept for (before jitter)
+        after an iteration, or ``None`` if it hasn't slept yet.
+    :ivar int iterations: Number of completed convergence iterations.
+    :ivar float last_iteration_duration: Seconds the last completed
+        iteration took, or ``None`` if none has completed yet.
+    """
+
+
 class ConvergenceLoop(object):
     """
     World object for the convergence loop state machine, executing the actions
@@ -260,28 +308,145 @@ class ConvergenceLoop(object):
     :ivar Deployment state: Actual cluster state.  Initially ``None``.
 
     :ivar fsm: The finite state machine this is part of.
+
+    :ivar float heartbeat_interval: Seconds after which the complete local
+        state is sent to the control service even if it hasn't changed.
     """
-    def __init__(self, reactor, deployer):
+    heartbeat_interval = 60.0
+
+    def __init__(self, reactor, deployer, interval=1.0, max_interval=None,
+                 jitter=0.0, metrics=None):
         """
         :param IReactorTime reactor: Used to schedule delays in the loop.
 
         :param IDeployer deployer: Used to discover local state and calculate
             necessary changes to match desired configuration.
+
+        :param float interval: Seconds to sleep between iterations when
+            nothing is known to have changed.
+
+        :param max_interval: Seconds the sleep between iterations may back
+            off to while no changes are necessary, or ``None`` to always
+            use ``interval``.
+
+        :param float jitter: Sleeps are randomly lengthened or shortened by
+            up to this fraction, so that many agents started together don't
+            stay in lockstep.
+
+        :param ConvergenceLoopMetrics metrics: Updated as the loop runs.
         """
+        if max_interval is None:
+            max_interval = interval
+        if metrics is None:
+            metrics = ConvergenceLoopMetrics()
         self.reactor = reactor
         self.deployer = deployer
+        self.interval = interval
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.metrics = metrics
+        self.configuration = None
+        self._wakeup_call = None
+        self._next_interval = interval
+        self._changes_calculated = False
+        # (client, NodeState, time of last complete send) for the last
+        # local state the control service acknowledged, or None if there
+        # is no such state or an update is in flight:
+        self._acknowledged = None
+        self._sends = 0
 
     def output_STORE_INFO(self, context):
+        changed = (self.configuration is not None and
+                   context.configuration != self.configuration)
         self.client, self.configuration, self.cluster_state = (
             context.client, context.configuration, context.state)
+        if changed:
+            # Changes to cluster state alone are picked up by the next
+            # scheduled iteration, but a new desired configuration should be
+            # acted on straight away.
+            self._next_interval = self.interval
+            self.fsm.receive(ConvergenceLoopInputs.WAKEUP)
+
+    def output_SCHEDULE_WAKEUP(self, context):
+        # Keep iterating quickly while there is work to do, otherwise back
+        # off exponentially:
+        if self._changes_calculated:
+            self._next_interval = self.interval
+        interval = self._next_interval
+        self._next_interval = min(interval * 2, self.max_interval)
+        self.metrics.interval = interval
+        self._wakeup_call = self.reactor.callLater(
+            interval * uniform(1 - self.jitter, 1 + self.jitter),
+            self.fsm.receive, ConvergenceLoopInputs.WAKEUP)
+
+    def output_CANCEL_WAKEUP(self, context):
+        if self._wakeup_call.active():
+            self._wakeup_call.cancel()
+        self._wakeup_call = None
+
+    def _local_state_update(self, local_state):
+        """
+        Calculate the update the control service needs to learn about the
+        discovered local state.
 
-    def output_CONVERGE(self, context):
-        nodes = [node for node in self.cluster_state.nodes
-                 if node.hostname == self.deployer.hostname]
-        if nodes:
-            known_local_state = nodes[0]
+        :param NodeState local_state: The discovered local state.
+
+        :return: ``None`` if nothing needs to be sent, otherwise the
+            ``NodeState`` to send; fields the control service already knows
+            about are set to ``None``.
+        """
+        if self._acknowledged is None:
+            return local_state
+        client, acknowledged, last_complete = self._acknowledged
+        if client is not self.client or (
+                self.reactor.seconds() - last_complete >=
+                self.heartbeat_interval):
+            return local_state
+        if acknowledged == local_state:
+            return None
+        update = local_state
+        for key, value in local_state.items():
+            if key != "hostname" and acknowledged.get(key) == value:
+                update = update.set(key, None)
+        return update
+
+    def _send_local_state(self, local_state):
+        """
+        Send whatever changed in the local state to the control service.
+
+        :param NodeState local_state: The discovered local state.
+        """
+        update = self._local_state_update(local_state)
+        if update is None:
+            return
+        client = self.client
+        if update is local_state:
+            last_complete = self.reactor.seconds()
         else:
-            known_local_state = NodeState(hostname=self.deployer.hostname)
+            last_complete = self._acknowledged[2]
+        # Until this update is acknowledged we don't know what the control
+        # service knows, so the next update will be complete:
+        self._acknowledged = None
+        self._sends += 1
+        send = self._sends
+        with LOG_SEND_TO_CONTROL_SERVICE(
+                self.fsm.logger, connection=client) as context:
+            d = client.callRemote(NodeStateCommand,
+                                  node_state=update,
+                                  eliot_context=context)
+
+        def acknowledged(_):
+            # Acknowledgement of an older update says nothing about the
+            # newer one in flight:
+            if send == self._sends:
+                self._acknowledged = (client, local_state, last_complete)
+        d.addCallback(acknowledged)
+
+    def output_CONVERGE(self, context):
+        started = self.reactor.seconds()
+        known_local_state = self.cluster_state.get_node(
+            self.deployer.hostname,
+            default=NodeState(hostname=self.deployer.hostname))
         d = DeferredContext(self.deployer.discover_local_state(
             known_local_state))
 
@@ -289,63 +454,92 @@ class ConvergenceLoop(object):
             # Current cluster state is likely out of date as regards the local
             # state, so update it accordingly.
             self.cluster_state = self.cluster_state.update_node(local_state)
-            with LOG_SEND_TO_CONTROL_SERVICE(
-                    self.fsm.logger, connection=self.client) as context:
-                self.client.callRemote(NodeStateCommand,
-                                       node_state=local_state,
-                                       eliot_context=context)
+            self._send_local_state(local_state)
             action = self.deployer.calculate_necessary_state_changes(
                 local_state, self.configuration, self.cluster_state
             )
+            self._changes_calculated = _has_changes(action)
             return action.run(self.deployer)
         d.addCallback(got_local_state)
 
-        # It would be better to have a "quiet time" state in the FSM and
-        # transition to that next, then have a timeout input kick the machine
-        # back around to the beginning of the loop in the FSM.  However, we're
-        # not going to keep this sleep-for-a-bit solution in the long term.
-        # Instead, we'll be more event driven.  So just going with the simple
-        # solution and inserting a side-effect-y delay directly here.
-
-        d.addCallback(
-            lambda _:
-                self.reactor.callLater(
-                    1.0, self.fsm.receive, ConvergenceLoopInputs.ITERATION_DONE
-                )
-        )
+        def iteration_done(_):
+            self.metrics.iterations += 1
+            self.metrics.last_iteration_duration = (
+                self.reactor.seconds() - started)
+            self.fsm.receive(ConvergenceLoopInputs.ITERATION_DONE)
+        d.addCallback(iteration_done)
         # This needs error handling:
         # https://clusterhq.atlassian.net/browse/FLOC-1357
 
 
-def build_convergence_loop_fsm(reactor, deployer):
+def build_convergence_loop_fsm(reactor, deployer, interval=1.0,
+                               max_interval=None, jitter=0.0, metrics=None):
     """
     Create a convergence loop FSM.
 
+    Once an iteration is done the loop sleeps until it is woken up, either
+    by a new desired configuration, by a ``WAKEUP`` input sent because
+    local state may have changed, or by the idle timer.  The idle timer
+    starts at ``interval`` and doubles after each iteration that had no
+    changes to make, up to ``max_interval``.
+
     :param IReactorTime reactor: Used to schedule delays in the loop.
 
     :param IDeployer deployer: Used to discover local state and calcualte
         necessary changes to match desired configuration.
+
+    :param float interval: Seconds to sleep between iterations when
+        nothing is known to have changed.
+
+    :param max_interval: Seconds the sleep between iterations may back off
+        to, or ``None`` to always use ``interval``.
+
+    :param float jitter: Fraction by which sleeps are randomly varied.
+
+    :param ConvergenceLoopMetrics metrics: Updated as the loop runs.
     """
     I = ConvergenceLoopInputs
     O = ConvergenceLoopOutputs
     S = ConvergenceLoopStates
 
     table = TransitionTable()
-    table = table.addTransition(
-        S.STOPPED, I.STATUS_UPDATE, [O.STORE_INFO, O.CONVERGE], S.CONVERGING)
+    table = table.addTransitions(
+        S.STOPPED, {
+            I.STATUS_UPDATE: ([O.STORE_INFO, O.CONVERGE], S.CONVERGING),
+            # We'll discover everything once we're started anyway:
+            I.WAKEUP: ([], S.STOPPED),
+        })
     table = table.addTransitions(
         S.CONVERGING, {
             I.STATUS_UPDATE: ([O.STORE_INFO], S.CONVERGING),
             I.STOP: ([], S.CONVERGING_STOPPING),
+            I.ITERATION_DONE: ([O.SCHEDULE_WAKEUP], S.SLEEPING),
+            # Discovery may already have happened, so remember to go around
+            # again:
+            I.WAKEUP: ([], S.CONVERGING_WOKEN),
+        })
+    table = table.addTransitions(
+        S.CONVERGING_WOKEN, {
+            I.STATUS_UPDATE: ([O.STORE_INFO], S.CONVERGING_WOKEN),
+            I.STOP: ([], S.CONVERGING_STOPPING),
             I.ITERATION_DONE: ([O.CONVERGE], S.CONVERGING),
+            I.WAKEUP: ([], S.CONVERGING_WOKEN),
         })
     table = table.addTransitions(
         S.CONVERGING_STOPPING, {
             I.STATUS_UPDATE: ([O.STORE_INFO], S.CONVERGING),
             I.ITERATION_DONE: ([], S.STOPPED),
+            I.WAKEUP: ([], S.CONVERGING_STOPPING),
+        })
+    table = table.addTransitions(
+        S.SLEEPING, {
+            I.STATUS_UPDATE: ([O.STORE_INFO], S.SLEEPING),
+            I.STOP: ([O.CANCEL_WAKEUP], S.STOPPED),
+            I.WAKEUP: ([O.CANCEL_WAKEUP, O.CONVERGE], S.CONVERGING),
         })
 
-    loop = ConvergenceLoop(reactor, deployer)
+    loop = ConvergenceLoop(reactor, deployer, interval, max_interval, jitter,
+                           metrics)
     fsm = constructFiniteStateMachine(
         inputs=I, outputs=O, states=S, initial=S.STOPPED, table=table,
         richInputs=[_ClientStatusUpdate], inputContext={},
@@ -355,7 +549,8 @@ def build_convergence_loop_fsm(reactor, deployer):
 
 
 @implementer(IConvergenceAgent)
-@attributes(["reactor", "deployer", "host", "port"])
+@attributes(["reactor", "deployer", "host", "port",
+             Attribute("max_interval", default_value=10.0)])
 class AgentLoopService(object, MultiService):
     """
     Service in charge of running the convergence loop.
@@ -365,20 +560,35 @@ class AgentLoopService(object, MultiService):
             then changing it.
     :ivar host: Host to connect to.
     :ivar port: Port to connect to.
+    :ivar max_interval: Seconds the convergence loop may sleep between
+        iterations while nothing needs changing.
+    :ivar ConvergenceLoopMetrics metrics: Statistics about the convergence
+        loop.
+    :ivar convergence_loop: A convergence loop FSM.
     :ivar cluster_status: A cluster status FSM.
     :ivar factory: The factory used to connect to the control service.
     """
 
     def __init__(self):
         MultiService.__init__(self)
-        convergence_loop = build_convergence_loop_fsm(
-            self.reactor, self.deployer
+        self.metrics = ConvergenceLoopMetrics()
+        self.convergence_loop = build_convergence_loop_fsm(
+            self.reactor, self.deployer, max_interval=self.max_interval,
+            jitter=0.2, metrics=self.metrics,
         )
-        self.logger = convergence_loop.logger
-        self.cluster_status = build_cluster_status_fsm(convergence_loop)
+        self.logger = self.convergence_loop.logger
+        self.cluster_status = build_cluster_status_fsm(self.convergence_loop)
         self.factory = ReconnectingClientFactory.forProtocol(
             lambda: AgentAMP(self))
 
+    def local_state_changed(self):
+        """
+        Notify the convergence loop that local state may have changed, e.g.
+        because a container exited, so that it doesn't wait for the idle
+        timer before converging again.
+        """
+        self.convergence_loop.receive(ConvergenceLoopInputs.WAKEUP)
+
     def startService(self):
         MultiService.startService(self)
         self.reactor.connectTCP(self.host, self.port, self.factory)
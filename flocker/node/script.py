@@ -8,6 +8,7 @@ The command-line ``flocker-changestate``, ``flocker-reportstate`` and
 
 import sys
 from functools import partial
+from tempfile import mkdtemp
 
 from yaml import safe_load, safe_dump
 from yaml.error import YAMLError
@@ -16,6 +17,9 @@ from pyrsistent import PRecord, field
 
 from zope.interface import implementer
 
+from twisted.application.service import Service
+from twisted.internet.endpoints import TCP4ServerEndpoint
+from twisted.python.filepath import FilePath
 from twisted.python.usage import Options, UsageError
 
 from ..control._config import (
@@ -26,6 +30,10 @@ from ..volume.service import (
     ICommandLineVolumeScript, VolumeScript)
 
 from ..volume.script import flocker_volume_options
+from ..volume._transfer import (
+    CODECS, TRANSFER_PORT, VolumeTransferPool, VolumeTransferService,
+)
+from ..common import SSHConnectionCache
 from ..common.script import (
     ICommandLineScript,
     flocker_standard_options, FlockerScriptRunner, main_for_service)
@@ -243,6 +251,31 @@ class ZFSAgentOptions(Options):
     optParameters = [
         ["destination-port", "p", 4524,
          "The port on the control service to connect to.", int],
+        ["max-convergence-interval", None, 10.0,
+         "The longest time in seconds to wait between convergence "
+         "iterations while nothing needs changing.", float],
+        ["transfer-secret-file", None, None,
+         "Push datasets to agents over a direct connection instead of SSH, "
+         "authenticating with the secret in this file.  Every agent must "
+         "use the same secret.  The data is not encrypted, so only use this "
+         "on a trusted network.  Requires --transfer-interface."],
+        ["transfer-interface", None, None,
+         "The address on which datasets are received from other agents "
+         "when --transfer-secret-file is given."],
+        ["transfer-port", None, TRANSFER_PORT,
+         "The port on which datasets are transferred between agents.", int],
+        ["transfer-compression", None, None,
+         "Compress datasets sent to agents which support it with this "
+         "codec: " + ", ".join(sorted(CODECS)) + "."],
+        ["transfer-compression-level", None, None,
+         "The level to compress at, from 1 (fastest) to 9 (smallest).  The "
+         "default depends on the codec.", int],
+    ]
+
+    optFlags = [
+        ["reuse-ssh-connections", None,
+         "Push all the datasets sent to a node over SSH through a single "
+         "connection to it."],
     ]
 
     def parseArgs(self, hostname, host):
@@ -252,6 +285,50 @@ class ZFSAgentOptions(Options):
         self["hostname"] = unicode(hostname, "ascii")
         self["destination-host"] = unicode(host, "ascii")
 
+    def postOptions(self):
+        self["transfer-secret"] = None
+        secret_file = self["transfer-secret-file"]
+        if (secret_file is None) != (self["transfer-interface"] is None):
+            raise UsageError(
+                "--transfer-secret-file and --transfer-interface must be "
+                "given together.")
+        if secret_file is not None:
+            try:
+                secret = FilePath(secret_file).getContent().strip()
+            except IOError as e:
+                raise UsageError(
+                    "Can't read transfer secret file {}: {}".format(
+                        secret_file, e.strerror))
+            if not secret:
+                raise UsageError(
+                    "Transfer secret file {} is empty.".format(secret_file))
+            self["transfer-secret"] = secret
+        compression = self["transfer-compression"]
+        if compression is not None and compression not in CODECS:
+            raise UsageError(
+                "Unknown transfer compression codec: {}".format(compression))
+        level = self["transfer-compression-level"]
+        if level is not None and not 1 <= level <= 9:
+            raise UsageError(
+                "Transfer compression level must be from 1 to 9, not "
+                "{}".format(level))
+
+
+class _ConnectionCacheService(Service):
+    """
+    Close an ``SSHConnectionCache`` when the service stops.
+
+    :ivar SSHConnectionCache connection_cache: The cache to close.
+    """
+    def __init__(self, connection_cache):
+        self.connection_cache = connection_cache
+
+    def stopService(self):
+        Service.stopService(self)
+        # Only the local master processes are asked to exit, so this is
+        # quick enough to do without a thread:
+        self.connection_cache.close()
+
 
 @implementer(ICommandLineVolumeScript)
 class ZFSAgentScript(object):
@@ -262,11 +339,38 @@ class ZFSAgentScript(object):
     def main(self, reactor, options, volume_service):
         host = options["destination-host"]
         port = options["destination-port"]
-        deployer = P2PNodeDeployer(options["hostname"].decode("ascii"),
-                                   volume_service)
-        loop = AgentLoopService(reactor=reactor, deployer=deployer,
-                                host=host, port=port)
+        transfer_port = options["transfer-port"]
+        secret = options["transfer-secret"]
+        # Datasets are pushed over SSH unless the transfer channel has been
+        # configured:
+        transfer_pool = None
+        if secret is not None:
+            transfer_pool = VolumeTransferPool(
+                reactor, secret, transfer_port,
+                compression=options["transfer-compression"],
+                compression_level=options["transfer-compression-level"])
+        connection_cache = None
+        if options["reuse-ssh-connections"]:
+            connection_cache = SSHConnectionCache(FilePath(mkdtemp()))
+        deployer = P2PNodeDeployer(
+            options["hostname"].decode("ascii"), volume_service,
+            transfer_pool=transfer_pool, connection_cache=connection_cache)
+        loop = AgentLoopService(
+            reactor=reactor, deployer=deployer, host=host, port=port,
+            max_interval=options["max-convergence-interval"])
+        if connection_cache is not None:
+            _ConnectionCacheService(connection_cache).setServiceParent(loop)
+        # Converge as soon as a container changes, rather than whenever the
+        # loop next wakes up on its own:
+        deployer.docker_client.add_change_listener(loop.local_state_changed)
         volume_service.setServiceParent(loop)
+        if secret is not None:
+            VolumeTransferService(
+                volume_service,
+                TCP4ServerEndpoint(
+                    reactor, transfer_port,
+                    interface=options["transfer-interface"]),
+                secret, reactor).setServiceParent(loop)
         return main_for_service(reactor, loop)
 
 
@@ -296,6 +400,9 @@ class DatasetAgentOptions(Options):
     optParameters = [
         ["destination-port", "p", 4524,
          "The port on the control service to connect to.", int],
+        ["max-convergence-interval", None, 10.0,
+         "The longest time in seconds to wait between convergence "
+         "iterations while nothing needs changing.", float],
     ]
 
     def parseArgs(self, hostname, host):
@@ -355,6 +462,7 @@ class DatasetAgentServiceFactory(PRecord):
             reactor=reactor,
             deployer=self.deployer_factory(hostname=options["hostname"]),
             host=options["destination-host"], port=options["destination-port"],
+            max_interval=options["max-convergence-interval"],
         )
 
 
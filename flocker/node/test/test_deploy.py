@@ -6,6 +6,7 @@ Tests for ``flocker.node._deploy``.
 
 from uuid import uuid4
 
+from zope.interface import implementer
 from zope.interface.verify import verifyObject
 
 from eliot.testing import validate_logging
@@ -32,18 +33,23 @@ from .._deploy import (
     ResizeDataset, _link_environment, _to_volume_name,
     DeleteDataset, OpenPorts
 )
-from ...testtools import CustomException
+from ...testtools import CustomException, NonReactor, NonThreadPool
 from .. import _deploy
 from ...control._model import AttachedVolume, Dataset, Manifestation
 from .._docker import (
     FakeDockerClient, AlreadyExists, Unit, PortMap, Environment,
-    DockerClient, Volume as DockerVolume)
-from ...route import Proxy, OpenPort, make_memory_network
+    DockerClient, DockerEvents, Volume as DockerVolume)
+from ...route import (
+    Proxy, OpenPort, IBatchedNetwork, ThreadedNetwork, make_memory_network,
+)
+from ...route._memory import MemoryNetwork
 from ...route._iptables import HostNetwork
 from ...volume.service import Volume, VolumeName
 from ...volume._model import VolumeSize
 from ...volume.testtools import create_volume_service
-from ...volume._ipc import RemoteVolumeManager, standard_node
+from ...volume._ipc import StreamingRemoteVolumeManager, standard_node
+from ...volume._transfer import VolumeTransferPool
+from ...common import SSHConnectionCache
 
 
 class P2PNodeDeployerAttributesTests(SynchronousTestCase):
@@ -59,6 +65,16 @@ class P2PNodeDeployerAttributesTests(SynchronousTestCase):
             DockerClient
         )
 
+    def test_docker_client_default_events(self):
+        """
+        The default ``P2PNodeDeployer.docker_client`` caches units based on
+        ``DockerEvents``.
+        """
+        self.assertIsInstance(
+            P2PNodeDeployer(u"example.com", None).docker_client._events,
+            DockerEvents
+        )
+
     def test_docker_override(self):
         """
         ``P2PNodeDeployer.docker_client`` can be overridden in the constructor.
@@ -72,10 +88,13 @@ class P2PNodeDeployerAttributesTests(SynchronousTestCase):
 
     def test_network_default(self):
         """
-        ``P2PNodeDeployer._network`` is a ``HostNetwork`` by default.
+        ``P2PNodeDeployer._network`` is by default a ``ThreadedNetwork``
+        wrapping a ``HostNetwork``.
         """
-        self.assertIsInstance(P2PNodeDeployer(u'example.com', None).network,
-                              HostNetwork)
+        network = P2PNodeDeployer(u'example.com', None).network
+        self.assertEqual(
+            (ThreadedNetwork, HostNetwork),
+            (type(network), type(network.network)))
 
     def test_network_override(self):
         """
@@ -1631,6 +1650,81 @@ class ApplicationNodeDeployerDiscoverNodeConfigurationTests(
             state
         )
 
+    def test_discover_forgets_network_cache(self):
+        """
+        ``discover_local_state`` tells the deployer's ``INetwork`` provider to
+        forget any cached state so that each convergence iteration sees the
+        current network configuration.
+        """
+        forgotten = []
+        self.patch(self.network, "forget_cached_state",
+                   lambda: forgotten.append(True))
+        api = ApplicationNodeDeployer(
+            u'example.com',
+            docker_client=FakeDockerClient(),
+            network=self.network
+        )
+        self.successResultOf(api.discover_local_state(EMPTY_NODESTATE))
+        self.assertEqual([True], forgotten)
+
+    def test_discover_waits_for_forgetting(self):
+        """
+        ``discover_local_state`` does not enumerate the network configuration
+        until the network has forgotten its cached state.
+        """
+        forgetting = Deferred()
+        enumerated = []
+        self.patch(self.network, "forget_cached_state", lambda: forgetting)
+        self.patch(self.network, "enumerate_proxies",
+                   lambda: enumerated.append(True) or [])
+        api = ApplicationNodeDeployer(
+            u'example.com',
+            docker_client=FakeDockerClient(),
+            network=self.network
+        )
+        discovering = api.discover_local_state(EMPTY_NODESTATE)
+        before = list(enumerated)
+        forgetting.callback(None)
+        self.successResultOf(discovering)
+        self.assertEqual(([], [True]), (before, enumerated))
+
+    def test_discover_proxies_and_open_ports(self):
+        """
+        ``discover_local_state`` returns a ``NodeState`` with the proxies and
+        open ports configured on the network.
+        """
+        network = make_memory_network()
+        network.create_proxy_to(ip=u'192.0.2.100', port=3306)
+        network.open_port(port=8080)
+        api = ApplicationNodeDeployer(
+            u'example.com',
+            docker_client=FakeDockerClient(),
+            network=make_immediate_network(network)
+        )
+        state = self.successResultOf(api.discover_local_state(
+            EMPTY_NODESTATE))
+        self.assertEqual(
+            (state.proxies, state.open_ports),
+            ({Proxy(ip=u'192.0.2.100', port=3306)}, {OpenPort(port=8080)}))
+
+    def test_discover_used_ports_async_network(self):
+        """
+        If the deployer's network is an ``IAsyncNetwork`` the ports in use are
+        the result of its ``enumerate_used_ports``.
+        """
+        used_ports = frozenset([1, 3, 5, 1000])
+        api = ApplicationNodeDeployer(
+            u'example.com',
+            docker_client=FakeDockerClient(),
+            network=make_immediate_network(
+                make_memory_network(used_ports=used_ports))
+        )
+
+        discovering = api.discover_local_state(EMPTY_NODESTATE)
+        state = self.successResultOf(discovering)
+
+        self.assertEqual(used_ports, state.used_ports)
+
     def test_discover_application_restart_policy(self):
         """
         An ``Application`` with the appropriate ``IRestartPolicy`` is
@@ -1676,7 +1770,9 @@ class ApplicationNodeDeployerDiscoverNodeConfigurationTests(
                                    applications=None,
                                    used_ports=None,
                                    manifestations=None,
-                                   paths=None),
+                                   paths=None,
+                                   proxies=None,
+                                   open_ports=None),
                          self.successResultOf(d))
 
 
@@ -1871,6 +1967,87 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
         expected = Sequentially(changes=[SetProxies(ports=frozenset())])
         self.assertEqual(expected, result)
 
+    def test_proxy_empty_async_network(self):
+        """
+        When the deployer's network is an ``IAsyncNetwork``,
+        ``P2PNodeDeployer.calculate_necessary_state_changes`` compares the
+        desired proxies with those found by discovery.
+        """
+        network = make_memory_network()
+        network.create_proxy_to(ip=u'192.0.2.100', port=3306)
+
+        api = P2PNodeDeployer(u'node2.example.com',
+                              create_volume_service(self),
+                              docker_client=FakeDockerClient(),
+                              network=make_immediate_network(network))
+        desired = Deployment(nodes=frozenset())
+        result = api.calculate_necessary_state_changes(
+            self.successResultOf(api.discover_local_state(
+                NodeState(hostname=api.hostname))),
+            desired_configuration=desired, current_cluster_state=EMPTY)
+        expected = Sequentially(changes=[SetProxies(ports=frozenset())])
+        self.assertEqual(expected, result)
+
+    def test_compares_given_state(self):
+        """
+        ``P2PNodeDeployer.calculate_necessary_state_changes`` compares the
+        desired proxies and open ports with those in the given local state,
+        even if it was not discovered by the same deployer.
+        """
+        network = make_memory_network()
+        network.create_proxy_to(ip=u'192.0.2.100', port=3306)
+        api = P2PNodeDeployer(u'node2.example.com',
+                              create_volume_service(self),
+                              docker_client=FakeDockerClient(),
+                              network=make_immediate_network(network))
+        result = api.calculate_necessary_state_changes(
+            NodeState(hostname=api.hostname,
+                      open_ports=[OpenPort(port=1234)]),
+            desired_configuration=Deployment(nodes=frozenset()),
+            current_cluster_state=EMPTY)
+        self.assertEqual(
+            Sequentially(changes=[OpenPorts(ports=frozenset())]), result)
+
+    def test_unknown_network_state(self):
+        """
+        If the given local state does not include proxies and open ports,
+        ``P2PNodeDeployer.calculate_necessary_state_changes`` sets them to
+        the desired ones regardless.
+        """
+        api = P2PNodeDeployer(u'node2.example.com',
+                              create_volume_service(self),
+                              docker_client=FakeDockerClient(),
+                              network=make_memory_network())
+        result = api.calculate_necessary_state_changes(
+            NodeState(hostname=api.hostname, proxies=None, open_ports=None),
+            desired_configuration=Deployment(nodes=frozenset()),
+            current_cluster_state=EMPTY)
+        self.assertEqual(
+            Sequentially(changes=[SetProxies(ports=frozenset()),
+                                  OpenPorts(ports=frozenset())]), result)
+
+    def test_network_not_read_again(self):
+        """
+        ``P2PNodeDeployer.calculate_necessary_state_changes`` uses the proxies
+        and open ports found by discovery rather than reading them from the
+        network again.
+        """
+        network = make_memory_network()
+        network.create_proxy_to(ip=u'192.0.2.100', port=3306)
+        api = P2PNodeDeployer(u'node2.example.com',
+                              create_volume_service(self),
+                              docker_client=FakeDockerClient(),
+                              network=make_immediate_network(network))
+        local_state = self.successResultOf(api.discover_local_state(
+            NodeState(hostname=api.hostname)))
+        self.patch(network, "enumerate_proxies", lambda: 1/0)
+        self.patch(network, "enumerate_open_ports", lambda: 1/0)
+        result = api.calculate_necessary_state_changes(
+            local_state, desired_configuration=Deployment(nodes=frozenset()),
+            current_cluster_state=EMPTY)
+        self.assertEqual(
+            Sequentially(changes=[SetProxies(ports=frozenset())]), result)
+
     def test_open_port_needs_creating(self):
         """
         ``P2PNodeDeployer.calculate_necessary_state_changes`` returns a
@@ -3517,6 +3694,70 @@ class DeployerCalculateNecessaryStateChangesDatasetOnlyTests(
         self.assertEqual(expected, changes)
 
 
+def make_immediate_network(network):
+    """
+    Create an ``IAsyncNetwork`` which runs the operations of ``network``
+    synchronously.
+
+    :param INetwork network: The network to wrap.
+
+    :return: A ``ThreadedNetwork`` which does not use threads.
+    """
+    return ThreadedNetwork(NonReactor(), network, NonThreadPool())
+
+
+@implementer(IBatchedNetwork)
+class BatchedMemoryNetwork(MemoryNetwork):
+    """
+    A ``MemoryNetwork`` which also provides ``IBatchedNetwork`` and records
+    the batches it is asked to apply.
+
+    :ivar list batches: ``(method name, argument)`` tuples, one for each call
+        to ``set_proxies`` or ``set_open_ports``.
+    """
+    def __init__(self):
+        MemoryNetwork.__init__(self, used_ports=frozenset())
+        self.batches = []
+
+    def set_proxies(self, proxies):
+        self.batches.append(("set_proxies", proxies))
+        self._proxies = set(proxies)
+
+    def set_open_ports(self, open_ports):
+        self.batches.append(("set_open_ports", open_ports))
+        self._open_ports = set(open_ports)
+
+
+class CountingMemoryNetwork(MemoryNetwork):
+    """
+    A ``MemoryNetwork`` which records the changes made to it.
+
+    :ivar list operations: ``(method name, argument)`` tuples, one for each
+        proxy or open port created or deleted.
+    """
+    def __init__(self):
+        MemoryNetwork.__init__(self, used_ports=frozenset())
+        self.operations = []
+
+    def create_proxy_to(self, ip, port):
+        proxy = MemoryNetwork.create_proxy_to(self, ip, port)
+        self.operations.append(("create_proxy_to", proxy))
+        return proxy
+
+    def delete_proxy(self, proxy):
+        self.operations.append(("delete_proxy", proxy))
+        MemoryNetwork.delete_proxy(self, proxy)
+
+    def open_port(self, port):
+        open_port = MemoryNetwork.open_port(self, port)
+        self.operations.append(("open_port", open_port))
+        return open_port
+
+    def delete_open_port(self, open_port):
+        self.operations.append(("delete_open_port", open_port))
+        MemoryNetwork.delete_open_port(self, open_port)
+
+
 class SetProxiesTests(SynchronousTestCase):
     """
     Tests for ``SetProxies``.
@@ -3651,6 +3892,82 @@ class SetProxiesTests(SynchronousTestCase):
         failures = self.flushLoggedErrors(ZeroDivisionError)
         self.assertEqual(3, len(failures))
 
+    def test_single_change(self):
+        """
+        When one proxy out of hundreds changes, only the old proxy is deleted
+        and only the new proxy is created.
+        """
+        network = CountingMemoryNetwork()
+        existing = [
+            network.create_proxy_to(ip=u'192.0.2.100', port=port)
+            for port in range(10000, 10500)
+        ]
+        del network.operations[:]
+        api = P2PNodeDeployer(
+            u'example.com',
+            create_volume_service(self), docker_client=FakeDockerClient(),
+            network=network)
+
+        replacement = Proxy(ip=u'192.0.2.101', port=10000)
+        d = SetProxies(ports=existing[1:] + [replacement]).run(api)
+        self.successResultOf(d)
+        self.assertEqual(
+            [("delete_proxy", existing[0]),
+             ("create_proxy_to", replacement)],
+            network.operations)
+
+    def test_async_network(self):
+        """
+        If the network provides ``IAsyncNetwork`` then the ``Deferred``
+        returned by its ``set_proxies`` method is returned.
+        """
+        network = make_memory_network()
+        network.create_proxy_to(ip=u'192.0.2.100', port=3306)
+        api = P2PNodeDeployer(
+            u'example.com',
+            create_volume_service(self), docker_client=FakeDockerClient(),
+            network=make_immediate_network(network))
+
+        expected = Proxy(ip=u'192.0.2.101', port=3306)
+        d = SetProxies(ports=[expected]).run(api)
+        self.successResultOf(d)
+        self.assertEqual([expected], network.enumerate_proxies())
+
+    def test_batched_network(self):
+        """
+        If the network provides ``IBatchedNetwork`` then all of the proxies
+        are passed to its ``set_proxies`` method in a single call.
+        """
+        network = BatchedMemoryNetwork()
+        network.create_proxy_to(ip=u'192.0.2.100', port=3306)
+        api = P2PNodeDeployer(
+            u'example.com',
+            create_volume_service(self), docker_client=FakeDockerClient(),
+            network=network)
+
+        expected = [Proxy(ip=u'192.0.2.101', port=3306),
+                    Proxy(ip=u'192.0.2.102', port=8080)]
+        d = SetProxies(ports=expected).run(api)
+        self.successResultOf(d)
+        self.assertEqual(
+            ([("set_proxies", expected)], set(expected)),
+            (network.batches, set(network.enumerate_proxies())))
+
+    def test_batched_network_errors_as_errbacks(self):
+        """
+        Exceptions raised by ``IBatchedNetwork.set_proxies`` are reported as
+        failures in the returned deferred.
+        """
+        network = BatchedMemoryNetwork()
+        network.set_proxies = lambda proxies: 1/0
+        api = P2PNodeDeployer(
+            u'example.com',
+            create_volume_service(self), docker_client=FakeDockerClient(),
+            network=network)
+
+        d = SetProxies(ports=[Proxy(ip=u'192.0.2.100', port=3306)]).run(api)
+        self.failureResultOf(d, ZeroDivisionError)
+
 
 class OpenPortsTests(SynchronousTestCase):
     """
@@ -3786,6 +4103,78 @@ class OpenPortsTests(SynchronousTestCase):
         failures = self.flushLoggedErrors(ZeroDivisionError)
         self.assertEqual(3, len(failures))
 
+    def test_single_change(self):
+        """
+        When one open port out of hundreds changes, only the old port is
+        closed and only the new port is opened.
+        """
+        network = CountingMemoryNetwork()
+        existing = [network.open_port(port) for port in range(10000, 10500)]
+        del network.operations[:]
+        api = P2PNodeDeployer(
+            u'example.com',
+            create_volume_service(self), docker_client=FakeDockerClient(),
+            network=network)
+
+        replacement = OpenPort(port=20000)
+        d = OpenPorts(ports=existing[1:] + [replacement]).run(api)
+        self.successResultOf(d)
+        self.assertEqual(
+            [("delete_open_port", existing[0]),
+             ("open_port", replacement)],
+            network.operations)
+
+    def test_async_network(self):
+        """
+        If the network provides ``IAsyncNetwork`` then the ``Deferred``
+        returned by its ``set_open_ports`` method is returned.
+        """
+        network = make_memory_network()
+        network.open_port(port=3305)
+        api = P2PNodeDeployer(
+            u'example.com',
+            create_volume_service(self), docker_client=FakeDockerClient(),
+            network=make_immediate_network(network))
+
+        d = OpenPorts(ports=[OpenPort(port=3306)]).run(api)
+        self.successResultOf(d)
+        self.assertEqual(
+            [OpenPort(port=3306)], network.enumerate_open_ports())
+
+    def test_batched_network(self):
+        """
+        If the network provides ``IBatchedNetwork`` then all of the open ports
+        are passed to its ``set_open_ports`` method in a single call.
+        """
+        network = BatchedMemoryNetwork()
+        network.open_port(port=3305)
+        api = P2PNodeDeployer(
+            u'example.com',
+            create_volume_service(self), docker_client=FakeDockerClient(),
+            network=network)
+
+        expected = pset([OpenPort(port=3306), OpenPort(port=8080)])
+        d = OpenPorts(ports=expected).run(api)
+        self.successResultOf(d)
+        self.assertEqual(
+            ([("set_open_ports", expected)], set(expected)),
+            (network.batches, set(network.enumerate_open_ports())))
+
+    def test_batched_network_errors_as_errbacks(self):
+        """
+        Exceptions raised by ``IBatchedNetwork.set_open_ports`` are reported
+        as failures in the returned deferred.
+        """
+        network = BatchedMemoryNetwork()
+        network.set_open_ports = lambda open_ports: 1/0
+        api = P2PNodeDeployer(
+            u'example.com',
+            create_volume_service(self), docker_client=FakeDockerClient(),
+            network=network)
+
+        d = OpenPorts(ports=[OpenPort(port=3306)]).run(api)
+        self.failureResultOf(d, ZeroDivisionError)
+
 
 class ChangeNodeStateTests(SynchronousTestCase):
     """
@@ -4150,7 +4539,36 @@ class HandoffVolumeTests(SynchronousTestCase):
         self.assertEqual(
             result,
             [volume_service.get(_to_volume_name(DATASET.dataset_id)),
-             RemoteVolumeManager(standard_node(hostname))])
+             StreamingRemoteVolumeManager(standard_node(hostname))])
+
+    def test_handoff_transfer_pool(self):
+        """
+        ``HandoffVolume.run()`` hands off the named volume using the deployer's
+        ``transfer_pool`` if it has one.
+        """
+        volume_service = create_volume_service(self)
+        hostname = b"dest.example.com"
+        pool = VolumeTransferPool(reactor=None, secret=b"secret")
+
+        result = []
+
+        def _handoff(volume, destination):
+            result.extend([volume, destination])
+        self.patch(volume_service, "handoff", _handoff)
+        deployer = P2PNodeDeployer(
+            u'example.com',
+            volume_service,
+            docker_client=FakeDockerClient(),
+            network=make_memory_network(),
+            transfer_pool=pool)
+        handoff = HandoffDataset(
+            dataset=APPLICATION_WITH_VOLUME.volume.dataset,
+            hostname=hostname)
+        handoff.run(deployer)
+        self.assertEqual(
+            result,
+            [volume_service.get(_to_volume_name(DATASET.dataset_id)),
+             pool.remote_volume_manager(hostname)])
 
     def test_return(self):
         """
@@ -4202,7 +4620,96 @@ class PushVolumeTests(SynchronousTestCase):
         self.assertEqual(
             result,
             [volume_service.get(_to_volume_name(DATASET.dataset_id)),
-             RemoteVolumeManager(standard_node(hostname))])
+             StreamingRemoteVolumeManager(standard_node(hostname))])
+
+    def test_push_transfer_pool(self):
+        """
+        ``PushVolume.run()`` pushes the named volume using the deployer's
+        ``transfer_pool`` if it has one.
+        """
+        volume_service = create_volume_service(self)
+        hostname = b"dest.example.com"
+        pool = VolumeTransferPool(reactor=None, secret=b"secret")
+
+        result = []
+
+        def _push(volume, destination):
+            result.extend([volume, destination])
+        self.patch(volume_service, "push", _push)
+        deployer = P2PNodeDeployer(
+            u'example.com',
+            volume_service,
+            docker_client=FakeDockerClient(),
+            network=make_memory_network(),
+            transfer_pool=pool)
+        push = PushDataset(
+            dataset=APPLICATION_WITH_VOLUME.volume.dataset,
+            hostname=hostname)
+        push.run(deployer)
+        self.assertEqual(
+            result,
+            [volume_service.get(_to_volume_name(DATASET.dataset_id)),
+             pool.remote_volume_manager(hostname)])
+
+    def test_push_connection_cache(self):
+        """
+        ``PushVolume.run()`` pushes the named volume over SSH through the
+        deployer's ``connection_cache``.
+        """
+        volume_service = create_volume_service(self)
+        hostname = b"dest.example.com"
+        cache = SSHConnectionCache(FilePath(b"/tmp/ssh"))
+
+        result = []
+
+        def _push(volume, destination):
+            result.extend([volume, destination])
+        self.patch(volume_service, "push", _push)
+        deployer = P2PNodeDeployer(
+            u'example.com',
+            volume_service,
+            docker_client=FakeDockerClient(),
+            network=make_memory_network(),
+            connection_cache=cache)
+        push = PushDataset(
+            dataset=APPLICATION_WITH_VOLUME.volume.dataset,
+            hostname=hostname)
+        push.run(deployer)
+        self.assertEqual(
+            result,
+            [volume_service.get(_to_volume_name(DATASET.dataset_id)),
+             StreamingRemoteVolumeManager(
+                 standard_node(hostname, connection_cache=cache))])
+
+    def test_push_transfer_pool_not_streaming(self):
+        """
+        ``PushVolume.run()`` pushes the named volume over SSH even if the
+        deployer has a ``transfer_pool``, if the volume's filesystem does not
+        provide ``IStreamingFilesystem``.
+        """
+        volume_service = create_volume_service(self)
+        self.patch(volume_service.pool, "get", lambda volume: object())
+        hostname = b"dest.example.com"
+
+        result = []
+
+        def _push(volume, destination):
+            result.extend([volume, destination])
+        self.patch(volume_service, "push", _push)
+        deployer = P2PNodeDeployer(
+            u'example.com',
+            volume_service,
+            docker_client=FakeDockerClient(),
+            network=make_memory_network(),
+            transfer_pool=VolumeTransferPool(reactor=None, secret=b"secret"))
+        push = PushDataset(
+            dataset=APPLICATION_WITH_VOLUME.volume.dataset,
+            hostname=hostname)
+        push.run(deployer)
+        self.assertEqual(
+            result,
+            [volume_service.get(_to_volume_name(DATASET.dataset_id)),
+             StreamingRemoteVolumeManager(standard_node(hostname))])
 
     def test_return(self):
         """
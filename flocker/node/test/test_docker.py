@@ -6,13 +6,15 @@ from zope.interface.verify import verifyObject
 
 from pyrsistent import pset
 
-from twisted.trial.unittest import TestCase
+from twisted.trial.unittest import TestCase, SynchronousTestCase
 from twisted.python.filepath import FilePath
 
 from ...testtools import random_name, make_with_init_tests
+from ..testtools import FakeDockerAPI
 from .._docker import (
     IDockerClient, FakeDockerClient, AlreadyExists, PortMap, Unit,
-    Environment, Volume)
+    Environment, Volume, IDockerEvents, FakeDockerEvents, DockerEvents,
+    DockerClient, BASE_NAMESPACE, _parse_events, _LRUCache)
 
 from ...control._model import RestartAlways, RestartNever, RestartOnFailure
 
@@ -370,3 +372,337 @@ class VolumeInitTests(
     """
     Tests for ``Volume.__init__``.
     """
+
+
+def make_idockerevents_tests(fixture):
+    """
+    Create a TestCase for ``IDockerEvents``.
+
+    :param fixture: A fixture that returns a ``IDockerEvents`` provider.
+    """
+    class IDockerEventsTests(SynchronousTestCase):
+        """
+        Tests for ``IDockerEvents``.
+        """
+        def test_interface(self):
+            """
+            The tested object provides ``IDockerEvents``.
+            """
+            self.assertTrue(verifyObject(IDockerEvents, fixture(self)))
+
+    return IDockerEventsTests
+
+
+class FakeDockerEventsInterfaceTests(
+        make_idockerevents_tests(lambda test: FakeDockerEvents())):
+    """
+    ``IDockerEvents`` tests for ``FakeDockerEvents``.
+    """
+
+
+class DockerEventsInterfaceTests(
+        make_idockerevents_tests(lambda test: DockerEvents())):
+    """
+    ``IDockerEvents`` tests for ``DockerEvents``.
+    """
+
+
+class DockerEventsTests(SynchronousTestCase):
+    """
+    Tests for ``DockerEvents``.
+    """
+    def test_no_timeout(self):
+        """
+        ``DockerEvents`` reads events from a Docker client which never times
+        out.
+        """
+        self.assertIs(None, DockerEvents()._client._timeout)
+
+
+class FakeDockerEventsTests(SynchronousTestCase):
+    """
+    Tests for ``FakeDockerEvents``.
+    """
+    def setUp(self):
+        self.events = FakeDockerEvents()
+        self.changed = []
+        self.lost = []
+        self.events.start(self.changed.append, lambda: self.lost.append(None))
+
+    def test_emit(self):
+        """
+        ``FakeDockerEvents.emit`` passes the container ID to the ``changed``
+        callback.
+        """
+        self.events.emit(u"abc")
+        self.assertEqual((self.changed, self.events.starts), ([u"abc"], 1))
+
+    def test_lose(self):
+        """
+        ``FakeDockerEvents.lose`` calls the ``lost`` callback, after which
+        no events are delivered.
+        """
+        self.events.lose()
+        self.events.emit(u"abc")
+        self.assertEqual((self.changed, self.lost), ([], [None]))
+
+
+class ParseEventsTests(SynchronousTestCase):
+    """
+    Tests for ``_parse_events``.
+    """
+    def test_split(self):
+        """
+        Events split across chunks, or sharing a chunk, are parsed.
+        """
+        chunks = [b'{"status": "create", "id": "a"}',
+                  b'{"status": "st', b'art", "id": "a"}\n{"status"',
+                  b': "die", "id": "a"}']
+        self.assertEqual(
+            list(_parse_events(chunks)),
+            [{u"status": u"create", u"id": u"a"},
+             {u"status": u"start", u"id": u"a"},
+             {u"status": u"die", u"id": u"a"}])
+
+
+class DockerClientCacheTests(TestCase):
+    """
+    Tests for ``DockerClient.list`` when caching units based on Docker
+    events.
+    """
+    def setUp(self):
+        self.events = FakeDockerEvents()
+        self.client = DockerClient(events=self.events)
+        self.api = self.client._client = FakeDockerAPI()
+        self.api.containers_by_id = {
+            u"a": BASE_NAMESPACE + u"app-a", u"b": u"not-flocker"}
+
+    def unit(self, name):
+        """
+        :return: The ``Unit`` listed for a ``FakeDockerAPI`` container.
+        """
+        return Unit(name=name, container_name=BASE_NAMESPACE + name,
+                    activation_state=u"active", container_image=u"busybox")
+
+    def list_twice(self):
+        """
+        List units twice, recording which containers were inspected the
+        second time.
+
+        :return: ``Deferred`` firing with the result of the second listing.
+        """
+        d = self.client.list()
+
+        def listed(_):
+            del self.api.inspected[:]
+            return self.client.list()
+        return d.addCallback(listed)
+
+    def test_seeded_once(self):
+        """
+        All containers are inspected once, after which unchanged units are
+        listed without inspecting anything.
+        """
+        d = self.list_twice()
+        d.addCallback(lambda units: self.assertEqual(
+            (units, self.api.inspected, self.events.starts),
+            ({self.unit(u"app-a")}, [], 1)))
+        return d
+
+    def test_event_reinspects(self):
+        """
+        A container Docker reports an event for is inspected again; no
+        other container is.
+        """
+        d = self.client.list()
+
+        def listed(_):
+            del self.api.inspected[:]
+            self.api.containers_by_id[u"c"] = BASE_NAMESPACE + u"app-c"
+            self.events.emit(u"c")
+            return self.client.list()
+        d.addCallback(listed)
+        d.addCallback(lambda units: self.assertEqual(
+            (units, self.api.inspected),
+            ({self.unit(u"app-a"), self.unit(u"app-c")}, [u"c"])))
+        return d
+
+    def test_destroyed(self):
+        """
+        A container Docker reports an event for that no longer exists is no
+        longer listed.
+        """
+        d = self.client.list()
+
+        def listed(_):
+            del self.api.containers_by_id[u"a"]
+            self.events.emit(u"a")
+            return self.client.list()
+        d.addCallback(listed)
+        d.addCallback(self.assertEqual, set())
+        return d
+
+    def test_removed(self):
+        """
+        A unit removed using the client is no longer listed, even before
+        Docker reports an event for it.
+        """
+        d = self.client.list()
+        d.addCallback(lambda _: self.client.remove(u"app-a"))
+        d.addCallback(lambda _: self.client.list())
+        d.addCallback(self.assertEqual, set())
+        return d
+
+    def test_events_lost(self):
+        """
+        If the event stream is lost all containers are inspected again,
+        having restarted the event stream.
+        """
+        d = self.client.list()
+
+        def listed(_):
+            del self.api.inspected[:]
+            self.events.lose()
+            return self.client.list()
+        d.addCallback(listed)
+        d.addCallback(lambda units: self.assertEqual(
+            (units, sorted(self.api.inspected), self.events.starts),
+            ({self.unit(u"app-a")}, [u"a", u"b"], 2)))
+        return d
+
+    def test_no_events(self):
+        """
+        Without an ``IDockerEvents`` provider all containers are inspected
+        every time.
+        """
+        self.client._events = None
+        d = self.list_twice()
+        d.addCallback(lambda units: self.assertEqual(
+            (units, sorted(self.api.inspected)),
+            ({self.unit(u"app-a")}, [u"a", u"b"])))
+        return d
+
+    def test_change_listener(self):
+        """
+        A listener added with ``DockerClient.add_change_listener`` is called
+        for each event, starting the event stream if necessary, and the
+        container is still inspected again.
+        """
+        changes = []
+        self.client.add_change_listener(lambda: changes.append(None))
+        d = self.client.list()
+
+        def listed(_):
+            del self.api.inspected[:]
+            self.events.emit(u"a")
+            return self.client.list()
+        d.addCallback(listed)
+        d.addCallback(lambda units: self.assertEqual(
+            (changes, self.api.inspected, self.events.starts),
+            ([None], [u"a"], 1)))
+        return d
+
+    def test_change_listener_events_lost(self):
+        """
+        A listener added with ``DockerClient.add_change_listener`` is called
+        if the event stream is lost.
+        """
+        changes = []
+        self.client.add_change_listener(lambda: changes.append(None))
+        self.events.lose()
+        self.assertEqual([None], changes)
+
+    def test_change_listener_no_events(self):
+        """
+        Without an ``IDockerEvents`` provider
+        ``DockerClient.add_change_listener`` does nothing.
+        """
+        self.client._events = None
+        self.client.add_change_listener(lambda: None)
+        self.assertEqual(0, self.events.starts)
+
+
+class LRUCacheTests(SynchronousTestCase):
+    """
+    Tests for ``_LRUCache``.
+    """
+    def setUp(self):
+        self.created = []
+        self.cache = _LRUCache(2)
+
+    def get(self, key):
+        """
+        Get a value from the cache, recording any creation.
+        """
+        def create(key):
+            self.created.append(key)
+            return key * 2
+        return self.cache.get(key, create)
+
+    def test_created_once(self):
+        """
+        The value for a key is created on first use, and afterwards
+        returned from the cache.
+        """
+        self.assertEqual((self.get(1), self.get(1), self.created),
+                         (2, 2, [1]))
+
+    def test_evicts_least_recently_used(self):
+        """
+        When the cache is full the least recently used entry is evicted.
+        """
+        self.get(1)
+        self.get(2)
+        self.get(1)
+        self.get(3)
+        self.get(1)
+        self.get(2)
+        self.assertEqual(self.created, [1, 2, 3, 2])
+
+
+class DockerClientInspectionTests(TestCase):
+    """
+    Tests for how ``DockerClient.list`` inspects containers and images.
+    """
+    def setUp(self):
+        self.client = DockerClient()
+        self.api = self.client._client = FakeDockerAPI()
+        for i in range(10):
+            self.api.containers_by_id[u"%d" % (i,)] = (
+                BASE_NAMESPACE + u"app-%d" % (i,))
+            self.api.images_by_id[u"%d" % (i,)] = u"image-%d" % (i % 2,)
+
+    def test_image_inspected_once(self):
+        """
+        Each distinct image is inspected once, however many containers use
+        it and however often units are listed.
+        """
+        d = self.client.list()
+        d.addCallback(lambda _: self.client.list())
+        d.addCallback(lambda units: self.assertEqual(
+            (len(units), sorted(self.api.images_inspected)),
+            (10, [u"image-0", u"image-1"])))
+        return d
+
+    def test_bounded_concurrency(self):
+        """
+        No more than ``inspect_concurrency`` containers are inspected at
+        once.
+        """
+        self.client = DockerClient(inspect_concurrency=2)
+        self.client._client = self.api
+        self.api.latency = 0.01
+        d = self.client.list()
+        d.addCallback(lambda units: self.assertEqual(
+            (len(units), self.api.max_concurrency <= 2), (10, True)))
+        return d
+
+    def test_inspection_error(self):
+        """
+        If inspecting a container fails for a reason other than it not
+        existing, listing fails with that error.
+        """
+        def inspect_container(container):
+            raise ZeroDivisionError()
+        self.api.inspect_container = inspect_container
+        return self.assertFailure(self.client.list(), ZeroDivisionError)
@@ -20,8 +20,11 @@ from .._loop import (
     build_cluster_status_fsm, ClusterStatusInputs, _ClientStatusUpdate,
     _StatusUpdate, _ConnectedToControlService, ConvergenceLoopInputs,
     ConvergenceLoopStates, build_convergence_loop_fsm, AgentLoopService,
-    ClusterStatus, ConvergenceLoop, LOG_SEND_TO_CONTROL_SERVICE
+    ClusterStatus, ConvergenceLoop, LOG_SEND_TO_CONTROL_SERVICE,
+    ConvergenceLoopMetrics, _has_changes,
     )
+from .. import _loop
+from .._deploy import Sequentially, InParallel
 from ..testtools import ControllableDeployer, ControllableAction, to_node
 from ...control import (
     NodeState, Deployment, Manifestation, Dataset, DeploymentState,
@@ -426,12 +429,11 @@ class ConvergenceLoopFSMTests(SynchronousTestCase):
             client=client, configuration=configuration, state=state))
         reactor.advance(1.0)
         # Calculating actions happened, result was run... and then we did
-        # whole thing again:
+        # whole thing again, except for sending the unchanged local state:
         self.assertEqual((deployer.calculate_inputs, client.calls),
                          ([(local_state, configuration, state),
                            (local_state2, configuration, state)],
-                          [(NodeStateCommand, dict(node_state=local_state)),
-                           (NodeStateCommand, dict(node_state=local_state2))]))
+                          [(NodeStateCommand, dict(node_state=local_state))]))
 
     def test_convergence_status_update(self):
         """
@@ -569,6 +571,463 @@ class ConvergenceLoopFSMTests(SynchronousTestCase):
              [(NodeStateCommand, dict(node_state=local_state2))]))
 
 
+class ConvergenceLoopSleepTests(SynchronousTestCase):
+    """
+    Tests for the idle behaviour of the FSM created by
+    ``build_convergence_loop_fsm`` between convergence iterations.
+    """
+    def setUp(self):
+        self.local_state = NodeState(hostname=b'192.0.2.123')
+        self.configuration = Deployment(
+            nodes=frozenset([to_node(self.local_state)]))
+        self.state = DeploymentState(nodes=[self.local_state])
+        # The first iteration finishes immediately; the second one never
+        # does:
+        self.action2 = ControllableAction(result=Deferred())
+        self.deployer = ControllableDeployer(
+            [succeed(self.local_state), succeed(self.local_state)],
+            [ControllableAction(result=succeed(None)), self.action2])
+        self.client = FakeAMPClient()
+        self.client.register_response(
+            NodeStateCommand, dict(node_state=self.local_state),
+            {"result": None})
+        self.reactor = Clock()
+
+    def start(self, **kwargs):
+        """
+        Create a convergence loop and run its first iteration.
+
+        :param kwargs: Additional arguments for
+            ``build_convergence_loop_fsm``.
+
+        :return: The convergence loop FSM.
+        """
+        loop = build_convergence_loop_fsm(
+            self.reactor, self.deployer, **kwargs)
+        loop.receive(_ClientStatusUpdate(
+            client=self.client, configuration=self.configuration,
+            state=self.state))
+        return loop
+
+    def assert_iterations(self, expected):
+        """
+        Assert the number of convergence iterations that have calculated
+        changes so far.
+        """
+        self.assertEqual(len(self.deployer.calculate_inputs), expected)
+
+    def test_sleeps_after_iteration(self):
+        """
+        Once an iteration is done the FSM sleeps, with a wakeup scheduled
+        after the interval.
+        """
+        loop = self.start(interval=5.0)
+        self.assertEqual(
+            (loop.state,
+             [call.getTime() for call in self.reactor.getDelayedCalls()]),
+            (ConvergenceLoopStates.SLEEPING, [5.0]))
+
+    def test_wakes_up_after_interval(self):
+        """
+        A sleeping FSM starts another iteration when the interval has
+        passed, and not before.
+        """
+        loop = self.start(interval=5.0)
+        self.reactor.advance(4.9)
+        self.assert_iterations(1)
+        self.reactor.advance(0.1)
+        self.assert_iterations(2)
+        self.assertEqual(loop.state, ConvergenceLoopStates.CONVERGING)
+
+    def test_state_update_does_not_wake(self):
+        """
+        A sleeping FSM that receives a status update with an unchanged
+        configuration stores it but keeps sleeping.
+        """
+        loop = self.start()
+        state2 = DeploymentState(nodes=[])
+        loop.receive(_ClientStatusUpdate(
+            client=self.client, configuration=self.configuration,
+            state=state2))
+        self.assert_iterations(1)
+        self.reactor.advance(1.0)
+        self.assertEqual(self.deployer.calculate_inputs[-1],
+                         (self.local_state, self.configuration,
+                          DeploymentState(nodes=[self.local_state])))
+
+    def test_configuration_change_wakes(self):
+        """
+        A sleeping FSM that receives a status update with a changed
+        configuration starts another iteration immediately, and the
+        scheduled wakeup is cancelled.
+        """
+        loop = self.start()
+        configuration2 = Deployment(nodes=frozenset())
+        loop.receive(_ClientStatusUpdate(
+            client=self.client, configuration=configuration2,
+            state=self.state))
+        self.assertEqual(
+            (self.deployer.calculate_inputs[-1][1], loop.state,
+             self.reactor.getDelayedCalls()),
+            (configuration2, ConvergenceLoopStates.CONVERGING, []))
+
+    def test_wakeup_while_sleeping(self):
+        """
+        A sleeping FSM that receives a ``WAKEUP`` input starts another
+        iteration immediately, and the scheduled wakeup is cancelled.
+        """
+        loop = self.start()
+        loop.receive(ConvergenceLoopInputs.WAKEUP)
+        self.assertEqual(
+            (len(self.deployer.calculate_inputs), loop.state,
+             self.reactor.getDelayedCalls()),
+            (2, ConvergenceLoopStates.CONVERGING, []))
+
+    def test_wakeup_while_converging(self):
+        """
+        A converging FSM that receives a ``WAKEUP`` input starts another
+        iteration as soon as the current one is done, without sleeping.
+        """
+        # The third iteration's discovery never finishes:
+        self.deployer.local_states.append(Deferred())
+        loop = self.start()
+        # Start the second iteration:
+        loop.receive(ConvergenceLoopInputs.WAKEUP)
+        loop.receive(ConvergenceLoopInputs.WAKEUP)
+        self.action2.result.callback(None)
+        self.assertEqual(
+            (len(self.deployer.local_states), loop.state,
+             self.reactor.getDelayedCalls()),
+            (0, ConvergenceLoopStates.CONVERGING, []))
+
+    def test_wakeup_while_stopped(self):
+        """
+        A stopped FSM ignores ``WAKEUP`` inputs.
+        """
+        loop = build_convergence_loop_fsm(self.reactor, self.deployer)
+        loop.receive(ConvergenceLoopInputs.WAKEUP)
+        self.assertEqual(
+            (loop.state, len(self.deployer.local_states)),
+            (ConvergenceLoopStates.STOPPED, 2))
+
+    def test_stop_while_sleeping(self):
+        """
+        A sleeping FSM that receives a stop input stops immediately and
+        cancels the scheduled wakeup.
+        """
+        loop = self.start()
+        loop.receive(ConvergenceLoopInputs.STOP)
+        self.assertEqual(
+            (loop.state, self.reactor.getDelayedCalls()),
+            (ConvergenceLoopStates.STOPPED, []))
+
+
+class UnresponsiveAMPClient(object):
+    """
+    An AMP client look-alike whose commands never get a response.
+
+    :ivar list calls: ``(command, kwargs)`` tuples of commands that have
+        been sent using ``callRemote``.
+    """
+    def __init__(self):
+        self.calls = []
+
+    def callRemote(self, command, **kwargs):
+        kwargs.pop("eliot_context", None)
+        self.calls.append((command, kwargs))
+        return Deferred()
+
+
+class ConvergenceLoopSendTests(SynchronousTestCase):
+    """
+    Tests for how the FSM created by ``build_convergence_loop_fsm`` sends
+    discovered local state to the control service.
+    """
+    def setUp(self):
+        self.local_state = NodeState(hostname=u'192.0.2.123')
+        self.local_state2 = self.local_state.set(used_ports=[1234])
+        self.reactor = Clock()
+
+    def start(self, client, local_states):
+        """
+        Create a convergence loop and run its first iteration.
+
+        :param client: The AMP client to use.
+        :param local_states: The ``NodeState`` discovered in each
+            iteration.
+
+        :return: The convergence loop FSM.
+        """
+        self.deployer = ControllableDeployer(
+            [succeed(state) for state in local_states],
+            [ControllableAction(result=succeed(None))
+             for state in local_states])
+        loop = build_convergence_loop_fsm(self.reactor, self.deployer)
+        loop.receive(_ClientStatusUpdate(
+            client=client, configuration=Deployment(),
+            state=DeploymentState()))
+        return loop
+
+    def respond(self, client, node_states):
+        """
+        Register successful responses to ``NodeStateCommand``.
+
+        :param FakeAMPClient client: The client to register responses on.
+        :param node_states: The node states we expect to be sent.
+        """
+        for node_state in node_states:
+            client.register_response(
+                NodeStateCommand, dict(node_state=node_state),
+                {"result": None})
+
+    def test_unchanged_not_sent(self):
+        """
+        Local state that matches what the control service acknowledged is
+        not sent again.
+        """
+        client = FakeAMPClient()
+        self.respond(client, [self.local_state])
+        self.start(client, [self.local_state, self.local_state])
+        self.reactor.advance(1.0)
+        self.assertEqual(
+            (len(self.deployer.calculate_inputs), client.calls),
+            (2, [(NodeStateCommand, dict(node_state=self.local_state))]))
+
+    def test_changed_fields_sent(self):
+        """
+        When local state changes only the changed fields are sent; fields
+        the control service already knows are ``None``.
+        """
+        update = NodeState(hostname=self.local_state.hostname,
+                           used_ports=[1234], applications=None,
+                           manifestations=None, paths=None, proxies=None,
+                           open_ports=None)
+        client = FakeAMPClient()
+        self.respond(client, [self.local_state, update])
+        self.start(client, [self.local_state, self.local_state2])
+        self.reactor.advance(1.0)
+        self.assertEqual(
+            client.calls,
+            [(NodeStateCommand, dict(node_state=self.local_state)),
+             (NodeStateCommand, dict(node_state=update))])
+
+    def test_new_client(self):
+        """
+        Complete local state is sent over a new connection to the control
+        service, even if it is unchanged.
+        """
+        client = FakeAMPClient()
+        self.respond(client, [self.local_state])
+        client2 = FakeAMPClient()
+        self.respond(client2, [self.local_state])
+        loop = self.start(client, [self.local_state, self.local_state])
+        loop.receive(_ClientStatusUpdate(
+            client=client2, configuration=Deployment(),
+            state=DeploymentState()))
+        self.reactor.advance(1.0)
+        self.assertEqual(
+            client2.calls,
+            [(NodeStateCommand, dict(node_state=self.local_state))])
+
+    def test_heartbeat(self):
+        """
+        Complete local state is sent if it was last sent at least
+        ``heartbeat_interval`` seconds ago, even if it is unchanged.
+        """
+        client = FakeAMPClient()
+        self.respond(client, [self.local_state])
+        loop = self.start(
+            client, [self.local_state, self.local_state, self.local_state])
+        loop._fsm._world.original.heartbeat_interval = 2.0
+        self.reactor.advance(1.0)
+        self.reactor.advance(1.0)
+        self.assertEqual(
+            client.calls,
+            [(NodeStateCommand, dict(node_state=self.local_state))] * 2)
+
+    def test_unacknowledged(self):
+        """
+        If the last update hasn't been acknowledged the complete local state
+        is sent.
+        """
+        client = UnresponsiveAMPClient()
+        self.start(client, [self.local_state, self.local_state2])
+        self.reactor.advance(1.0)
+        self.assertEqual(
+            client.calls,
+            [(NodeStateCommand, dict(node_state=self.local_state)),
+             (NodeStateCommand, dict(node_state=self.local_state2))])
+
+
+class HasChangesTests(SynchronousTestCase):
+    """
+    Tests for ``_has_changes``.
+    """
+    def test_empty(self):
+        """
+        Nested ``Sequentially`` and ``InParallel`` changes with nothing in
+        them have no changes.
+        """
+        self.assertFalse(_has_changes(Sequentially(changes=[
+            InParallel(changes=[]), Sequentially(changes=[])])))
+
+    def test_nested_change(self):
+        """
+        A change nested inside ``Sequentially`` and ``InParallel`` changes
+        counts as a change.
+        """
+        self.assertTrue(_has_changes(Sequentially(changes=[
+            InParallel(changes=[]),
+            InParallel(changes=[ControllableAction(result=succeed(None))])])))
+
+
+class ConvergenceLoopBackoffTests(SynchronousTestCase):
+    """
+    Tests for the adaptive sleep interval of the FSM created by
+    ``build_convergence_loop_fsm``.
+    """
+    def setUp(self):
+        self.local_state = NodeState(hostname=b'192.0.2.123')
+        self.configuration = Deployment(
+            nodes=frozenset([to_node(self.local_state)]))
+        self.client = FakeAMPClient()
+        self.client.register_response(
+            NodeStateCommand, dict(node_state=self.local_state),
+            {"result": None})
+        self.reactor = Clock()
+        self.metrics = ConvergenceLoopMetrics()
+
+    def run_iterations(self, actions, **kwargs):
+        """
+        Run a convergence loop until it has run the given actions.
+
+        :param actions: The ``IStateChange`` providers the deployer
+            calculates in each iteration; each must finish synchronously.
+        :param kwargs: Additional arguments for
+            ``build_convergence_loop_fsm``.
+
+        :return: ``list`` of the delays, in seconds, the loop slept for
+            after each iteration.
+        """
+        deployer = ControllableDeployer(
+            [succeed(self.local_state) for action in actions], actions)
+        loop = build_convergence_loop_fsm(
+            self.reactor, deployer, metrics=self.metrics, **kwargs)
+        loop.receive(_ClientStatusUpdate(
+            client=self.client, configuration=self.configuration,
+            state=DeploymentState(nodes=[self.local_state])))
+        delays = []
+        while deployer.local_states:
+            [call] = self.reactor.getDelayedCalls()
+            delay = call.getTime() - self.reactor.seconds()
+            delays.append(delay)
+            self.reactor.advance(delay)
+        [call] = self.reactor.getDelayedCalls()
+        delays.append(call.getTime() - self.reactor.seconds())
+        return delays
+
+    def no_change(self):
+        """
+        :return: An ``IStateChange`` that makes no changes.
+        """
+        return Sequentially(changes=[InParallel(changes=[])])
+
+    def change(self):
+        """
+        :return: An ``IStateChange`` that makes a change.
+        """
+        return ControllableAction(result=succeed(None))
+
+    def test_no_backoff_by_default(self):
+        """
+        By default the loop always sleeps for the interval.
+        """
+        self.assertEqual(
+            self.run_iterations([self.no_change() for i in range(3)],
+                                interval=2.0),
+            [2.0, 2.0, 2.0])
+
+    def test_backoff(self):
+        """
+        While no changes are calculated the interval doubles after each
+        iteration, up to the maximum.
+        """
+        self.assertEqual(
+            self.run_iterations([self.no_change() for i in range(5)],
+                                max_interval=5.0),
+            [1.0, 2.0, 4.0, 5.0, 5.0])
+
+    def test_changes_reset_backoff(self):
+        """
+        An iteration that calculates changes resets the interval.
+        """
+        self.assertEqual(
+            self.run_iterations(
+                [self.no_change(), self.no_change(), self.change(),
+                 self.no_change()],
+                max_interval=5.0),
+            [1.0, 2.0, 1.0, 2.0])
+
+    def test_configuration_change_resets_backoff(self):
+        """
+        A status update with a changed configuration resets the interval.
+        """
+        deployer = ControllableDeployer(
+            [succeed(self.local_state) for i in range(3)],
+            [self.no_change() for i in range(3)])
+        loop = build_convergence_loop_fsm(
+            self.reactor, deployer, max_interval=5.0)
+        loop.receive(_ClientStatusUpdate(
+            client=self.client, configuration=self.configuration,
+            state=DeploymentState()))
+        self.reactor.advance(1.0)
+        loop.receive(_ClientStatusUpdate(
+            client=self.client, configuration=Deployment(),
+            state=DeploymentState()))
+        [call] = self.reactor.getDelayedCalls()
+        self.assertEqual(call.getTime() - self.reactor.seconds(), 1.0)
+
+    def test_jitter(self):
+        """
+        The sleep is randomly varied by up to the given fraction of the
+        interval.
+        """
+        ranges = []
+
+        def uniform(a, b):
+            ranges.append((a, b))
+            return b
+        self.patch(_loop, "uniform", uniform)
+        delays = self.run_iterations(
+            [self.no_change(), self.no_change()], max_interval=5.0,
+            jitter=0.25)
+        self.assertEqual((delays, ranges),
+                         ([1.25, 2.5], [(0.75, 1.25), (0.75, 1.25)]))
+
+    def test_metrics(self):
+        """
+        The metrics record the number of completed iterations, how long the
+        last one took and the current interval.
+        """
+        result = Deferred()
+        deployer = ControllableDeployer(
+            [succeed(self.local_state), succeed(self.local_state)],
+            [self.no_change(), ControllableAction(result=result)])
+        loop = build_convergence_loop_fsm(
+            self.reactor, deployer, max_interval=5.0, metrics=self.metrics)
+        loop.receive(_ClientStatusUpdate(
+            client=self.client, configuration=self.configuration,
+            state=DeploymentState()))
+        # Start the second iteration, which takes three seconds:
+        self.reactor.advance(1.0)
+        self.reactor.advance(3.0)
+        result.callback(None)
+        self.assertEqual(
+            self.metrics,
+            ConvergenceLoopMetrics(
+                interval=1.0, iterations=2, last_iteration_duration=3.0))
+
+
 class AgentLoopServiceTests(SynchronousTestCase):
     """
     Tests for ``AgentLoopService``.
@@ -589,6 +1048,21 @@ class AgentLoopServiceTests(SynchronousTestCase):
                           convergence_loop_fsm_world.deployer),
                          (ClusterStatus, ConvergenceLoop, deployer))
 
+    def test_convergence_loop_configuration(self):
+        """
+        The convergence loop FSM backs off up to the service's
+        ``max_interval``, with jitter, and updates the service's
+        ``metrics``.
+        """
+        service = AgentLoopService(
+            reactor=None, deployer=object(), host=u"example.com", port=1234,
+            max_interval=30.0)
+        world = service.convergence_loop._fsm._world.original
+        self.assertEqual(
+            (world.max_interval, world.jitter > 0,
+             world.metrics is service.metrics),
+            (30.0, True, True))
+
     def test_start_service(self):
         """
         Starting the service starts a reconnecting TCP client to given host
@@ -664,6 +1138,18 @@ class AgentLoopServiceTests(SynchronousTestCase):
         self.assertEqual(fsm.inputted, [_StatusUpdate(configuration=config,
                                                       state=state)])
 
+    def test_local_state_changed(self):
+        """
+        When ``local_state_changed()`` is called a
+        ``ConvergenceLoopInputs.WAKEUP`` input is passed to the convergence
+        loop FSM.
+        """
+        service = AgentLoopService(
+            reactor=None, deployer=object(), host=u"example.com", port=1234)
+        service.convergence_loop = fsm = StubFSM()
+        service.local_state_changed()
+        self.assertEqual(fsm.inputted, [ConvergenceLoopInputs.WAKEUP])
+
 
 def _build_service(test):
     """
@@ -28,13 +28,15 @@ from ..script import (
     ChangeStateOptions, ChangeStateScript,
     ReportStateOptions, ReportStateScript, DatasetAgentOptions)
 from .. import script as script_module
-from .._docker import FakeDockerClient, Unit
+from .._docker import FakeDockerClient, FakeDockerEvents, Unit
 from ...control._model import (
     Application, Deployment, DockerImage, Node, AttachedVolume, Dataset,
     Manifestation)
 from ...control._config import dataset_id_from_name
-from .._loop import AgentLoopService
+from .._loop import AgentLoopService, ConvergenceLoopInputs
 from .._deploy import P2PNodeDeployer
+from .. import _deploy as deploy_module
+from ...volume._transfer import VolumeTransferService
 
 from ...volume.testtools import create_volume_service
 
@@ -418,10 +420,29 @@ class ReportStateScriptMainTests(SynchronousTestCase):
         self.assertEqual(safe_load(content.getvalue()), expected)
 
 
+def secret_file(test_case):
+    """
+    Create a file containing a volume transfer secret.
+
+    :param TestCase test_case: The test the file is for.
+
+    :return: The path of the file, as ``bytes``.  The secret is
+        ``b"secret"``.
+    """
+    path = FilePath(test_case.mktemp())
+    path.setContent(b"secret\n")
+    return path.path
+
+
 class ZFSAgentScriptTests(SynchronousTestCase):
     """
     Tests for ``ZFSAgentScript``.
     """
+    def setUp(self):
+        # Don't listen to the real Docker's events:
+        self.events = FakeDockerEvents()
+        self.patch(deploy_module, "DockerEvents", lambda: self.events)
+
     def test_main_starts_service(self):
         """
         ``ZFSAgentScript.main`` starts the given service.
@@ -448,8 +469,9 @@ class ZFSAgentScriptTests(SynchronousTestCase):
         """
         service = Service()
         options = ZFSAgentOptions()
-        options.parseOptions([b"--destination-port", b"1234", b"1.2.3.4",
-                              b"example.com"])
+        options.parseOptions([b"--destination-port", b"1234",
+                              b"--max-convergence-interval", b"30",
+                              b"1.2.3.4", b"example.com"])
         test_reactor = MemoryCoreReactor()
         ZFSAgentScript().main(test_reactor, options, service)
         parent_service = service.parent
@@ -463,9 +485,114 @@ class ZFSAgentScriptTests(SynchronousTestCase):
                          (AgentLoopService(reactor=test_reactor,
                                            deployer=None,
                                            host=u"example.com",
-                                           port=1234),
+                                           port=1234,
+                                           max_interval=30.0),
                           P2PNodeDeployer, b"1.2.3.4", service, True))
 
+    def test_docker_events_wake_loop(self):
+        """
+        ``ZFSAgentScript.main`` makes Docker events wake up the convergence
+        loop.
+        """
+        service = Service()
+        options = ZFSAgentOptions()
+        options.parseOptions([b"1.2.3.4", b"example.com"])
+        ZFSAgentScript().main(MemoryCoreReactor(), options, service)
+        received = []
+        self.patch(service.parent.convergence_loop, "receive",
+                   received.append)
+        self.events.emit(u"abc")
+        self.assertEqual([ConvergenceLoopInputs.WAKEUP], received)
+
+    def test_no_transfer_service(self):
+        """
+        Unless a transfer secret is configured ``ZFSAgentScript.main`` does
+        not listen for volume transfers, and the deployer pushes volumes
+        over SSH.
+        """
+        service = Service()
+        options = ZFSAgentOptions()
+        options.parseOptions([b"1.2.3.4", b"example.com"])
+        test_reactor = MemoryCoreReactor()
+        ZFSAgentScript().main(test_reactor, options, service)
+        self.assertEqual(
+            ([], None),
+            ([child for child in service.parent
+              if isinstance(child, VolumeTransferService)],
+             service.parent.deployer.transfer_pool))
+
+    def test_starts_transfer_service(self):
+        """
+        ``ZFSAgentScript.main`` listens for volume transfers on the configured
+        address and port, authenticating with the configured secret, and
+        gives the deployer a ``VolumeTransferPool`` connecting to the same
+        port on other nodes with the same secret.
+        """
+        service = Service()
+        options = ZFSAgentOptions()
+        options.parseOptions([b"--transfer-port", b"5678",
+                              b"--transfer-secret-file", secret_file(self),
+                              b"--transfer-interface", b"10.0.0.1",
+                              b"1.2.3.4", b"example.com"])
+        test_reactor = MemoryCoreReactor()
+        ZFSAgentScript().main(test_reactor, options, service)
+        parent_service = service.parent
+        transfer = [child for child in parent_service
+                    if isinstance(child, VolumeTransferService)]
+        pool = parent_service.deployer.transfer_pool
+        self.assertEqual(
+            (1, service, b"secret", [(5678, b"10.0.0.1")],
+             5678, b"secret"),
+            (len(transfer), transfer[0].volume_service, transfer[0].secret,
+             [(port, interface) for (port, factory, backlog, interface)
+              in test_reactor.tcpServers],
+             pool._port, pool._secret))
+
+    def test_no_connection_cache(self):
+        """
+        Unless ``--reuse-ssh-connections`` is given the deployer connects
+        afresh for each command it runs over SSH.
+        """
+        service = Service()
+        options = ZFSAgentOptions()
+        options.parseOptions([b"1.2.3.4", b"example.com"])
+        ZFSAgentScript().main(MemoryCoreReactor(), options, service)
+        self.assertIs(None, service.parent.deployer.connection_cache)
+
+    def test_connection_cache(self):
+        """
+        If ``--reuse-ssh-connections`` is given ``ZFSAgentScript.main`` gives
+        the deployer an ``SSHConnectionCache``, which is closed when the
+        convergence loop service stops.
+        """
+        service = Service()
+        options = ZFSAgentOptions()
+        options.parseOptions([b"--reuse-ssh-connections",
+                              b"1.2.3.4", b"example.com"])
+        ZFSAgentScript().main(MemoryCoreReactor(), options, service)
+        cache = service.parent.deployer.connection_cache
+        existed = cache.directory.exists()
+        service.parent.stopService()
+        self.assertEqual((True, False),
+                         (existed, cache.directory.exists()))
+
+    def test_transfer_compression(self):
+        """
+        ``ZFSAgentScript.main`` configures the deployer's
+        ``VolumeTransferPool`` to compress as the options say.
+        """
+        service = Service()
+        options = ZFSAgentOptions()
+        options.parseOptions([b"--transfer-compression", b"bz2",
+                              b"--transfer-compression-level", b"5",
+                              b"--transfer-secret-file", secret_file(self),
+                              b"--transfer-interface", b"10.0.0.1",
+                              b"1.2.3.4", b"example.com"])
+        ZFSAgentScript().main(MemoryCoreReactor(), options, service)
+        pool = service.parent.deployer.transfer_pool
+        self.assertEqual(
+            (b"bz2", 5), (pool.compression, pool.compression_level))
+
 
 class DatasetAgentServiceFactoryTests(SynchronousTestCase):
     """
@@ -486,7 +613,9 @@ class DatasetAgentServiceFactoryTests(SynchronousTestCase):
         reactor = MemoryCoreReactor()
         options = DatasetAgentOptions()
         options.parseOptions([
-            b"--destination-port", b"1234", b"10.0.0.1", b"10.0.0.2",
+            b"--destination-port", b"1234",
+            b"--max-convergence-interval", b"30",
+            b"10.0.0.1", b"10.0.0.2",
         ])
         service_factory = DatasetAgentServiceFactory(
             deployer_factory=factory
@@ -497,6 +626,7 @@ class DatasetAgentServiceFactoryTests(SynchronousTestCase):
                 deployer=deployer,
                 host=b"10.0.0.2",
                 port=1234,
+                max_interval=30.0,
             ),
             service_factory.get_service(reactor, options)
         )
@@ -637,6 +767,22 @@ def make_amp_agent_options_tests(options_type):
                                        b"1.2.3.4", b"example.com"])
             self.assertEqual(self.options["destination-port"], 1234)
 
+        def test_default_max_convergence_interval(self):
+            """
+            The default maximum convergence interval is 10 seconds.
+            """
+            self.options.parseOptions([b"1.2.3.4", b"example.com"])
+            self.assertEqual(self.options["max-convergence-interval"], 10.0)
+
+        def test_custom_max_convergence_interval(self):
+            """
+            The ``--max-convergence-interval`` command-line option allows
+            configuring the maximum convergence interval.
+            """
+            self.options.parseOptions([b"--max-convergence-interval", b"2.5",
+                                       b"1.2.3.4", b"example.com"])
+            self.assertEqual(self.options["max-convergence-interval"], 2.5)
+
         def test_host(self):
             """
             The second required command-line argument allows configuring the
@@ -670,6 +816,150 @@ class ZFSAgentOptionsTests(make_amp_agent_options_tests(ZFSAgentOptions)):
     """
     Tests for ``ZFSAgentOptions``.
     """
+    def test_default_transfer_port(self):
+        """
+        The default volume transfer port configured by ``ZFSAgentOptions`` is
+        4526.
+        """
+        self.options.parseOptions([b"1.2.3.4", b"example.com"])
+        self.assertEqual(self.options["transfer-port"], 4526)
+
+    def test_custom_transfer_port(self):
+        """
+        The ``--transfer-port`` command-line option allows configuring the
+        volume transfer port.
+        """
+        self.options.parseOptions([b"--transfer-port", b"1234",
+                                   b"1.2.3.4", b"example.com"])
+        self.assertEqual(self.options["transfer-port"], 1234)
+
+    def test_default_transfer_secret(self):
+        """
+        By default no transfer secret is configured.
+        """
+        self.options.parseOptions([b"1.2.3.4", b"example.com"])
+        self.assertEqual(
+            (None, None),
+            (self.options["transfer-secret"],
+             self.options["transfer-interface"]))
+
+    def test_transfer_secret(self):
+        """
+        The ``--transfer-secret-file`` command-line option gives a file from
+        which the transfer secret is read, without surrounding whitespace.
+        """
+        self.options.parseOptions(
+            [b"--transfer-secret-file", secret_file(self),
+             b"--transfer-interface", b"10.0.0.1",
+             b"1.2.3.4", b"example.com"])
+        self.assertEqual(
+            (b"secret", b"10.0.0.1"),
+            (self.options["transfer-secret"],
+             self.options["transfer-interface"]))
+
+    def test_transfer_secret_without_interface(self):
+        """
+        A ``UsageError`` is raised if ``--transfer-secret-file`` is given
+        without ``--transfer-interface``.
+        """
+        self.assertRaises(
+            UsageError, self.options.parseOptions,
+            [b"--transfer-secret-file", secret_file(self),
+             b"1.2.3.4", b"example.com"])
+
+    def test_transfer_interface_without_secret(self):
+        """
+        A ``UsageError`` is raised if ``--transfer-interface`` is given
+        without ``--transfer-secret-file``.
+        """
+        self.assertRaises(
+            UsageError, self.options.parseOptions,
+            [b"--transfer-interface", b"10.0.0.1",
+             b"1.2.3.4", b"example.com"])
+
+    def test_missing_transfer_secret_file(self):
+        """
+        A ``UsageError`` is raised if the ``--transfer-secret-file`` can't be
+        read.
+        """
+        self.assertRaises(
+            UsageError, self.options.parseOptions,
+            [b"--transfer-secret-file", self.mktemp(),
+             b"--transfer-interface", b"10.0.0.1",
+             b"1.2.3.4", b"example.com"])
+
+    def test_empty_transfer_secret(self):
+        """
+        A ``UsageError`` is raised if the ``--transfer-secret-file`` is
+        empty.
+        """
+        path = FilePath(self.mktemp())
+        path.setContent(b"\n")
+        self.assertRaises(
+            UsageError, self.options.parseOptions,
+            [b"--transfer-secret-file", path.path,
+             b"--transfer-interface", b"10.0.0.1",
+             b"1.2.3.4", b"example.com"])
+
+    def test_default_transfer_compression(self):
+        """
+        By default datasets are transferred uncompressed.
+        """
+        self.options.parseOptions([b"1.2.3.4", b"example.com"])
+        self.assertEqual(
+            (None, None),
+            (self.options["transfer-compression"],
+             self.options["transfer-compression-level"]))
+
+    def test_custom_transfer_compression(self):
+        """
+        The ``--transfer-compression`` and ``--transfer-compression-level``
+        command-line options allow configuring how transferred datasets are
+        compressed.
+        """
+        self.options.parseOptions([b"--transfer-compression", b"zlib",
+                                   b"--transfer-compression-level", b"3",
+                                   b"1.2.3.4", b"example.com"])
+        self.assertEqual(
+            (b"zlib", 3),
+            (self.options["transfer-compression"],
+             self.options["transfer-compression-level"]))
+
+    def test_unknown_transfer_compression(self):
+        """
+        A ``UsageError`` is raised if ``--transfer-compression`` is not the
+        name of a supported codec.
+        """
+        self.assertRaises(
+            UsageError, self.options.parseOptions,
+            [b"--transfer-compression", b"unknown",
+             b"1.2.3.4", b"example.com"])
+
+    def test_default_reuse_ssh_connections(self):
+        """
+        By default SSH connections are not reused.
+        """
+        self.options.parseOptions([b"1.2.3.4", b"example.com"])
+        self.assertFalse(self.options["reuse-ssh-connections"])
+
+    def test_reuse_ssh_connections(self):
+        """
+        The ``--reuse-ssh-connections`` command-line option turns on SSH
+        connection reuse.
+        """
+        self.options.parseOptions([b"--reuse-ssh-connections",
+                                   b"1.2.3.4", b"example.com"])
+        self.assertTrue(self.options["reuse-ssh-connections"])
+
+    def test_invalid_transfer_compression_level(self):
+        """
+        A ``UsageError`` is raised if ``--transfer-compression-level`` is not
+        from 1 to 9.
+        """
+        self.assertRaises(
+            UsageError, self.options.parseOptions,
+            [b"--transfer-compression-level", b"10",
+             b"1.2.3.4", b"example.com"])
 
 
 class ZFSAgentOptionsVolumeTests(make_volume_options_tests(
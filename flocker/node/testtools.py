@@ -8,13 +8,18 @@ import errno
 import os
 import pwd
 import socket
+from threading import Lock
+from time import sleep
 from unittest import skipUnless
 
 from zope.interface import implementer
 
 from characteristic import attributes
 
+from docker.errors import APIError
+
 from twisted.trial.unittest import TestCase
+from twisted.web.http import NOT_FOUND
 
 from zope.interface.verify import verifyObject
 
@@ -167,3 +172,87 @@ def to_node(node_state):
     return Node(hostname=node_state.hostname,
                 applications=node_state.applications,
                 manifestations=node_state.manifestations)
+
+
+class _NotFoundResponse(object):
+    """
+    Enough of a ``requests`` response for ``APIError``.
+    """
+    status_code = NOT_FOUND
+    content = b""
+
+
+class FakeDockerAPI(object):
+    """
+    Enough of ``docker.Client`` for ``DockerClient`` to list and remove
+    containers, recording the calls made.  All containers are running and
+    have the same minimal configuration.
+
+    The methods may be called from multiple threads at once.
+
+    :ivar dict containers_by_id: Maps container IDs to their names.
+    :ivar dict images_by_id: Maps container IDs to their image IDs; the
+        default is ``u"image"``.
+    :ivar list inspected: The containers that have been inspected.
+    :ivar list images_inspected: The images that have been inspected.
+    :ivar int max_concurrency: The largest number of simultaneous
+        inspections.
+    """
+    def __init__(self, latency=0):
+        """
+        :param float latency: Seconds each inspection takes, simulating
+            the round trip to the Docker daemon.
+        """
+        self.latency = latency
+        self.containers_by_id = {}
+        self.images_by_id = {}
+        self.inspected = []
+        self.images_inspected = []
+        self.max_concurrency = 0
+        self._concurrency = 0
+        self._lock = Lock()
+
+    def containers(self, quiet, all):
+        return [{u"Id": container_id}
+                for container_id in self.containers_by_id]
+
+    def inspect_container(self, container):
+        with self._lock:
+            self.inspected.append(container)
+            self._concurrency += 1
+            self.max_concurrency = max(
+                self.max_concurrency, self._concurrency)
+        try:
+            sleep(self.latency)
+            for container_id, name in self.containers_by_id.items():
+                if container in (container_id, name):
+                    return {
+                        u"Id": container_id,
+                        u"Image": self.images_by_id.get(
+                            container_id, u"image"),
+                        u"Name": u"/" + name,
+                        u"State": {u"Running": True},
+                        u"Config": {u"Image": u"busybox", u"Env": [],
+                                    u"CpuShares": 0, u"Memory": 0},
+                        u"HostConfig": {
+                            u"PortBindings": None, u"Binds": None,
+                            u"RestartPolicy": {u"Name": u""}},
+                    }
+            raise APIError("Not found", _NotFoundResponse())
+        finally:
+            with self._lock:
+                self._concurrency -= 1
+
+    def inspect_image(self, image):
+        with self._lock:
+            self.images_inspected.append(image)
+        sleep(self.latency)
+        return {u"Config": {u"Env": []}}
+
+    def stop(self, container):
+        pass
+
+    def remove_container(self, container):
+        for container_id, name in self.containers_by_id.items():
+            if container == name:
+                del self.containers_by_id[container_id]
@@ -17,12 +17,15 @@ cooperating nodes.
 """
 
 __all__ = [
-    "INetwork", "make_host_network", "make_memory_network",
+    "INetwork", "IBatchedNetwork", "IAsyncNetwork",
+    "make_host_network", "make_memory_network", "make_threaded_network",
+    "ThreadedNetwork",
     "Proxy", "OpenPort",
 ]
 
 
-from ._interfaces import INetwork
+from ._interfaces import INetwork, IBatchedNetwork, IAsyncNetwork
 from ._iptables import make_host_network
 from ._memory import make_memory_network
+from ._threaded import ThreadedNetwork, make_threaded_network
 from ._model import Proxy, OpenPort
@@ -75,6 +75,14 @@ class INetwork(Interface):
             ports.
         """
 
+    def forget_cached_state():
+        """
+        Discard any knowledge of the system's network configuration cached by
+        this object, so that the next enumeration inspects the system again.
+
+        Providers which do not cache anything may do nothing.
+        """
+
     def enumerate_used_ports():
         """
         Retrieve information about port numbers which are in use.
@@ -85,3 +93,91 @@ class INetwork(Interface):
             proxies created by this ``INetwork`` provider and TCP ports opend
             by this ``INetworkProvider``.
         """
+
+
+class IBatchedNetwork(INetwork):
+    """
+    An ``INetwork`` which can replace its whole configuration in one step.
+    """
+    def set_proxies(proxies):
+        """
+        Make the configured proxies exactly ``proxies``.
+
+        Only the proxies which differ from the current configuration are
+        created or deleted.
+
+        :param proxies: A collection of objects like those returned by
+            :py:meth:`INetwork.create_proxy_to`.
+        """
+
+    def set_open_ports(open_ports):
+        """
+        Make the configured open ports exactly ``open_ports``.
+
+        Only the open ports which differ from the current configuration are
+        created or deleted.
+
+        :param open_ports: A collection of objects like those returned by
+            :py:meth:`INetwork.open_port`.
+        """
+
+
+class IAsyncNetwork(Interface):
+    """
+    An ``INetwork`` whose operations do not block.
+
+    Each method corresponds to the ``INetwork`` or ``IBatchedNetwork``
+    method of the same name but returns a ``Deferred`` which fires with
+    that method's result.
+    """
+    network = Attribute("The ``INetwork`` provider operated on.")
+
+    def create_proxy_to(ip, port):
+        """
+        :see: :py:meth:`INetwork.create_proxy_to`
+        """
+
+    def delete_proxy(proxy):
+        """
+        :see: :py:meth:`INetwork.delete_proxy`
+        """
+
+    def open_port(port):
+        """
+        :see: :py:meth:`INetwork.open_port`
+        """
+
+    def delete_open_port(port):
+        """
+        :see: :py:meth:`INetwork.delete_open_port`
+        """
+
+    def set_proxies(proxies):
+        """
+        :see: :py:meth:`IBatchedNetwork.set_proxies`
+        """
+
+    def set_open_ports(open_ports):
+        """
+        :see: :py:meth:`IBatchedNetwork.set_open_ports`
+        """
+
+    def forget_cached_state():
+        """
+        :see: :py:meth:`INetwork.forget_cached_state`
+        """
+
+    def enumerate_proxies():
+        """
+        :see: :py:meth:`INetwork.enumerate_proxies`
+        """
+
+    def enumerate_open_ports():
+        """
+        :see: :py:meth:`INetwork.enumerate_open_ports`
+        """
+
+    def enumerate_used_ports():
+        """
+        :see: :py:meth:`INetwork.enumerate_used_ports`
+        """
@@ -8,7 +8,11 @@ Manipulate network routing behavior on a node using ``iptables``.
 from __future__ import unicode_literals
 
 import shlex
-from subprocess import check_call, check_output
+from collections import OrderedDict
+from contextlib import contextmanager
+from subprocess import (
+    PIPE, CalledProcessError, Popen, check_call, check_output,
+)
 
 from zope.interface import implementer
 from ipaddr import IPAddress
@@ -18,11 +22,11 @@ from psutil import net_connections
 from twisted.python.filepath import FilePath
 
 from ._logging import (
-    IPTABLES,
+    IPTABLES, IPTABLES_RESTORE,
     CREATE_PROXY_TO, DELETE_PROXY,
     OPEN_PORT, DELETE_OPEN_PORT,
 )
-from ._interfaces import INetwork
+from ._interfaces import INetwork, IBatchedNetwork
 from ._model import Proxy, OpenPort
 
 FLOCKER_PROXY_COMMENT_MARKER = b"flocker create_proxy_to"
@@ -53,32 +57,57 @@ def iptables(logger, argv):
         check_call([b"iptables"] + argv)
 
 
-def create_proxy_to(logger, ip, port):
+def iptables_restore(logger, rules):
     """
-    :see: ``HostNetwork.create_proxy_to``
+    Apply a batch of rule changes with ``iptables-restore``.
+
+    ``--noflush`` is used so only the given rules are affected.  The kernel
+    commits each table in a single step so either every change in ``rules``
+    is made or none of them is.
+
+    :param bytes rules: Input in the format accepted by ``iptables-restore``.
+
+    :raise CalledProcessError: If ``iptables-restore`` fails.
     """
-    action = CREATE_PROXY_TO(
-        logger=logger, target_ip=ip, target_port=port)
+    argv = [b"iptables-restore", b"--noflush"]
+    with IPTABLES_RESTORE(
+            logger=logger, argv=argv, rules=rules.decode("ascii")):
+        process = Popen(argv, stdin=PIPE)
+        process.communicate(rules)
+        if process.returncode:
+            raise CalledProcessError(process.returncode, argv)
 
-    with action:
-        encoded_ip = unicode(ip).encode("ascii")
-        encoded_port = unicode(port).encode("ascii")
 
+def _proxy_rules(ip, port):
+    """
+    Describe the iptables rules which implement a proxy.
+
+    :param ip: The destination to which to proxy.
+    :type ip: ipaddr.IPv4Address
+
+    :param int port: The TCP port number on which to proxy.
+
+    :return: A ``list`` of ``(table, position, chain, argv)`` tuples.
+        ``position`` is ``b"--append"`` or ``b"--insert"`` and ``argv`` is
+        the rest of the rule specification.
+    """
+    encoded_ip = unicode(ip).encode("ascii")
+    encoded_port = unicode(port).encode("ascii")
+
+    return [
         # The first goal is to configure "Destination NAT" (DNAT).  We're just
         # going to rewrite the destination address of traffic arriving on the
         # specified port so it looks like it is destined for the specified ip
         # instead of destined for "us".  This gets the packets delivered to the
         # right destination.
-        iptables(logger, [
-            # All NAT stuff happens in the netfilter NAT table.
-            b"--table", b"nat",
-
-            # Destination NAT has to happen "pre"-routing so that the normal
-            # routing rules on the machine will use the re-written destination
-            # address and get the packet to that new destination.  Accomplish
-            # this by appending the rule to the PREROUTING chain.
-            b"--append", b"PREROUTING",
-
+        #
+        # All NAT stuff happens in the netfilter NAT table.
+        #
+        # Destination NAT has to happen "pre"-routing so that the normal
+        # routing rules on the machine will use the re-written destination
+        # address and get the packet to that new destination.  Accomplish this
+        # by appending the rule to the PREROUTING chain.
+        (b"nat", b"--append", b"PREROUTING", [
             # Only re-route traffic with a destination port matching the one we
             # were told to manipulate.  It is also necessary to specify TCP (or
             # UDP) here since that is the layer of the network stack that
@@ -99,7 +128,7 @@ def create_proxy_to(logger, ip, port):
             # knows how to mangle the packet - rewrite the destination IP of
             # the address to the target we were told to use.
             b"--jump", b"DNAT", b"--to-destination", encoded_ip,
-        ])
+        ]),
 
         # Bonus round!  Having performed DNAT (changing the destination) during
         # prerouting we are now prepared to send the packet on somewhere else.
@@ -117,15 +146,11 @@ def create_proxy_to(logger, ip, port):
         # if it ever changes the rule gets updated and it may require some
         # steps to do port allocation (not sure what they are yet).  So we'll
         # just masquerade for now.
-        iptables(logger, [
-            # All NAT stuff happens in the netfilter NAT table.
-            b"--table", b"nat",
-
-            # As described above, this transformation happens after routing
-            # decisions have been made and the packet is on its way out of the
-            # system.  Therefore, append the rule to the POSTROUTING chain.
-            b"--append", b"POSTROUTING",
-
+        #
+        # As described above, this transformation happens after routing
+        # decisions have been made and the packet is on its way out of the
+        # system.  Therefore, append the rule to the POSTROUTING chain.
+        (b"nat", b"--append", b"POSTROUTING", [
             # We'll stick to matching the same kinds of packets we matched in
             # the earlier stage.  We might want to change the factoring of this
             # code to avoid the duplication - particularly in case we want to
@@ -137,20 +162,14 @@ def create_proxy_to(logger, ip, port):
 
             # Do the masquerading.
             b"--jump", b"MASQUERADE",
-        ])
+        ]),
 
         # Secret level!!  Traffic that originates *on* the host bypasses the
         # PREROUTING chain.  Instead, it passes through the OUTPUT chain.  If
         # we want connections from localhost to the forwarded port to be
         # affected then we need a rule in the OUTPUT chain to do the same kind
         # of DNAT that we did in the PREROUTING chain.
-        iptables(logger, [
-            # All NAT stuff happens in the netfilter NAT table.
-            b"--table", b"nat",
-
-            # As mentioned, this rule is for the OUTPUT chain.
-            b"--append", b"OUTPUT",
-
+        (b"nat", b"--append", b"OUTPUT", [
             # Matching the exact same kinds of packets as the PREROUTING rule
             # matches.
             b"--protocol", b"tcp",
@@ -159,46 +178,29 @@ def create_proxy_to(logger, ip, port):
 
             # Do the same DNAT as we did in the rule for the PREROUTING chain.
             b"--jump", b"DNAT", b"--to-destination", encoded_ip,
-        ])
-
-        iptables(logger, [
-            b"--table", b"filter",
-            b"--insert", b"FORWARD",
+        ]),
 
+        (b"filter", b"--insert", b"FORWARD", [
             b"--destination", encoded_ip,
             b"--protocol", b"tcp", b"--destination-port", encoded_port,
 
             b"--jump", b"ACCEPT",
-        ])
-
-        # The network stack only considers forwarding traffic when certain
-        # system configuration is in place.
-        #
-        # https://www.kernel.org/doc/Documentation/networking/ip-sysctl.txt
-        # will explain the meaning of these in (very slightly) more detail.
-        conf = FilePath(b"/proc/sys/net/ipv4/conf")
-        descendant = conf.descendant([b"default", b"forwarding"])
-        with descendant.open("wb") as forwarding:
-            forwarding.write(b"1")
-
-        # In order to have the OUTPUT chain DNAT rule affect routing decisions,
-        # we also need to tell the system to make routing decisions about
-        # traffic from or to localhost.
-        for path in conf.children():
-            with path.child(b"route_localnet").open("wb") as route_localnet:
-                route_localnet.write(b"1")
+        ]),
+    ]
 
-        return Proxy(ip=ip, port=port)
 
+def _open_port_rules(port):
+    """
+    Describe the iptables rules which implement an open port.
 
-def open_port(logger, port):
-    with OPEN_PORT(
-            logger=logger, target_port=port):
-        encoded_port = unicode(port).encode("ascii")
-        iptables(logger, [
-            b"--table", b"filter",
-            b"--insert", b"INPUT",
+    :param int port: The TCP port number to open.
 
+    :return: A ``list`` of rule tuples like the one returned by
+        ``_proxy_rules``.
+    """
+    encoded_port = unicode(port).encode("ascii")
+    return [
+        (b"filter", b"--insert", b"INPUT", [
             b"--protocol", b"tcp", b"--destination-port", encoded_port,
 
             # Tag it as a flocker-created rule so we can recognize it later.
@@ -206,7 +208,86 @@ def open_port(logger, port):
             b"--comment", FLOCKER_OPENPORT_COMMENT_MARKER,
 
             b"--jump", b"ACCEPT",
-        ])
+        ]),
+    ]
+
+
+def _enable_forwarding():
+    """
+    Configure the system so that the rules created for proxies take effect.
+    """
+    # The network stack only considers forwarding traffic when certain
+    # system configuration is in place.
+    #
+    # https://www.kernel.org/doc/Documentation/networking/ip-sysctl.txt
+    # will explain the meaning of these in (very slightly) more detail.
+    conf = FilePath(b"/proc/sys/net/ipv4/conf")
+    descendant = conf.descendant([b"default", b"forwarding"])
+    with descendant.open("wb") as forwarding:
+        forwarding.write(b"1")
+
+    # In order to have the OUTPUT chain DNAT rule affect routing decisions,
+    # we also need to tell the system to make routing decisions about
+    # traffic from or to localhost.
+    for path in conf.children():
+        with path.child(b"route_localnet").open("wb") as route_localnet:
+            route_localnet.write(b"1")
+
+
+def _quote(argument):
+    """
+    Quote an argument for inclusion in ``iptables-restore`` input.
+    """
+    if b" " in argument:
+        return b'"%s"' % (argument,)
+    return argument
+
+
+def restore_input(deletions, additions):
+    """
+    Construct ``iptables-restore`` input which deletes and adds rules.
+
+    :param deletions: A ``list`` of rule tuples (as returned by
+        ``_proxy_rules``) to delete.
+    :param additions: A ``list`` of rule tuples to add.
+
+    :return: ``bytes`` suitable for ``iptables-restore --noflush``.  All
+        deletions in a table happen before any additions in that table.
+    """
+    tables = OrderedDict()
+    for table, position, chain, argv in deletions:
+        tables.setdefault(table, []).append([b"--delete", chain] + argv)
+    for table, position, chain, argv in additions:
+        tables.setdefault(table, []).append([position, chain] + argv)
+
+    lines = []
+    for table, commands in tables.items():
+        lines.append(b"*" + table)
+        for command in commands:
+            lines.append(b" ".join(_quote(argument) for argument in command))
+        lines.append(b"COMMIT")
+    return b"".join(line + b"\n" for line in lines)
+
+
+def create_proxy_to(logger, ip, port):
+    """
+    :see: ``HostNetwork.create_proxy_to``
+    """
+    action = CREATE_PROXY_TO(
+        logger=logger, target_ip=ip, target_port=port)
+
+    with action:
+        for table, position, chain, argv in _proxy_rules(ip, port):
+            iptables(logger, [b"--table", table, position, chain] + argv)
+        _enable_forwarding()
+        return Proxy(ip=ip, port=port)
+
+
+def open_port(logger, port):
+    with OPEN_PORT(
+            logger=logger, target_port=port):
+        for table, position, chain, argv in _open_port_rules(port):
+            iptables(logger, [b"--table", table, position, chain] + argv)
 
     return OpenPort(port=port)
 
@@ -215,35 +296,10 @@ def delete_proxy(logger, proxy):
     """
     :see: ``HostNetwork.delete_proxy``
     """
-    ip = unicode(proxy.ip).encode("ascii")
-    port = unicode(proxy.port).encode("ascii")
-
-    commands = [
-        [b"--table", b"nat",
-         b"--delete", b"PREROUTING",
-         b"--protocol", b"tcp", b"--destination-port", port,
-         b"--match", b"addrtype", b"--dst-type", b"LOCAL",
-         b"--match", b"comment", b"--comment", FLOCKER_PROXY_COMMENT_MARKER,
-         b"--jump", b"DNAT", b"--to-destination", ip],
-        [b"--table", b"nat",
-         b"--delete", b"POSTROUTING",
-         b"--protocol", b"tcp", b"--destination-port", port,
-         b"--jump", b"MASQUERADE"],
-        [b"--table", b"nat",
-         b"--delete", b"OUTPUT",
-         b"--protocol", b"tcp", b"--destination-port", port,
-         b"--match", b"addrtype", b"--dst-type", b"LOCAL",
-         b"--jump", b"DNAT", b"--to-destination", ip],
-        [b"--table", b"filter",
-         b"--delete", b"FORWARD",
-         b"--destination", ip,
-         b"--protocol", b"tcp", b"--destination-port", port,
-         b"--jump", b"ACCEPT"],
-    ]
-
     with DELETE_PROXY(logger, target_ip=proxy.ip, target_port=proxy.port):
-        for argv in commands:
-            iptables(logger, argv)
+        for table, position, chain, argv in _proxy_rules(
+                proxy.ip, proxy.port):
+            iptables(logger, [b"--table", table, b"--delete", chain] + argv)
 
 
 def delete_open_port(logger, port):
@@ -254,85 +310,143 @@ def delete_open_port(logger, port):
         logger=logger, target_port=port)
 
     with action:
-        encoded_port = unicode(port.port).encode("ascii")
-        iptables(logger, [
-            b"--table", b"filter",
-            b"--delete", b"INPUT",
+        for table, position, chain, argv in _open_port_rules(port.port):
+            iptables(logger, [b"--table", table, b"--delete", chain] + argv)
 
-            b"--protocol", b"tcp", b"--destination-port", encoded_port,
 
-            # Tag it as a flocker-created rule so we can recognize it later.
-            b"--match", b"comment",
-            b"--comment", FLOCKER_OPENPORT_COMMENT_MARKER,
+def set_proxies(logger, current, proxies):
+    """
+    :param current: The proxies which are currently configured.
 
-            b"--jump", b"ACCEPT",
-        ])
+    :see: ``HostNetwork.set_proxies``
+    """
+    current = set(current)
+    desired = set(proxies)
+    deletions = [
+        rule
+        for proxy in current - desired
+        for rule in _proxy_rules(proxy.ip, proxy.port)
+    ]
+    additions = [
+        rule
+        for proxy in desired - current
+        for rule in _proxy_rules(proxy.ip, proxy.port)
+    ]
+    if deletions or additions:
+        iptables_restore(logger, restore_input(deletions, additions))
+    if additions:
+        _enable_forwarding()
 
 
-def enumerate_proxies():
+def set_open_ports(logger, current, open_ports):
+    """
+    :param current: The open ports which are currently configured.
+
+    :see: ``HostNetwork.set_open_ports``
+    """
+    current = set(current)
+    desired = set(open_ports)
+    deletions = [
+        rule
+        for open_port in current - desired
+        for rule in _open_port_rules(open_port.port)
+    ]
+    additions = [
+        rule
+        for open_port in desired - current
+        for rule in _open_port_rules(open_port.port)
+    ]
+    if deletions or additions:
+        iptables_restore(logger, restore_input(deletions, additions))
+
+
+def enumerate_proxies(tables=None):
     """
     Inspect the system's iptables configuration to determine what proxies
     currently exist.
 
+    :param tables: The result of ``iptables_save`` to inspect, or ``None``
+        to run ``iptables-save`` now.
+
     :see: :py:meth:`INetwork.enumerate_proxies` for parameter documentation.
     """
     proxies = []
     for rule in get_flocker_rules(
             comment_marker=FLOCKER_PROXY_COMMENT_MARKER,
-            table=b'nat'):
+            table=b'nat', tables=tables):
         proxies.append(
             Proxy(ip=rule.to_destination, port=rule.destination_port))
 
     return proxies
 
 
-def enumerate_open_ports():
+def enumerate_open_ports(tables=None):
     """
     Inspect the system's iptables configuration to determine which ports
     are currently open.
 
+    :param tables: The result of ``iptables_save`` to inspect, or ``None``
+        to run ``iptables-save`` now.
+
     :see: :py:meth:`INetwork.enumerate_open_ports` for parameter documentation.
     """
     ports = []
     for rule in get_flocker_rules(
             comment_marker=FLOCKER_OPENPORT_COMMENT_MARKER,
-            table=b'filter'):
+            table=b'filter', tables=tables):
         ports.append(
             OpenPort(port=rule.destination_port))
 
     return ports
 
 
-def get_flocker_rules(comment_marker, table):
+def iptables_save():
     """
-    Look up all of the iptables rules created/managed by flocker.
+    Run ``iptables-save`` and parse its output.
 
-    :return: An iterator of :py:class:`Options` instances, one for each rule
-        found.
+    :return: The result of ``parse_iptables_save`` for the current system
+        configuration.
     """
     # Life is horrible.
     # https://stackoverflow.com/questions/109553/how-can-i-programmatically-manage-iptables-rules-on-the-fly
-    # At least we know all the rules we need to inspect are in the NAT table.
-    output = check_output([b"iptables-save"])
+    return parse_iptables_save(check_output([b"iptables-save"]))
 
-    # Find the beginning of the NAT table
-    header = b"*%s\n" % (table,)
-    begin = output.find(header) + len(header)
 
-    # Find the end of the NAT table
-    footer = b"COMMIT\n"
-    end = output.find(footer, begin)
+def parse_iptables_save(output):
+    """
+    Parse the commented rules out of iptables-save(8) output.
 
-    # Slice it out.
-    nat = output[begin:end]
+    :param bytes output: The output of ``iptables-save``.
 
-    for line in nat.splitlines():
-        if line.startswith(b":"):
-            # Skip these lines describing a chain or the table overall.
-            continue
+    :return: A ``dict`` mapping table names (``bytes``) to a ``list`` of
+        :py:class:`RuleOptions` instances, one for each rule in that table
+        which has a comment.
+    """
+    tables = {}
+    rules = None
+    for line in output.splitlines():
+        if line.startswith(b"*"):
+            rules = tables.setdefault(line[1:], [])
+        elif rules is not None and b"--comment" in line:
+            # Every rule Flocker creates is tagged with a comment.  Skip the
+            # relatively expensive parsing of all other rules.
+            rules.append(parse_iptables_options(shlex.split(line)))
+    return tables
+
+
+def get_flocker_rules(comment_marker, table, tables=None):
+    """
+    Look up all of the iptables rules created/managed by flocker.
 
-        options = parse_iptables_options(shlex.split(line))
+    :param tables: The result of ``iptables_save`` to search, or ``None``
+        to run ``iptables-save`` now.
 
+    :return: An iterator of :py:class:`RuleOptions` instances, one for each
+        rule found.
+    """
+    if tables is None:
+        tables = iptables_save()
+    for options in tables.get(table, []):
         if options.comment == comment_marker:
             yield options
 
@@ -388,20 +502,103 @@ def parse_iptables_options(argv):
         to_destination=to_destination)
 
 
-@implementer(INetwork)
+def parse_tcp_table(contents):
+    """
+    Find the local port numbers of the sockets in a ``/proc/net/tcp`` or
+    ``/proc/net/tcp6`` table.
+
+    Sockets in every state are included, so both listening servers and
+    connected clients are found.
+
+    :param bytes contents: The contents of the table.
+
+    :return: A ``frozenset`` of ``int`` port numbers.
+    """
+    ports = set()
+    # The first line is a header.  The rest look like:
+    #
+    #   0: 0100007F:1F90 00000000:0000 0A 00000000:00000000 00:00000000 ...
+    #
+    # The second field is the local address and port, in hexadecimal.
+    for line in contents.splitlines()[1:]:
+        fields = line.split(None, 2)
+        if len(fields) < 2:
+            continue
+        ports.add(int(fields[1].rsplit(b":", 1)[1], 16))
+    return frozenset(ports)
+
+
+@implementer(INetwork, IBatchedNetwork)
 class HostNetwork(object):
     """
     An ``INetwork`` implementation based on ``iptables``.
+
+    The proxies and open ports found by one ``iptables-save`` are remembered
+    and kept up to date as this object changes the rules, until
+    ``forget_cached_state`` is called.
+
+    Ports used by TCP sockets are found by reading the kernel's TCP tables
+    directly, which is much cheaper than asking ``psutil`` on a host with
+    many sockets.
+
+    :ivar list _tcp_tables: ``FilePath``\ s of the kernel's TCP tables.  If
+        none of them can be read ``psutil`` is used instead.
+
+    ``set_proxies`` and ``set_open_ports`` apply all of their changes in a
+    single ``iptables-restore`` transaction rather than running ``iptables``
+    once per rule.
     """
     logger = Logger()
 
+    _tcp_tables = [FilePath(b"/proc/net/tcp"), FilePath(b"/proc/net/tcp6")]
+
+    def __init__(self):
+        self._proxies = None
+        self._open_ports = None
+
+    def forget_cached_state(self):
+        """
+        Discard the proxies and open ports remembered from the last
+        ``iptables-save``.
+
+        :see: :meth:`INetwork.forget_cached_state`
+        """
+        self._proxies = None
+        self._open_ports = None
+
+    def _load(self):
+        """
+        Run ``iptables-save`` if the proxies and open ports are not already
+        known.
+        """
+        if self._proxies is None:
+            tables = iptables_save()
+            self._proxies = set(enumerate_proxies(tables))
+            self._open_ports = set(enumerate_open_ports(tables))
+
+    @contextmanager
+    def _changing(self):
+        """
+        Forget the cached state if the rule changes made in this context fail,
+        since it is then unknown which of them took effect.
+        """
+        try:
+            yield
+        except:
+            self.forget_cached_state()
+            raise
+
     def create_proxy_to(self, ip, port):
         """
         Configure iptables to proxy TCP traffic on the given port.
 
         :see: :meth:`INetwork.create_proxy_to` for parameter documentation.
         """
-        return create_proxy_to(self.logger, ip, port)
+        with self._changing():
+            proxy = create_proxy_to(self.logger, ip, port)
+        if self._proxies is not None:
+            self._proxies.add(proxy)
+        return proxy
 
     def delete_proxy(self, proxy):
         """
@@ -409,20 +606,65 @@ class HostNetwork(object):
 
         :see: :meth:`INetwork.delete_proxy` for parameter documentation.
         """
-        return delete_proxy(self.logger, proxy)
+        with self._changing():
+            delete_proxy(self.logger, proxy)
+        if self._proxies is not None:
+            self._proxies.discard(proxy)
 
     def open_port(self, port):
         """
         Configure iptables to allow TCP traffic to the given port.
         """
-        return open_port(self.logger, port)
+        with self._changing():
+            open_port_ = open_port(self.logger, port)
+        if self._open_ports is not None:
+            self._open_ports.add(open_port_)
+        return open_port_
 
     def delete_open_port(self, port):
-        return delete_open_port(self.logger, port)
+        with self._changing():
+            delete_open_port(self.logger, port)
+        if self._open_ports is not None:
+            self._open_ports.discard(port)
+
+    def set_proxies(self, proxies):
+        """
+        Make the configured proxies exactly ``proxies`` using one
+        ``iptables-restore`` transaction.
 
-    enumerate_proxies = staticmethod(enumerate_proxies)
+        :see: :meth:`IBatchedNetwork.set_proxies` for parameter
+            documentation.
+        """
+        with self._changing():
+            set_proxies(self.logger, self.enumerate_proxies(), proxies)
+        self._proxies = set(proxies)
 
-    enumerate_open_ports = staticmethod(enumerate_open_ports)
+    def set_open_ports(self, open_ports):
+        """
+        Make the open ports exactly ``open_ports`` using one
+        ``iptables-restore`` transaction.
+
+        :see: :meth:`IBatchedNetwork.set_open_ports` for parameter
+            documentation.
+        """
+        with self._changing():
+            set_open_ports(
+                self.logger, self.enumerate_open_ports(), open_ports)
+        self._open_ports = set(open_ports)
+
+    def enumerate_proxies(self):
+        """
+        :see: :meth:`INetwork.enumerate_proxies`
+        """
+        self._load()
+        return list(self._proxies)
+
+    def enumerate_open_ports(self):
+        """
+        :see: :meth:`INetwork.enumerate_open_ports`
+        """
+        self._load()
+        return list(self._open_ports)
 
     def enumerate_used_ports(self):
         """
@@ -432,11 +674,7 @@ class HostNetwork(object):
         :see: :meth:`INetwork.enumerate_used_ports` for parameter
             documentation.
         """
-        listening = set(
-            conn.laddr[1]
-            for conn
-            in net_connections(kind='tcp')
-        )
+        listening = self._tcp_ports()
         proxied = set(
             proxy.port
             for proxy in self.enumerate_proxies()
@@ -445,10 +683,30 @@ class HostNetwork(object):
             open_port.port
             for open_port in self.enumerate_open_ports()
         )
-        # net_connections won't tell us about ports bound by sockets that
+        # The TCP tables won't tell us about ports bound by sockets that
         # haven't entered the TCP state graph yet.
         return frozenset(listening | proxied | open_ports)
 
+    def _tcp_ports(self):
+        """
+        Find the local ports of all TCP sockets on this node.
+
+        :return: A ``set`` of ``int`` port numbers.
+        """
+        ports = set()
+        found = False
+        for path in self._tcp_tables:
+            try:
+                contents = path.getContent()
+            except (IOError, OSError):
+                # For example, IPv6 is disabled.
+                continue
+            found = True
+            ports |= parse_tcp_table(contents)
+        if not found:
+            ports = set(conn.laddr[1] for conn in net_connections(kind='tcp'))
+        return ports
+
 
 def make_host_network():
     """
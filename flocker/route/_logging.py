@@ -46,6 +46,19 @@ IPTABLES = ActionType(
     u"An iptables command which Flocker is executing against the system.")
 
 
+RULES = Field.forTypes(
+    u"rules", [unicode],
+    u"The input being given to iptables-restore.")
+
+
+IPTABLES_RESTORE = ActionType(
+    _system(u"iptables_restore"),
+    [ARGV, RULES],
+    [],
+    u"A batch of iptables rule changes which Flocker is applying to the "
+    u"system.")
+
+
 CREATE_PROXY_TO = ActionType(
     _system(u"create_proxy_to"),
     [TARGET_IP, TARGET_PORT],
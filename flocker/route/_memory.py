@@ -42,6 +42,9 @@ class MemoryNetwork(object):
     def delete_open_port(self, open_port):
         self._open_ports.remove(open_port)
 
+    def forget_cached_state(self):
+        pass
+
     def enumerate_proxies(self):
         return list(self._proxies)
 
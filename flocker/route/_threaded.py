@@ -0,0 +1,134 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+# -*- test-case-name: flocker.route.test.test_threaded -*-
+
+"""
+An ``IAsyncNetwork`` which runs the operations of an ``INetwork`` in a
+thread.
+"""
+
+from zope.interface import implementer
+
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+from ._interfaces import IAsyncNetwork, IBatchedNetwork
+
+
+def _set_proxies(network, proxies):
+    """
+    Make the proxies configured on ``network`` exactly ``proxies``.
+
+    :param INetwork network: The network to change.
+    :param proxies: A collection of ``Proxy`` instances.
+    """
+    if IBatchedNetwork.providedBy(network):
+        return network.set_proxies(proxies)
+    current = set(network.enumerate_proxies())
+    desired = set(proxies)
+    for proxy in current - desired:
+        network.delete_proxy(proxy)
+    for proxy in desired - current:
+        network.create_proxy_to(proxy.ip, proxy.port)
+
+
+def _set_open_ports(network, open_ports):
+    """
+    Make the open ports configured on ``network`` exactly ``open_ports``.
+
+    :param INetwork network: The network to change.
+    :param open_ports: A collection of ``OpenPort`` instances.
+    """
+    if IBatchedNetwork.providedBy(network):
+        return network.set_open_ports(open_ports)
+    current = set(network.enumerate_open_ports())
+    desired = set(open_ports)
+    for open_port in current - desired:
+        network.delete_open_port(open_port)
+    for open_port in desired - current:
+        network.open_port(open_port.port)
+
+
+@implementer(IAsyncNetwork)
+class ThreadedNetwork(object):
+    """
+    Run the operations of an ``INetwork`` provider in a thread pool.
+
+    Operations are run one at a time, in the order they were requested, if
+    the thread pool has a single thread.  This keeps the wrapped network's
+    state consistent and avoids contending with ourselves for the
+    ``iptables`` lock.
+
+    :ivar network: The wrapped ``INetwork`` provider.
+    """
+    def __init__(self, reactor, network, threadpool):
+        """
+        :param reactor: The reactor results are delivered in.
+        :param INetwork network: The network to operate on.
+        :param ThreadPool threadpool: The thread pool to run operations in.
+        """
+        self._reactor = reactor
+        self._threadpool = threadpool
+        self.network = network
+
+    def _call(self, function, *args):
+        """
+        Call ``function`` with ``args`` in the thread pool, starting the pool
+        if this is the first call.
+
+        :return: A ``Deferred`` firing with the result.
+        """
+        if not self._threadpool.started:
+            self._threadpool.start()
+        return deferToThreadPool(
+            self._reactor, self._threadpool, function, *args)
+
+    def create_proxy_to(self, ip, port):
+        return self._call(self.network.create_proxy_to, ip, port)
+
+    def delete_proxy(self, proxy):
+        return self._call(self.network.delete_proxy, proxy)
+
+    def open_port(self, port):
+        return self._call(self.network.open_port, port)
+
+    def delete_open_port(self, port):
+        return self._call(self.network.delete_open_port, port)
+
+    def set_proxies(self, proxies):
+        return self._call(_set_proxies, self.network, proxies)
+
+    def set_open_ports(self, open_ports):
+        return self._call(_set_open_ports, self.network, open_ports)
+
+    def forget_cached_state(self):
+        return self._call(self.network.forget_cached_state)
+
+    def enumerate_proxies(self):
+        return self._call(self.network.enumerate_proxies)
+
+    def enumerate_open_ports(self):
+        return self._call(self.network.enumerate_open_ports)
+
+    def enumerate_used_ports(self):
+        return self._call(self.network.enumerate_used_ports)
+
+
+def make_threaded_network(network, reactor=None):
+    """
+    Create an ``IAsyncNetwork`` which runs the operations of ``network`` in a
+    dedicated thread.
+
+    The thread is started when it is first needed and stopped when the
+    reactor shuts down.
+
+    :param INetwork network: The network to operate on.
+    :param reactor: The reactor to use, or ``None`` for the global reactor.
+
+    :return: A ``ThreadedNetwork``.
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+    threadpool = ThreadPool(
+        minthreads=1, maxthreads=1, name="flocker:route:network")
+    reactor.addSystemEventTrigger("during", "shutdown", threadpool.stop)
+    return ThreadedNetwork(reactor, network, threadpool)
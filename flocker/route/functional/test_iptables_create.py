@@ -20,8 +20,10 @@ from twisted.trial.unittest import TestCase
 from twisted.python.procutils import which
 
 from ...testtools import if_root
-from .. import make_host_network
-from .._logging import CREATE_PROXY_TO, DELETE_PROXY, IPTABLES
+from .. import make_host_network, Proxy, OpenPort
+from .._logging import (
+    CREATE_PROXY_TO, DELETE_PROXY, IPTABLES, IPTABLES_RESTORE,
+)
 from .networktests import make_network_tests
 
 try:
@@ -404,6 +406,62 @@ class DeleteTests(TestCase):
             actual)
 
 
+class BatchTests(TestCase):
+    """
+    Tests for applying proxy and open port changes with a single
+    ``iptables-restore``.
+    """
+    @_dependency_skip
+    @_environment_skip
+    def setUp(self):
+        self.addCleanup(create_network_namespace().restore)
+        self.network = make_host_network()
+
+    @validateLogging(assertHasAction, IPTABLES_RESTORE, True)
+    def test_set_proxies(self, logger):
+        """
+        ``HostNetwork.set_proxies`` deletes proxies which are not wanted,
+        leaves proxies which are wanted and creates missing ones.
+        """
+        self.patch(self.network, "logger", logger)
+        self.network.create_proxy_to(IPAddress("10.1.2.3"), 12345)
+        kept = self.network.create_proxy_to(IPAddress("10.1.2.4"), 23456)
+        new = Proxy(ip=IPAddress("10.1.2.5"), port=34567)
+
+        self.network.set_proxies([kept, new])
+
+        self.assertEqual(
+            set([kept, new]), set(self.network.enumerate_proxies()))
+
+    def test_set_proxies_rules(self):
+        """
+        The rules created by ``HostNetwork.set_proxies`` are the same as those
+        created by ``HostNetwork.create_proxy_to``.
+        """
+        self.network.create_proxy_to(IPAddress("10.1.2.3"), 12345)
+        expected = get_iptables_rules()
+        self.network.delete_proxy(Proxy(ip=IPAddress("10.1.2.3"), port=12345))
+
+        self.network.set_proxies(
+            [Proxy(ip=IPAddress("10.1.2.3"), port=12345)])
+
+        self.assertEqual(expected, get_iptables_rules())
+
+    def test_set_open_ports(self):
+        """
+        ``HostNetwork.set_open_ports`` closes ports which are not wanted,
+        leaves ports which are wanted and opens missing ones.
+        """
+        self.network.open_port(1234)
+        self.network.open_port(2345)
+
+        self.network.set_open_ports([OpenPort(port=2345), OpenPort(port=3456)])
+
+        self.assertEqual(
+            set([OpenPort(port=2345), OpenPort(port=3456)]),
+            set(self.network.enumerate_open_ports()))
+
+
 class UsedPortsTests(TestCase):
     """
     Tests for enumeration of used ports.
@@ -0,0 +1,415 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Tests for ``flocker.route._iptables`` which do not need to change the system
+network configuration.
+"""
+
+from collections import namedtuple
+
+from ipaddr import IPAddress
+
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import SynchronousTestCase
+
+from .. import Proxy, OpenPort
+from .. import _iptables
+from .._iptables import (
+    FLOCKER_PROXY_COMMENT_MARKER, HostNetwork, _proxy_rules,
+    _open_port_rules, restore_input, set_proxies, set_open_ports,
+    parse_iptables_save, enumerate_proxies, enumerate_open_ports,
+    parse_tcp_table,
+)
+
+
+class RestoreInputTests(SynchronousTestCase):
+    """
+    Tests for ``restore_input``.
+    """
+    def test_empty(self):
+        """
+        No input is generated when there are no changes.
+        """
+        self.assertEqual(b"", restore_input([], []))
+
+    def test_tables(self):
+        """
+        The changes for each table are grouped into a section which begins
+        with the table name and ends with ``COMMIT``.  Within a table, all
+        deletions come before any additions.
+        """
+        deletions = [
+            (b"nat", b"--append", b"OUTPUT", [b"-j", b"ACCEPT"]),
+            (b"filter", b"--insert", b"INPUT", [b"-j", b"DROP"]),
+        ]
+        additions = [
+            (b"nat", b"--append", b"PREROUTING", [b"-j", b"RETURN"]),
+        ]
+        self.assertEqual(
+            b"*nat\n"
+            b"--delete OUTPUT -j ACCEPT\n"
+            b"--append PREROUTING -j RETURN\n"
+            b"COMMIT\n"
+            b"*filter\n"
+            b"--delete INPUT -j DROP\n"
+            b"COMMIT\n",
+            restore_input(deletions, additions))
+
+    def test_quoting(self):
+        """
+        Arguments which contain spaces, such as the comment used to mark
+        Flocker rules, are quoted.
+        """
+        rules = _proxy_rules(IPAddress("10.1.2.3"), 1234)
+        self.assertIn(
+            b' --comment "%s" ' % (FLOCKER_PROXY_COMMENT_MARKER,),
+            restore_input([], rules))
+
+
+class BatchTestsMixin(object):
+    """
+    Helpers for tests for ``set_proxies`` and ``set_open_ports`` which
+    replace the parts of ``flocker.route._iptables`` that touch the system.
+    """
+    def setUp(self):
+        self.restores = []
+        self.forwarding_enabled = []
+        self.patch(
+            _iptables, "iptables_restore",
+            lambda logger, rules: self.restores.append(rules))
+        self.patch(
+            _iptables, "_enable_forwarding",
+            lambda: self.forwarding_enabled.append(True))
+
+
+class SetProxiesTests(BatchTestsMixin, SynchronousTestCase):
+    """
+    Tests for ``set_proxies``.
+    """
+    def test_changes(self):
+        """
+        The rules for proxies which are no longer wanted are deleted and the
+        rules for new proxies are added using a single ``iptables-restore``.
+        Forwarding is enabled for the new proxies.
+        """
+        old = Proxy(ip=IPAddress("10.0.0.1"), port=1000)
+        kept = Proxy(ip=IPAddress("10.0.0.2"), port=2000)
+        new = Proxy(ip=IPAddress("10.0.0.3"), port=3000)
+        set_proxies(None, [old, kept], [kept, new])
+
+        self.assertEqual(
+            ([restore_input(_proxy_rules(old.ip, old.port),
+                            _proxy_rules(new.ip, new.port))],
+             [True]),
+            (self.restores, self.forwarding_enabled))
+
+    def test_unchanged(self):
+        """
+        If the proxies are already configured then ``iptables-restore`` is not
+        run.
+        """
+        proxy = Proxy(ip=IPAddress("10.0.0.1"), port=1000)
+        set_proxies(None, [proxy], [proxy])
+
+        self.assertEqual(([], []), (self.restores, self.forwarding_enabled))
+
+    def test_only_deletions(self):
+        """
+        If proxies are only being removed then forwarding configuration is
+        left alone.
+        """
+        proxy = Proxy(ip=IPAddress("10.0.0.1"), port=1000)
+        set_proxies(None, [proxy], [])
+
+        self.assertEqual(
+            ([restore_input(_proxy_rules(proxy.ip, proxy.port), [])], []),
+            (self.restores, self.forwarding_enabled))
+
+
+class SetOpenPortsTests(BatchTestsMixin, SynchronousTestCase):
+    """
+    Tests for ``set_open_ports``.
+    """
+    def test_changes(self):
+        """
+        The rules for ports which should no longer be open are deleted and the
+        rules for newly opened ports are added using a single
+        ``iptables-restore``.
+        """
+        set_open_ports(
+            None, [OpenPort(port=1000), OpenPort(port=2000)],
+            [OpenPort(port=2000), OpenPort(port=3000)])
+
+        self.assertEqual(
+            [restore_input(_open_port_rules(1000), _open_port_rules(3000))],
+            self.restores)
+
+    def test_unchanged(self):
+        """
+        If the ports are already open then ``iptables-restore`` is not run.
+        """
+        set_open_ports(None, [OpenPort(port=1000)], [OpenPort(port=1000)])
+
+        self.assertEqual([], self.restores)
+
+
+IPTABLES_SAVE_OUTPUT = b"""\
+# Generated by iptables-save v1.4.21 on Tue Mar 10 12:00:00 2015
+*nat
+:PREROUTING ACCEPT [0:0]
+:INPUT ACCEPT [0:0]
+:OUTPUT ACCEPT [0:0]
+:POSTROUTING ACCEPT [0:0]
+-A PREROUTING -p tcp -m tcp --dport 4567 -m addrtype --dst-type LOCAL \
+-m comment --comment "flocker create_proxy_to" -j DNAT \
+--to-destination 10.1.2.3
+-A OUTPUT -p tcp -m tcp --dport 4567 -m addrtype --dst-type LOCAL -j DNAT \
+--to-destination 10.1.2.3
+-A POSTROUTING -p tcp -m tcp --dport 4567 -j MASQUERADE
+-A PREROUTING -p tcp -m tcp --dport 80 -m comment --comment "someone else" \
+-j DNAT --to-destination 10.9.9.9
+COMMIT
+# Completed on Tue Mar 10 12:00:00 2015
+*filter
+:INPUT ACCEPT [0:0]
+:FORWARD ACCEPT [0:0]
+:OUTPUT ACCEPT [0:0]
+-A INPUT -p tcp -m tcp --dport 8080 -m comment --comment "flocker open_port" \
+-j ACCEPT
+-A FORWARD -d 10.1.2.3/32 -p tcp -m tcp --dport 4567 -j ACCEPT
+COMMIT
+"""
+
+
+class ParseIPTablesSaveTests(SynchronousTestCase):
+    """
+    Tests for ``parse_iptables_save`` and the enumeration functions which
+    use its result.
+    """
+    def test_commented_rules(self):
+        """
+        ``parse_iptables_save`` returns the commented rules of each table.
+        """
+        tables = parse_iptables_save(IPTABLES_SAVE_OUTPUT)
+        self.assertEqual(
+            {b"nat": [(b"flocker create_proxy_to", 4567,
+                       IPAddress("10.1.2.3")),
+                      (b"someone else", 80, IPAddress("10.9.9.9"))],
+             b"filter": [(b"flocker open_port", 8080, None)]},
+            {table: [(rule.comment, rule.destination_port,
+                      rule.to_destination) for rule in rules]
+             for (table, rules) in tables.items()})
+
+    def test_enumerate_proxies(self):
+        """
+        ``enumerate_proxies`` finds the proxies in a parsed ``iptables-save``
+        result without running ``iptables-save`` again.
+        """
+        tables = parse_iptables_save(IPTABLES_SAVE_OUTPUT)
+        self.patch(_iptables, "iptables_save", lambda: 1/0)
+        self.assertEqual(
+            [Proxy(ip=IPAddress("10.1.2.3"), port=4567)],
+            enumerate_proxies(tables))
+
+    def test_enumerate_open_ports(self):
+        """
+        ``enumerate_open_ports`` finds the open ports in a parsed
+        ``iptables-save`` result.
+        """
+        tables = parse_iptables_save(IPTABLES_SAVE_OUTPUT)
+        self.assertEqual([OpenPort(port=8080)], enumerate_open_ports(tables))
+
+
+class HostNetworkCacheTests(SynchronousTestCase):
+    """
+    Tests for the caching of ``iptables-save`` results by ``HostNetwork``.
+    """
+    def setUp(self):
+        self.saves = []
+        self.restores = []
+        self.output = IPTABLES_SAVE_OUTPUT
+
+        def iptables_save():
+            self.saves.append(True)
+            return parse_iptables_save(self.output)
+        self.patch(_iptables, "iptables_save", iptables_save)
+        self.patch(
+            _iptables, "iptables_restore",
+            lambda logger, rules: self.restores.append(rules))
+        self.patch(_iptables, "_enable_forwarding", lambda: None)
+        self.patch(_iptables, "net_connections", lambda kind: [])
+        self.network = HostNetwork()
+        self.network._tcp_tables = []
+
+    def test_iteration(self):
+        """
+        The enumerations and changes made by one convergence iteration run
+        ``iptables-save`` only once.
+        """
+        proxy = Proxy(ip=IPAddress("10.1.2.4"), port=1234)
+        self.network.enumerate_used_ports()
+        self.network.enumerate_proxies()
+        self.network.enumerate_open_ports()
+        self.network.set_proxies([proxy])
+        self.network.set_open_ports([])
+        self.assertEqual(
+            (1, 2, [proxy], []),
+            (len(self.saves), len(self.restores),
+             self.network.enumerate_proxies(),
+             self.network.enumerate_open_ports()))
+
+    def test_forget_cached_state(self):
+        """
+        After ``HostNetwork.forget_cached_state`` the next enumeration runs
+        ``iptables-save`` again.
+        """
+        self.network.enumerate_proxies()
+        self.output = b""
+        self.network.forget_cached_state()
+        self.assertEqual(
+            ([], 2), (self.network.enumerate_proxies(), len(self.saves)))
+
+    def test_individual_changes(self):
+        """
+        Proxies and open ports created or deleted one at a time are reflected
+        in the cached state.
+        """
+        self.network.enumerate_proxies()
+        self.patch(_iptables, "iptables", lambda logger, argv: None)
+        proxy = self.network.create_proxy_to(IPAddress("10.1.2.4"), 1234)
+        self.network.delete_proxy(Proxy(ip=IPAddress("10.1.2.3"), port=4567))
+        open_port = self.network.open_port(1234)
+        self.network.delete_open_port(OpenPort(port=8080))
+        self.assertEqual(
+            (1, [proxy], [open_port]),
+            (len(self.saves), self.network.enumerate_proxies(),
+             self.network.enumerate_open_ports()))
+
+    def test_failed_change(self):
+        """
+        If changing the rules fails the cached state is discarded, since
+        the change may have been partially applied.
+        """
+        self.network.enumerate_proxies()
+
+        def iptables_restore(logger, rules):
+            raise ZeroDivisionError()
+        self.patch(_iptables, "iptables_restore", iptables_restore)
+        self.assertRaises(ZeroDivisionError, self.network.set_proxies, [])
+        self.network.enumerate_proxies()
+        self.assertEqual(2, len(self.saves))
+
+
+# Trimmed from real /proc/net/tcp output: sockets listening on 0.0.0.0:2024
+# and 127.0.0.1:48271, a connection from local port 43917 in TIME_WAIT and
+# an established connection from local port 22.
+PROC_NET_TCP = b"""\
+  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt \
+  uid  timeout inode
+   0: 00000000:07E8 00000000:0000 0A 00000000:00000000 00:00000000 00000000 \
+    0        0 662 1 00000000211ab32c 100 0 0 10 0
+   1: 0100007F:BC8F 00000000:0000 0A 00000000:00000000 00:00000000 00000000 \
+65534        0 916 1 000000003165d927 100 0 0 10 0
+   2: 0100007F:AB8D 0100007F:CC7A 06 00000000:00000000 03:00000E4F 00000000 \
+    0        0 0 3 00000000b03829c8
+   3: 0A000002:0016 0A000001:D362 01 00000000:00000000 02:0009A1E1 00000000 \
+    0        0 10493 2 0000000030bb9189 20 4 29 10 -1
+"""
+
+# A socket listening on [::]:8080 and one on [::1]:631.
+PROC_NET_TCP6 = b"""\
+  sl  local_address                         remote_address                \
+        st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode
+   0: 00000000000000000000000000000000:1F90 \
+00000000000000000000000000000000:0000 0A 00000000:00000000 00:00000000 \
+00000000     0        0 19107 1 ffff88003d3c0000 100 0 0 10 0
+   1: 00000000000000000000000001000000:0277 \
+00000000000000000000000000000000:0000 0A 00000000:00000000 00:00000000 \
+00000000     0        0 11230 1 ffff88003d3c0780 100 0 0 10 0
+"""
+
+
+class ParseTCPTableTests(SynchronousTestCase):
+    """
+    Tests for ``parse_tcp_table``.
+    """
+    def test_tcp(self):
+        """
+        ``parse_tcp_table`` returns the local ports of all of the sockets in
+        a ``/proc/net/tcp`` table, whatever their state.
+        """
+        self.assertEqual(
+            frozenset([2024, 48271, 43917, 22]),
+            parse_tcp_table(PROC_NET_TCP))
+
+    def test_tcp6(self):
+        """
+        ``parse_tcp_table`` understands the IPv6 addresses in a
+        ``/proc/net/tcp6`` table.
+        """
+        self.assertEqual(
+            frozenset([8080, 631]), parse_tcp_table(PROC_NET_TCP6))
+
+    def test_empty(self):
+        """
+        ``parse_tcp_table`` returns an empty ``frozenset`` for a table with
+        only a header.
+        """
+        self.assertEqual(
+            frozenset(), parse_tcp_table(PROC_NET_TCP.splitlines()[0]))
+
+
+_Connection = namedtuple("_Connection", "laddr")
+
+
+class HostNetworkUsedPortsTests(SynchronousTestCase):
+    """
+    Tests for ``HostNetwork.enumerate_used_ports``.
+    """
+    def setUp(self):
+        self.patch(_iptables, "iptables_save", lambda: {})
+        self.network = HostNetwork()
+        tcp = FilePath(self.mktemp())
+        tcp.setContent(PROC_NET_TCP)
+        tcp6 = FilePath(self.mktemp())
+        tcp6.setContent(PROC_NET_TCP6)
+        self.network._tcp_tables = [tcp, tcp6]
+
+    def test_tcp_tables(self):
+        """
+        The local ports of the sockets in the kernel's TCP tables are used.
+        """
+        self.assertEqual(
+            frozenset([2024, 48271, 43917, 22, 8080, 631]),
+            self.network.enumerate_used_ports())
+
+    def test_missing_table(self):
+        """
+        Tables which cannot be read are ignored.
+        """
+        self.network._tcp_tables[1].remove()
+        self.assertEqual(
+            frozenset([2024, 48271, 43917, 22]),
+            self.network.enumerate_used_ports())
+
+    def test_no_tables(self):
+        """
+        If none of the tables can be read, ``psutil`` is used instead.
+        """
+        self.network._tcp_tables = [FilePath(self.mktemp())]
+        self.patch(
+            _iptables, "net_connections",
+            lambda kind: [_Connection(laddr=("0.0.0.0", 1234))])
+        self.assertEqual(
+            frozenset([1234]), self.network.enumerate_used_ports())
+
+    def test_tables_read_again(self):
+        """
+        The tables are read again each time, so sockets which have since
+        been closed are no longer reported.
+        """
+        self.network.enumerate_used_ports()
+        self.network._tcp_tables[1].setContent(PROC_NET_TCP6.splitlines()[0])
+        self.assertEqual(
+            frozenset([2024, 48271, 43917, 22]),
+            self.network.enumerate_used_ports())
@@ -0,0 +1,125 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Tests for ``flocker.route._threaded``.
+"""
+
+from threading import current_thread
+
+from zope.interface.verify import verifyObject
+
+from ipaddr import IPAddress
+
+from twisted.internet import reactor
+from twisted.python.threadpool import ThreadPool
+from twisted.trial.unittest import SynchronousTestCase, TestCase
+
+from ...testtools import NonReactor, NonThreadPool
+from .. import (
+    IAsyncNetwork, ThreadedNetwork, Proxy, OpenPort, make_memory_network,
+)
+from .._memory import MemoryNetwork
+
+
+class ThreadedNetworkTests(SynchronousTestCase):
+    """
+    Tests for ``ThreadedNetwork`` which run its operations synchronously.
+    """
+    def setUp(self):
+        self.network = make_memory_network(used_ports=frozenset([22]))
+        self.threaded = ThreadedNetwork(
+            NonReactor(), self.network, NonThreadPool())
+
+    def test_interface(self):
+        """
+        ``ThreadedNetwork`` provides ``IAsyncNetwork``.
+        """
+        self.assertTrue(verifyObject(IAsyncNetwork, self.threaded))
+
+    def test_proxies(self):
+        """
+        Proxies created and deleted using ``ThreadedNetwork`` are created and
+        deleted on the wrapped network, and the results of the wrapped
+        network's methods are the results of the returned ``Deferred``\ s.
+        """
+        ip = IPAddress("10.1.2.3")
+        proxy = self.successResultOf(self.threaded.create_proxy_to(ip, 1234))
+        other = self.successResultOf(self.threaded.create_proxy_to(ip, 2345))
+        self.successResultOf(self.threaded.delete_proxy(other))
+        self.assertEqual(
+            ([proxy], [proxy], frozenset([22, 1234])),
+            (self.network.enumerate_proxies(),
+             self.successResultOf(self.threaded.enumerate_proxies()),
+             self.successResultOf(self.threaded.enumerate_used_ports())))
+
+    def test_open_ports(self):
+        """
+        Ports opened and closed using ``ThreadedNetwork`` are opened and closed
+        on the wrapped network.
+        """
+        port = self.successResultOf(self.threaded.open_port(1234))
+        other = self.successResultOf(self.threaded.open_port(2345))
+        self.successResultOf(self.threaded.delete_open_port(other))
+        self.assertEqual(
+            [port], self.successResultOf(self.threaded.enumerate_open_ports()))
+
+    def test_set_proxies(self):
+        """
+        ``ThreadedNetwork.set_proxies`` changes the wrapped network's proxies,
+        even if the wrapped network does not provide ``IBatchedNetwork``.
+        """
+        ip = IPAddress("10.1.2.3")
+        self.network.create_proxy_to(ip, 1234)
+        kept = self.network.create_proxy_to(ip, 2345)
+        new = Proxy(ip=ip, port=3456)
+        self.successResultOf(self.threaded.set_proxies([kept, new]))
+        self.assertEqual(
+            set([kept, new]), set(self.network.enumerate_proxies()))
+
+    def test_set_open_ports(self):
+        """
+        ``ThreadedNetwork.set_open_ports`` changes the wrapped network's open
+        ports.
+        """
+        self.network.open_port(1234)
+        self.successResultOf(
+            self.threaded.set_open_ports([OpenPort(port=2345)]))
+        self.assertEqual(
+            [OpenPort(port=2345)], self.network.enumerate_open_ports())
+
+    def test_errors(self):
+        """
+        Exceptions raised by the wrapped network are reported as failures of
+        the returned ``Deferred``.
+        """
+        self.network.open_port = lambda port: 1/0
+        self.failureResultOf(self.threaded.open_port(1234), ZeroDivisionError)
+
+
+class ThreadedNetworkThreadTests(TestCase):
+    """
+    Tests for ``ThreadedNetwork`` using a real thread pool.
+    """
+    def test_runs_in_thread(self):
+        """
+        Operations are run in the thread pool, not the reactor thread.
+        """
+        threads = []
+
+        class RecordingNetwork(MemoryNetwork):
+            def enumerate_used_ports(self):
+                threads.append(current_thread())
+                return MemoryNetwork.enumerate_used_ports(self)
+
+        threadpool = ThreadPool(minthreads=1, maxthreads=1)
+        self.addCleanup(threadpool.stop)
+        threaded = ThreadedNetwork(
+            reactor, RecordingNetwork(used_ports=frozenset([22])), threadpool)
+        d = threaded.enumerate_used_ports()
+
+        def used(ports):
+            self.assertEqual(
+                (frozenset([22]), False),
+                (ports, threads[0] is current_thread()))
+        d.addCallback(used)
+        return d
@@ -30,6 +30,7 @@ from twisted.internet.interfaces import (
     IProcessTransport, IReactorProcess, IReactorCore,
 )
 from twisted.python.filepath import FilePath, Permissions
+from twisted.python.failure import Failure
 from twisted.internet.task import Clock, deferLater
 from twisted.internet.defer import maybeDeferred, Deferred, succeed
 from twisted.internet.error import ConnectionDone
@@ -54,14 +55,41 @@ class FakeProcessTransport(object):
     Mock process transport to observe signals sent to a process.
 
     @ivar signals: L{list} of signals sent to process.
+    @ivar data: L{bytes} written to the process's stdin.
+    @ivar stdin_closed: Whether the process's stdin has been closed.
+    @ivar producer: The producer registered for the process's stdin, or
+        C{None}.
+    @ivar paused: Whether reading from the process's output is paused.
     """
 
     def __init__(self):
         self.signals = []
+        self.data = b""
+        self.stdin_closed = False
+        self.producer = None
+        self.paused = False
 
     def signalProcess(self, signal):
         self.signals.append(signal)
 
+    def write(self, data):
+        self.data += data
+
+    def closeStdin(self):
+        self.stdin_closed = True
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
 
 class SpawnProcessArguments(namedtuple(
                             'ProcessData',
@@ -711,6 +739,31 @@ class MemoryCoreReactor(MemoryReactor):
             event.fireEvent()
 
 
+class NonThreadPool(object):
+    """
+    A stand-in for ``ThreadPool`` which runs functions immediately, in the
+    calling thread.  Use it with ``NonReactor`` and ``deferToThreadPool`` to
+    get results synchronously.
+    """
+    started = True
+
+    def callInThreadWithCallback(self, onResult, func, *args, **kw):
+        try:
+            result = func(*args, **kw)
+        except:
+            onResult(False, Failure())
+        else:
+            onResult(True, result)
+
+
+class NonReactor(object):
+    """
+    Just enough of a reactor to deliver results from a ``NonThreadPool``.
+    """
+    def callFromThread(self, func, *args, **kw):
+        func(*args, **kw)
+
+
 def make_script_tests(executable):
     """
     Generate a test suite which applies to any Flocker-installed node script.
@@ -4,8 +4,9 @@
 Inter-process communication for the volume manager.
 
 Specific volume managers ("nodes") may wish to push data to other
-nodes. In the current iteration this is done over SSH using a blocking
-API. In some future iteration this will be replaced with an actual
+nodes. In the current iteration this is done over SSH, either using a
+blocking API or by running ``ssh`` as a child process of the reactor. In
+some future iteration this will be replaced with an actual
 well-specified communication protocol between daemon processes using
 Twisted's event loop (https://clusterhq.atlassian.net/browse/FLOC-154).
 """
@@ -20,7 +21,7 @@ from zope.interface import Interface, implementer
 from twisted.internet.defer import succeed
 from twisted.python.filepath import FilePath
 
-from ..common._ipc import ProcessNode
+from ..common._ipc import ProcessNode, process_output, pipe_processes
 from .service import DEFAULT_CONFIG_PATH
 from .filesystems.zfs import Snapshot
 
@@ -32,7 +33,7 @@ from .filesystems.zfs import Snapshot
 SSH_PRIVATE_KEY_PATH = FilePath(b"/etc/flocker/id_rsa_flocker")
 
 
-def standard_node(hostname):
+def standard_node(hostname, connection_cache=None):
     """
     Create the default production ``INode`` for the given hostname.
 
@@ -40,14 +41,19 @@ def standard_node(hostname):
     and authenticates using the cluster private key.
 
     :param bytes hostname: The host to connect to.
+    :param SSHConnectionCache connection_cache: The cache through which
+        commands share a connection, or ``None`` to make a new connection
+        for every command.
     :return: A ``INode`` that can connect to the given hostname using SSH.
     """
-    return ProcessNode.using_ssh(hostname, 22, b"root", SSH_PRIVATE_KEY_PATH)
+    return ProcessNode.using_ssh(hostname, 22, b"root", SSH_PRIVATE_KEY_PATH,
+                                 connection_cache=connection_cache)
 
 
-class IRemoteVolumeManager(Interface):
+class IBasicRemoteVolumeManager(Interface):
     """
-    A remote volume manager with which one can communicate somehow.
+    The operations supported by every remote volume manager, however a
+    volume's contents are sent to it.
     """
     def snapshots(volume):
         """
@@ -60,6 +66,33 @@ class IRemoteVolumeManager(Interface):
             ordered from oldest to newest.
         """
 
+    def acquire(volume):
+        """
+        Tell the remote volume manager to acquire the given volume.
+
+        :param Volume volume: The volume which will be acquired by the
+            remote volume manager.
+
+        :return: The node ID of the remote volume manager (as ``unicode``),
+            or a ``Deferred`` that fires with it.
+        """
+
+    def clone_to(parent, name):
+        """
+        Clone a parent volume to a new one with the given name.
+
+        :param Volume parent: The volume to clone.
+
+        :param VolumeName name: The name of the volume to clone to.
+
+        :return: A ``Deferred`` that fires when cloning finished.
+        """
+
+
+class IRemoteVolumeManager(IBasicRemoteVolumeManager):
+    """
+    A remote volume manager with which one can communicate somehow.
+    """
     def receive(volume):
         """
         Context manager that returns a file-like object to which a volume's
@@ -72,25 +105,62 @@ class IRemoteVolumeManager(Interface):
              update the volume on the remote volume manager.
         """
 
-    def acquire(volume):
+
+class IStreamingRemoteVolumeManager(IBasicRemoteVolumeManager):
+    """
+    A remote volume manager which can receive a volume's contents from a
+    local process without blocking.
+
+    Providers need not support :meth:`IRemoteVolumeManager.receive`, so
+    they can only be pushed to from an ``IStreamingFilesystem``.
+    """
+    def receive_stream(volume, command):
         """
-        Tell the remote volume manager to acquire the given volume.
+        Run a local command and send its stdout to the remote volume manager.
 
-        :param Volume volume: The volume which will be acquired by the
+        :param Volume volume: The volume which will be pushed to the
             remote volume manager.
 
-        :return: The node ID of the remote volume manager (as ``unicode``).
+        :param command: ``list`` of ``bytes``, a local command which writes
+            the volume's contents to its stdout, e.g. one constructed by
+            :meth:`IStreamingFilesystem.send_command`.
+
+        :return: A ``Deferred`` that fires when the remote volume manager has
+            received the volume.
         """
 
-    def clone_to(parent, name):
+
+class IResumableRemoteVolumeManager(IStreamingRemoteVolumeManager):
+    """
+    A remote volume manager which keeps the data of interrupted receives so
+    they can be resumed.
+
+    Streams sent with :meth:`IStreamingRemoteVolumeManager.receive_stream`
+    are new streams; any interrupted receive of the volume is discarded.
+    """
+    def resume_token(volume):
         """
-        Clone a parent volume to a new one with the given name.
+        Find out whether an earlier receive of a volume was interrupted.
 
-        :param Volume parent: The volume to clone.
+        :param Volume volume: The volume being pushed.
 
-        :param VolumeName name: The name of the volume to clone to.
+        :return: A ``Deferred`` that fires with the
+            :meth:`IResumableFilesystem.resume_token` of the remote
+            filesystem, or ``None`` if there is nothing to resume.
+        """
 
-        :return: A ``Deferred`` that fires when cloning finished.
+    def resume_stream(volume, command):
+        """
+        Like :meth:`IStreamingRemoteVolumeManager.receive_stream`, but the
+        command's output continues an interrupted receive.
+
+        :param Volume volume: The volume being pushed.
+
+        :param command: ``list`` of ``bytes``, a local command constructed
+            by :meth:`IResumableFilesystem.resume_command`.
+
+        :return: A ``Deferred`` that fires when the remote volume manager has
+            received the rest of the volume.
         """
 
 
@@ -110,47 +180,108 @@ class RemoteVolumeManager(object):
         self._destination = destination
         self._config_path = config_path
 
+    def _flocker_volume(self, subcommand, volume, *arguments):
+        """
+        Construct a ``flocker-volume`` command to run on the destination.
+
+        :param bytes subcommand: The ``flocker-volume`` subcommand to run.
+        :param Volume volume: The volume the subcommand operates on.
+        :param arguments: Further ``bytes`` arguments for the subcommand.
+
+        :return: ``list`` of ``bytes``, the remote command.
+        """
+        return [b"flocker-volume",
+                b"--config", self._config_path.path,
+                subcommand,
+                volume.node_id.encode(b"ascii"),
+                volume.name.to_bytes()] + list(arguments)
+
     def snapshots(self, volume):
         """
         Run ``flocker-volume snapshots`` on the destination and parse the
         output into a ``list`` of ``Snapshot`` instances.
         """
         data = self._destination.get_output(
-            [b"flocker-volume",
-             b"--config", self._config_path.path,
-             b"snapshots",
-             volume.node_id.encode("ascii"),
-             volume.name.to_bytes()]
-        )
-        return succeed([
-            Snapshot(name=name)
-            for name
-            in data.splitlines()
-        ])
+            self._flocker_volume(b"snapshots", volume))
+        return succeed(_parse_snapshots(data))
 
     def receive(self, volume):
-        return self._destination.run([b"flocker-volume",
-                                      b"--config", self._config_path.path,
-                                      b"receive",
-                                      volume.node_id.encode(b"ascii"),
-                                      volume.name.to_bytes()])
+        return self._destination.run(self._flocker_volume(b"receive", volume))
 
     def acquire(self, volume):
         return self._destination.get_output(
-            [b"flocker-volume",
-             b"--config", self._config_path.path,
-             b"acquire",
-             volume.node_id.encode(b"ascii"),
-             volume.name.to_bytes()]).decode("ascii")
+            self._flocker_volume(b"acquire", volume)).decode("ascii")
 
     def clone_to(self, parent, name):
         return self._destination.get_output(
-            [b"flocker-volume",
-             b"--config", self._config_path.path,
-             b"clone_to",
-             parent.node_id.encode(b"ascii"),
-             parent.name.to_bytes(),
-             name.to_bytes()]).decode("ascii")
+            self._flocker_volume(
+                b"clone_to", parent, name.to_bytes())).decode("ascii")
+
+
+@implementer(IStreamingRemoteVolumeManager)
+class StreamingRemoteVolumeManager(RemoteVolumeManager):
+    """
+    ``ProcessNode``\-based communication with a remote volume manager which
+    runs its commands as child processes of the reactor, so that none of its
+    operations block.
+    """
+    def __init__(self, destination, config_path=DEFAULT_CONFIG_PATH,
+                 reactor=None):
+        """
+        :param ProcessNode destination: The node to push to.
+        :param FilePath config_path: Path to configuration file for the
+            remote ``flocker-volume``.
+        :param IReactorProcess reactor: The reactor to run commands with, or
+            ``None`` for the global reactor.
+        """
+        RemoteVolumeManager.__init__(self, destination, config_path)
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+
+    def _get_output(self, remote_command):
+        """
+        Run a command on the destination.
+
+        :param remote_command: ``list`` of ``bytes``, the remote command.
+
+        :return: ``Deferred`` firing with the ``bytes`` of its stdout.
+        """
+        return process_output(
+            self._reactor, self._destination.command(remote_command))
+
+    def snapshots(self, volume):
+        d = self._get_output(self._flocker_volume(b"snapshots", volume))
+        d.addCallback(_parse_snapshots)
+        return d
+
+    def receive_stream(self, volume, command):
+        return pipe_processes(
+            self._reactor, command,
+            self._destination.command(
+                self._flocker_volume(b"receive", volume)))
+
+    def acquire(self, volume):
+        d = self._get_output(self._flocker_volume(b"acquire", volume))
+        d.addCallback(lambda node_id: node_id.decode("ascii"))
+        return d
+
+    def clone_to(self, parent, name):
+        d = self._get_output(
+            self._flocker_volume(b"clone_to", parent, name.to_bytes()))
+        d.addCallback(lambda node_id: node_id.decode("ascii"))
+        return d
+
+
+def _parse_snapshots(data):
+    """
+    Parse the output of ``flocker-volume snapshots``.
+
+    :param bytes data: The output.
+
+    :return: ``list`` of ``Snapshot`` instances.
+    """
+    return [Snapshot(name=name) for name in data.splitlines()]
 
 
 @implementer(IRemoteVolumeManager)
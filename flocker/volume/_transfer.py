@@ -0,0 +1,931 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+# -*- test-case-name: flocker.volume.test.test_transfer -*-
+
+"""
+A long-lived agent-to-agent channel for transferring volumes.
+
+``RemoteVolumeManager`` runs ``flocker-volume`` over SSH for every
+operation, paying for an SSH handshake and a Python interpreter each time.
+Instead, each agent can run a ``VolumeTransferService`` which accepts AMP
+connections from other agents, and push volumes to other agents using a
+``TransferRemoteVolumeManager``.  Connections are kept in a
+``VolumeTransferPool`` and reused, so the snapshot negotiation, the data
+stream and the ownership change all happen over one persistent connection.
+
+The data can be compressed on the wire with one of ``CODECS``, chosen from
+those the sender asks for by the receiver.  Receives are resumable: if a
+stream is interrupted the receiving filesystem keeps what it got, and the
+next push sends only the rest.
+
+Agents share a secret, and both ends of a connection prove they know it
+(see ``AuthenticateCommand``) before any volume can be touched.  The data
+itself is not encrypted, so the channel is only suitable for a trusted
+network.
+"""
+
+import bz2
+import hashlib
+import hmac
+import os
+import zlib
+from Queue import Queue, Empty
+
+from characteristic import attributes, with_cmp
+
+from eliot import Field, Logger, MessageType
+
+from zope.interface import implementer
+
+from twisted.application.internet import StreamServerEndpointService
+from twisted.application.service import Service
+from twisted.internet.defer import (
+    Deferred, fail, gatherResults, maybeDeferred, succeed,
+)
+from twisted.internet.endpoints import TCP4ClientEndpoint, connectProtocol
+from twisted.internet.error import ProcessDone, ProcessExitedAlready
+from twisted.internet.protocol import ProcessProtocol, ServerFactory
+from twisted.internet.threads import deferToThreadPool
+from twisted.protocols.amp import (
+    AMP, Boolean, Command, CommandLocator, ListOf, MAX_VALUE_LENGTH, String,
+    Unicode,
+)
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+
+from ._ipc import IResumableRemoteVolumeManager
+from .filesystems.zfs import Snapshot
+from .service import Volume, VolumeName
+
+
+# The port agents listen on for volume transfers from other agents.
+TRANSFER_PORT = 4526
+
+# The length of the nonces exchanged to authenticate connections.
+_NONCE_LENGTH = 32
+
+# The number of data chunks which may be sent before the receiver has
+# acknowledged them.  Reading from the sending process is paused while this
+# many are outstanding.
+_WINDOW = 16
+
+
+@attributes(["compressor", "decompressor", "default_level"])
+class Codec(object):
+    """
+    A compression format for volume data in transit.
+
+    :ivar compressor: Callable taking a compression level from 1 (fastest)
+        to 9 (smallest) and returning an object with ``compress`` and
+        ``flush`` methods.
+    :ivar decompressor: Callable returning an object with a ``decompress``
+        method.
+    :ivar int default_level: The level used if none is configured.
+    """
+
+
+# Compression formats supported by both ends of a transfer, by name:
+CODECS = {
+    b"zlib": Codec(compressor=zlib.compressobj,
+                   decompressor=zlib.decompressobj, default_level=6),
+    b"bz2": Codec(compressor=bz2.BZ2Compressor,
+                  decompressor=bz2.BZ2Decompressor, default_level=9),
+}
+
+
+class AuthenticationFailed(Exception):
+    """
+    The other end of a volume transfer connection did not prove it knows the
+    shared secret.
+    """
+
+
+def _proof(secret, role, nonce):
+    """
+    Prove knowledge of the shared secret.
+
+    :param bytes secret: The shared secret.
+    :param bytes role: ``b"client"`` or ``b"server"``, so that neither end's
+        proof can be replayed as the other's.
+    :param bytes nonce: The nonce chosen by the other end.
+
+    :return: ``bytes``, the proof.
+    """
+    return hmac.new(secret, role + nonce, hashlib.sha256).digest()
+
+
+class ChallengeCommand(Command):
+    """
+    Get a nonce to prove knowledge of the shared secret with.
+    """
+    arguments = []
+    response = [('nonce', String())]
+
+
+class AuthenticateCommand(Command):
+    """
+    Prove knowledge of the shared secret with the ``proof`` of the nonce from
+    ``ChallengeCommand``, and challenge the server with ``nonce``.  The
+    response's ``proof`` is the server's proof of that nonce.
+
+    No other commands are accepted on a connection until this succeeds.
+    """
+    arguments = [('proof', String()),
+                 ('nonce', String())]
+    response = [('proof', String())]
+    errors = {AuthenticationFailed: 'AUTHENTICATION_FAILED'}
+
+
+# The commands accepted on connections which aren't authenticated yet:
+_UNAUTHENTICATED_COMMANDS = frozenset([
+    ChallengeCommand.commandName, AuthenticateCommand.commandName])
+
+
+class SnapshotsCommand(Command):
+    """
+    List the snapshots of a volume.
+    """
+    arguments = [('node_id', Unicode()),
+                 ('name', String())]
+    response = [('snapshots', ListOf(String()))]
+
+
+class ReceiveStartCommand(Command):
+    """
+    Start receiving a volume's data.
+
+    ``codecs`` are the names of the compression formats the sender can use,
+    most preferred first; the response's ``codec`` is the one the data will
+    be compressed with, or is missing if it won't be compressed.
+    ``resume`` is ``True`` if the data continues an interrupted receive.
+    """
+    arguments = [('node_id', Unicode()),
+                 ('name', String()),
+                 ('codecs', ListOf(String(), optional=True)),
+                 ('resume', Boolean(optional=True))]
+    response = [('codec', String(optional=True))]
+
+
+class ReceiveDataCommand(Command):
+    """
+    Some of the data of a volume being received.  The response is sent once
+    the receiver has consumed the data.
+    """
+    arguments = [('node_id', Unicode()),
+                 ('name', String()),
+                 ('data', String())]
+    response = []
+    errors = {ValueError: 'VALUE_ERROR', IOError: 'IO_ERROR'}
+
+
+class ReceiveEndCommand(Command):
+    """
+    Finish receiving a volume's data.  The response is sent once the volume
+    has been updated.
+    """
+    arguments = [('node_id', Unicode()),
+                 ('name', String()),
+                 ('succeeded', Boolean())]
+    response = []
+    errors = {ValueError: 'VALUE_ERROR', IOError: 'IO_ERROR'}
+
+
+class ResumeTokenCommand(Command):
+    """
+    Find out whether a receive of a volume was interrupted.  The response's
+    ``token`` is missing if there is nothing to resume.
+    """
+    arguments = [('node_id', Unicode()),
+                 ('name', String())]
+    response = [('token', String(optional=True))]
+
+
+class AcquireCommand(Command):
+    """
+    Take ownership of a volume.
+    """
+    arguments = [('node_id', Unicode()),
+                 ('name', String())]
+    response = [('node_id', Unicode())]
+    errors = {ValueError: 'VALUE_ERROR'}
+
+
+class CloneToCommand(Command):
+    """
+    Clone a volume to a new one.
+    """
+    arguments = [('node_id', Unicode()),
+                 ('name', String()),
+                 ('new_name', String())]
+    response = []
+
+
+class _ChunkReader(object):
+    """
+    A file-like object which is read by ``VolumeService.receive`` in a
+    thread and fed the data of ``ReceiveDataCommand``\ s from the reactor
+    thread.
+
+    Compressed data is decompressed in the reading thread.
+    """
+    def __init__(self, reactor, decompressor=None):
+        """
+        :param reactor: The reactor the chunks are fed from.
+        :param decompressor: An object whose ``decompress`` method is applied
+            to the data fed, or ``None`` if the data isn't compressed.
+        """
+        self._reactor = reactor
+        self._decompressor = decompressor
+        self._chunks = Queue()
+        self._buffer = b""
+        self._finished = False
+        self._failure = None
+
+    def feed(self, data):
+        """
+        Add some data to be read.  Called in the reactor thread.
+
+        :param bytes data: The data.
+
+        :return: ``Deferred`` that fires when the data has been read.
+        """
+        if self._failure is not None:
+            return fail(self._failure)
+        consumed = Deferred()
+        self._chunks.put((data, consumed))
+        return consumed
+
+    def finish(self, succeeded):
+        """
+        Indicate there is no more data.  Called in the reactor thread.
+
+        :param bool succeeded: ``False`` if the data is incomplete, in which
+            case reading raises ``IOError`` rather than reaching the end.
+        """
+        self._chunks.put((succeeded, None))
+
+    def fail(self, reason):
+        """
+        Indicate that the data will not be read any more.  Called in the
+        reactor thread once the reading thread is done.
+
+        :param Failure reason: Why the data will not be read.
+
+        :return: ``reason``.
+        """
+        self._failure = reason
+        while True:
+            try:
+                data, consumed = self._chunks.get_nowait()
+            except Empty:
+                return reason
+            if consumed is not None:
+                consumed.errback(reason)
+
+    def read(self, size):
+        """
+        Read some data, blocking until it is available.  Called in the
+        reading thread.
+
+        :param int size: The most data to return.
+
+        :return: ``bytes``, which are empty at the end of the data.
+        """
+        while not self._buffer and not self._finished:
+            data, consumed = self._chunks.get()
+            if consumed is None:
+                if not data:
+                    raise IOError("Volume data is incomplete")
+                self._finished = True
+            else:
+                if self._decompressor is not None:
+                    data = self._decompressor.decompress(data)
+                self._buffer = data
+                self._reactor.callFromThread(consumed.callback, None)
+        result, self._buffer = self._buffer[:size], self._buffer[size:]
+        return result
+
+
+class _TransferLocator(CommandLocator):
+    """
+    Command locator for the volumes transfer server.
+
+    :ivar bool authenticated: Whether the client has proven it knows the
+        shared secret.  Only ``_UNAUTHENTICATED_COMMANDS`` are handled until
+        it has.
+    :ivar dict receiving: Map ``(node_id, name)`` to
+        ``(_ChunkReader, Deferred)`` for volumes being received on this
+        connection.  The ``Deferred`` fires when ``VolumeService.receive``
+        has finished.
+    """
+    def __init__(self, transfer_service):
+        """
+        :param VolumeTransferService transfer_service: The service which
+            accepted the connection.
+        """
+        CommandLocator.__init__(self)
+        self._transfer_service = transfer_service
+        self._volume_service = transfer_service.volume_service
+        self._nonce = None
+        self.authenticated = False
+        self.receiving = {}
+
+    def locateResponder(self, name):
+        if not self.authenticated and name not in _UNAUTHENTICATED_COMMANDS:
+            return None
+        return CommandLocator.locateResponder(self, name)
+
+    @ChallengeCommand.responder
+    def challenge(self):
+        self._nonce = os.urandom(_NONCE_LENGTH)
+        return {'nonce': self._nonce}
+
+    @AuthenticateCommand.responder
+    def authenticate(self, proof, nonce):
+        # Each challenge can only be answered once:
+        challenge, self._nonce = self._nonce, None
+        secret = self._transfer_service.secret
+        if challenge is None or not hmac.compare_digest(
+                proof, _proof(secret, b"client", challenge)):
+            raise AuthenticationFailed()
+        self.authenticated = True
+        return {'proof': _proof(secret, b"server", nonce)}
+
+    def _volume(self, node_id, name):
+        return Volume(node_id=node_id, name=VolumeName.from_bytes(name),
+                      service=self._volume_service)
+
+    @SnapshotsCommand.responder
+    def snapshots(self, node_id, name):
+        d = self._volume(node_id, name).get_filesystem().snapshots()
+        d.addCallback(lambda snapshots: {
+            'snapshots': [snapshot.name for snapshot in snapshots]})
+        return d
+
+    @ReceiveStartCommand.responder
+    def receive_start(self, node_id, name, codecs=None, resume=False):
+        response = {}
+        decompressor = None
+        for codec in codecs or []:
+            if codec in CODECS:
+                response['codec'] = codec
+                decompressor = CODECS[codec].decompressor()
+                break
+        reader = _ChunkReader(self._transfer_service.reactor, decompressor)
+        receiving = self._transfer_service.in_thread(
+            self._volume_service.receive_resumable, node_id,
+            VolumeName.from_bytes(name), reader, bool(resume))
+        receiving.addErrback(reader.fail)
+        self.receiving[(node_id, name)] = (reader, receiving)
+        return response
+
+    @ReceiveDataCommand.responder
+    def receive_data(self, node_id, name, data):
+        reader, receiving = self.receiving[(node_id, name)]
+        d = reader.feed(data)
+        d.addCallback(lambda _: {})
+        return d
+
+    @ReceiveEndCommand.responder
+    def receive_end(self, node_id, name, succeeded):
+        reader, receiving = self.receiving.pop((node_id, name))
+        reader.finish(succeeded)
+        receiving.addCallback(lambda _: {})
+        return receiving
+
+    @ResumeTokenCommand.responder
+    def resume_token(self, node_id, name):
+        d = self._transfer_service.in_thread(
+            self._volume_service.resume_token, node_id,
+            VolumeName.from_bytes(name))
+        d.addCallback(lambda token: {} if token is None else {'token': token})
+        return d
+
+    @AcquireCommand.responder
+    def acquire(self, node_id, name):
+        d = self._volume_service.acquire(
+            node_id, VolumeName.from_bytes(name))
+        d.addCallback(lambda _: {'node_id': self._volume_service.node_id})
+        return d
+
+    @CloneToCommand.responder
+    def clone_to(self, node_id, name, new_name):
+        d = self._volume_service.clone_to(
+            self._volume(node_id, name), VolumeName.from_bytes(new_name))
+        d.addCallback(lambda _: {})
+        return d
+
+    def abort(self):
+        """
+        Stop receiving all volumes being received on this connection.
+        """
+        for reader, receiving in self.receiving.values():
+            reader.finish(False)
+            # Nobody is left to report the failure to:
+            receiving.addErrback(lambda _: None)
+        self.receiving.clear()
+
+
+class _TransferServerAMP(AMP):
+    """
+    AMP protocol for the volume transfer server.
+    """
+    def __init__(self, transfer_service):
+        """
+        :param VolumeTransferService transfer_service: The service which
+            accepted the connection.
+        """
+        AMP.__init__(self, locator=_TransferLocator(transfer_service))
+        self.transfer_service = transfer_service
+
+    def connectionMade(self):
+        AMP.connectionMade(self)
+        self.transfer_service.connections.add(self)
+
+    def connectionLost(self, reason):
+        AMP.connectionLost(self, reason)
+        self.locator.abort()
+        self.transfer_service.connections.discard(self)
+
+
+class VolumeTransferService(Service):
+    """
+    Accept connections from other agents pushing volumes to this node.
+
+    Received data is written to the volume by ``VolumeService.receive`` in a
+    thread pool, so several volumes can be received at once without blocking
+    the reactor.
+
+    :ivar VolumeService volume_service: The volume manager to operate on.
+    :ivar bytes secret: The secret shared by the agents.
+    :ivar reactor: The reactor.
+    :ivar set connections: The currently connected ``AMP`` instances.
+    """
+    def __init__(self, volume_service, endpoint, secret, reactor=None):
+        """
+        :param VolumeService volume_service: The volume manager to operate
+            on.
+        :param endpoint: Endpoint to listen on.
+        :param bytes secret: The secret shared by the agents, which clients
+            must prove they know.
+        :param reactor: The reactor to use, or ``None`` for the global
+            reactor.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.volume_service = volume_service
+        self.secret = secret
+        self.connections = set()
+        self._threadpool = ThreadPool(
+            minthreads=0, maxthreads=4, name="flocker:volume:transfer")
+        self.endpoint_service = StreamServerEndpointService(
+            endpoint,
+            ServerFactory.forProtocol(lambda: _TransferServerAMP(self)))
+
+    def in_thread(self, function, *args):
+        """
+        Call ``function`` with ``args`` in the thread pool.
+
+        :return: A ``Deferred`` firing with the result.
+        """
+        return deferToThreadPool(
+            self.reactor, self._threadpool, function, *args)
+
+    def startService(self):
+        Service.startService(self)
+        self._threadpool.start()
+        self.endpoint_service.startService()
+
+    def stopService(self):
+        Service.stopService(self)
+        stopping = self.endpoint_service.stopService()
+        for connection in self.connections:
+            connection.locator.abort()
+            connection.transport.loseConnection()
+        self._threadpool.stop()
+        return stopping
+
+
+class _TransferClientAMP(AMP):
+    """
+    AMP protocol for connections in a ``VolumeTransferPool``.
+
+    :ivar bool lost: Whether the connection has been lost.
+    :ivar Deferred disconnected: Fires when the connection has been lost.
+    """
+    lost = False
+
+    def __init__(self, pool, host):
+        """
+        :param VolumeTransferPool pool: The pool the connection belongs to.
+        :param bytes host: The host connected to.
+        """
+        AMP.__init__(self)
+        self._pool = pool
+        self._host = host
+        self.disconnected = Deferred()
+
+    def connectionLost(self, reason):
+        AMP.connectionLost(self, reason)
+        self.lost = True
+        self._pool.forget(self._host, self)
+        self.disconnected.callback(None)
+
+
+class VolumeTransferPool(object):
+    """
+    Connections to the ``VolumeTransferService`` of other nodes, kept open
+    for reuse.
+
+    A connection is used by one operation at a time; concurrent operations
+    on the same node use additional connections.  New connections are
+    authenticated before they are used.
+
+    :ivar bytes compression: The name of the codec in ``CODECS`` to compress
+        volume data with if the receiver supports it, or ``None`` to send
+        it uncompressed.
+    :ivar int compression_level: The level to compress at, or ``None`` for
+        the codec's default.
+    """
+    def __init__(self, reactor, secret, port=TRANSFER_PORT, compression=None,
+                 compression_level=None):
+        """
+        :param reactor: The reactor to connect and run processes with.
+        :param bytes secret: The secret shared by the agents.
+        :param int port: The port other nodes' ``VolumeTransferService``
+            listen on.
+        :param bytes compression: The name of the codec to compress with, or
+            ``None``.
+        :param int compression_level: The level to compress at, or ``None``
+            for the codec's default.
+
+        :raises ValueError: If ``compression`` is not in ``CODECS``.
+        """
+        if compression is not None and compression not in CODECS:
+            raise ValueError("Unknown compression codec", compression)
+        self._reactor = reactor
+        self._secret = secret
+        self._port = port
+        self._idle = {}
+        self.compression = compression
+        self.compression_level = compression_level
+
+    def remote_volume_manager(self, host):
+        """
+        :param bytes host: The node to talk to.
+
+        :return: A ``TransferRemoteVolumeManager`` for that node.
+        """
+        return TransferRemoteVolumeManager(self, host, self._reactor)
+
+    def with_connection(self, host, function):
+        """
+        Call ``function`` with a connection to ``host``, returning the
+        connection to the pool once the result of ``function`` is
+        available.
+
+        :param bytes host: The node to connect to.
+        :param function: Callable taking an ``AMP`` instance.
+
+        :return: ``Deferred`` firing with the result of ``function``.
+        """
+        idle = self._idle.get(host)
+        if idle:
+            connecting = succeed(idle.pop())
+        else:
+            connecting = connectProtocol(
+                TCP4ClientEndpoint(self._reactor, host, self._port),
+                _TransferClientAMP(self, host))
+            connecting.addCallback(self._authenticate)
+
+        def connected(connection):
+            d = maybeDeferred(function, connection)
+
+            def release(result):
+                if not connection.lost:
+                    self._idle.setdefault(host, []).append(connection)
+                return result
+            d.addBoth(release)
+            return d
+        connecting.addCallback(connected)
+        return connecting
+
+    def _authenticate(self, connection):
+        """
+        Prove to the server that we know the shared secret, and make it prove
+        the same.
+
+        :param AMP connection: A new connection.
+
+        :return: ``Deferred`` firing with ``connection`` once both ends are
+            authenticated, or errbacking with ``AuthenticationFailed`` (and
+            disconnecting) if either end isn't.
+        """
+        nonce = os.urandom(_NONCE_LENGTH)
+        d = connection.callRemote(ChallengeCommand)
+        d.addCallback(lambda response: connection.callRemote(
+            AuthenticateCommand, nonce=nonce,
+            proof=_proof(self._secret, b"client", response['nonce'])))
+
+        def authenticated(response):
+            if not hmac.compare_digest(
+                    response['proof'], _proof(self._secret, b"server", nonce)):
+                raise AuthenticationFailed()
+            return connection
+
+        def failed(reason):
+            connection.transport.loseConnection()
+            return reason
+        d.addCallback(authenticated)
+        d.addErrback(failed)
+        return d
+
+    def forget(self, host, connection):
+        """
+        Stop reusing a connection which has been lost.
+
+        :param bytes host: The host connected to.
+        :param AMP connection: The connection.
+        """
+        idle = self._idle.get(host, [])
+        if connection in idle:
+            idle.remove(connection)
+
+    def close(self):
+        """
+        Disconnect all idle connections.
+
+        :return: ``Deferred`` that fires when they have been disconnected.
+        """
+        disconnecting = []
+        for idle in self._idle.values():
+            for connection in idle:
+                disconnecting.append(connection.disconnected)
+                connection.transport.loseConnection()
+        self._idle.clear()
+        return gatherResults(disconnecting)
+
+
+_HOST = Field.forTypes(
+    u"host", [bytes], u"The node a volume was sent to.")
+
+_VOLUME_NAME = Field(
+    u"volume_name", lambda name: name.to_bytes().decode("ascii"),
+    u"The name of the volume sent.")
+
+_CODEC = Field.forTypes(
+    u"codec", [bytes, None],
+    u"The codec the data was compressed with, or null if it wasn't.")
+
+_RESUMED = Field.forTypes(
+    u"resumed", [bool], u"Whether an interrupted stream was resumed.")
+
+_BYTES = Field.forTypes(
+    u"bytes", [int, long], u"The size of the stream before compression.")
+
+_WIRE_BYTES = Field.forTypes(
+    u"wire_bytes", [int, long], u"The size of the data actually sent.")
+
+_ELAPSED = Field.forTypes(
+    u"elapsed", [float], u"Seconds taken to send the stream.")
+
+_THROUGHPUT = Field.forTypes(
+    u"throughput", [float],
+    u"Bytes of the stream, before compression, sent per second.")
+
+_RATIO = Field.forTypes(
+    u"ratio", [float],
+    u"The size of the data sent divided by the size of the stream.")
+
+VOLUME_SENT = MessageType(
+    u"flocker:volume:transfer:sent",
+    [_HOST, _VOLUME_NAME, _CODEC, _RESUMED, _BYTES, _WIRE_BYTES, _ELAPSED,
+     _THROUGHPUT, _RATIO],
+    u"A volume's data was sent to another node.")
+
+
+class _StreamSender(ProcessProtocol):
+    """
+    Send the stdout of a process to a ``VolumeTransferService`` as
+    ``ReceiveDataCommand``\ s, pausing the process while too many have not
+    been acknowledged.
+
+    :ivar ended: ``Deferred`` firing when the process has exited
+        successfully and all its output has been acknowledged, or errbacking
+        if either failed.
+    :ivar int bytes: The amount of output read from the process.
+    :ivar int wire_bytes: The amount of data sent, after compression.
+    """
+    def __init__(self, connection, arguments, command, compressor=None):
+        """
+        :param AMP connection: The connection to send the data over.
+        :param dict arguments: The ``node_id`` and ``name`` arguments of the
+            commands.
+        :param command: ``list`` of ``bytes``, the command being run.
+        :param compressor: An object with ``compress`` and ``flush`` methods
+            to compress the output with, or ``None`` to send it as is.
+        """
+        self._connection = connection
+        self._arguments = arguments
+        self._command = command
+        self._compressor = compressor
+        self._outstanding = 0
+        self._paused = False
+        self._exited = False
+        self._failure = None
+        self.bytes = 0
+        self.wire_bytes = 0
+        self.ended = Deferred()
+
+    def connectionMade(self):
+        self.transport.closeStdin()
+
+    def outReceived(self, data):
+        self.bytes += len(data)
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        self._send_all(data)
+
+    def _send_all(self, data):
+        self.wire_bytes += len(data)
+        for start in range(0, len(data), MAX_VALUE_LENGTH):
+            self._send(data[start:start + MAX_VALUE_LENGTH])
+
+    def _send(self, chunk):
+        self._outstanding += 1
+        d = self._connection.callRemote(
+            ReceiveDataCommand, data=chunk, **self._arguments)
+        d.addCallbacks(self._acknowledged, self._refused)
+        if (self._outstanding >= _WINDOW and not self._paused and
+                not self._exited):
+            self._paused = True
+            self.transport.pauseProducing()
+
+    def _acknowledged(self, result):
+        self._outstanding -= 1
+        if self._paused and self._outstanding < _WINDOW:
+            self._paused = False
+            self.transport.resumeProducing()
+        self._check_ended()
+
+    def _refused(self, reason):
+        self._outstanding -= 1
+        if self._failure is None:
+            self._failure = reason
+            try:
+                self.transport.signalProcess("TERM")
+            except ProcessExitedAlready:
+                pass
+        self._check_ended()
+
+    def processEnded(self, reason):
+        if self._failure is None and not reason.check(ProcessDone):
+            self._failure = Failure(IOError(
+                "Bad exit", self._command, reason.value.exitCode))
+        self._exited = True
+        if self._failure is None and self._compressor is not None:
+            self._send_all(self._compressor.flush())
+        self._check_ended()
+
+    def _check_ended(self):
+        if self._exited and not self._outstanding:
+            if self._failure is None:
+                self.ended.callback(None)
+            else:
+                self.ended.errback(self._failure)
+
+
+@implementer(IResumableRemoteVolumeManager)
+@with_cmp(["_pool", "_host"])
+class TransferRemoteVolumeManager(object):
+    """
+    Communicate with the ``VolumeTransferService`` of a remote node.
+
+    This is not an ``IRemoteVolumeManager``: its ``receive`` would have to
+    block the reactor while the data is sent, so volumes can only be pushed
+    to it from an ``IStreamingFilesystem``.
+
+    A ``VOLUME_SENT`` message reporting the size, compression ratio and
+    throughput of each stream sent is logged.
+
+    :ivar eliot.Logger logger: The log writer to use.
+    """
+    logger = Logger()
+
+    def __init__(self, pool, host, reactor):
+        """
+        :param VolumeTransferPool pool: The pool of connections to use.
+        :param bytes host: The node to talk to.
+        :param reactor: The reactor to run processes with.
+        """
+        self._pool = pool
+        self._host = host
+        self._reactor = reactor
+
+    def _call(self, command, **kwargs):
+        """
+        Send a command to the remote node.
+
+        :return: ``Deferred`` firing with the response.
+        """
+        return self._pool.with_connection(
+            self._host,
+            lambda connection: connection.callRemote(command, **kwargs))
+
+    def snapshots(self, volume):
+        d = self._call(SnapshotsCommand, node_id=volume.node_id,
+                       name=volume.name.to_bytes())
+        d.addCallback(lambda response: [
+            Snapshot(name=name) for name in response['snapshots']])
+        return d
+
+    def receive_stream(self, volume, command):
+        return self._send_stream(volume, command, False)
+
+    def resume_token(self, volume):
+        d = self._call(ResumeTokenCommand, node_id=volume.node_id,
+                       name=volume.name.to_bytes())
+        d.addCallback(lambda response: response.get('token'))
+        return d
+
+    def resume_stream(self, volume, command):
+        return self._send_stream(volume, command, True)
+
+    def acquire(self, volume):
+        d = self._call(AcquireCommand, node_id=volume.node_id,
+                       name=volume.name.to_bytes())
+        d.addCallback(lambda response: response['node_id'])
+        return d
+
+    def clone_to(self, parent, name):
+        d = self._call(CloneToCommand, node_id=parent.node_id,
+                       name=parent.name.to_bytes(),
+                       new_name=name.to_bytes())
+        d.addCallback(lambda _: None)
+        return d
+
+    def _send_stream(self, volume, command, resume):
+        """
+        Run a local command and send its stdout to the remote node.
+
+        :param Volume volume: The volume being sent.
+        :param command: ``list`` of ``bytes``, the command to run.
+        :param bool resume: Whether the stream continues an interrupted
+            receive.
+
+        :return: ``Deferred`` that fires when the remote node has received
+            the data.
+        """
+        arguments = dict(node_id=volume.node_id, name=volume.name.to_bytes())
+        codecs = []
+        if self._pool.compression is not None:
+            codecs.append(self._pool.compression)
+
+        def send(connection):
+            d = connection.callRemote(
+                ReceiveStartCommand, codecs=codecs, resume=resume,
+                **arguments)
+
+            def started(response):
+                codec = response.get('codec')
+                compressor = None
+                if codec is not None:
+                    level = self._pool.compression_level
+                    if level is None:
+                        level = CODECS[codec].default_level
+                    compressor = CODECS[codec].compressor(level)
+                sender = _StreamSender(
+                    connection, arguments, command, compressor)
+                starting = self._reactor.seconds()
+                self._reactor.spawnProcess(
+                    sender, command[0], command, env=os.environ,
+                    childFDs={0: "w", 1: "r", 2: 2})
+
+                def sent(result):
+                    elapsed = self._reactor.seconds() - starting
+                    VOLUME_SENT(
+                        host=self._host, volume_name=volume.name,
+                        codec=codec, resumed=resume, bytes=sender.bytes,
+                        wire_bytes=sender.wire_bytes, elapsed=elapsed,
+                        throughput=sender.bytes / elapsed if elapsed else 0.0,
+                        ratio=(float(sender.wire_bytes) / sender.bytes
+                               if sender.bytes else 1.0),
+                    ).write(self.logger)
+                    return result
+                sender.ended.addCallback(sent)
+                return sender.ended
+            d.addCallback(started)
+
+            def ended(result):
+                ending = connection.callRemote(
+                    ReceiveEndCommand, succeeded=result is None, **arguments)
+                if result is None:
+                    ending.addCallback(lambda _: None)
+                    return ending
+                # The end of a failed stream is expected to fail too; the
+                # sending failure is the interesting one.
+                ending.addBoth(lambda _: result)
+                return ending
+            d.addBoth(ended)
+            return d
+        return self._pool.with_connection(self._host, send)
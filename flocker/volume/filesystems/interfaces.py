@@ -116,6 +116,64 @@ class IFilesystem(Interface):
         """Equal objects should have the same hash."""
 
 
+class IStreamingFilesystem(IFilesystem):
+    """
+    A filesystem whose contents can be read by a local process, allowing
+    them to be streamed elsewhere without blocking.
+    """
+
+    def send_command(remote_snapshots=None):
+        """
+        Prepare to send the contents of the filesystem.
+
+        :param remote_snapshots: As for :meth:`IFilesystem.reader`.
+
+        :return: A ``Deferred`` that fires with a ``list`` of ``bytes``, a
+            local command and its arguments.  The command writes the same
+            data as :meth:`IFilesystem.reader` to its stdout.
+        """
+
+
+class IResumableFilesystem(IStreamingFilesystem):
+    """
+    A filesystem which can keep the data of an interrupted receive, so the
+    sender can continue from where it left off rather than starting over.
+    """
+
+    def resume_token():
+        """
+        Describe the data kept from an interrupted receive.
+
+        This is a blocking API.
+
+        :return: ``bytes`` identifying what has been received, to be passed
+            to :meth:`resume_command` on the sending filesystem, or ``None``
+            if there is no interrupted receive to resume.
+        """
+
+    def resume_command(token):
+        """
+        Prepare to send the rest of an interrupted stream.
+
+        :param bytes token: The result of :meth:`resume_token` on the
+            receiving filesystem.
+
+        :return: A ``Deferred`` that fires with a ``list`` of ``bytes``, a
+            local command and its arguments.  The command writes the rest of
+            the stream to its stdout.
+        """
+
+    def resumable_writer(resume=False):
+        """
+        Like :meth:`IFilesystem.writer`, but if the data written is
+        incomplete it is kept so that the receive can be resumed.
+
+        :param bool resume: ``True`` if the data written continues an
+            interrupted receive, ``False`` if it is a new stream, in which
+            case the data of any interrupted receive is discarded.
+        """
+
+
 class IStoragePool(Interface):
     """
     Pool of on-disk storage where filesystems are stored.
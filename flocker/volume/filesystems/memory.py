@@ -6,6 +6,7 @@ from __future__ import absolute_import
 
 from errno import ENOENT
 from contextlib import contextmanager
+from tempfile import mkdtemp
 from tarfile import TarFile
 from io import BytesIO
 
@@ -14,10 +15,11 @@ from zope.interface import implementer
 from characteristic import with_init, with_cmp, with_repr
 
 from twisted.internet.defer import succeed, fail
+from twisted.python.filepath import FilePath
 from twisted.application.service import Service
 
 from .interfaces import (
-    IFilesystemSnapshots, IStoragePool, IFilesystem,
+    IFilesystemSnapshots, IStoragePool, IStreamingFilesystem,
     FilesystemAlreadyExists)
 from .zfs import Snapshot
 
@@ -44,7 +46,7 @@ class CannedFilesystemSnapshots(object):
         return succeed(self._snapshots)
 
 
-@implementer(IFilesystem)
+@implementer(IStreamingFilesystem)
 @with_cmp(["path"])
 @with_repr(["path", "size"])
 @with_init(["path", "size"],
@@ -125,6 +127,18 @@ class DirectoryFilesystem(object):
         result.seek(0, 0)
         yield result
 
+    def send_command(self, remote_snapshots=None):
+        """
+        Write the output of ``reader`` to a temporary file and construct a
+        command which outputs the file and then deletes it.
+        """
+        directory = FilePath(mkdtemp())
+        stream = directory.child(b"stream")
+        with self.reader(remote_snapshots) as reader:
+            stream.setContent(reader.read())
+        return succeed([b"sh", b"-c", b'cat "$0" && rm -r "$1"',
+                        stream.path, directory.path])
+
     @contextmanager
     def writer(self):
         """Expect written bytes to be a tarball."""
@@ -8,7 +8,7 @@ from __future__ import absolute_import
 
 import os
 from contextlib import contextmanager
-from uuid import uuid4
+from uuid import UUID, uuid4
 from subprocess import (
     CalledProcessError, STDOUT, PIPE, Popen, check_call, check_output
 )
@@ -17,7 +17,7 @@ from characteristic import attributes, with_cmp, with_repr
 
 from zope.interface import implementer
 
-from eliot import Field, MessageType, Logger
+from eliot import Field, MessageType, Logger, write_failure
 
 from twisted.python.failure import Failure
 from twisted.python.filepath import FilePath
@@ -29,7 +29,7 @@ from twisted.application.service import Service
 
 from .errors import MaximumSizeTooSmall
 from .interfaces import (
-    IFilesystemSnapshots, IStoragePool, IFilesystem,
+    IFilesystemSnapshots, IStoragePool, IResumableFilesystem,
     FilesystemAlreadyExists)
 
 from .._model import VolumeSize
@@ -168,7 +168,48 @@ def _latest_common_snapshot(some, others):
     return None
 
 
-@implementer(IFilesystem)
+def _is_push_snapshot(snapshot):
+    """
+    Determine whether a snapshot was taken in order to push a filesystem.
+
+    :param Snapshot snapshot: The snapshot to consider.
+
+    :return: ``True`` if ``snapshot`` has the UUID name given to snapshots
+        taken by ``Filesystem.reader`` and ``Filesystem.send_command``,
+        ``False`` otherwise.
+    """
+    try:
+        UUID(snapshot.name)
+    except ValueError:
+        return False
+    return True
+
+
+def _obsolete_snapshots(snapshots, base):
+    """
+    Pick the push snapshots which are no longer needed as the basis of an
+    incremental stream.
+
+    Incremental streams are always based on the most recent snapshot shared
+    by the two sides, so once both have ``base`` the push snapshots taken
+    before it are obsolete.  ``base`` itself, anything newer (which may yet
+    be sent) and snapshots not taken for pushes are all kept.
+
+    :param list snapshots: ``Snapshot`` instances, ordered from oldest to
+        newest.
+    :param Snapshot base: The snapshot the next incremental stream will be
+        based on, or ``None`` if there is none.
+
+    :return: A ``list`` of the obsolete ``Snapshot`` instances, ordered from
+        oldest to newest.
+    """
+    if base not in snapshots:
+        return []
+    return [snapshot for snapshot in snapshots[:snapshots.index(base)]
+            if _is_push_snapshot(snapshot)]
+
+
+@implementer(IResumableFilesystem)
 @with_cmp(["pool", "dataset"])
 @with_repr(["pool", "dataset"])
 class Filesystem(object):
@@ -177,7 +218,13 @@ class Filesystem(object):
     For now the goal is simply not to pass bytes around when referring to a
     filesystem.  This will likely grow into a more sophisticiated
     implementation over time.
+
+    Snapshots taken to push the filesystem are pruned once they can no
+    longer be the basis of an incremental stream; see
+    ``_obsolete_snapshots``.
     """
+    logger = Logger()
+
     def __init__(self, pool, dataset, mountpoint=None, size=None,
                  reactor=None):
         """
@@ -253,13 +300,94 @@ class Filesystem(object):
 
         # Determine whether there is a shared snapshot which can be used as the
         # basis for an incremental send.
-        local_snapshots = list(
+        local_snapshots = self._list_snapshots_sync()
+
+        process = Popen(
+            self._send_command(snapshot, local_snapshots, remote_snapshots),
+            stdout=PIPE)
+        try:
+            yield process.stdout
+        finally:
+            process.stdout.close()
+            process.wait()
+        # Prune once the stream is done, so as not to delay its start.
+        pruning = self._prune_command(local_snapshots, remote_snapshots)
+        if pruning is not None:
+            _sync_command_error_squashed([b"zfs"] + pruning, self.logger)
+
+    def send_command(self, remote_snapshots=None):
+        """
+        Take a snapshot and construct the ``zfs send`` command which sends
+        it, without blocking.
+
+        See :meth:`reader` for details of the snapshot and the stream.
+        """
+        snapshot = b"%s@%s" % (self.name, uuid4())
+        d = zfs_command(self._reactor, [b"snapshot", snapshot])
+        d.addCallback(lambda _: _list_snapshots(self._reactor, self))
+
+        def listed(names):
+            local_snapshots = [Snapshot(name=name) for name in names]
+            pruning = self._prune_command(local_snapshots, remote_snapshots)
+            if pruning is not None:
+                # The send doesn't wait for this; failures are only logged.
+                pruned = zfs_command(self._reactor, pruning)
+                pruned.addErrback(
+                    write_failure, self.logger, u"filesystem:zfs:prune")
+            return self._send_command(
+                snapshot, local_snapshots, remote_snapshots)
+        d.addCallback(listed)
+        return d
+
+    def _list_snapshots_sync(self):
+        """
+        Synchronously list the snapshots of this filesystem.
+
+        :return: A ``list`` of ``Snapshot`` instances, ordered from oldest to
+            newest.
+        """
+        return [
             Snapshot(name=name) for name in
             _parse_snapshots(
                 check_output([b"zfs"] + _list_snapshots_command(self)),
                 self
-            ))
+            )]
+
+    def _prune_command(self, local_snapshots, remote_snapshots):
+        """
+        Construct the ``zfs`` command which destroys the local push snapshots
+        older than the latest one shared with the writer.
+
+        :param list local_snapshots: ``Snapshot`` instances, ordered from
+            oldest to newest, which exist locally.
+        :param list remote_snapshots: ``Snapshot`` instances, ordered from
+            oldest to newest, which are available on the writer, or ``None``.
 
+        :return: An argument list (of ``bytes``) for ``zfs``, or ``None`` if
+            there is nothing to prune.
+        """
+        if remote_snapshots is None:
+            remote_snapshots = []
+        obsolete = _obsolete_snapshots(
+            local_snapshots,
+            _latest_common_snapshot(remote_snapshots, local_snapshots))
+        if not obsolete:
+            return None
+        return _destroy_snapshots_command(self, obsolete)
+
+    def _send_command(self, snapshot, local_snapshots, remote_snapshots):
+        """
+        Construct the ``zfs send`` command for a snapshot, generating an
+        incremental stream if the writer shares a snapshot with us.
+
+        :param bytes snapshot: The full name of the snapshot to send.
+        :param list local_snapshots: ``Snapshot`` instances, ordered from
+            oldest to newest, which exist locally.
+        :param list remote_snapshots: ``Snapshot`` instances, ordered from
+            oldest to newest, which are available on the writer, or ``None``.
+
+        :return: ``list`` of ``bytes``, the command and its arguments.
+        """
         if remote_snapshots is None:
             remote_snapshots = []
 
@@ -275,19 +403,67 @@ class Filesystem(object):
                     self.name, latest_common_snapshot.name).encode("ascii"),
                 snapshot,
             ]
+        return [b"zfs", b"send"] + identifier
 
-        process = Popen([b"zfs", b"send"] + identifier, stdout=PIPE)
+    def resume_token(self):
+        """
+        Get the ``receive_resume_token`` ZFS left behind when a receive with
+        ``-s`` was interrupted.
+        """
         try:
-            yield process.stdout
-        finally:
-            process.stdout.close()
-            process.wait()
+            output = check_output(
+                [b"zfs", b"get", b"-H", b"-o", b"value",
+                 b"receive_resume_token", self.name], stderr=STDOUT)
+        except CalledProcessError:
+            # Either the filesystem doesn't exist or this version of ZFS
+            # can't resume receives; either way there's nothing to resume.
+            return None
+        token = output.strip()
+        if token in (b"", b"-"):
+            return None
+        return token
+
+    def resume_command(self, token):
+        """
+        Construct the ``zfs send`` command which sends the rest of an
+        interrupted stream.
+        """
+        return succeed([b"zfs", b"send", b"-t", token])
+
+    def _discard_partial(self):
+        """
+        Throw away the data of an interrupted receive, if any, since ZFS
+        refuses to receive a new stream into a filesystem which has some.
+        """
+        if self.resume_token() is not None:
+            check_call([b"zfs", b"receive", b"-A", self.name])
 
-    @contextmanager
     def writer(self):
         """
         Read in zfs stream.
         """
+        self._discard_partial()
+        return self._receive([])
+
+    def resumable_writer(self, resume=False):
+        """
+        Read in zfs stream, keeping the received data if the stream is
+        incomplete.
+        """
+        if not resume:
+            self._discard_partial()
+        # -s means "save the partially received state if the stream is
+        # interrupted", and is what makes receive_resume_token available.
+        return self._receive([b"-s"])
+
+    @contextmanager
+    def _receive(self, options):
+        """
+        Run ``zfs receive`` on the data written.
+
+        :param options: ``list`` of ``bytes``, extra options for
+            ``zfs receive``.
+        """
         if self._exists():
             # If the filesystem already exists then this should be an
             # incremental data stream to up date it to a more recent snapshot.
@@ -308,11 +484,11 @@ class Filesystem(object):
             # it in order to receive the stream.  To do that you have to
             # force.
             #
-            cmd = [b"zfs", b"receive", b"-F", self.name]
+            cmd = [b"zfs", b"receive", b"-F"] + options + [self.name]
         else:
             # If the filesystem doesn't already exist then this is a complete
             # data stream.
-            cmd = [b"zfs", b"receive", self.name]
+            cmd = [b"zfs", b"receive"] + options + [self.name]
         process = Popen(cmd, stdin=PIPE)
         succeeded = False
         try:
@@ -324,6 +500,24 @@ class Filesystem(object):
             check_call([b"zfs", b"set",
                         b"mountpoint=" + self._mountpoint.path,
                         self.name])
+            self._prune_received()
+
+    def _prune_received(self):
+        """
+        Destroy the push snapshots older than the one just received, since
+        the next incremental stream will be based on that one.
+        """
+        try:
+            snapshots = self._list_snapshots_sync()
+        except CalledProcessError:
+            return
+        if not snapshots:
+            return
+        obsolete = _obsolete_snapshots(snapshots, snapshots[-1])
+        if obsolete:
+            _sync_command_error_squashed(
+                [b"zfs"] + _destroy_snapshots_command(self, obsolete),
+                self.logger)
 
 
 @implementer(IFilesystemSnapshots)
@@ -378,6 +572,29 @@ def _list_snapshots_command(filesystem):
     ]
 
 
+def _destroy_snapshots_command(filesystem, snapshots):
+    """
+    Construct a ``zfs`` command which will destroy some snapshots of the
+    given filesystem.
+
+    :param Filesystem filesystem: The ZFS filesystem the snapshots of which to
+        destroy.
+    :param list snapshots: The ``Snapshot`` instances to destroy.
+
+    :return list: An argument list (of ``bytes``) which can be passed to
+        ``zfs`` to destroy the snapshots.  ``zfs`` is not included as the
+        first element.
+    """
+    # A single command can destroy a comma separated list of snapshots of
+    # one filesystem.
+    return [
+        b"destroy",
+        b"%s@%s" % (
+            filesystem.name,
+            b",".join(snapshot.name for snapshot in snapshots)),
+    ]
+
+
 def _parse_snapshots(data, filesystem):
     """
     Parse the output of a ``zfs list`` command (like the one defined by
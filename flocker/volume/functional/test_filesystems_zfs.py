@@ -14,6 +14,7 @@ import subprocess
 import errno
 
 from twisted.internet import reactor
+from twisted.internet.defer import gatherResults
 from twisted.internet.task import cooperate
 from twisted.trial.unittest import TestCase
 from twisted.python.filepath import FilePath
@@ -457,6 +458,123 @@ class IncrementalPushTests(TestCase):
         return loading
 
 
+class ResumableReceiveTests(TestCase):
+    """
+    Tests for resuming interrupted receives using ZFS resume tokens.
+    """
+    def setUp(self):
+        pool = build_pool(self)
+        service = service_for_pool(self, pool)
+        self.from_volume = service.get(MY_VOLUME)
+        self.to_volume = Volume(
+            node_id=service.node_id, name=MY_VOLUME,
+            service=service_for_pool(self, build_pool(self)))
+        creating = pool.create(self.from_volume)
+
+        def created(filesystem):
+            filesystem.get_path().child(b"file").setContent(
+                b"some bytes" * 1024 * 100)
+        return creating.addCallback(created)
+
+    def interrupt(self):
+        """
+        Send part of the stream of ``from_volume`` to ``to_volume``, keeping
+        the data received.
+
+        :return: The ``Filesystem`` of ``to_volume``.
+        """
+        with self.from_volume.get_filesystem().reader() as reader:
+            stream = reader.read()
+        to_filesystem = self.to_volume.get_filesystem()
+        try:
+            with to_filesystem.resumable_writer() as writer:
+                writer.write(stream[:len(stream) // 2])
+                raise IOError("Interrupted")
+        except IOError:
+            pass
+        return to_filesystem
+
+    def test_no_resume_token(self):
+        """
+        ``Filesystem.resume_token`` returns ``None`` if no receive was
+        interrupted.
+        """
+        self.assertIs(
+            None, self.from_volume.get_filesystem().resume_token())
+
+    def test_resume_token(self):
+        """
+        ``Filesystem.resume_token`` returns a token once a receive using
+        ``Filesystem.resumable_writer`` has been interrupted.
+        """
+        self.assertIsInstance(self.interrupt().resume_token(), bytes)
+
+    def test_resume(self):
+        """
+        The output of the ``Filesystem.resume_command`` for a resume token,
+        written with ``Filesystem.resumable_writer(resume=True)``, completes
+        the interrupted receive.
+        """
+        to_filesystem = self.interrupt()
+        d = self.from_volume.get_filesystem().resume_command(
+            to_filesystem.resume_token())
+
+        def got_command(command):
+            stream = subprocess.check_output(command)
+            with to_filesystem.resumable_writer(resume=True) as writer:
+                writer.write(stream)
+            assertVolumesEqual(self, self.from_volume, self.to_volume)
+            self.assertIs(None, to_filesystem.resume_token())
+        d.addCallback(got_command)
+        return d
+
+    def test_new_stream_discards(self):
+        """
+        Writing a new stream with ``Filesystem.writer`` discards the data of
+        an interrupted receive.
+        """
+        self.interrupt()
+        d = copy(self.from_volume, self.to_volume)
+        d.addCallback(lambda _: assertVolumesEqual(
+            self, self.from_volume, self.to_volume))
+        return d
+
+
+class SnapshotPruningTests(TestCase):
+    """
+    Tests for pruning the snapshots taken to push a filesystem.
+    """
+    def setUp(self):
+        pool = build_pool(self)
+        service = service_for_pool(self, pool)
+        self.from_volume = service.get(MY_VOLUME)
+        self.to_volume = Volume(
+            node_id=service.node_id, name=MY_VOLUME,
+            service=service_for_pool(self, build_pool(self)))
+        return pool.create(self.from_volume)
+
+    def test_pruned(self):
+        """
+        After repeated pushes the reader keeps only the snapshot shared with
+        the writer and the newest one, and the writer keeps only the newest
+        one.
+        """
+        d = copy(self.from_volume, self.to_volume)
+        d.addCallback(lambda _: copy(self.from_volume, self.to_volume))
+        d.addCallback(lambda _: copy(self.from_volume, self.to_volume))
+        d.addCallback(lambda _: gatherResults([
+            self.from_volume.get_filesystem().snapshots(),
+            self.to_volume.get_filesystem().snapshots()]))
+
+        def got_snapshots(snapshots):
+            from_snapshots, to_snapshots = snapshots
+            self.assertEqual(
+                (2, from_snapshots[-1:]),
+                (len(from_snapshots), to_snapshots))
+        d.addCallback(got_snapshots)
+        return d
+
+
 class FilesystemTests(TestCase):
     """
     ZFS-specific tests for ``Filesystem``.
@@ -11,3 +11,11 @@ class RemoteVolumeManagerInterfaceTests(
     """
     Tests for ``RemoteVolumeManger`` as a ``IRemoteVolumeManager``.
     """
+
+
+class StreamingRemoteVolumeManagerInterfaceTests(
+        make_iremote_volume_manager(
+            lambda test: create_realistic_servicepair(test, streaming=True))):
+    """
+    Tests for ``StreamingRemoteVolumeManger`` as a ``IRemoteVolumeManager``.
+    """
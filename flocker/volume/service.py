@@ -16,6 +16,8 @@ from zope.interface import Interface, implementer
 
 from characteristic import attributes
 
+from eliot import Logger, write_failure
+
 from twisted.internet.defer import maybeDeferred
 from twisted.internet.task import deferLater
 from twisted.python.filepath import FilePath
@@ -26,6 +28,9 @@ from twisted.internet.defer import fail
 # module... but in this case the usage is temporary and should go away as
 # part of https://clusterhq.atlassian.net/browse/FLOC-64
 from .filesystems.zfs import StoragePool
+from .filesystems.interfaces import (
+    IResumableFilesystem, IStreamingFilesystem,
+)
 from ._model import VolumeSize
 from ..common.script import ICommandLineScript
 
@@ -35,6 +40,8 @@ FLOCKER_POOL = b"flocker"
 
 WAIT_FOR_VOLUME_INTERVAL = 0.1
 
+_logger = Logger()
+
 
 class CreateConfigurationError(Exception):
     """Create the configuration file failed."""
@@ -284,25 +291,51 @@ class VolumeService(Service):
         """
         Push the latest data in the volume to a remote destination.
 
-        This is a blocking API for now.
+        If the volume's filesystem provides ``IStreamingFilesystem`` and the
+        destination provides ``IStreamingRemoteVolumeManager`` the data is
+        streamed between child processes without blocking.  Otherwise this
+        is a blocking API.  If the filesystem provides
+        ``IResumableFilesystem`` and the destination provides
+        ``IResumableRemoteVolumeManager``, an interrupted earlier push is
+        resumed first.
 
         Only locally owned volumes (i.e. volumes whose ``uuid`` matches
         this service's) can be pushed.
 
         :param Volume volume: The volume to push.
 
-        :param IRemoteVolumeManager destination: The remote volume manager
-            to push to.
+        :param destination: The ``IRemoteVolumeManager`` to push to, or an
+            ``IStreamingRemoteVolumeManager`` if the volume's filesystem
+            provides ``IStreamingFilesystem``.
 
         :raises ValueError: If the uuid of the volume is different than
             our own; only locally-owned volumes can be pushed.
+
+        :return: ``Deferred`` that fires when the push has finished.
         """
+        # _ipc imports this module, so import it lazily:
+        from ._ipc import (
+            IResumableRemoteVolumeManager, IStreamingRemoteVolumeManager,
+        )
         if volume.node_id != self.node_id:
             raise ValueError()
         fs = volume.get_filesystem()
-        getting_snapshots = destination.snapshots(volume)
+        if (IResumableFilesystem.providedBy(fs) and
+                IResumableRemoteVolumeManager.providedBy(destination)):
+            resuming = self._resume(volume, fs, destination)
+            getting_snapshots = resuming.addCallback(
+                lambda _: destination.snapshots(volume))
+        else:
+            getting_snapshots = destination.snapshots(volume)
 
         def got_snapshots(snapshots):
+            if (IStreamingFilesystem.providedBy(fs) and
+                    IStreamingRemoteVolumeManager.providedBy(destination)):
+                sending = fs.send_command(snapshots)
+                sending.addCallback(
+                    lambda command: destination.receive_stream(
+                        volume, command))
+                return sending
             with destination.receive(volume) as receiver:
                 with fs.reader(snapshots) as contents:
                     for chunk in iter(lambda: contents.read(1024 * 1024), b""):
@@ -311,6 +344,37 @@ class VolumeService(Service):
         pushing = getting_snapshots.addCallback(got_snapshots)
         return pushing
 
+    def _resume(self, volume, fs, destination):
+        """
+        Finish sending the stream of an earlier push of a volume, if it was
+        interrupted.
+
+        Once it has been received the destination has the snapshot that
+        stream was sending, so the rest of the push only needs to send the
+        changes since then.  Failing to resume isn't fatal: the push goes on
+        to send a new stream, which discards the interrupted one.
+
+        :param Volume volume: The volume being pushed.
+        :param IResumableFilesystem fs: The volume's filesystem.
+        :param IResumableRemoteVolumeManager destination: The remote volume
+            manager being pushed to.
+
+        :return: ``Deferred`` that fires when the interrupted stream has been
+            sent, or there was none.
+        """
+        d = destination.resume_token(volume)
+
+        def got_token(token):
+            if token is None:
+                return None
+            resuming = fs.resume_command(token)
+            resuming.addCallback(
+                lambda command: destination.resume_stream(volume, command))
+            return resuming
+        d.addCallback(got_token)
+        d.addErrback(write_failure, _logger, u"flocker:volume:push:resume")
+        return d
+
     def receive(self, volume_node_id, volume_name, input_file):
         """
         Process a volume's data that can be read from a file-like object.
@@ -328,10 +392,70 @@ class VolumeService(Service):
         :raises ValueError: If the uuid of the volume matches our own;
             remote nodes can't overwrite locally-owned volumes.
         """
+        fs = self._received_filesystem(volume_node_id, volume_name)
+        self._copy(input_file, fs.writer())
+
+    def receive_resumable(self, volume_node_id, volume_name, input_file,
+                          resume=False):
+        """
+        Like ``receive``, but if the volume's filesystem provides
+        ``IResumableFilesystem`` the data of an interrupted receive is kept
+        so a later call can resume it.
+
+        :param bool resume: ``True`` if the data continues an interrupted
+            receive, ``False`` if it is a new stream.
+
+        :raises ValueError: If the uuid of the volume matches our own;
+            remote nodes can't overwrite locally-owned volumes.
+        """
+        fs = self._received_filesystem(volume_node_id, volume_name)
+        if IResumableFilesystem.providedBy(fs):
+            writer = fs.resumable_writer(resume)
+        else:
+            writer = fs.writer()
+        self._copy(input_file, writer)
+
+    def resume_token(self, volume_node_id, volume_name):
+        """
+        Find out whether a receive of a volume was interrupted.
+
+        This is a blocking API.
+
+        :param unicode volume_node_id: The volume's owner's node ID.
+        :param VolumeName volume_name: The volume's name.
+
+        :return: The ``IResumableFilesystem.resume_token`` of the volume's
+            filesystem, or ``None`` if it can't resume receives.
+        """
+        fs = Volume(node_id=volume_node_id, name=volume_name,
+                    service=self).get_filesystem()
+        if IResumableFilesystem.providedBy(fs):
+            return fs.resume_token()
+        return None
+
+    def _received_filesystem(self, volume_node_id, volume_name):
+        """
+        :param unicode volume_node_id: The owner of a volume being received.
+        :param VolumeName volume_name: The volume's name.
+
+        :raises ValueError: If the uuid of the volume matches our own.
+
+        :return: The ``IFilesystem`` to write the volume's data to.
+        """
         if volume_node_id == self.node_id:
             raise ValueError()
         volume = Volume(node_id=volume_node_id, name=volume_name, service=self)
-        with volume.get_filesystem().writer() as writer:
+        return volume.get_filesystem()
+
+    def _copy(self, input_file, writing):
+        """
+        Copy the contents of a file-like object to a filesystem.
+
+        :param input_file: A file-like object to read the data from.
+        :param writing: The context manager returned by the filesystem's
+            ``writer`` method.
+        """
+        with writing as writer:
             for chunk in iter(lambda: input_file.read(1024 * 1024), b""):
                 writer.write(chunk)
 
@@ -361,8 +485,8 @@ class VolumeService(Service):
 
         The remote destination will be the new owner of the volume.
 
-        This is a blocking API for now (but it does return a ``Deferred``
-        for success/failure).
+        This blocks only where ``push`` does, or if the destination's
+        ``acquire`` does.
 
         :param Volume volume: The volume to handoff.
         :param IRemoteVolumeManager destination: The remote volume manager
@@ -375,8 +499,9 @@ class VolumeService(Service):
         pushing = maybeDeferred(self.push, volume, destination)
 
         def pushed(ignored):
-            remote_uuid = destination.acquire(volume)
-            return volume.change_owner(remote_uuid)
+            acquiring = maybeDeferred(destination.acquire, volume)
+            acquiring.addCallback(volume.change_owner)
+            return acquiring
         changing_owner = pushing.addCallback(pushed)
         return changing_owner
 
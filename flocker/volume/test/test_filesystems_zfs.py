@@ -7,6 +7,9 @@ Further coverage is provided in
 """
 
 import os
+from uuid import uuid4
+
+from zope.interface.verify import verifyObject
 
 from twisted.trial.unittest import SynchronousTestCase
 from twisted.internet.error import ProcessDone, ProcessTerminated
@@ -26,8 +29,9 @@ from ..filesystems.zfs import (
     _DatasetInfo,
     zfs_command, CommandFailed, BadArguments, Filesystem, ZFSSnapshots,
     _sync_command_error_squashed, _latest_common_snapshot, ZFS_ERROR,
-    Snapshot,
+    Snapshot, _obsolete_snapshots,
 )
+from ..filesystems.interfaces import IResumableFilesystem
 
 
 class FilesystemTests(SynchronousTestCase):
@@ -106,6 +110,197 @@ class FilesystemTests(SynchronousTestCase):
         )
 
 
+class ResumeCommandTests(SynchronousTestCase):
+    """
+    Tests for ``Filesystem.resume_command``.
+    """
+    def test_interface(self):
+        """
+        ``Filesystem`` provides ``IResumableFilesystem``.
+        """
+        self.assertTrue(verifyObject(
+            IResumableFilesystem, Filesystem(b"pool", b"fs")))
+
+    def test_command(self):
+        """
+        ``Filesystem.resume_command`` fires with a ``zfs send`` command which
+        resumes the stream identified by the token.
+        """
+        filesystem = Filesystem(b"pool", b"fs", reactor=FakeProcessReactor())
+        self.assertEqual(
+            [b"zfs", b"send", b"-t", b"1-abc-def"],
+            self.successResultOf(filesystem.resume_command(b"1-abc-def")))
+
+
+class SendCommandTests(SynchronousTestCase):
+    """
+    Tests for ``Filesystem.send_command``.
+    """
+    def setUp(self):
+        self.reactor = FakeProcessReactor()
+        self.filesystem = Filesystem(b"pool", b"fs", reactor=self.reactor)
+
+    def finish(self, output=b""):
+        """
+        Make the most recently spawned process write some output and exit
+        successfully.
+
+        :param bytes output: The process's stdout.
+        """
+        protocol = self.reactor.processes[-1].processProtocol
+        protocol.childDataReceived(1, output)
+        protocol.processEnded(Failure(ProcessDone(0)))
+
+    def test_snapshot(self):
+        """
+        ``Filesystem.send_command`` takes a new snapshot of the filesystem
+        without blocking.
+        """
+        d = self.filesystem.send_command()
+        self.assertEqual(
+            ([b"zfs", b"snapshot"], b"pool/fs@"),
+            (self.reactor.processes[0].args[:2],
+             self.reactor.processes[0].args[2][:len(b"pool/fs@")]))
+        self.assertNoResult(d)
+
+    def test_complete(self):
+        """
+        If there are no snapshots in common with the writer
+        ``Filesystem.send_command`` fires with a command which sends a
+        complete stream of the new snapshot.
+        """
+        d = self.filesystem.send_command([Snapshot(name=b"other")])
+        snapshot = self.reactor.processes[0].args[2]
+        self.finish()
+        self.finish(b"pool/fs@older\n" + snapshot + b"\n")
+        self.assertEqual(
+            [b"zfs", b"send", snapshot], self.successResultOf(d))
+
+    def test_incremental(self):
+        """
+        If there is a snapshot in common with the writer
+        ``Filesystem.send_command`` fires with a command which sends an
+        incremental stream based on that snapshot.
+        """
+        d = self.filesystem.send_command([Snapshot(name=b"older")])
+        snapshot = self.reactor.processes[0].args[2]
+        self.finish()
+        self.finish(b"pool/fs@older\n" + snapshot + b"\n")
+        self.assertEqual(
+            [b"zfs", b"send", b"-i", b"pool/fs@older", snapshot],
+            self.successResultOf(d))
+
+    def send_incremental(self, local, remote):
+        """
+        Call ``Filesystem.send_command`` for an incremental stream.
+
+        :param list local: ``bytes`` names of the snapshots which already
+            exist locally.
+        :param list remote: ``bytes`` names of the snapshots available on
+            the writer.
+
+        :return: The ``Deferred`` returned by ``send_command``.
+        """
+        d = self.filesystem.send_command(
+            [Snapshot(name=name) for name in remote])
+        snapshot = self.reactor.processes[0].args[2]
+        self.finish()
+        self.finish(b"".join(b"pool/fs@" + name + b"\n" for name in local) +
+                    snapshot + b"\n")
+        return d
+
+    def test_prune(self):
+        """
+        ``Filesystem.send_command`` destroys the snapshots it took for earlier
+        pushes which are older than the basis of the incremental stream,
+        without waiting for them to be destroyed.
+        """
+        names = [bytes(uuid4()) for i in range(3)]
+        d = self.send_incremental(names, names[-1:])
+        self.assertEqual(
+            (b"send", [b"zfs", b"destroy",
+                       b"pool/fs@" + names[0] + b"," + names[1]]),
+            (self.successResultOf(d)[1], self.reactor.processes[2].args))
+
+    def test_prune_keeps_other_snapshots(self):
+        """
+        ``Filesystem.send_command`` does not destroy snapshots which weren't
+        taken for pushes, nor the basis of the incremental stream, nor newer
+        snapshots.
+        """
+        names = [bytes(uuid4()) for i in range(3)]
+        self.send_incremental(
+            [names[0], b"manual", names[1], names[2]], names[1:2])
+        self.assertEqual(
+            [b"zfs", b"destroy", b"pool/fs@" + names[0]],
+            self.reactor.processes[2].args)
+
+    def test_no_prune(self):
+        """
+        ``Filesystem.send_command`` destroys no snapshots if the writer
+        shares none with it.
+        """
+        names = [bytes(uuid4()) for i in range(2)]
+        self.send_incremental(names, [b"other"])
+        self.assertEqual(2, len(self.reactor.processes))
+
+    @validateLogging(None)
+    def test_prune_failure_logged(self, logger):
+        """
+        If destroying obsolete snapshots fails, ``Filesystem.send_command``
+        logs the failure.
+        """
+        self.filesystem.logger = logger
+        names = [bytes(uuid4()) for i in range(2)]
+        d = self.send_incremental(names, names[-1:])
+        self.reactor.processes[2].processProtocol.processEnded(
+            Failure(ProcessTerminated(1)))
+        self.assertEqual(
+            (b"send", 1),
+            (self.successResultOf(d)[1],
+             len(logger.flushTracebacks(CommandFailed))))
+
+
+class ObsoleteSnapshotsTests(SynchronousTestCase):
+    """
+    Tests for ``_obsolete_snapshots``.
+    """
+    def setUp(self):
+        self.pushed = [Snapshot(name=bytes(uuid4())) for i in range(3)]
+
+    def test_no_base(self):
+        """
+        If there is no basis for an incremental stream, no snapshots are
+        obsolete.
+        """
+        self.assertEqual([], _obsolete_snapshots(self.pushed, None))
+
+    def test_unknown_base(self):
+        """
+        If the basis for an incremental stream is not one of the given
+        snapshots, no snapshots are obsolete.
+        """
+        self.assertEqual(
+            [], _obsolete_snapshots(self.pushed, Snapshot(name=b"other")))
+
+    def test_older(self):
+        """
+        Push snapshots older than the basis are obsolete, the basis and
+        newer snapshots are not.
+        """
+        self.assertEqual(
+            self.pushed[:1], _obsolete_snapshots(self.pushed, self.pushed[1]))
+
+    def test_not_pushed(self):
+        """
+        Snapshots whose names aren't UUIDs weren't taken for pushes and are
+        never obsolete.
+        """
+        snapshots = [Snapshot(name=b"manual")] + self.pushed
+        self.assertEqual(
+            self.pushed[:2], _obsolete_snapshots(snapshots, self.pushed[2]))
+
+
 class ZFSCommandTests(SynchronousTestCase):
     """
     Tests for :func:`zfs_command`.
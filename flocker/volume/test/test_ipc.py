@@ -8,7 +8,10 @@ from __future__ import absolute_import
 
 from zope.interface.verify import verifyObject
 
+from twisted.internet.defer import maybeDeferred
+from twisted.internet.error import ProcessDone
 from twisted.internet.task import Clock
+from twisted.python.failure import Failure
 from twisted.python.filepath import FilePath
 from twisted.trial.unittest import TestCase
 
@@ -17,10 +20,12 @@ from ..filesystems.zfs import Snapshot
 from ..filesystems.memory import FilesystemStoragePool
 from .._ipc import (
     IRemoteVolumeManager, RemoteVolumeManager, LocalVolumeManager,
+    IStreamingRemoteVolumeManager, StreamingRemoteVolumeManager,
     standard_node, SSH_PRIVATE_KEY_PATH)
 from ..testtools import ServicePair
 from ...common import FakeNode
-from ...common._ipc import ProcessNode
+from ...common._ipc import ProcessNode, SSHConnectionCache
+from ...testtools import FakeProcessReactor
 
 
 MY_VOLUME = VolumeName(namespace=u"myns", dataset_id=u"myvol")
@@ -167,8 +172,8 @@ def make_iremote_volume_manager(fixture):
             created = self.remotely_owned_volume(service_pair)
 
             def got_volume(pushed_volume):
-                service_pair.remote.acquire(pushed_volume)
-                d = to_service.enumerate()
+                d = maybeDeferred(service_pair.remote.acquire, pushed_volume)
+                d.addCallback(lambda _: to_service.enumerate())
                 d.addCallback(lambda results: self.assertEqual(
                     list(results),
                     [Volume(node_id=to_service.node_id,
@@ -195,8 +200,10 @@ def make_iremote_volume_manager(fixture):
                     pushed_volume, service_pair.remote)
 
                 def pushed(ignored):
-                    service_pair.remote.acquire(pushed_volume)
+                    return maybeDeferred(
+                        service_pair.remote.acquire, pushed_volume)
 
+                def acquired(ignored):
                     filesystem = Volume(node_id=to_service.node_id,
                                         name=pushed_volume.name,
                                         service=to_service).get_filesystem()
@@ -204,6 +211,7 @@ def make_iremote_volume_manager(fixture):
                     self.assertEqual(new_root.child(b"test").getContent(),
                                      b"some data")
                 pushing.addCallback(pushed)
+                pushing.addCallback(acquired)
                 return pushing
 
             created.addCallback(got_volume)
@@ -218,9 +226,10 @@ def make_iremote_volume_manager(fixture):
             created = self.remotely_owned_volume(service_pair)
 
             def got_volume(pushed_volume):
-                result = service_pair.remote.acquire(pushed_volume)
-                self.assertEqual(result, to_service.node_id)
+                return maybeDeferred(
+                    service_pair.remote.acquire, pushed_volume)
             created.addCallback(got_volume)
+            created.addCallback(self.assertEqual, to_service.node_id)
             return created
 
         def test_clone_to(self):
@@ -371,6 +380,91 @@ class RemoteVolumeManagerTests(TestCase):
                           b"myns.myvol"])
 
 
+class StreamingRemoteVolumeManagerTests(TestCase):
+    """
+    Tests for ``StreamingRemoteVolumeManager``.
+    """
+    def setUp(self):
+        self.pool = FilesystemStoragePool(FilePath(self.mktemp()))
+        self.service = VolumeService(
+            FilePath(self.mktemp()), self.pool, reactor=Clock())
+        self.service.startService()
+        self.volume = self.successResultOf(self.service.create(
+            self.service.get(MY_VOLUME)
+        ))
+        self.reactor = FakeProcessReactor()
+        self.remote = StreamingRemoteVolumeManager(
+            ProcessNode([b"ssh", b"remote"]), FilePath(b"/path/to/json"),
+            self.reactor)
+
+    def remote_command(self, subcommand):
+        """
+        :param bytes subcommand: A ``flocker-volume`` subcommand.
+
+        :return: The local command which runs ``subcommand`` on the remote
+            node for ``self.volume``.
+        """
+        return [b"ssh", b"remote", b"flocker-volume",
+                b"--config", b"/path/to/json", subcommand,
+                self.volume.node_id.encode("ascii"), b"myns.myvol"]
+
+    def finish(self, output):
+        """
+        Make the first spawned process write some output and exit
+        successfully.
+
+        :param bytes output: The process's stdout.
+        """
+        protocol = self.reactor.processes[0].processProtocol
+        protocol.childDataReceived(1, output)
+        protocol.processEnded(Failure(ProcessDone(0)))
+
+    def test_interface(self):
+        """
+        ``StreamingRemoteVolumeManager`` provides
+        ``IStreamingRemoteVolumeManager``.
+        """
+        self.assertTrue(
+            verifyObject(IStreamingRemoteVolumeManager, self.remote))
+
+    def test_snapshots(self):
+        """
+        ``StreamingRemoteVolumeManager.snapshots`` runs ``flocker-volume
+        snapshots`` on the destination in a child process and parses the
+        output.
+        """
+        d = self.remote.snapshots(self.volume)
+        self.assertEqual(self.remote_command(b"snapshots"),
+                         self.reactor.processes[0].args)
+        self.assertNoResult(d)
+        self.finish(b"abc\ndef\n")
+        self.assertEqual(
+            [Snapshot(name="abc"), Snapshot(name="def")],
+            self.successResultOf(d))
+
+    def test_acquire(self):
+        """
+        ``StreamingRemoteVolumeManager.acquire`` runs ``flocker-volume
+        acquire`` on the destination in a child process and returns a
+        ``Deferred`` firing with the node ID it outputs.
+        """
+        d = self.remote.acquire(self.volume)
+        self.assertEqual(self.remote_command(b"acquire"),
+                         self.reactor.processes[0].args)
+        self.finish(b"remoteuuid")
+        self.assertEqual(u"remoteuuid", self.successResultOf(d))
+
+    def test_receive_stream(self):
+        """
+        ``StreamingRemoteVolumeManager.receive_stream`` pipes the given
+        command's output to ``flocker-volume receive`` on the destination.
+        """
+        self.remote.receive_stream(self.volume, [b"zfs", b"send", b"x"])
+        self.assertEqual(
+            [self.remote_command(b"receive"), [b"zfs", b"send", b"x"]],
+            [process.args for process in self.reactor.processes])
+
+
 class StandardNodeTests(TestCase):
     """
     Tests for ``standard_node``.
@@ -383,3 +477,14 @@ class StandardNodeTests(TestCase):
         node = standard_node(b'example.com')
         self.assertEqual(node, ProcessNode.using_ssh(
             b'example.com', 22, b'root', SSH_PRIVATE_KEY_PATH))
+
+    def test_connection_cache(self):
+        """
+        ``standard_node`` returns a node that shares connections through the
+        given ``SSHConnectionCache``.
+        """
+        cache = SSHConnectionCache(FilePath(b"/tmp/ssh"))
+        node = standard_node(b'example.com', connection_cache=cache)
+        self.assertEqual(node, ProcessNode.using_ssh(
+            b'example.com', 22, b'root', SSH_PRIVATE_KEY_PATH,
+            connection_cache=cache))
@@ -15,7 +15,10 @@ from StringIO import StringIO
 from zope.interface import implementer
 from zope.interface.verify import verifyObject
 
+from eliot.testing import validateLogging
+
 from twisted.application.service import IService, Service
+from twisted.internet.defer import Deferred, succeed
 from twisted.internet.task import Clock
 from twisted.python.filepath import FilePath, Permissions
 from twisted.trial.unittest import SynchronousTestCase, TestCase
@@ -28,8 +31,15 @@ from ..service import (
 from ..script import VolumeOptions
 
 from ..filesystems.memory import FilesystemStoragePool
-from ..filesystems.zfs import StoragePool
-from .._ipc import RemoteVolumeManager, LocalVolumeManager
+from ..filesystems.zfs import StoragePool, Snapshot
+from ..filesystems.interfaces import (
+    IResumableFilesystem, IStreamingFilesystem,
+)
+from .._ipc import (
+    RemoteVolumeManager, LocalVolumeManager, IResumableRemoteVolumeManager,
+    IStreamingRemoteVolumeManager,
+)
+from .. import service as service_module
 from ..testtools import create_volume_service
 from ...common import FakeNode
 from ...testtools import (
@@ -139,6 +149,50 @@ class VolumeSizeComparisonTests(TestCase):
         assert_not_equal_comparison(self, a, b)
 
 
+@implementer(IResumableFilesystem)
+class ResumableFilesystem(object):
+    """
+    A fake ``IResumableFilesystem`` which only constructs commands.
+    """
+    def send_command(self, remote_snapshots=None):
+        return succeed([b"send"])
+
+    def resume_command(self, token):
+        return succeed([b"resume", token])
+
+
+@implementer(IResumableRemoteVolumeManager)
+class ResumableVolumeManager(object):
+    """
+    A fake ``IResumableRemoteVolumeManager`` which records the commands it
+    is asked to run.
+
+    :ivar list streams: ``(resumed, command)`` for each stream received.
+    :ivar resumed: ``Deferred`` returned by ``resume_stream``.
+    """
+    def __init__(self, token):
+        """
+        :param bytes token: The token ``resume_token`` returns.
+        """
+        self._token = token
+        self.streams = []
+        self.resumed = Deferred()
+
+    def snapshots(self, volume):
+        return succeed([])
+
+    def resume_token(self, volume):
+        return succeed(self._token)
+
+    def resume_stream(self, volume, command):
+        self.streams.append((True, command))
+        return self.resumed
+
+    def receive_stream(self, volume, command):
+        self.streams.append((False, command))
+        return succeed(None)
+
+
 class VolumeServiceStartupTests(TestCase):
     """
     Tests for :class:`VolumeService` startup.
@@ -483,6 +537,136 @@ class VolumeServiceAPITests(TestCase):
             [b"incremental stream based on", b"stuff"],
             writer.getvalue().splitlines()[-2:])
 
+    def test_push_streams(self):
+        """
+        Pushing a volume whose filesystem provides ``IStreamingFilesystem`` to
+        a remote volume manager which provides
+        ``IStreamingRemoteVolumeManager`` runs the filesystem's send command
+        via the remote volume manager instead of copying the data.
+        """
+        @implementer(IStreamingFilesystem)
+        class StreamingFilesystem(object):
+            def send_command(self, remote_snapshots=None):
+                self.remote_snapshots = remote_snapshots
+                return succeed([b"send", b"it"])
+
+        @implementer(IStreamingRemoteVolumeManager)
+        class StreamingVolumeManager(object):
+            def __init__(self):
+                self.streams = []
+                self.received = Deferred()
+
+            def snapshots(self, volume):
+                return succeed([Snapshot(name=b"common")])
+
+            def receive_stream(self, volume, command):
+                self.streams.append((volume, command))
+                return self.received
+
+        service = create_volume_service(self)
+        volume = self.successResultOf(service.create(service.get(MY_VOLUME)))
+        filesystem = StreamingFilesystem()
+        self.patch(volume, "get_filesystem", lambda: filesystem)
+        remote_manager = StreamingVolumeManager()
+
+        pushing = service.push(volume, remote_manager)
+        self.assertNoResult(pushing)
+        remote_manager.received.callback(None)
+        self.successResultOf(pushing)
+        self.assertEqual(
+            ([Snapshot(name=b"common")], [(volume, [b"send", b"it"])]),
+            (filesystem.remote_snapshots, remote_manager.streams))
+
+    def push_resumable(self, token):
+        """
+        Push a volume with a ``ResumableFilesystem`` to a
+        ``ResumableVolumeManager``.
+
+        :param bytes token: The resume token of the remote volume manager.
+
+        :return: ``(pushing, remote_manager)``, the result of
+            ``VolumeService.push`` and the remote volume manager.
+        """
+        service = create_volume_service(self)
+        volume = self.successResultOf(service.create(service.get(MY_VOLUME)))
+        filesystem = ResumableFilesystem()
+        self.patch(volume, "get_filesystem", lambda: filesystem)
+        remote_manager = ResumableVolumeManager(token)
+        return service.push(volume, remote_manager), remote_manager
+
+    def test_push_resumes(self):
+        """
+        If the destination has an interrupted receive of the volume,
+        ``VolumeService.push`` sends the rest of the interrupted stream
+        before a new stream.
+        """
+        pushing, remote_manager = self.push_resumable(b"token")
+        self.assertNoResult(pushing)
+        remote_manager.resumed.callback(None)
+        self.successResultOf(pushing)
+        self.assertEqual(
+            [(True, [b"resume", b"token"]), (False, [b"send"])],
+            remote_manager.streams)
+
+    def test_push_nothing_to_resume(self):
+        """
+        If the destination has no interrupted receive of the volume,
+        ``VolumeService.push`` only sends a new stream.
+        """
+        pushing, remote_manager = self.push_resumable(None)
+        self.successResultOf(pushing)
+        self.assertEqual([(False, [b"send"])], remote_manager.streams)
+
+    @validateLogging(None)
+    def test_push_resume_fails(self, logger):
+        """
+        If resuming the interrupted stream fails, the failure is logged and
+        ``VolumeService.push`` sends a new stream anyway.
+        """
+        self.patch(service_module, "_logger", logger)
+        pushing, remote_manager = self.push_resumable(b"token")
+        remote_manager.resumed.errback(IOError("Bad exit"))
+        self.successResultOf(pushing)
+        self.assertEqual(
+            ([(True, [b"resume", b"token"]), (False, [b"send"])], 1),
+            (remote_manager.streams, len(logger.flushTracebacks(IOError))))
+
+    def test_receive_resumable_local_node_id(self):
+        """
+        If a volume with the same node ID as the service is received by
+        ``receive_resumable``, ``ValueError`` is raised.
+        """
+        service = create_volume_service(self)
+        self.assertRaises(ValueError, service.receive_resumable,
+                          service.node_id, MY_VOLUME, None)
+
+    def test_receive_resumable_not_resumable(self):
+        """
+        ``receive_resumable`` receives into a filesystem which doesn't provide
+        ``IResumableFilesystem`` with its ordinary ``writer``.
+        """
+        service = create_volume_service(self)
+        volume = self.successResultOf(service.create(service.get(MY_VOLUME)))
+        volume.get_filesystem().get_path().child(b"afile").setContent(b"x")
+        manager_node_id = unicode(uuid4())
+        with volume.get_filesystem().reader() as reader:
+            service.receive_resumable(
+                manager_node_id, MY_VOLUME, reader, resume=False)
+        received = Volume(node_id=manager_node_id, name=MY_VOLUME,
+                          service=service)
+        self.assertEqual(
+            b"x",
+            received.get_filesystem().get_path().child(b"afile").getContent())
+
+    def test_resume_token_not_resumable(self):
+        """
+        ``VolumeService.resume_token`` returns ``None`` if the volume's
+        filesystem doesn't provide ``IResumableFilesystem``.
+        """
+        service = create_volume_service(self)
+        self.assertIs(
+            None, service.resume_token(unicode(uuid4()), MY_VOLUME))
+
     def test_receive_local_node_id(self):
         """
         If a volume with the same node ID as the service is received,
@@ -730,6 +914,29 @@ class VolumeServiceAPITests(TestCase):
         created.addCallback(handed_off)
         return created
 
+    def test_handoff_acquire_deferred(self):
+        """
+        ``VolumeService.handoff()`` waits for the ``Deferred`` returned by the
+        destination's ``acquire`` and changes the owner node ID of the local
+        volume to the node ID it fires with.
+        """
+        origin_service = create_volume_service(self)
+        destination_service = create_volume_service(self)
+        destination = LocalVolumeManager(destination_service)
+        acquired = Deferred()
+        self.patch(destination, "acquire", lambda volume: acquired)
+        volume = self.successResultOf(
+            origin_service.create(origin_service.get(MY_VOLUME)))
+
+        handing_off = origin_service.handoff(volume, destination)
+        self.assertNoResult(handing_off)
+        acquired.callback(destination_service.node_id)
+        self.successResultOf(handing_off)
+        self.assertEqual(
+            [Volume(node_id=destination_service.node_id, name=MY_VOLUME,
+                    service=origin_service)],
+            list(self.successResultOf(origin_service.enumerate())))
+
 
 class VolumeInitializationTests(make_with_init_tests(
         Volume,
@@ -0,0 +1,512 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Tests for ``flocker.volume._transfer``.
+"""
+
+from os import urandom
+
+from zope.interface.verify import verifyObject
+
+from eliot.testing import validateLogging, LoggedMessage
+
+from twisted.internet import reactor
+from twisted.internet.defer import gatherResults
+from twisted.internet.endpoints import (
+    TCP4ClientEndpoint, TCP4ServerEndpoint, connectProtocol,
+)
+from twisted.protocols.amp import AMP, UnhandledCommand
+from twisted.trial.unittest import TestCase
+
+from ..service import Volume
+from ..filesystems.zfs import Snapshot
+from .._ipc import IRemoteVolumeManager, IResumableRemoteVolumeManager
+from .._transfer import (
+    CODECS, VOLUME_SENT, AuthenticationFailed, SnapshotsCommand,
+    VolumeTransferPool, VolumeTransferService, _TransferLocator, _proof,
+)
+from ..testtools import ServicePair, create_volume_service
+from ...testtools import find_free_port, loop_until
+from .test_ipc import MY_VOLUME, MY_VOLUME2
+
+
+# The secret shared by the agents in these tests:
+SECRET = b"shared secret"
+
+
+def create_transfer_servicepair(test, compression=None, secret=SECRET):
+    """
+    Create a ``ServicePair`` whose ``remote`` talks to a
+    ``VolumeTransferService`` for ``to_service`` over a loopback TCP
+    connection.
+
+    :param TestCase test: A unit test.
+    :param bytes compression: The codec the pool compresses with, if any.
+    :param bytes secret: The secret the pool authenticates with.
+
+    :return: A new ``ServicePair`` with an extra ``transfer`` attribute, the
+        ``VolumeTransferService``.
+    """
+    from_service = create_volume_service(test)
+    to_service = create_volume_service(test)
+    port = find_free_port()[1]
+    transfer = VolumeTransferService(
+        to_service, TCP4ServerEndpoint(reactor, port, interface=b"127.0.0.1"),
+        SECRET, reactor)
+    transfer.startService()
+    test.addCleanup(loop_until, lambda: not transfer.connections)
+    test.addCleanup(transfer.stopService)
+    pool = VolumeTransferPool(
+        reactor, secret, port, compression=compression)
+    test.addCleanup(pool.close)
+    pair = ServicePair(from_service=from_service, to_service=to_service,
+                       remote=pool.remote_volume_manager(b"127.0.0.1"))
+    pair.transfer = transfer
+    pair.port = port
+    return pair
+
+
+class TransferRemoteVolumeManagerTests(TestCase):
+    """
+    Tests for ``TransferRemoteVolumeManager`` talking to a
+    ``VolumeTransferService``.
+    """
+    def setUp(self):
+        self.pair = create_transfer_servicepair(self)
+        self.from_service = self.pair.from_service
+        self.to_service = self.pair.to_service
+        self.remote = self.pair.remote
+
+    def create(self, contents=b"WORKS!"):
+        """
+        Create ``MY_VOLUME`` on the origin service containing a file.
+
+        :param bytes contents: The contents of the file.
+
+        :return: The ``Volume``.
+        """
+        volume = self.successResultOf(
+            self.from_service.create(self.from_service.get(MY_VOLUME)))
+        volume.get_filesystem().get_path().child(b"afile").setContent(
+            contents)
+        return volume
+
+    def received_contents(self):
+        """
+        :return: The contents of the file in ``MY_VOLUME`` as received by the
+            destination service.
+        """
+        volume = Volume(node_id=self.from_service.node_id, name=MY_VOLUME,
+                        service=self.to_service)
+        return volume.get_filesystem().get_path().child(
+            b"afile").getContent()
+
+    def test_interface(self):
+        """
+        ``TransferRemoteVolumeManager`` provides
+        ``IResumableRemoteVolumeManager``.
+        """
+        self.assertTrue(
+            verifyObject(IResumableRemoteVolumeManager, self.remote))
+
+    def test_not_blocking_interface(self):
+        """
+        ``TransferRemoteVolumeManager`` does not provide the blocking
+        ``IRemoteVolumeManager``.
+        """
+        self.assertFalse(IRemoteVolumeManager.providedBy(self.remote))
+
+    def test_snapshots_no_filesystem(self):
+        """
+        If the volume does not exist on the remote node, ``snapshots`` fires
+        with an empty list.
+        """
+        d = self.remote.snapshots(self.create())
+        d.addCallback(self.assertEqual, [])
+        return d
+
+    def test_push(self):
+        """
+        ``VolumeService.push`` sends the volume's data over the transfer
+        connection.
+        """
+        d = self.from_service.push(self.create(), self.remote)
+        d.addCallback(lambda _: self.assertEqual(
+            b"WORKS!", self.received_contents()))
+        return d
+
+    def test_push_large(self):
+        """
+        Volumes much larger than the data of a single AMP command and the
+        window of unacknowledged commands are sent completely.
+        """
+        contents = urandom(4 * 1024 * 1024)
+        d = self.from_service.push(self.create(contents), self.remote)
+        d.addCallback(lambda _: self.assertEqual(
+            contents, self.received_contents()))
+        return d
+
+    def test_snapshots(self):
+        """
+        ``snapshots`` fires with the snapshots of a volume pushed to the
+        remote node.
+        """
+        volume = self.create()
+        volume.get_filesystem().snapshot(b"first")
+        d = self.from_service.push(volume, self.remote)
+        d.addCallback(lambda _: self.remote.snapshots(volume))
+        d.addCallback(self.assertEqual, [Snapshot(name=b"first")])
+        return d
+
+    def test_receive_stream_source_failed(self):
+        """
+        If the local command fails ``receive_stream`` errbacks with
+        ``IOError`` and the remote node does not create the volume.
+        """
+        volume = self.create()
+        d = self.remote.receive_stream(volume, [b"false"])
+        d = self.assertFailure(d, IOError)
+        d.addCallback(lambda _: self.to_service.enumerate())
+        d.addCallback(lambda volumes: self.assertEqual([], list(volumes)))
+        return d
+
+    def test_receive_stream_locally_owned(self):
+        """
+        ``receive_stream`` errbacks with ``ValueError`` if the remote node
+        owns the volume.
+        """
+        volume = Volume(node_id=self.to_service.node_id, name=MY_VOLUME,
+                        service=self.from_service)
+        d = self.remote.receive_stream(volume, [b"echo", b"hello"])
+        return self.assertFailure(d, ValueError)
+
+    def test_handoff(self):
+        """
+        ``VolumeService.handoff`` pushes the volume and makes the remote node
+        its owner.
+        """
+        volume = self.create()
+        d = self.from_service.handoff(volume, self.remote)
+        d.addCallback(lambda _: self.to_service.enumerate())
+        d.addCallback(lambda volumes: self.assertEqual(
+            [Volume(node_id=self.to_service.node_id, name=MY_VOLUME,
+                    service=self.to_service)],
+            list(volumes)))
+        return d
+
+    def test_acquire_returns_node_id(self):
+        """
+        ``acquire`` fires with the node ID of the remote node.
+        """
+        volume = self.create()
+        d = self.from_service.push(volume, self.remote)
+        d.addCallback(lambda _: self.remote.acquire(volume))
+        d.addCallback(self.assertEqual, self.to_service.node_id)
+        return d
+
+    def test_acquire_locally_owned(self):
+        """
+        ``acquire`` errbacks with ``ValueError`` if the remote node already
+        owns the volume.
+        """
+        volume = Volume(node_id=self.to_service.node_id, name=MY_VOLUME,
+                        service=self.from_service)
+        return self.assertFailure(self.remote.acquire(volume), ValueError)
+
+    def test_clone_to(self):
+        """
+        ``clone_to`` clones a volume on the remote node.
+        """
+        parent = self.successResultOf(
+            self.to_service.create(self.to_service.get(MY_VOLUME)))
+        parent.get_filesystem().get_path().child(b"f").setContent(b"ORIG")
+        d = self.remote.clone_to(parent, MY_VOLUME2)
+        d.addCallback(lambda _: self.assertEqual(
+            b"ORIG",
+            self.to_service.get(MY_VOLUME2).get_filesystem().get_path().child(
+                b"f").getContent()))
+        return d
+
+    def test_connection_reused(self):
+        """
+        Consecutive operations reuse a single connection.
+        """
+        volume = self.create()
+        d = self.remote.snapshots(volume)
+        d.addCallback(lambda _: self.from_service.push(volume, self.remote))
+        d.addCallback(lambda _: self.remote.acquire(volume))
+        d.addCallback(lambda _: self.assertEqual(
+            1, len(self.pair.transfer.connections)))
+        return d
+
+    def test_concurrent_connections(self):
+        """
+        Concurrent operations use separate connections.
+        """
+        volume = self.create()
+        d = gatherResults([self.remote.snapshots(volume),
+                           self.remote.snapshots(volume)])
+        d.addCallback(lambda _: self.assertEqual(
+            2, len(self.pair.transfer.connections)))
+        return d
+
+    @validateLogging(None)
+    def test_sent_logged(self, logger):
+        """
+        A ``VOLUME_SENT`` message reports the amount of data sent, which is
+        the same before and after compression when there is none.
+        """
+        self.remote.logger = logger
+        d = self.from_service.push(self.create(), self.remote)
+
+        def pushed(_):
+            [message] = LoggedMessage.ofType(logger.messages, VOLUME_SENT)
+            self.assertEqual(
+                (b"127.0.0.1", MY_VOLUME, None, False, 1.0,
+                 message.message[u"bytes"]),
+                (message.message[u"host"], message.message[u"volume_name"],
+                 message.message[u"codec"], message.message[u"resumed"],
+                 message.message[u"ratio"], message.message[u"wire_bytes"]))
+        d.addCallback(pushed)
+        return d
+
+    def test_resume_token_none(self):
+        """
+        ``resume_token`` fires with ``None`` if the remote filesystem has no
+        interrupted receive to resume.
+        """
+        d = self.remote.resume_token(self.create())
+        d.addCallback(self.assertIs, None)
+        return d
+
+    def test_resume_token(self):
+        """
+        ``resume_token`` fires with the remote volume service's
+        ``resume_token`` for the volume.
+        """
+        volume = self.create()
+        calls = []
+
+        def resume_token(node_id, name):
+            calls.append((node_id, name))
+            return b"sometoken"
+        self.patch(self.to_service, "resume_token", resume_token)
+        d = self.remote.resume_token(volume)
+        d.addCallback(lambda token: self.assertEqual(
+            (b"sometoken", [(volume.node_id, volume.name)]), (token, calls)))
+        return d
+
+    def resumed_flags(self, send):
+        """
+        Record the ``resume`` argument with which the remote volume service's
+        ``receive_resumable`` is called when sending a stream.
+
+        :param send: Callable taking the ``Volume`` and a command and sending
+            the command's output to the remote node.
+
+        :return: ``Deferred`` firing with a ``list`` of the flags.
+        """
+        volume = self.create()
+        flags = []
+        receive = self.to_service.receive_resumable
+
+        def receive_resumable(node_id, name, input_file, resume=False):
+            flags.append(resume)
+            return receive(node_id, name, input_file, resume)
+        self.patch(self.to_service, "receive_resumable", receive_resumable)
+        d = self.from_service.get(MY_VOLUME).get_filesystem().send_command()
+        d.addCallback(lambda command: send(volume, command))
+        d.addCallback(lambda _: flags)
+        return d
+
+    def test_receive_stream_not_resumed(self):
+        """
+        ``receive_stream`` tells the remote node the stream is a new one.
+        """
+        d = self.resumed_flags(self.remote.receive_stream)
+        d.addCallback(self.assertEqual, [False])
+        return d
+
+    def test_resume_stream(self):
+        """
+        ``resume_stream`` tells the remote node the stream continues an
+        interrupted receive.
+        """
+        d = self.resumed_flags(self.remote.resume_stream)
+        d.addCallback(self.assertEqual, [True])
+        return d
+
+
+class CompressionTests(TestCase):
+    """
+    Tests for compression of the data sent by ``TransferRemoteVolumeManager``.
+    """
+    def push(self, compression, contents):
+        """
+        Push a volume containing a file using a ``VolumeTransferPool``
+        compressing with the given codec.
+
+        :param bytes compression: The codec to compress with.
+        :param bytes contents: The contents of the file.
+
+        :return: ``Deferred`` firing with the contents of the file received
+            by the remote node.
+        """
+        pair = create_transfer_servicepair(self, compression=compression)
+        from_service, to_service = pair.from_service, pair.to_service
+        volume = self.successResultOf(
+            from_service.create(from_service.get(MY_VOLUME)))
+        volume.get_filesystem().get_path().child(b"afile").setContent(
+            contents)
+        self.remote = pair.remote
+        self.transfer = pair.transfer
+        d = from_service.push(volume, pair.remote)
+        d.addCallback(lambda _: Volume(
+            node_id=from_service.node_id, name=MY_VOLUME,
+            service=to_service).get_filesystem().get_path().child(
+                b"afile").getContent())
+        return d
+
+    def test_codecs(self):
+        """
+        Volumes are transferred intact using each of the ``CODECS``.
+        """
+        contents = urandom(1024 * 1024) + b"\0" * (4 * 1024 * 1024)
+        d = gatherResults([self.push(codec, contents) for codec in CODECS])
+        d.addCallback(self.assertEqual, [contents] * len(CODECS))
+        return d
+
+    @validateLogging(None)
+    def test_compressed_logged(self, logger):
+        """
+        The ``VOLUME_SENT`` message of a compressed stream reports the codec
+        and the reduced amount of data sent.
+        """
+        d = self.push(b"zlib", b"\0" * (1024 * 1024))
+        self.remote.logger = logger
+
+        def pushed(_):
+            [message] = LoggedMessage.ofType(logger.messages, VOLUME_SENT)
+            fields = message.message
+            self.assertEqual(
+                (u"zlib", True,
+                 float(fields[u"wire_bytes"]) / fields[u"bytes"]),
+                (fields[u"codec"], fields[u"wire_bytes"] < fields[u"bytes"],
+                 fields[u"ratio"]))
+        d.addCallback(pushed)
+        return d
+
+    def test_negotiation(self):
+        """
+        The receiver picks the first of the codecs offered by the sender which
+        it supports.
+        """
+        transfer = create_transfer_servicepair(self).transfer
+        locator = _TransferLocator(transfer)
+        self.addCleanup(locator.abort)
+        response = locator.receive_start(
+            u"othernode", MY_VOLUME.to_bytes(), [b"unknown", b"bz2", b"zlib"])
+        self.assertEqual({'codec': b"bz2"}, response)
+
+    def test_negotiation_no_codec(self):
+        """
+        If the receiver supports none of the codecs offered by the sender the
+        response has no codec, so the data is sent uncompressed.
+        """
+        transfer = create_transfer_servicepair(self).transfer
+        locator = _TransferLocator(transfer)
+        self.addCleanup(locator.abort)
+        response = locator.receive_start(
+            u"othernode", MY_VOLUME.to_bytes(), [b"unknown"])
+        self.assertEqual({}, response)
+
+    def test_unknown_codec(self):
+        """
+        ``VolumeTransferPool`` raises ``ValueError`` if asked to compress with
+        a codec which isn't in ``CODECS``.
+        """
+        self.assertRaises(
+            ValueError, VolumeTransferPool, reactor, SECRET,
+            compression=b"unknown")
+
+
+class AuthenticationTests(TestCase):
+    """
+    Tests for authentication of volume transfer connections.
+    """
+    def test_wrong_secret(self):
+        """
+        Operations fail with ``AuthenticationFailed`` if the pool's secret is
+        not the service's, and the connection is not kept.
+        """
+        pair = create_transfer_servicepair(self, secret=b"wrong")
+        volume = pair.from_service.get(MY_VOLUME)
+        d = self.assertFailure(
+            pair.remote.snapshots(volume), AuthenticationFailed)
+        d.addCallback(lambda _: loop_until(
+            lambda: not pair.transfer.connections))
+        return d
+
+    def test_unauthenticated(self):
+        """
+        Commands other than those used to authenticate are refused on a
+        connection which hasn't authenticated.
+        """
+        pair = create_transfer_servicepair(self)
+        connecting = connectProtocol(
+            TCP4ClientEndpoint(reactor, b"127.0.0.1", pair.port), AMP())
+
+        def connected(connection):
+            self.addCleanup(connection.transport.loseConnection)
+            return self.assertFailure(
+                connection.callRemote(
+                    SnapshotsCommand, node_id=u"othernode",
+                    name=MY_VOLUME.to_bytes()),
+                UnhandledCommand)
+        connecting.addCallback(connected)
+        return connecting
+
+    def test_authenticate(self):
+        """
+        ``_TransferLocator.authenticate`` accepts the client's proof of the
+        nonce from ``_TransferLocator.challenge`` and responds with the
+        server's proof of the client's nonce.
+        """
+        locator = _TransferLocator(create_transfer_servicepair(self).transfer)
+        nonce = locator.challenge()['nonce']
+        response = locator.authenticate(
+            _proof(SECRET, b"client", nonce), b"client nonce")
+        self.assertEqual(
+            ({'proof': _proof(SECRET, b"server", b"client nonce")}, True),
+            (response, locator.authenticated))
+
+    def test_challenge_used_once(self):
+        """
+        ``_TransferLocator.authenticate`` raises ``AuthenticationFailed`` if
+        the challenge has already been answered.
+        """
+        locator = _TransferLocator(create_transfer_servicepair(self).transfer)
+        proof = _proof(SECRET, b"client", locator.challenge()['nonce'])
+        locator.authenticate(proof, b"client nonce")
+        self.assertRaises(
+            AuthenticationFailed, locator.authenticate, proof,
+            b"client nonce")
+
+    def test_no_challenge(self):
+        """
+        ``_TransferLocator.authenticate`` raises ``AuthenticationFailed`` if
+        no challenge was issued.
+        """
+        locator = _TransferLocator(create_transfer_servicepair(self).transfer)
+        self.assertRaises(
+            AuthenticationFailed, locator.authenticate,
+            _proof(SECRET, b"client", b""), b"client nonce")
+
+    def test_roles_differ(self):
+        """
+        The server's proof of a nonce is not the client's, so a proof can't
+        be reflected back to the other end.
+        """
+        self.assertNotEqual(
+            _proof(SECRET, b"client", b"nonce"),
+            _proof(SECRET, b"server", b"nonce"))
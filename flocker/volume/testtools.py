@@ -17,7 +17,7 @@ from twisted.internet import reactor
 from twisted.trial.unittest import SynchronousTestCase
 
 from ..common import ProcessNode
-from ._ipc import RemoteVolumeManager
+from ._ipc import RemoteVolumeManager, StreamingRemoteVolumeManager
 
 from .filesystems.zfs import StoragePool
 from .service import VolumeService
@@ -107,11 +107,8 @@ class MutatingProcessNode(ProcessNode):
             b"--mountpoint", self.to_service.pool._mount_root.path
         ] + remote_command[1:]
 
-    def run(self, remote_command):
-        return ProcessNode.run(self, self._mutate(remote_command))
-
-    def get_output(self, remote_command):
-        return ProcessNode.get_output(self, self._mutate(remote_command))
+    def command(self, remote_command):
+        return ProcessNode.command(self, self._mutate(remote_command))
 
 
 @attributes(["from_service", "to_service", "remote"])
@@ -125,12 +122,13 @@ class ServicePair(object):
     """
 
 
-def create_realistic_servicepair(test):
+def create_realistic_servicepair(test, streaming=False):
     """
     Create a ``ServicePair`` that uses ZFS for testing
     ``RemoteVolumeManager``.
 
     :param TestCase test: A unit test.
+    :param bool streaming: If true, use a ``StreamingRemoteVolumeManager``.
 
     :return: A new ``ServicePair``.
     """
@@ -148,8 +146,12 @@ def create_realistic_servicepair(test):
     to_service.startService()
     test.addCleanup(to_service.stopService)
 
-    remote = RemoteVolumeManager(MutatingProcessNode(to_service),
-                                 to_config)
+    if streaming:
+        remote = StreamingRemoteVolumeManager(
+            MutatingProcessNode(to_service), to_config, reactor)
+    else:
+        remote = RemoteVolumeManager(MutatingProcessNode(to_service),
+                                     to_config)
     return ServicePair(from_service=from_service, to_service=to_service,
                        remote=remote)
 